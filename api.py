@@ -0,0 +1,215 @@
+import hmac
+import math
+import time
+from flask import Blueprint, request, jsonify
+from config import API_TOKEN, API_BATCH_MAX, API_TRUSTED_PROXIES, VALID_CURRENCIES
+from utils import metrics
+from utils.quota import consume
+from utils.common import is_tw_stock_symbol, is_us_stock_symbol
+from utils.market_calendar import market_ttl, symbol_market, INTRADAY_INTERVALS
+from utils.async_http import run_sync, run_blocking, fan_out_async
+from services.stock_service import (
+    get_stock_info_async, get_us_stock_info, get_valid_stock_obj_async, quote_ttl
+)
+from services.forex_service import get_forex_info_async, get_taiwan_bank_rates_async
+from services.indicator_service import get_symbols_indicators
+from services.chart_service import generate_stock_chart_url_async, CHART_URL_MAX_TTL
+
+# 其他內部工具使用的 JSON API (與 LINE 指令共用同一組快取，不再各自打 Yahoo / 爬 bot)
+# - 路徑中的代號 / 幣別可用逗號一次查多筆：單筆回傳該筆資料，多筆回傳 {"results": {...}, "missing": [...]}
+# - 回應帶 ETag 與 Cache-Control (max-age 與快取到期時間一致)，支援 If-None-Match 條件請求 (304)
+# - 上游查詢在共用事件迴圈並行執行，不佔用 fanout 執行緒池
+# - 未設定 API_TOKEN (公開) 時，依來源 IP 與全域扣除 api / api_chart 配額 (每個代號扣 1，與 LINE 指令分開)，超過回應 429
+
+api_v1 = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+PERIODS = ('1d', '5d', '1mo', '3mo', '6mo', '1y', '2y', '5y', '10y', 'ytd', 'max')
+INTERVALS = INTRADAY_INTERVALS + ('1d', '5d', '1wk', '1mo', '3mo')
+CHART_TYPES = ('line', 'candlestick', 'bar')
+
+
+class ApiError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+@api_v1.errorhandler(ApiError)
+def api_error(e):
+    response = jsonify({"error": e.message})
+    response.status_code = e.status
+    response.cache_control.no_store = True
+    if e.retry_after is not None: response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@api_v1.before_request
+def check_token():
+    if not API_TOKEN: return
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-API-Token', '')
+    if not hmac.compare_digest(token.encode(), API_TOKEN.encode()):
+        raise ApiError(401, "invalid API token")
+
+def _client_ip():
+    """
+    來源 IP：每層反向代理會把它看到的來源附加在 X-Forwarded-For 最後，
+    只採用 API_TRUSTED_PROXIES 層代理附加的那一筆 (更前面的可由用戶端偽造)
+    """
+    forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+    if not API_TRUSTED_PROXIES or not forwarded: return request.remote_addr
+    return forwarded[-min(API_TRUSTED_PROXIES, len(forwarded))]
+
+def _charge(endpoint, cost):
+    """公開模式 (未設定 API_TOKEN) 扣除 api_<endpoint> 所屬類別 (api / api_chart) 的配額 (來源 IP + 全域)，不足時回應 429"""
+    if API_TOKEN: return
+    allowed, retry_after = consume(f"api_{endpoint}", f"ip:{_client_ip()}", None, cost)
+    if not allowed:
+        metrics.incr(f"api.{endpoint}.limited")
+        wait = math.ceil(retry_after)
+        raise ApiError(429, f"rate limited, retry in {wait}s", retry_after=wait)
+
+def _clean(value):
+    """轉成可輸出為 JSON 的值 (numpy 數值轉成 Python 型別，NaN / inf 轉成 null)"""
+    if isinstance(value, dict): return {k: _clean(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [_clean(v) for v in value]
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)): value = value.item()
+    if isinstance(value, float) and not math.isfinite(value): return None
+    return value
+
+def _split(raw, valid, kind):
+    """路徑中以逗號分隔的代號 (轉大寫、去重)，格式不符或超過 API_BATCH_MAX 回應 400"""
+    items = list(dict.fromkeys(s.strip().upper() for s in raw.split(',') if s.strip()))
+    if not items: raise ApiError(400, f"no {kind} given")
+    if len(items) > API_BATCH_MAX: raise ApiError(400, f"at most {API_BATCH_MAX} {kind} per request")
+    invalid = [s for s in items if not valid(s)]
+    if invalid: raise ApiError(400, f"invalid {kind}: {', '.join(invalid)}")
+    return items
+
+def _arg(name, default, allowed):
+    value = request.args.get(name, default)
+    if value not in allowed: raise ApiError(400, f"invalid {name}: {value} (allowed: {', '.join(allowed)})")
+    return value
+
+def _respond(endpoint, results, max_age, start):
+    """
+    單筆：查無資料回應 404；多筆：回傳有資料者與查無資料的清單
+    附上 ETag / Cache-Control，與 If-None-Match 相符時回應 304 (不含內容)
+    """
+    found = {k: _clean(v) for k, v in results.items() if v}
+    missing = [k for k, v in results.items() if not v]
+    if len(results) == 1:
+        if not found: raise ApiError(404, f"no data for {missing[0]}")
+        body = next(iter(found.values()))
+    else:
+        body = {"results": found, "missing": missing}
+
+    response = jsonify(body)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(max_age), 0)
+    response.add_etag()
+    response.make_conditional(request)
+    metrics.observe(f"api.{endpoint}", time.monotonic() - start)
+    if response.status_code == 304: metrics.incr(f"api.{endpoint}.not_modified")
+    return response
+
+async def _resolve_full_symbols(symbols):
+    """代號 -> Yahoo 代號 (台股探測上市 / 上櫃，探測失敗的純數字代號假定為上市)；已含後綴或美股維持原樣"""
+    probes = [s for s in symbols if is_tw_stock_symbol(s)]
+    found = await fan_out_async({s: get_valid_stock_obj_async(s) for s in probes}) if probes else {}
+    full = {}
+    for s in symbols:
+        if s not in found: full[s] = s
+        elif found[s] and found[s][0]: full[s] = s + found[s][2]
+        elif s.isdigit(): full[s] = s + ".TW"
+    return full
+
+def _is_full_symbol(s):
+    base, _, suffix = s.partition('.')
+    return is_tw_stock_symbol(base) and suffix in ('TW', 'TWO')
+
+@api_v1.route("/quote/<symbols>", methods=['GET'])
+def quote(symbols):
+    """
+    即時報價 (格式同 get_stock_info / get_us_stock_info)，e.g. /api/v1/quote/2330,0050,AAPL
+    台股另含 "source" (報價來源)，美股不含
+    """
+    start = time.monotonic()
+    symbols = _split(symbols, lambda s: is_tw_stock_symbol(s) or is_us_stock_symbol(s), "symbols")
+    _charge('quote', len(symbols))
+    markets = {s: 'tw' if is_tw_stock_symbol(s) else 'us' for s in symbols}
+
+    async def fetch():
+        return await fan_out_async({
+            s: get_stock_info_async(s) if markets[s] == 'tw' else run_blocking(get_us_stock_info, s)
+            for s in symbols
+        })
+
+    return _respond('quote', run_sync(fetch()), min(quote_ttl(m) for m in markets.values()), start)
+
+@api_v1.route("/forex/<currencies>", methods=['GET'])
+def forex(currencies):
+    """
+    匯率：Yahoo 即時盤 (get_forex_info) 與台灣各銀行現鈔賣出 (get_taiwan_bank_rates)
+    e.g. /api/v1/forex/JPY,KRW -> {"currency", "info", "banks"}
+    """
+    start = time.monotonic()
+    currencies = _split(currencies, lambda c: c in VALID_CURRENCIES, "currencies")
+    _charge('forex', len(currencies))
+
+    async def fetch_one(currency):
+        fetched = await fan_out_async({
+            "info": get_forex_info_async(currency),
+            "bank": get_taiwan_bank_rates_async(currency)
+        })
+        banks = fetched["bank"] if isinstance(fetched["bank"], list) else []
+        if not fetched["info"] and not banks: return None
+        return {"currency": currency, "info": fetched["info"], "banks": banks}
+
+    async def fetch():
+        return await fan_out_async({c: fetch_one(c) for c in currencies})
+
+    max_age = min(market_ttl('fx', live_ttl=30), market_ttl('tw_bank', live_ttl=300))
+    return _respond('forex', run_sync(fetch()), max_age, start)
+
+@api_v1.route("/indicators/<symbols>", methods=['GET'])
+def indicators(symbols):
+    """
+    最新技術指標 (格式同 get_latest_indicators)，可帶 ?period=6mo&interval=1d
+    代號可含後綴 (e.g. 2330.TW) 省去上市 / 上櫃探測
+    """
+    start = time.monotonic()
+    symbols = _split(symbols, lambda s: is_tw_stock_symbol(s) or is_us_stock_symbol(s) or _is_full_symbol(s), "symbols")
+    period = _arg('period', '6mo', PERIODS)
+    interval = _arg('interval', '1d', INTERVALS)
+    _charge('indicators', len(symbols))
+
+    full = run_sync(_resolve_full_symbols(symbols))
+    computed = get_symbols_indicators(list(dict.fromkeys(full.values())), period, interval)
+    results = {s: computed.get(full[s]) if s in full else None for s in symbols}
+    max_age = min(market_ttl(symbol_market(f), interval) for f in full.values()) if full else 0
+    return _respond('indicators', results, max_age, start)
+
+@api_v1.route("/chart/<symbols>", methods=['GET'])
+def chart(symbols):
+    """
+    台股走勢圖網址 (QuickChart，約 3 天後失效)，可帶 ?period=1d&interval=5m&type=line
+    type: line / candlestick / bar，e.g. 日K 為 ?period=1y&interval=1d&type=candlestick
+    """
+    start = time.monotonic()
+    symbols = _split(symbols, is_tw_stock_symbol, "symbols")
+    period = _arg('period', '1d', PERIODS)
+    interval = _arg('interval', '5m', INTERVALS)
+    chart_type = _arg('type', 'line', CHART_TYPES)
+    _charge('chart', len(symbols))
+
+    async def fetch_one(symbol):
+        url = await generate_stock_chart_url_async(symbol, period, interval, chart_type=chart_type)
+        if not url: return None
+        return {"symbol": symbol, "period": period, "interval": interval, "type": chart_type, "url": url}
+
+    async def fetch():
+        return await fan_out_async({s: fetch_one(s) for s in symbols})
+
+    return _respond('chart', run_sync(fetch()), min(market_ttl('tw', interval), CHART_URL_MAX_TTL), start)
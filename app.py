@@ -1,39 +1,73 @@
 
 import os
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, abort, jsonify
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, ImageSendMessage
 )
+import math
+import time
+import threading
 import urllib3
+from functools import partial
+from datetime import datetime
 
 # Config & Utils
 from config import (
     LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, TARGET_ID, 
-    VALID_CURRENCIES, BOT_USER_ID
+    VALID_CURRENCIES, CACHE_SNAPSHOT_INTERVAL,
+    SCHEDULER_ENABLED, PUSH_SCHEDULE, REPORT_PREBUILD_LEAD, WATCHLIST_MAX,
+    GEMINI_API_KEY, AI_ANALYSIS_TEXT, ASYNC_MODE
 )
-# Note: BOT_USER_ID cache is better handled in app scope or a singleton, 
-# for now we keep the global variable logic here but initialize it via config logic or lazy load.
 
-from utils.common import get_greeting
+from utils.common import (
+    get_greeting, is_tw_stock_symbol, is_us_stock_symbol, parse_multi_symbols,
+    WATCHLIST_COMMANDS, WATCHLIST_VIEW_COMMANDS
+)
+from utils.market_calendar import is_tw_data_settled, TW_TZ
+from utils.fanout import fan_out
+from utils.async_http import fan_out_async, run_blocking
+from utils.event_dispatcher import dispatch, get_chat_id
+from utils.quota import consume, quota_report, COMMAND_CLASSES
+from utils.event_dedupe import is_duplicate_event
+from utils.latency_budget import run_within_budget, submit_within_budget, remember, recall, budget_report
+from utils import metrics, profiler
+from utils.line_client import LineClient
+from utils.cache_backend import restore_caches, start_snapshot_thread, memory_report
+from utils.scheduler import parse_schedule, add_job, start_scheduler, get_schedule
 from utils.flex_templates import (
     generate_currency_flex_message, generate_help_message, 
     generate_currency_menu_flex, generate_dashboard_flex_message,
-    generate_us_stock_flex_message, generate_stock_flex_message
+    generate_us_stock_flex_message, generate_stock_flex_message,
+    generate_stock_carousel_message
 )
 
 # Services
-from services.forex_service import get_taiwan_bank_rates, get_forex_info
+from services.forex_service import (
+    get_taiwan_bank_rates, get_forex_info, get_taiwan_bank_rates_async, get_forex_info_async
+)
 from services.stock_service import (
     get_stock_info, get_us_stock_info, get_stock_name, 
-    generate_vix_report, get_market_dashboard_data, get_valid_stock_obj
+    get_valid_stock_obj,
+    get_stock_history, get_batch_stock_info,
+    get_stock_info_async, get_stock_name_async, get_valid_stock_obj_async
 )
 from services.chart_service import (
-    generate_forex_chart_url_yf, generate_stock_chart_url_yf
+    generate_forex_chart_url_yf, generate_stock_chart_url_yf,
+    generate_forex_chart_url_async, generate_stock_chart_url_async
+)
+from services.indicator_service import get_latest_indicators, calculate_technical_indicators, get_symbol_indicators
+from services.quote_provider_service import provider_report
+from services.prefetch_service import record_symbol_request, start_nightly_prefetch, run_nightly_prefetch, last_prefetch, check_shared_cache
+from services.watchlist_service import get_user_dashboard, add_symbol, remove_symbol, warm_snapshot
+from services.report_service import (
+    get_report_builder, get_prebuilt_report, prebuild_report, send_report, last_error, report_status
 )
-from services.indicator_service import get_latest_indicators, calculate_technical_indicators
 from services.ai_advisor_service import get_ai_stock_analysis
+from services.level_service import compute_levels
+from services.market_panel_service import update_panel
+from api import api_v1
 import yfinance as yf # Needed for fetching history for indicators
 import pandas as pd
 import yfinance as yf # Needed for fetching history for indicators
@@ -43,23 +77,144 @@ import yfinance as yf # Needed for fetching history for indicators
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 app = Flask(__name__)
+app.register_blueprint(api_v1)
+
+# 重啟 / 休眠喚醒後先載入快取快照 (過期的資料在背景更新)，之後定期寫回
+restore_caches()
+start_snapshot_thread(CACHE_SNAPSHOT_INTERVAL)
+warm_snapshot()
+
+# 共用連線池、使用者名稱快取與各端點耗時統計 (方法與 LineBotApi 相同)
+line_bot_api = LineClient(LINE_CHANNEL_ACCESS_TOKEN)
+line_bot_api.resolve_bot_info_async()
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+
+# --- Helpers ---
+
+def get_target_id(event):
+    """push_message 的對象 (群組 / 聊天室優先)"""
+    if event.source.type == 'group': return event.source.group_id
+    if event.source.type == 'room': return event.source.room_id
+    return event.source.user_id
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+def stale_notice(saved_at):
+    saved = datetime.fromtimestamp(saved_at, TW_TZ).strftime('%H:%M')
+    return f"⚠️ 即時資料讀取較慢，以下為 {saved} 的快取資料，最新結果稍後補上"
+
+def image_message(url):
+    return ImageSendMessage(original_content_url=url, preview_image_url=url)
+
+def recalled(key, render):
+    """最近一次成功結果轉成訊息，回傳 (訊息, 儲存時間) 或 None"""
+    last = recall(key)
+    return (render(last[0]), last[1]) if last else None
+
+def ai_report_messages(report):
+    analysis_text, chart_url = report
+    msgs = [TextSendMessage(text=analysis_text)]
+    if chart_url: msgs.insert(0, image_message(chart_url))
+    return msgs
+
+def within_quota(event, command, cached=None, cost=1):
+    """
+    檢查指令配額 (使用者 / 聊天室 / 全域)
+    超過時不做新的上游查詢：有快取結果 (cached() 回傳 (訊息, 儲存時間)) 就回覆快取，
+    否則提示幾秒後再試，並回傳 False
+    """
+    allowed, retry_after = consume(command, getattr(event.source, 'user_id', None), get_chat_id(event), cost)
+    if allowed: return True
+
+    last = cached() if cached else None
+    if last:
+        msgs, saved_at = last
+        metrics.incr(f"quota.{COMMAND_CLASSES[command]}.served_cached")
+        saved = datetime.fromtimestamp(saved_at, TW_TZ).strftime('%H:%M')
+        msgs = [TextSendMessage(text=f"⚠️ 查詢太頻繁，以下為 {saved} 的快取資料")] + (msgs if isinstance(msgs, list) else [msgs])
+    else:
+        msgs = TextSendMessage(text=f"⏳ 查詢太頻繁，請 {math.ceil(retry_after)} 秒後再試")
+    line_bot_api.reply_message(event.reply_token, msgs)
+    return False
+
+def run_command(event, command, build, build_async=None, build_partial=None):
+    """
+    在回覆期限內執行指令 (逾時先回覆部分結果，其餘以 push 補送)
+    ASYNC_MODE：交給共用事件迴圈後立即返回，webhook worker 不需等待上游；
+    沒有 async 版本 (build_async) 的指令在執行緒池執行 build
+    """
+    if not ASYNC_MODE:
+        run_within_budget(command, build,
+                          lambda msgs: line_bot_api.reply_message(event.reply_token, msgs),
+                          lambda msgs: line_bot_api.push_message(get_target_id(event), msgs),
+                          build_partial=build_partial)
+        return
+    submit_within_budget(get_chat_id(event), command, build_async or partial(run_blocking, build),
+                         lambda msgs: line_bot_api.reply_message_async(event.reply_token, msgs),
+                         lambda msgs: line_bot_api.push_message_async(get_target_id(event), msgs),
+                         build_partial=build_partial)
+
+def format_quote_text(data, saved_at):
+    """無圖表時先回覆的文字報價"""
+    sign = "+" if data['change'] > 0 else ""
+    saved = datetime.fromtimestamp(saved_at, TW_TZ).strftime('%H:%M')
+    return (f"📊 {data['name']} ({data['symbol']}) {data['price']:.2f} "
+            f"{sign}{data['change']:.2f} ({sign}{data['change_percent']:.2f}%) [{saved}]")
 
 # --- Routes ---
 
 @app.route("/", methods=['GET'])
 def home(): return "Alive", 200
 
+@app.route("/metrics", methods=['GET'])
+def metrics_view():
+    """各指令耗時與回覆期限命中率 (JSON)"""
+    data = metrics.snapshot()
+    data["reply_budget"] = budget_report()
+    data["schedule"] = get_schedule()
+    data["quota"] = quota_report()
+    data["quote_providers"] = provider_report()
+    data["cache_memory"] = memory_report()
+    data["reports"] = report_status()
+    return jsonify(data)
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    try: handler.handle(body, signature)
+    try: events = parser.parse(body, signature)
     except InvalidSignatureError: abort(400)
+    # LINE 重送 (webhookEventId 已處理過) 的事件直接略過
+    events = [e for e in events if not is_duplicate_event(e)]
+    # 管理者可帶 X-Profile 標頭剖析這次的事件
+    mode = profiler.requested_mode(request.headers)
+    # 事件交給背景 worker pool：同聊天室依序、不同聊天室並行
+    dispatch(events, partial(handle_event, profile=mode) if mode else handle_event)
     return 'OK'
 
+def push_to_target(text):
+    line_bot_api.push_message(TARGET_ID, TextSendMessage(text=text))
+
+def _send_report_in_background(name, force):
+    try:
+        send_report(name, push_to_target, force=force)
+    except Exception as e:
+        print(f"[Debug] Background report {name} failed: {e}")
+
+def trigger_report(name, sent_text):
+    """
+    推送報告：有預先產生的內容時立即推送；
+    沒有則在背景產生後推送，讓外部 cron 不會因為爬取太久而逾時
+    背景產生失敗的原因記錄在 /metrics 的 reports，並附在下一次 202 回應中
+    """
+    force = request.args.get('force') == '1'
+    if get_prebuilt_report(name) is None:
+        previous = last_error(name)
+        threading.Thread(target=_send_report_in_background, args=(name, force), daemon=True).start()
+        if previous: return f"{sent_text} (building; last attempt failed: {previous['error']})", 202
+        return f"{sent_text} (building)", 202
+    if send_report(name, push_to_target, force=force) == 'skipped':
+        return f"{sent_text} (already sent recently)", 200
+    return sent_text, 200
+
 @app.route("/push_forex", defaults={'currency': 'KRW'}, methods=['GET'])
 @app.route("/push_forex/<currency>", methods=['GET'])
 def push_forex(currency):
@@ -74,34 +229,17 @@ def push_forex(currency):
         return f"Invalid Currency: {currency}. Supported: {', '.join(VALID_CURRENCIES)}", 400
 
     try:
-        forex_report = get_taiwan_bank_rates(currency)
-        
-        # 處理報告回傳格式 (字串或列表)
-        if isinstance(forex_report, list) and forex_report:
-            report_str = f"📊 {currency} 匯率報告 (Top 10)\n{'-'*20}\n"
-            for item in forex_report:
-                report_str += f"{item['bank']}: {item['cash_selling']}\n"
-        else:
-            report_str = str(forex_report) if forex_report else "查無資料"
-
-        message = f"{get_greeting()}！\n\n{report_str}"
-        
-        line_bot_api.push_message(TARGET_ID, TextSendMessage(text=message))
-        return f"Forex Report Sent ({currency})", 200
+        return trigger_report(f"forex:{currency}", f"Forex Report Sent ({currency})")
     except Exception as e:
         print(f"[Debug] Error pushing forex report: {e}")
         return str(e), 500
 
 @app.route("/push_vix", methods=['GET'])
 def push_vix():
-    """定時推送 VIX 恐慌指數（晚上 18:00，由外部 cron job 觸發）"""
+    """定時推送 VIX 恐慌指數（晚上 18:00，由內建排程或外部 cron job 觸發）"""
     if not TARGET_ID: return "No Target ID", 500
     try:
-        vix_report = generate_vix_report()
-        message = f"{get_greeting()}！\n\n{vix_report}"
-        
-        line_bot_api.push_message(TARGET_ID, TextSendMessage(text=message))
-        return "VIX Report Sent", 200
+        return trigger_report('vix', "VIX Report Sent")
     except Exception as e:
         print(f"[Debug] Error pushing VIX report: {e}")
         return str(e), 500
@@ -112,24 +250,52 @@ def push_report():
     """定時推送韓幣匯率與 VIX 恐慌指數報告（向後相容）"""
     if not TARGET_ID: return "No Target ID", 500
     try:
-        krw_report = get_taiwan_bank_rates('KRW')
-        # Here krw_report is list, need to convert to str for simple push
-        krw_str = ""
-        if isinstance(krw_report, list):
-             for item in krw_report[:5]:
-                 krw_str += f"{item['bank']}: {item['cash_selling']}\n"
-        else: krw_str = str(krw_report)
-
-        vix_report = generate_vix_report()
-        full_report = f"{get_greeting()}！\n\n📊 韓幣匯率\n{krw_str}\n\n{vix_report}"
-        
-        line_bot_api.push_message(TARGET_ID, TextSendMessage(text=full_report))
-        return "Report Sent (KRW + VIX)", 200
+        return trigger_report('report', "Report Sent (KRW + VIX)")
     except Exception as e:
         print(f"[Debug] Error pushing report: {e}")
         return str(e), 500
 
-@handler.add(MessageEvent, message=TextMessage)
+@app.route("/prefetch", methods=['GET'])
+def prefetch():
+    """
+    盤後預熱熱門個股的日線、技術指標與常用圖表（由外部 cron job 於台股收盤後觸發）
+    Usage: /prefetch (盤中會拒絕，可加 ?force=1 強制執行)
+    """
+    if not is_tw_data_settled() and request.args.get('force') != '1':
+        return "Market session not settled yet", 409
+    try:
+        check_shared_cache()
+    except RuntimeError as e:
+        return str(e), 409
+    start_nightly_prefetch()
+    return f"Prefetch Started (last run: {last_prefetch or 'N/A'})", 202
+
+def setup_schedule():
+    """依 PUSH_SCHEDULE 建立內建排程：盤後預熱、全市場日線，以及提前產生、準時推送的報告"""
+    for name, at, calendar in parse_schedule(PUSH_SCHEDULE):
+        if name == 'prefetch':
+            try:
+                check_shared_cache()
+            except RuntimeError as e:
+                print(f"[Debug] Scheduled prefetch disabled: {e}")
+                continue
+            add_job(name, at, calendar, run_nightly_prefetch)
+        elif name == 'panel':
+            add_job(name, at, calendar, update_panel)
+        elif get_report_builder(name) and TARGET_ID:
+            add_job(name, at, calendar, partial(send_report, name, push_to_target),
+                    prepare=partial(prebuild_report, name), lead=REPORT_PREBUILD_LEAD)
+        else:
+            print(f"[Debug] Unknown or unavailable scheduled job: {name}")
+    start_scheduler()
+
+if SCHEDULER_ENABLED: setup_schedule()
+
+def handle_event(event, profile=None):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        with profiler.profile_event(event.message.text, profile):
+            handle_message(event)
+
 def handle_message(event):
     msg = event.message.text.upper().strip()
     
@@ -143,17 +309,10 @@ def handle_message(event):
     
     # 方法 A: 檢查 event 中的 mention 物件
     if hasattr(event.message, 'mention') and event.message.mention:
-        global BOT_USER_ID
-        if 'BOT_USER_ID' not in globals() or not BOT_USER_ID:
-            try:
-                bot_info = line_bot_api.get_bot_info()
-                BOT_USER_ID = bot_info.user_id
-            except:
-                BOT_USER_ID = None
-        
-        if BOT_USER_ID:
+        bot_user_id = line_bot_api.bot_user_id
+        if bot_user_id:
             for mentionee in event.message.mention.mentionees:
-                if mentionee.user_id == BOT_USER_ID:
+                if mentionee.user_id == bot_user_id:
                     is_mentioned_bot = True
                     break
     
@@ -169,23 +328,18 @@ def handle_message(event):
          is_greeting = True
          print(f"Fallback mention detected via text: {msg}")
 
+    # 查看自選：與問候相同的儀表板
+    if msg in WATCHLIST_VIEW_COMMANDS:
+        is_greeting = True
+
     print(f"[Debug] Msg: {msg}, IsBotMention: {is_mentioned_bot}, IsPrivate: {is_private_chat}, HasGreeting: {has_greeting_word} -> IsGreeting: {is_greeting}")
     
     if is_greeting:
         user_id = event.source.user_id
-        user_name = "朋友"
-        try:
-             if event.source.type == 'group':
-                 profile = line_bot_api.get_group_member_profile(event.source.group_id, user_id)
-             elif event.source.type == 'room':
-                 profile = line_bot_api.get_room_member_profile(event.source.room_id, user_id)
-             else:
-                 profile = line_bot_api.get_profile(user_id)
-             user_name = profile.display_name
-        except: pass
+        user_name = line_bot_api.get_display_name(event.source) or "朋友"
 
         greeting_msg = get_greeting()
-        market_data = get_market_dashboard_data()
+        market_data = get_user_dashboard(user_id)
         reply_flex = generate_dashboard_flex_message(greeting_msg, user_name, market_data)
         
         line_bot_api.reply_message(event.reply_token, reply_flex)
@@ -204,101 +358,194 @@ def handle_message(event):
         line_bot_api.reply_message(event.reply_token, generate_currency_menu_flex())
         return
 
+    # 自選清單 (e.g. "加入 2330", "移除 AAPL")
+    parts = msg.split()
+    if len(parts) == 2 and parts[0] in WATCHLIST_COMMANDS:
+        symbol = parts[1]
+        user_id = event.source.user_id
+        if not (is_tw_stock_symbol(symbol) or is_us_stock_symbol(symbol)):
+            text = f"❌ 無效的代號: {symbol}"
+        elif not user_id:
+            text = "❌ 無法取得使用者 ID，請先加入好友"
+        elif parts[0] == '加入':
+            ok, watchlist = add_symbol(user_id, symbol)
+            if ok: text = f"✅ 已將 {symbol} 加入自選 ({len(watchlist)}/{WATCHLIST_MAX})\n輸入「自選」查看"
+            else: text = f"❌ 自選已達上限 {WATCHLIST_MAX} 檔，請先移除 (e.g. 移除 {watchlist[0]})"
+        else:
+            removed, watchlist = remove_symbol(user_id, symbol)
+            text = f"🗑️ 已將 {symbol} 移出自選" if removed else f"❌ {symbol} 不在自選清單中"
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+        return
+
+    # 以下查詢都在回覆期限內執行，逾時先回覆部分結果，其餘以 push 補送
+    push = lambda msgs: line_bot_api.push_message(get_target_id(event), msgs)
+
     # 1. 匯率查詢 (儀表板)
     if msg in VALID_CURRENCIES:
-        forex_data = get_forex_info(msg)
-        bank_report = get_taiwan_bank_rates(msg)
-        
-        if forex_data:
-            flex_msg = generate_currency_flex_message(forex_data, bank_report)
-            line_bot_api.reply_message(event.reply_token, flex_msg)
-        else:
-             if isinstance(bank_report, list):
-                  text_report = f"🏆 {msg} 匯率 (無即時盤)\n----------------\n"
-                  for item in bank_report[:10]:
-                      text_report += f"{item['bank']}: {item['cash_selling']}\n"
-                  line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text_report))
-             else:
-                  line_bot_api.reply_message(event.reply_token, TextSendMessage(text=str(bank_report)))
+        def render_forex(fetched):
+            forex_data = fetched["forex"]
+            bank_report = fetched["bank"] if fetched["bank"] is not None else []
+            
+            if forex_data:
+                return generate_currency_flex_message(forex_data, bank_report)
+            if isinstance(bank_report, list):
+                text_report = f"🏆 {msg} 匯率 (無即時盤)\n----------------\n"
+                for item in bank_report[:10]:
+                    text_report += f"{item['bank']}: {item['cash_selling']}\n"
+                return TextSendMessage(text=text_report)
+            return TextSendMessage(text=str(bank_report))
+
+        def build_forex():
+            # Yahoo 即時盤與銀行牌告同時抓取
+            return render_forex(fan_out({
+                "forex": partial(get_forex_info, msg),
+                "bank": partial(get_taiwan_bank_rates, msg)
+            }))
+
+        async def build_forex_async():
+            return render_forex(await fan_out_async({
+                "forex": get_forex_info_async(msg),
+                "bank": get_taiwan_bank_rates_async(msg)
+            }))
+
+        if not within_quota(event, 'forex'): return
+        run_command(event, 'forex', build_forex, build_forex_async,
+                    build_partial=lambda: TextSendMessage(text=f"⏳ {msg} 匯率讀取中，完成後會再傳送給您..."))
         return
 
     # 2. 匯率完整列表
-    parts = msg.split()
     if len(parts) == 2 and parts[1] == '列表' and parts[0] in VALID_CURRENCIES:
-        report = get_taiwan_bank_rates(parts[0])
-        if len(report) > 0 and isinstance(report, list):
-             text_report = f"🏆 {parts[0]} 匯率總覽\n(銀行 | 現鈔賣出 | 即期賣出)\n----------------\n"
-             for item in report:
-                 text_report += f"{item['bank']}: {item['cash_selling']} | {item['spot_selling']}\n"
-             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text_report))
-        else:
-             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=str(report) if report else "查無資料"))
+        def render_forex_list(report):
+            if len(report) > 0 and isinstance(report, list):
+                text_report = f"🏆 {parts[0]} 匯率總覽\n(銀行 | 現鈔賣出 | 即期賣出)\n----------------\n"
+                for item in report:
+                    text_report += f"{item['bank']}: {item['cash_selling']} | {item['spot_selling']}\n"
+                return TextSendMessage(text=text_report)
+            return TextSendMessage(text=str(report) if report else "查無資料")
+
+        async def build_forex_list_async():
+            return render_forex_list(await get_taiwan_bank_rates_async(parts[0]))
+
+        if not within_quota(event, 'forex_list'): return
+        run_command(event, 'forex_list', lambda: render_forex_list(get_taiwan_bank_rates(parts[0])),
+                    build_forex_list_async)
         return
 
     # 3. 匯率走勢圖
     if len(parts) == 2 and parts[0] in VALID_CURRENCIES:
         cmd = parts[1]
-        chart_url = None
-        if cmd == '1D': chart_url = generate_forex_chart_url_yf(parts[0], '1d', '15m')
-        elif cmd == '5D': chart_url = generate_forex_chart_url_yf(parts[0], '5d', '60m')
-        elif cmd == '1M': chart_url = generate_forex_chart_url_yf(parts[0], '1mo', '1d')
-        elif cmd == '1Y': chart_url = generate_forex_chart_url_yf(parts[0], '1y', '1d')
-        
-        if chart_url:
-            line_bot_api.reply_message(event.reply_token, ImageSendMessage(original_content_url=chart_url, preview_image_url=chart_url))
-        else:
-            if cmd in ['1D', '5D', '1M', '1Y']:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 暫無該時段走勢數據 (可能為週末或資料源問題)"))
+        forex_periods = {'1D': ('1d', '15m'), '5D': ('5d', '60m'), '1M': ('1mo', '1d'), '1Y': ('1y', '1d')}
+        if cmd in forex_periods:
+            def render_forex_chart(chart_url):
+                if chart_url:
+                    remember(('forex_chart', parts[0], cmd), chart_url)
+                    return image_message(chart_url)
+                return TextSendMessage(text="❌ 暫無該時段走勢數據 (可能為週末或資料源問題)")
+
+            async def build_forex_chart_async():
+                return render_forex_chart(await generate_forex_chart_url_async(parts[0], *forex_periods[cmd]))
+
+            if not within_quota(event, 'forex_chart', cached=partial(recalled, ('forex_chart', parts[0], cmd), image_message)):
+                return
+            run_command(event, 'forex_chart', lambda: render_forex_chart(generate_forex_chart_url_yf(parts[0], *forex_periods[cmd])),
+                        build_forex_chart_async,
+                        build_partial=lambda: TextSendMessage(text=f"⏳ {parts[0]} {cmd} 走勢圖產生中，完成後會再傳送給您..."))
         return
 
 
+    # 3.5 多檔股票同時查詢 (e.g. "2330 2317 2454 0050", "AAPL,NVDA,TSLA", "$AAPL $NVDA")
+    # 單次批次下載後以 Carousel 回覆
+    symbols = parse_multi_symbols(msg)
+    if symbols:
+        print(f"[Multi Stock Query] Attempting to fetch: {symbols}")
+        for symbol in symbols:
+            if is_tw_stock_symbol(symbol): record_symbol_request(symbol)
+
+        def build_multi_quote():
+            stocks = get_batch_stock_info(symbols)
+            if not stocks:
+                print(f"[Multi Stock Query] No data found for: {symbols}")
+                return None
+            return generate_stock_carousel_message(stocks)
+
+        if not within_quota(event, 'multi_quote', cost=len(symbols)): return
+        run_command(event, 'multi_quote', build_multi_quote)
+        return
+
     # 4. 台股複雜指令 (走勢圖/交易量)
+    stock_chart_cmds = {
+        '即時': ('1d', '5m', 'line'), '即時走勢': ('1d', '5m', 'line'), '即時走勢圖': ('1d', '5m', 'line'),
+        '日K': ('1y', '1d', 'candlestick'), '日線': ('1y', '1d', 'candlestick'),
+        '週K': ('2y', '1wk', 'candlestick'), '週線': ('2y', '1wk', 'candlestick'),
+        '月K': ('5y', '1mo', 'candlestick'), '月線': ('5y', '1mo', 'candlestick'),
+        '交易量': ('1mo', '1d', 'bar'), '近3日交易量': ('1mo', '1d', 'bar')
+    }
     if len(parts) == 2 and parts[0].isdigit():
         symbol = parts[0]
         cmd = parts[1]
+        record_symbol_request(symbol)
         
-        chart_url = None
-        stock_name = get_stock_name(symbol)
-        
-        if cmd in ['即時', '即時走勢', '即時走勢圖']:
-            chart_url = generate_stock_chart_url_yf(symbol, '1d', '5m', chart_type='line', stock_name=stock_name)
-        elif cmd in ['日K', '日線']:
-            chart_url = generate_stock_chart_url_yf(symbol, '1y', '1d', chart_type='candlestick', stock_name=stock_name)
-        elif cmd in ['週K', '週線']:
-            chart_url = generate_stock_chart_url_yf(symbol, '2y', '1wk', chart_type='candlestick', stock_name=stock_name)
-        elif cmd in ['月K', '月線']:
-            chart_url = generate_stock_chart_url_yf(symbol, '5y', '1mo', chart_type='candlestick', stock_name=stock_name)
-        elif cmd in ['交易量', '近3日交易量']:
-             chart_url = generate_stock_chart_url_yf(symbol, '1mo', '1d', chart_type='bar', stock_name=stock_name)
-
-        if chart_url:
-            line_bot_api.reply_message(event.reply_token, ImageSendMessage(original_content_url=chart_url, preview_image_url=chart_url))
-            return
-        else:
-            if cmd in ['即時', '日K', '週K', '月K', '交易量']:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 產生圖表失敗 ({cmd})"))
+        if cmd in stock_chart_cmds:
+            period, interval, chart_type = stock_chart_cmds[cmd]
+
+            def render_stock_chart(chart_url):
+                if chart_url:
+                    remember(('stock_chart', symbol, cmd), chart_url)
+                    return image_message(chart_url)
+                return TextSendMessage(text=f"❌ 產生圖表失敗 ({cmd})")
+
+            def build_stock_chart():
+                # 中文名稱與上市/上櫃判斷同時進行，判斷結果直接交給圖表，避免重複探測
+                fetched = fan_out({
+                    "name": partial(get_stock_name, symbol),
+                    "stock": partial(get_valid_stock_obj, symbol)
+                })
+                suffix = (fetched["stock"] or (None, None, None))[2]
+                return render_stock_chart(generate_stock_chart_url_yf(
+                    symbol, period, interval, chart_type=chart_type, stock_name=fetched["name"] or symbol, suffix=suffix))
+
+            async def build_stock_chart_async():
+                fetched = await fan_out_async({
+                    "name": get_stock_name_async(symbol),
+                    "stock": get_valid_stock_obj_async(symbol)
+                })
+                suffix = (fetched["stock"] or (None, None, None))[2]
+                return render_stock_chart(await generate_stock_chart_url_async(
+                    symbol, period, interval, chart_type=chart_type, stock_name=fetched["name"] or symbol, suffix=suffix))
+
+            def build_chart_partial():
+                # 先回覆文字報價 (若有)，圖表完成後補送
+                last = recall(('tw_quote', symbol))
+                text = f"⏳ {symbol} {cmd} 圖表產生中，完成後會再傳送給您..."
+                if last: text = f"{format_quote_text(*last)}\n\n{text}"
+                return TextSendMessage(text=text)
+
+            if not within_quota(event, 'stock_chart', cached=partial(recalled, ('stock_chart', symbol, cmd), image_message)):
                 return
+            run_command(event, 'stock_chart', build_stock_chart, build_stock_chart_async, build_partial=build_chart_partial)
+            return
             
-            elif cmd == '52週':
-                try:
-                    # 使用 yfinance 抓取 52 週數據
-                    t = yf.Ticker(symbol + ".TW") # 預設假設為台股
-                    info = t.info
-                    # 如果 .TW 沒資料，嘗試不加後綴 (防禦性)
-                    if not info or 'fiftyTwoWeekHigh' not in info:
-                         t = yf.Ticker(symbol)
-                         info = t.info
-                    
-                    h52 = info.get('fiftyTwoWeekHigh', 'N/A')
-                    l52 = info.get('fiftyTwoWeekLow', 'N/A')
-                    
-                    line_bot_api.reply_message(
-                        event.reply_token, 
-                        TextSendMessage(text=f"📊 {symbol} {stock_name}\n\n🔥 近 52 週最高: {h52}\n🧊 近 52 週最低: {l52}")
-                    )
-                except Exception as e:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 無法取得 52 週數據: {e}"))
-                return
+        elif cmd == '52週':
+            stock_name = get_stock_name(symbol)
+            try:
+                # 使用 yfinance 抓取 52 週數據
+                t = yf.Ticker(symbol + ".TW") # 預設假設為台股
+                info = t.info
+                # 如果 .TW 沒資料，嘗試不加後綴 (防禦性)
+                if not info or 'fiftyTwoWeekHigh' not in info:
+                     t = yf.Ticker(symbol)
+                     info = t.info
+                
+                h52 = info.get('fiftyTwoWeekHigh', 'N/A')
+                l52 = info.get('fiftyTwoWeekLow', 'N/A')
+                
+                line_bot_api.reply_message(
+                    event.reply_token, 
+                    TextSendMessage(text=f"📊 {symbol} {stock_name}\n\n🔥 近 52 週最高: {h52}\n🧊 近 52 週最低: {l52}")
+                )
+            except Exception as e:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 無法取得 52 週數據: {e}"))
+            return
 
         # If not handled above (e.g. '策略'), fall through to next logic
     
@@ -309,23 +556,51 @@ def handle_message(event):
     
     if (is_us_stock or is_index) and msg.isupper():
         print(f"[US Stock Query] Attempting to fetch: {msg}")
-        us_stock = get_us_stock_info(msg)
-        if us_stock:
-            line_bot_api.reply_message(event.reply_token, generate_us_stock_flex_message(us_stock))
+
+        def build_us_quote():
+            us_stock = get_us_stock_info(msg)
+            if not us_stock:
+                print(f"[US Stock Query] No data found for: {msg}")
+                return None
+            remember(('us_quote', msg), us_stock)
+            return generate_us_stock_flex_message(us_stock)
+
+        def build_us_partial():
+            last = recall(('us_quote', msg))
+            if not last: return None
+            return [TextSendMessage(text=stale_notice(last[1])), generate_us_stock_flex_message(last[0])]
+
+        if not within_quota(event, 'us_quote', cached=partial(recalled, ('us_quote', msg), generate_us_stock_flex_message)):
             return
-        else:
-            print(f"[US Stock Query] No data found for: {msg}")
+        run_command(event, 'us_quote', build_us_quote, build_partial=build_us_partial)
+        return
     
     # 6. 台股查詢（數字代號或混合代號，如 00981A）
     if msg.isascii() and msg.isalnum() and 4 <= len(msg) <= 6:
         if any(c.isdigit() for c in msg):
             print(f"[Taiwan Stock Query] Attempting to fetch: {msg}")
-            stock = get_stock_info(msg)
-            if stock:
-                line_bot_api.reply_message(event.reply_token, generate_stock_flex_message(stock))
+            record_symbol_request(msg)
+
+            def render_tw_quote(stock):
+                if not stock:
+                    print(f"[Taiwan Stock Query] No data found for: {msg}")
+                    return None
+                remember(('tw_quote', msg), stock)
+                return generate_stock_flex_message(stock)
+
+            async def build_tw_quote_async():
+                return render_tw_quote(await get_stock_info_async(msg))
+
+            def build_tw_partial():
+                last = recall(('tw_quote', msg))
+                if not last: return None
+                return [TextSendMessage(text=stale_notice(last[1])), generate_stock_flex_message(last[0])]
+
+            if not within_quota(event, 'tw_quote', cached=partial(recalled, ('tw_quote', msg), generate_stock_flex_message)):
                 return
-            else:
-                print(f"[Taiwan Stock Query] No data found for: {msg}")
+            run_command(event, 'tw_quote', lambda: render_tw_quote(get_stock_info(msg)), build_tw_quote_async,
+                        build_partial=build_tw_partial)
+            return
 
     # 7. AI 智能分析 (股票代號 + 分析/策略)
     # e.g. "2330 分析", "AAPL 策略", "TSLA 分析"
@@ -346,105 +621,93 @@ def handle_message(event):
              return
 
         print(f"[Debug] AI Command Triggered: Symbol={symbol}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"🤖 正在分析 {symbol} 的數據並諮詢 AI 顧問，請稍候... (約 3-5 秒)"))
-        
-        # 1. 取得歷史數據
-        try:
+        record_symbol_request(symbol)
+
+        def probe_full_symbol():
             # 判斷是台股還是美股/全代號
-            # 嘗試先用 helper 判斷
             s_obj, info, suffix = get_valid_stock_obj(symbol)
-            if s_obj:
-                full_symbol = symbol + suffix
-            else:
-                # Fallback: 如果是純數字且驗證失敗 (可能網路問題)，強路假定為台股 .TW
-                if symbol.isdigit() and len(symbol) >= 4:
-                     print(f"[Debug] Validation failed but looks like TW stock. Force appending .TW")
-                     full_symbol = symbol + ".TW"
-                else:
-                     full_symbol = symbol # Assume US stock or valid ticker
-            
+            if s_obj: return symbol + suffix, suffix
+            # Fallback: 如果是純數字且驗證失敗 (可能網路問題)，強路假定為台股 .TW
+            if symbol.isdigit() and len(symbol) >= 4:
+                print(f"[Debug] Validation failed but looks like TW stock. Force appending .TW")
+                return symbol + ".TW", ".TW"
+            return symbol, None # Assume US stock or valid ticker
+
+        # K 線圖與 AI 文字分析共用同一次上市/上櫃探測 (後呼叫者等待先呼叫者的結果)
+        resolved, resolve_lock = [], threading.Lock()
+        def resolve_full_symbol():
+            with resolve_lock:
+                if not resolved: resolved.append(probe_full_symbol())
+                return resolved[0]
+
+        def build_analysis():
+            # 1. 規則式支撐 / 壓力 (毫秒級)，直接標在 K 線圖上
+            full_symbol, suffix = resolve_full_symbol()
             stock_name = get_stock_name(symbol)
-            print(f"[Debug] Fetching history for {full_symbol}...")
-            
             # 下載數據 (至少 60 天以計算 MA60, 3個月約60天太緊繃，改抓6個月)
-            df = yf.download(full_symbol, period="6mo", interval="1d", progress=False)
-            
-            # Handle MultiIndex columns (yfinance v0.2+ / v1.1.0)
-            if isinstance(df.columns, pd.MultiIndex):
-                try:
-                    # 如果只有一層 ticker，直接移除第二層 (Ticker層)
-                     df.columns = df.columns.droplevel(1)
-                except Exception as e:
-                    print(f"[Debug] Flatten columns failed: {e}")
-                    pass
-            
-            if df.empty:
+            # 與盤後預熱共用快取，熱門個股隔天不需重新下載
+            df = get_stock_history(full_symbol, "6mo", "1d")
+            if df is None or df.empty:
                 print(f"[Debug] History empty for {full_symbol}")
-                # Determine correct target ID for error message
-                if event.source.type == 'group': target_id = event.source.group_id
-                elif event.source.type == 'room': target_id = event.source.room_id
-                else: target_id = event.source.user_id
-                
-                line_bot_api.push_message(target_id, TextSendMessage(text=f"❌ 找不到 {symbol} 的歷史數據，無法分析。"))
-                return
+                return TextSendMessage(text=f"❌ 找不到 {symbol} 的歷史數據，無法分析。")
+
+            levels = compute_levels(df)
+            if not levels:
+                return TextSendMessage(text="❌ 技術指標計算失敗 (數據不足)。")
+            chart_url = generate_stock_chart_url_yf(
+                symbol, '6mo', '1d',
+                chart_type='candlestick',
+                stock_name=stock_name,
+                annotations={'support': levels['support_price'], 'resistance': levels['resistance_price']},
+                suffix=suffix
+            )
+            text = f"📐 {stock_name} ({symbol}) 關鍵價位：\n\n{levels['formatted_text']}"
+            remember(('ai_analysis', symbol), (text, chart_url))
+            return ai_report_messages((text, chart_url))
+
+        def build_analysis_partial():
+            return TextSendMessage(text=f"🤖 正在分析 {symbol} 的數據，請稍候...")
+
+        # 圖表使用走勢圖配額；超過時改回覆最近一次的分析報告
+        if not within_quota(event, 'stock_chart', cached=partial(recalled, ('ai_analysis', symbol), ai_report_messages)):
+            return
+        run_command(event, 'ai_analysis', build_analysis, build_partial=build_analysis_partial)
 
-            print(f"[Debug] History fetched. Rows={len(df)}")
+        # 2. AI 文字分析為附加內容：未設定金鑰、超過 AI 配額或失敗時只保留規則式結果
+        if not (AI_ANALYSIS_TEXT and GEMINI_API_KEY): return
+        allowed, _ = consume('ai_analysis', getattr(event.source, 'user_id', None), get_chat_id(event))
+        if not allowed: return
 
-            # 2. 計算技術指標
-            indicators = get_latest_indicators(df)
-            
-            # 3. 呼叫 AI
-            if indicators:
+        def build_ai_text():
+            ai_start = time.monotonic()
+            try:
+                full_symbol, _ = resolve_full_symbol()
+                indicators = get_symbol_indicators(full_symbol, "6mo", "1d")
+                if not indicators: return None
                 print(f"[Debug] Indicators calculated. Calling AI...")
-                ai_result = get_ai_stock_analysis(symbol, stock_name, indicators)
+                ai_result = get_ai_stock_analysis(symbol, get_stock_name(symbol), indicators)
                 print(f"[Debug] AI Result: {str(ai_result)[:50]}...")
-                
-                # Check format
-                if isinstance(ai_result, dict):
-                    analysis_text = ai_result.get('formatted_text', str(ai_result))
-                    annotations = {
-                        'support': ai_result.get('support_price'),
-                        'resistance': ai_result.get('resistance_price')
-                    }
-                else:
-                    analysis_text = str(ai_result)
-                    annotations = None
-                
-                # 4. 同時產生一張 K 線圖作為輔助 (帶有分析線圖)
-                print(f"[Debug] Generating Chart...")
-                chart_url = generate_stock_chart_url_yf(
-                    symbol, '6mo', '1d', 
-                    chart_type='candlestick', 
-                    stock_name=stock_name,
-                    annotations=annotations
-                )
-                print(f"[Debug] Chart URL: {chart_url}")
-                
-                msgs = [TextSendMessage(text=f"🧠 AI 智能分析報告：\n\n{analysis_text}")]
-                if chart_url:
-                    msgs.insert(0, ImageSendMessage(original_content_url=chart_url, preview_image_url=chart_url))
-                
-                # Determine correct target ID (Group priority)
-                if event.source.type == 'group': target_id = event.source.group_id
-                elif event.source.type == 'room': target_id = event.source.room_id
-                else: target_id = event.source.user_id
-                
-                print(f"[Debug] Pushing report to {event.source.type} ID: {target_id}")
-                line_bot_api.push_message(target_id, msgs)
-                print(f"[Debug] AI Report Sent.")
-            else:
-                print(f"[Debug] Indicator calculation failed.")
-                if event.source.type == 'group': target_id = event.source.group_id
-                elif event.source.type == 'room': target_id = event.source.room_id
-                else: target_id = event.source.user_id
-                line_bot_api.push_message(target_id, TextSendMessage(text="❌ 技術指標計算失敗 (數據不足)。"))
-                
-        except Exception as e:
-            print(f"[Debug] AI Analysis Error: {e}")
-            if event.source.type == 'group': target_id = event.source.group_id
-            elif event.source.type == 'room': target_id = event.source.room_id
-            else: target_id = event.source.user_id
-            line_bot_api.push_message(target_id, TextSendMessage(text=f"❌ 分析過程中發生錯誤: {str(e)}"))
+                if not isinstance(ai_result, dict) or ai_result.get('sentiment') == 'N/A': return None
+
+                ai_text = f"🧠 AI 智能分析報告：\n\n{ai_result.get('formatted_text', str(ai_result))}"
+                last = recall(('ai_analysis', symbol))
+                if last: remember(('ai_analysis', symbol), (f"{last[0][0]}\n\n{ai_text}", last[0][1]))
+                print(f"[Debug] AI Report ready.")
+                return TextSendMessage(text=ai_text)
+            except Exception as e:
+                print(f"[Debug] AI Analysis Error: {e}")
+                return None
+            finally:
+                metrics.observe("ai_text", time.monotonic() - ai_start)
+
+        # reply token 已用於 K 線圖，AI 文字一律以 push 補送
+        # ASYNC_MODE：Gemini 呼叫在 run_blocking 的執行緒池執行，排在同聊天室的 K 線圖之後，不佔用事件執行緒
+        if not ASYNC_MODE:
+            msgs = build_ai_text()
+            if msgs: push(msgs)
+            return
+        push_async = lambda msgs: line_bot_api.push_message_async(get_target_id(event), msgs)
+        submit_within_budget(get_chat_id(event), 'ai_text', partial(run_blocking, build_ai_text), push_async, push_async)
         return
 
 if __name__ == "__main__":
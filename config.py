@@ -1,5 +1,6 @@
 
 import os
+import tempfile
 
 # --- 設定區 ---
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
@@ -7,7 +8,193 @@ LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 FUGLE_API_KEY = os.environ.get('FUGLE_API_KEY')
 TARGET_ID = os.environ.get('MY_USER_ID', '')
-BOT_USER_ID = None
+# 機器人的 user_id (判斷是否被標記)；未設定時於啟動時透過 get_bot_info 取得
+BOT_USER_ID = os.environ.get('BOT_USER_ID') or None
+
+# --- 上游服務網址 (可改指向自架服務，或 tools/loadtest 的 stub) ---
+LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me').rstrip('/')
+QUICKCHART_URL = os.environ.get('QUICKCHART_URL', 'https://quickchart.io').rstrip('/')
+FINDRATE_URL = os.environ.get('FINDRATE_URL', 'https://www.findrate.tw').rstrip('/')
+TWSE_MIS_URL = os.environ.get('TWSE_MIS_URL', 'https://mis.twse.com.tw').rstrip('/')
+TWSE_OPENAPI_URL = os.environ.get('TWSE_OPENAPI_URL', 'https://openapi.twse.com.tw').rstrip('/')
+TPEX_OPENAPI_URL = os.environ.get('TPEX_OPENAPI_URL', 'https://www.tpex.org.tw/openapi').rstrip('/')
+FUGLE_API_URL = os.environ.get('FUGLE_API_URL', 'https://api.fugle.tw').rstrip('/')
+# 設定時 Gemini 改用 REST 並連到此位址 (預設為官方 gRPC 端點)
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT') or None
+
+# --- LINE API 連線 ---
+LINE_CONNECT_TIMEOUT = float(os.environ.get('LINE_CONNECT_TIMEOUT', '3'))
+LINE_API_TIMEOUT = float(os.environ.get('LINE_API_TIMEOUT', '10'))
+LINE_POOL_SIZE = int(os.environ.get('LINE_POOL_SIZE', '32'))
+# 使用者名稱快取 (問候儀表板)
+PROFILE_CACHE_MAX = int(os.environ.get('PROFILE_CACHE_MAX', '1000'))
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', '3600'))
+
+# --- 快取 / 盤後預熱 ---
+# 多個 gunicorn worker 共用的本機資料夾 (Render 可掛載 Persistent Disk)
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'line_finance_bot'))
+# 快取後端: memory (行程內) / sqlite (同機器 worker 共用) / redis (Redis 相容服務)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory').lower()
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# 每個行程所有記憶體快取合計的上限 (MB，依估算大小)，超過時優先淘汰「重新抓取成本 / 大小」最低的資料；0 代表不限制
+CACHE_MEMORY_BUDGET_MB = float(os.environ.get('CACHE_MEMORY_BUDGET_MB', '128'))
+# 行程內快取寫入磁碟快照的間隔秒數 (重啟 / 休眠喚醒後直接載入)，0 代表只在結束時寫入
+CACHE_SNAPSHOT_INTERVAL = int(os.environ.get('CACHE_SNAPSHOT_INTERVAL', '300'))
+# 固定預熱的自選清單 (逗號分隔)，會與近期熱門查詢合併
+PREFETCH_WATCHLIST = [s.strip().upper() for s in os.environ.get('PREFETCH_WATCHLIST', '2330,0050,2317,2454').split(',') if s.strip()]
+PREFETCH_TOP_N = int(os.environ.get('PREFETCH_TOP_N', '20'))
+PREFETCH_LOOKBACK_DAYS = int(os.environ.get('PREFETCH_LOOKBACK_DAYS', '7'))
+
+# 盤中 (資料仍在變動時) 日線、圖表等快取秒數；收盤 / 休市時一律快取到下次開盤 (utils.market_calendar)
+LIVE_CACHE_TTL = int(os.environ.get('LIVE_CACHE_TTL', '60'))
+
+# 證交所本益比/殖利率 (BWIBBU) 盤後公布時間 (台北時間 HH:MM)，之後才會嘗試更新
+TWSE_STATS_PUBLISH_TIME = os.environ.get('TWSE_STATS_PUBLISH_TIME', '16:00')
+
+# 全市場日線 (上市 + 上櫃 OHLCV，np.memmap 欄位檔，所有 worker 唯讀共用)，由排程的 panel 工作每日附加
+PANEL_DIR = os.environ.get('PANEL_DIR', os.path.join(CACHE_DIR, 'ohlcv'))
+# 保留的交易日數
+PANEL_MAX_DAYS = int(os.environ.get('PANEL_MAX_DAYS', '500'))
+# 全市場技術指標使用的最近交易日數 (約 6 個月，與個股 AI 分析一致)
+PANEL_INDICATOR_ROWS = int(os.environ.get('PANEL_INDICATOR_ROWS', '120'))
+
+# --- 並行抓取 ---
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', '16'))
+# 上市/上櫃探測專用的執行緒池 (探測常在 fanout 的工作中被呼叫，不能等待同一個池)
+FANOUT_PROBE_WORKERS = int(os.environ.get('FANOUT_PROBE_WORKERS', '8'))
+# 巢狀 fan_out (fanout 的工作裡再並行抓取) 專用的執行緒池
+FANOUT_NESTED_WORKERS = int(os.environ.get('FANOUT_NESTED_WORKERS', '8'))
+FETCH_DEADLINE = float(os.environ.get('FETCH_DEADLINE', '8'))
+# 可捨棄的附加資料 (e.g. 本益比/殖利率) 最多等待秒數
+OPTIONAL_FETCH_DEADLINE = float(os.environ.get('OPTIONAL_FETCH_DEADLINE', '1.5'))
+
+# --- 回覆期限 (reply token 只在短時間內有效) ---
+# 指令在 REPLY_BUDGET 秒內未完成，先回覆部分結果，完整結果再以 push 補送
+REPLY_BUDGET = float(os.environ.get('REPLY_BUDGET', '4'))
+# 個別指令的預算，格式: "stock_chart=6,tw_quote=3"；也可指定類別 ai / chart / quote (e.g. "chart=6")
+REPLY_BUDGETS = {
+    k.strip(): float(v) for k, v in
+    (item.split('=') for item in os.environ.get('REPLY_BUDGETS', '').split(',') if '=' in item)
+}
+# 沒有部分結果可先回覆時，最多等到此秒數就改用 push
+REPLY_TOKEN_DEADLINE = float(os.environ.get('REPLY_TOKEN_DEADLINE', '20'))
+COMMAND_MAX_WORKERS = int(os.environ.get('COMMAND_MAX_WORKERS', '16'))
+# 同時處理的 webhook 事件數 (同一聊天室仍依序處理)
+EVENT_MAX_WORKERS = int(os.environ.get('EVENT_MAX_WORKERS', '8'))
+# 已處理的 webhookEventId 保留秒數與上限 (LINE 重送時直接略過)
+EVENT_DEDUPE_TTL = int(os.environ.get('EVENT_DEDUPE_TTL', '3600'))
+EVENT_DEDUPE_MAX = int(os.environ.get('EVENT_DEDUPE_MAX', '20000'))
+
+# --- asyncio 模式 ---
+# 開啟後查價 / 匯率 / 走勢圖指令交給共用事件迴圈 (aiohttp)，webhook worker 立即返回，
+# 單一行程可同時處理數百個等待上游回應的指令
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'false').lower() in ('1', 'true', 'yes')
+ASYNC_HTTP_LIMIT = int(os.environ.get('ASYNC_HTTP_LIMIT', '100'))
+ASYNC_HTTP_TIMEOUT = float(os.environ.get('ASYNC_HTTP_TIMEOUT', '10'))
+# 沒有 async 版本的呼叫 (yfinance) 使用的執行緒數
+ASYNC_BLOCKING_WORKERS = int(os.environ.get('ASYNC_BLOCKING_WORKERS', '64'))
+
+# --- CPU 密集工作的程序池 ---
+# 大型 HTML 表格解析、批次技術指標、長歷史的圖表設定改在子程序計算，不佔用 worker 的 GIL
+# 每個子程序會多佔用數十 MB 記憶體，預設 0 (不啟用，全部在原執行緒計算)
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', '0'))
+# 低於門檻的工作直接計算 (搬移資料的成本高於省下的時間)
+CPU_OFFLOAD_MIN_ROWS = int(os.environ.get('CPU_OFFLOAD_MIN_ROWS', '2000'))
+CPU_OFFLOAD_MIN_HTML = int(os.environ.get('CPU_OFFLOAD_MIN_HTML', '100000'))
+CPU_TASK_TIMEOUT = float(os.environ.get('CPU_TASK_TIMEOUT', '30'))
+
+# --- 台股報價來源路由 ---
+# 可用的來源與無統計資料時的優先順序: fugle (需 FUGLE_API_KEY) / mis (證交所基本市況) / yahoo / fake (本機假資料)
+QUOTE_PROVIDERS = [s.strip().lower() for s in os.environ.get('QUOTE_PROVIDERS', 'fugle,mis,yahoo').split(',') if s.strip()]
+# 第一個來源超過其 p95 延遲仍未回應時，同時向下一個來源查詢 (取先回來的結果)
+QUOTE_HEDGE = os.environ.get('QUOTE_HEDGE', 'true').lower() in ('1', 'true', 'yes')
+QUOTE_HEDGE_MIN_SAMPLES = int(os.environ.get('QUOTE_HEDGE_MIN_SAMPLES', '20'))
+# 錯誤率 (EWMA) 超過門檻視為不健康，排到最後；距上次錯誤超過冷卻秒數後再試
+QUOTE_PROVIDER_MAX_ERROR = float(os.environ.get('QUOTE_PROVIDER_MAX_ERROR', '0.5'))
+QUOTE_PROVIDER_COOLDOWN = float(os.environ.get('QUOTE_PROVIDER_COOLDOWN', '30'))
+# 報價來源專用的執行緒池 (Yahoo 來源內部還會用到 fanout，不能與 fanout 共用)
+QUOTE_PROVIDER_WORKERS = int(os.environ.get('QUOTE_PROVIDER_WORKERS', '8'))
+# fake 來源的延遲秒數與錯誤率
+QUOTE_FAKE_LATENCY = float(os.environ.get('QUOTE_FAKE_LATENCY', '0.05'))
+QUOTE_FAKE_ERROR_RATE = float(os.environ.get('QUOTE_FAKE_ERROR_RATE', '0'))
+# 即時報價快取秒數 (LINE 指令與 /api/v1 共用；收盤後快取到下次開盤)
+QUOTE_CACHE_TTL = int(os.environ.get('QUOTE_CACHE_TTL', '5'))
+
+# --- 台股盤中 K 棒 (由輪詢到的即時報價組成，存在 CACHE_DIR/intraday.db，供「即時」走勢圖使用) ---
+INTRADAY_BARS = os.environ.get('INTRADAY_BARS', 'true').lower() in ('1', 'true', 'yes')
+# 盤中以證交所 MIS 批次輪詢近期查詢過的代號的秒數，0 代表只使用查詢時取得的報價
+INTRADAY_POLL_INTERVAL = float(os.environ.get('INTRADAY_POLL_INTERVAL', '10'))
+# 代號最後一次被查詢後持續輪詢的秒數，以及同時保留 K 棒的代號上限
+INTRADAY_ACTIVE_SECONDS = int(os.environ.get('INTRADAY_ACTIVE_SECONDS', '1800'))
+INTRADAY_MAX_SYMBOLS = int(os.environ.get('INTRADAY_MAX_SYMBOLS', '200'))
+
+# --- JSON API (/api/v1) ---
+# 設定後需帶 Authorization: Bearer <token> 或 X-API-Token 標頭
+API_TOKEN = os.environ.get('API_TOKEN', '')
+# 一次查詢的代號 / 幣別上限 (以逗號分隔)
+API_BATCH_MAX = int(os.environ.get('API_BATCH_MAX', '20'))
+# 前面有幾層會附加 X-Forwarded-For 的反向代理 (Render 為 1)；0 = 直接連線，不採用 X-Forwarded-For (用戶端可任意偽造)
+API_TRUSTED_PROXIES = int(os.environ.get('API_TRUSTED_PROXIES', '0'))
+
+# --- 效能剖析 (預設關閉) ---
+# off / sample (堆疊取樣，輸出 collapsed stack) / cprofile (輸出 .pstats)
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off').lower()
+# 剖析的事件比例 (0~1)
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', '0.05'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+# 取樣間隔秒數
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+# 設定後 webhook 請求可帶 X-Profile: sample|cprofile 與 X-Profile-Token 強制剖析該次事件
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+# 只保留耗時達此秒數的事件，以及最新的 N 個檔案
+PROFILE_MIN_SECONDS = float(os.environ.get('PROFILE_MIN_SECONDS', '0'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+
+# --- 昂貴指令配額 (token bucket，容量/補滿秒數) ---
+# 類別: ai (AI 分析) / chart (走勢圖) / quote (報價) / api、api_chart (公開 API)；範圍: user / chat / global
+QUOTA_LIMITS = {
+    'ai': {'user': (3, 600), 'chat': (5, 600), 'global': (60, 3600)},
+    'chart': {'user': (10, 60), 'chat': (20, 60), 'global': (120, 60)},
+    'quote': {'user': (30, 60), 'chat': (60, 60), 'global': (600, 60)},
+    # 公開的 /api/v1 (未設定 API_TOKEN 時)：依來源 IP 與獨立的全域額度，不佔用 LINE 指令的額度
+    'api': {'user': (60, 60), 'global': (300, 60)},
+    'api_chart': {'user': (5, 60), 'global': (30, 60)}
+}
+# 覆寫格式: "ai.user=5/600,chart.global=200/60"，容量為 0 代表不限制
+for _item in os.environ.get('QUOTAS', '').split(','):
+    if '=' not in _item: continue
+    _name, _limit = _item.split('=', 1)
+    _cls, _, _scope = _name.strip().partition('.')
+    _capacity, _, _period = _limit.partition('/')
+    if float(_capacity) > 0:
+        QUOTA_LIMITS.setdefault(_cls, {})[_scope] = (float(_capacity), float(_period or 60))
+    else:
+        QUOTA_LIMITS.get(_cls, {}).pop(_scope, None)
+
+# --- AI 分析 ---
+# 支撐 / 壓力與圖表標線一律由規則引擎計算；此設定決定是否再附上 Gemini 的文字分析
+AI_ANALYSIS_TEXT = os.environ.get('AI_ANALYSIS_TEXT', 'true').lower() in ('1', 'true', 'yes')
+
+# --- 個人自選清單 ---
+# 使用者資料，建議指向 Persistent Disk
+WATCHLIST_DB = os.environ.get('WATCHLIST_DB', os.path.join(CACHE_DIR, 'watchlists.db'))
+WATCHLIST_MAX = int(os.environ.get('WATCHLIST_MAX', '10'))
+# 儀表板共用快照的更新間隔秒數
+DASHBOARD_REFRESH = int(os.environ.get('DASHBOARD_REFRESH', '60'))
+
+# --- 內建排程 (取代外部 cron，多個 worker 只有一個會執行) ---
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 格式: "名稱@HH:MM/行事曆"，以逗號分隔 (時間為台北時間)
+# 名稱: prefetch / panel / vix / report / forex:KRW ...；行事曆: tw (台股交易日) / us (美股前一交易時段有開盤) / daily
+# 預設只有盤後預熱與全市場日線；推播報告 (vix / report / forex:*) 需自行加入 (e.g. ",vix@18:00/us")
+PUSH_SCHEDULE = os.environ.get('PUSH_SCHEDULE', 'prefetch@14:30/tw,panel@16:30/tw')
+# 推播報告提前產生的秒數，以及預先產生的報告可沿用的秒數
+REPORT_PREBUILD_LEAD = int(os.environ.get('REPORT_PREBUILD_LEAD', '600'))
+REPORT_MAX_AGE = int(os.environ.get('REPORT_MAX_AGE', '3600'))
+# 同一份報告在此秒數內不重複推送 (排程與外部 cron 同時存在時)
+REPORT_RESEND_GUARD = int(os.environ.get('REPORT_RESEND_GUARD', '1800'))
+# 台股額外休市日 (YYYY-MM-DD，逗號分隔)，e.g. 農曆春節、補假、颱風假
+TW_MARKET_HOLIDAYS = [s.strip() for s in os.environ.get('TW_MARKET_HOLIDAYS', '').split(',') if s.strip()]
 
 # --- 支援的幣別代碼清單 ---
 VALID_CURRENCIES = [
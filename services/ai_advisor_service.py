@@ -1,6 +1,6 @@
 import google.generativeai as genai
 from google.api_core.exceptions import ResourceExhausted
-from config import GEMINI_API_KEY
+from config import GEMINI_API_KEY, GEMINI_API_ENDPOINT
 
 def get_ai_stock_analysis(symbol, stock_name, indicators):
     """
@@ -14,7 +14,10 @@ def get_ai_stock_analysis(symbol, stock_name, indicators):
         return "❌ 無法取得技術指標數據，請稍後再試。"
 
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=GEMINI_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=GEMINI_API_KEY)
         
         # 嘗試使用不同的模型名稱 (優先使用 2.5 系列)
         model_names = ['gemini-2.5-flash', 'gemini-2.5-pro', 'gemini-1.5-flash', 'gemini-pro']
@@ -1,18 +1,45 @@
 
+import json
+from functools import partial
 import requests
 import yfinance as yf
+from config import QUICKCHART_URL, CPU_OFFLOAD_MIN_ROWS
+from utils.cache_backend import make_cache
 from utils.common import get_greeting # Optional if used or not
+from utils.market_calendar import tw_cache_ttl, market_ttl, fx_chart_window
+from utils import async_http, process_pool
 
-def generate_forex_chart_url_yf(currency_code, period="1d", interval="15m"):
+CHART_CREATE_URL = f"{QUICKCHART_URL}/chart/create"
+
+# QuickChart 短網址約 3 天後失效，快取時間不可超過
+CHART_URL_MAX_TTL = 70 * 3600
+
+def _chart_ttu(key, value, now):
+    interval = key[2]
+    return now + min(tw_cache_ttl(interval), CHART_URL_MAX_TTL)
+
+# 已產生的台股圖表網址 (盤後會快取到下次開盤)
+chart_cache = make_cache('stock_chart', maxsize=128, ttu=_chart_ttu)
+
+def _forex_chart_ttu(key, value, now):
+    interval = key[2]
+    return now + min(market_ttl('fx', interval), CHART_URL_MAX_TTL)
+
+# 已產生的匯率走勢圖網址 (週末休市時快取到開盤)
+forex_chart_cache = make_cache('forex_chart', maxsize=64, ttu=_forex_chart_ttu)
+
+def build_forex_chart_payload(currency_code, period="1d", interval="15m"):
     """
-    產生匯率走勢圖
+    匯率走勢圖的 QuickChart 設定 (含抓取歷史資料)，無資料回傳 None
+    週末休市時直接改抓最近 5 日 (fx_chart_window)，不先試抓空的 1d
     """
     try:
         symbol = f"{currency_code}TWD=X"
         ticker = yf.Ticker(symbol)
+        period, interval = fx_chart_window(period, interval)
         data = ticker.history(period=period, interval=interval)
         
-        # Fallback 1: 1d 沒資料 -> 抓 5d
+        # Fallback 1: 1d 沒資料 (行事曆未涵蓋的休市日，e.g. 聖誕節) -> 抓 5d
         if data.empty and period == '1d':
             period = '5d'
             interval = '60m'
@@ -73,58 +100,140 @@ def generate_forex_chart_url_yf(currency_code, period="1d", interval="15m"):
             }
         }
         
-        url = "https://quickchart.io/chart/create"
-        payload = {
+        return {
             "chart": chart_config,
             "width": 800,
             "height": 600,
             "backgroundColor": "white",
             "version": "2.9.4"
         }
-        
-        response = requests.post(url, json=payload, headers={'Content-Type': 'application/json'})
-        if response.status_code == 200:
-            return response.json().get('url')
-        else:
-            return None
             
     except Exception as e:
         print(f"Chart Error: {e}")
         return None
 
-def generate_stock_chart_url_yf(symbol, period="1d", interval="15m", chart_type="line", stock_name=None, annotations=None):
+def create_chart(payload):
+    """送出 QuickChart 設定，回傳圖表短網址 (失敗回傳 None)"""
+    try:
+        response = requests.post(CHART_CREATE_URL, json=payload, headers={'Content-Type': 'application/json'})
+        if response.status_code == 200:
+            return response.json().get('url')
+        print(f"QuickChart Error: {response.text}")
+    except Exception as e:
+        print(f"QuickChart Error: {e}")
+    return None
+
+async def create_chart_async(payload):
+    """create_chart 的 async 版本 (共用 aiohttp 連線池)"""
+    try:
+        response = await async_http.request('POST', CHART_CREATE_URL, name='quickchart', json=payload)
+        if response.status == 200:
+            return response.json().get('url')
+        print(f"QuickChart Error: {response.text}")
+    except Exception as e:
+        print(f"QuickChart Error: {e}")
+    return None
+
+def generate_forex_chart_url_yf(currency_code, period="1d", interval="15m"):
+    """
+    產生匯率走勢圖
+    """
+    cache_key = (currency_code, period, interval)
+    chart_url = forex_chart_cache.get(cache_key)
+    if chart_url: return chart_url
+    payload = build_forex_chart_payload(currency_code, period, interval)
+    chart_url = create_chart(payload) if payload else None
+    if chart_url: forex_chart_cache[cache_key] = chart_url
+    return chart_url
+
+async def generate_forex_chart_url_async(currency_code, period="1d", interval="15m"):
+    """generate_forex_chart_url_yf 的 async 版本 (共用圖表快取；yfinance 在執行緒池執行)"""
+    cache_key = (currency_code, period, interval)
+    chart_url = forex_chart_cache.get(cache_key)
+    if chart_url: return chart_url
+    payload = await async_http.run_blocking(build_forex_chart_payload, currency_code, period, interval)
+    chart_url = await create_chart_async(payload) if payload else None
+    if chart_url: forex_chart_cache[cache_key] = chart_url
+    return chart_url
+
+def _display_name(symbol, stock_name, looked_up):
+    # 查詢不到中文名稱時 (名稱即代號) 只顯示代號
+    if looked_up and stock_name == symbol: return symbol
+    return f"{symbol} {stock_name}"
+
+def _chart_cache_key(symbol, period, interval, chart_type, display_name, annotations):
+    return (symbol, period, interval, chart_type, display_name,
+            json.dumps(annotations, sort_keys=True, default=str) if annotations else None)
+
+def generate_stock_chart_url_yf(symbol, period="1d", interval="15m", chart_type="line", stock_name=None, annotations=None, suffix=None):
     """
     產生台股走勢圖 (自動判斷上市/上櫃)
     chart_type: 'line' (折線圖), 'candlestick' (K線圖), 'bar' (交易量)
     annotations: dict, e.g. {'support': 1000, 'resistance': 1100}
+    suffix: 呼叫端已判斷過的後綴 ('.TW' / '.TWO')，提供時不再重複探測
     """
     # Import locally to avoid circular import if stock_service imports this
-    # But here we need get_stock_name...
-    # Better: Pass full stock name as argument from controller
-    # Or import stock_service inside function
     from services.stock_service import get_stock_name, get_valid_stock_obj
 
     # 如果沒有提供中文名稱，嘗試取得
-    if not stock_name:
-        stock_name = get_stock_name(symbol)
-        if stock_name == symbol:
-            display_name = symbol
-        else:
-            display_name = f"{symbol} {stock_name}"
-    else:
-        display_name = f"{symbol} {stock_name}"
-    try:
-        # 判斷是上市還是上櫃
+    display_name = _display_name(symbol, stock_name or get_stock_name(symbol), looked_up=not stock_name)
+    cache_key = _chart_cache_key(symbol, period, interval, chart_type, display_name, annotations)
+    cached_url = chart_cache.get(cache_key)
+    if cached_url: return cached_url
+
+    # 判斷是上市還是上櫃
+    if not suffix:
         stock, info, suffix = get_valid_stock_obj(symbol)
         if not stock: return None
-        
-        full_symbol = symbol + suffix
-        ticker = yf.Ticker(full_symbol)
-        
-        data = ticker.history(period=period, interval=interval)
-        
-        if data.empty: return None
 
+    payload = build_stock_chart_payload(symbol, suffix, period, interval, chart_type, display_name, annotations)
+    chart_url = create_chart(payload) if payload else None
+    if chart_url: chart_cache[cache_key] = chart_url
+    return chart_url
+
+async def generate_stock_chart_url_async(symbol, period="1d", interval="15m", chart_type="line", stock_name=None, annotations=None, suffix=None):
+    """generate_stock_chart_url_yf 的 async 版本 (共用圖表快取；yfinance 在執行緒池執行)"""
+    from services.stock_service import get_stock_name_async, get_valid_stock_obj_async
+
+    display_name = _display_name(symbol, stock_name or await get_stock_name_async(symbol), looked_up=not stock_name)
+    cache_key = _chart_cache_key(symbol, period, interval, chart_type, display_name, annotations)
+    cached_url = chart_cache.get(cache_key)
+    if cached_url: return cached_url
+
+    if not suffix:
+        stock, info, suffix = await get_valid_stock_obj_async(symbol)
+        if not stock: return None
+
+    payload = await async_http.run_blocking(build_stock_chart_payload, symbol, suffix, period, interval,
+                                            chart_type, display_name, annotations)
+    chart_url = await create_chart_async(payload) if payload else None
+    if chart_url: chart_cache[cache_key] = chart_url
+    return chart_url
+
+def build_stock_chart_payload(symbol, suffix, period, interval, chart_type, display_name, annotations=None):
+    """
+    台股圖表的 QuickChart 設定 (含抓取歷史 K 線)，無資料回傳 None
+    長歷史 (CPU_OFFLOAD_MIN_ROWS 筆以上) 且啟用程序池時，設定在子程序產生
+    """
+    from services.stock_service import get_stock_history
+    from services import intraday_service
+
+    try:
+        data = None
+        if period == '1d':
+            # 「即時」走勢：本機盤中 K 棒，只有開始記錄前的早盤向 Yahoo 補抓
+            data = intraday_service.session_frame(symbol, interval, partial(get_stock_history, symbol + suffix, period, interval))
+        if data is None: data = get_stock_history(symbol + suffix, period, interval)
+        if data is None or data.empty: return None
+        return process_pool.run_frame(stock_chart_payload, data, symbol, period, interval, chart_type,
+                                      display_name, annotations, threshold=CPU_OFFLOAD_MIN_ROWS, name='stock_chart')
+    except Exception as e:
+        print(f"Stock Chart Error: {e}")
+        return None
+
+def stock_chart_payload(data, symbol, period, interval, chart_type, display_name, annotations=None):
+    """由 K 線產生台股圖表的 QuickChart 設定 (純計算，可在程序池執行)"""
+    try:
         version = '2.9.4' # default
         
         # Build Annotation Plugin Config
@@ -348,22 +457,13 @@ def generate_stock_chart_url_yf(symbol, period="1d", interval="15m", chart_type=
                 }
              }
 
-        # 發送 Request
-        url = "https://quickchart.io/chart/create"
-        payload = {
+        return {
             "chart": chart_config,
             "width": 800,
             "height": 600,
             "backgroundColor": "white",
             "version": version
         }
-        
-        response = requests.post(url, json=payload, headers={'Content-Type': 'application/json'})
-        if response.status_code == 200:
-            return response.json().get('url')
-        else:
-            print(f"QuickChart Error: {response.text}")
-            return None
             
     except Exception as e:
         print(f"Stock Chart Error: {e}")
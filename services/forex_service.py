@@ -3,10 +3,85 @@ import requests
 import pandas as pd
 import io
 import yfinance as yf
-from cachetools import cached, TTLCache
+from cachetools import cached
+from cachetools.keys import hashkey
+from config import FINDRATE_URL, CPU_OFFLOAD_MIN_HTML
+from utils.cache_backend import make_cache
+from utils.market_calendar import market_ttl
+from utils import async_http, process_pool
 
 # Cache Settings
-rate_cache = TTLCache(maxsize=30, ttl=300)
+# 銀行營業時間內 5 分鐘，其餘時間快取到下個營業日 9:00；抓取失敗 (空清單 / 錯誤訊息) 只快取 1 分鐘
+def _rate_ttu(key, value, now):
+    if not value or isinstance(value, str): return now + 60
+    return now + market_ttl('tw_bank', live_ttl=300)
+
+rate_cache = make_cache('bank_rates', maxsize=30, ttu=_rate_ttu)
+# 即時匯率：盤中 30 秒，週末休市時快取到開盤
+forex_cache = make_cache('forex_info', maxsize=50, ttu=lambda key, value, now: now + market_ttl('fx', live_ttl=30))
+
+FINDRATE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+def _parse_bank_rates(html, currency_code):
+    """從比率網頁面取出各銀行匯率 (依現鈔賣出由低到高，最多 10 筆)"""
+    # 使用 io.StringIO 包裝
+    html_buffer = io.StringIO(html)
+    dfs = pd.read_html(html_buffer)
+    
+    target_df = None
+    for df in dfs:
+        cols_str = str(df.columns)
+        if "現鈔賣出" in cols_str: 
+             target_df = df
+             break
+    
+    if target_df is None:
+        for df in dfs:
+            if len(df.columns) >= 5 and "銀行" in str(df.columns):
+                target_df = df
+                break
+    
+    if target_df is None:
+        return f"找不到 {currency_code} 的匯率表格，可能該網站未提供。"
+
+    bank_rates = []
+    
+    for i in range(len(target_df)):
+        try:
+            row = target_df.iloc[i]
+            bank_name = str(row.iloc[0]).strip()
+            cash_selling = str(row.iloc[2]).strip()
+            spot_selling = str(row.iloc[4]).strip()
+            update_time = str(row.iloc[5]).strip()
+
+            if bank_name in ["銀行名稱", "銀行", "幣別"]: continue
+            if cash_selling == '--' and spot_selling == '--': continue
+            if len(bank_name) > 20: continue
+
+            rate_val = 9999.0
+            try: rate_val = float(cash_selling)
+            except: 
+                try: rate_val = float(spot_selling)
+                except: pass
+            
+            bank_rates.append({
+                "bank": bank_name,
+                "cash_selling": cash_selling,
+                "spot_selling": spot_selling,
+                "rate_sort": rate_val,
+                "time": update_time
+            })
+        except: continue
+
+    bank_rates.sort(key=lambda x: x['rate_sort'])
+    return bank_rates[:10]
+
+def parse_bank_rates(html, currency_code):
+    """頁面較大時 (CPU_OFFLOAD_MIN_HTML 字元以上) 在程序池解析，read_html 不佔用 worker 的 GIL"""
+    return process_pool.run(_parse_bank_rates, html, currency_code, size=len(html),
+                            threshold=CPU_OFFLOAD_MIN_HTML, name='bank_rates')
 
 @cached(rate_cache)
 def get_taiwan_bank_rates(currency_code="HKD"):
@@ -14,73 +89,40 @@ def get_taiwan_bank_rates(currency_code="HKD"):
     從比率網 (FindRate) 抓取台灣各家銀行的「現鈔賣出」匯率
     """
     try:
-        url = f"https://www.findrate.tw/{currency_code}/"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
+        response = requests.get(f"{FINDRATE_URL}/{currency_code}/", headers=FINDRATE_HEADERS)
         response.encoding = 'utf-8' 
-        
-        # 使用 io.StringIO 包裝
-        html_buffer = io.StringIO(response.text)
-        dfs = pd.read_html(html_buffer)
-        
-        target_df = None
-        for df in dfs:
-            cols_str = str(df.columns)
-            if "現鈔賣出" in cols_str: 
-                 target_df = df
-                 break
-        
-        if target_df is None:
-            for df in dfs:
-                if len(df.columns) >= 5 and "銀行" in str(df.columns):
-                    target_df = df
-                    break
-        
-        if target_df is None:
-            return f"找不到 {currency_code} 的匯率表格，可能該網站未提供。"
-
-        bank_rates = []
-        
-        for i in range(len(target_df)):
-            try:
-                row = target_df.iloc[i]
-                bank_name = str(row.iloc[0]).strip()
-                cash_selling = str(row.iloc[2]).strip()
-                spot_selling = str(row.iloc[4]).strip()
-                update_time = str(row.iloc[5]).strip()
-
-                if bank_name in ["銀行名稱", "銀行", "幣別"]: continue
-                if cash_selling == '--' and spot_selling == '--': continue
-                if len(bank_name) > 20: continue
-
-                rate_val = 9999.0
-                try: rate_val = float(cash_selling)
-                except: 
-                    try: rate_val = float(spot_selling)
-                    except: pass
-                
-                bank_rates.append({
-                    "bank": bank_name,
-                    "cash_selling": cash_selling,
-                    "spot_selling": spot_selling,
-                    "rate_sort": rate_val,
-                    "time": update_time
-                })
-            except: continue
-
-        bank_rates.sort(key=lambda x: x['rate_sort'])
-        return bank_rates[:10]
-        
+        return parse_bank_rates(response.text, currency_code)
     except Exception as e:
         print(f"Scrape Error: {e}")
         return []
-        
+
+async def get_taiwan_bank_rates_async(currency_code="HKD"):
+    """get_taiwan_bank_rates 的 async 版本 (共用快取；表格解析不在事件迴圈上進行)"""
+    key = hashkey(currency_code)
+    report = rate_cache.get(key)
+    if report is not None: return report
+    try:
+        response = await async_http.request('GET', f"{FINDRATE_URL}/{currency_code}/", name='findrate',
+                                            headers=FINDRATE_HEADERS)
+        html = response.content.decode('utf-8', errors='replace')
+        report = await async_http.run_blocking(parse_bank_rates, html, currency_code)
     except Exception as e:
-        return f"查詢失敗: {str(e)[:100]}..."
+        print(f"Scrape Error: {e}")
+        return []
+    rate_cache[key] = report
+    return report
+
+rate_cache.refresher = lambda key: get_taiwan_bank_rates(*key)
 
 def get_forex_info(currency_code):
+    key = hashkey(currency_code)
+    info = forex_cache.get(key)
+    if info is not None: return info
+    info = _fetch_forex_info(currency_code)
+    if info is not None: forex_cache[key] = info
+    return info
+
+def _fetch_forex_info(currency_code):
     try:
         symbol = f"{currency_code}TWD=X"
         ticker = yf.Ticker(symbol)
@@ -105,3 +147,8 @@ def get_forex_info(currency_code):
         print(f"Forex Info Error: {e}")
         return None
 
+forex_cache.refresher = lambda key: get_forex_info(*key)
+
+async def get_forex_info_async(currency_code):
+    """get_forex_info 的 async 版本 (yfinance 沒有 async 介面，在執行緒池執行)"""
+    return await async_http.run_blocking(get_forex_info, currency_code)
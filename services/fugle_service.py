@@ -1,75 +1,105 @@
-
 import requests
 import time
-from config import FUGLE_API_KEY
+import threading
+from config import FUGLE_API_KEY, FUGLE_API_URL
+from utils import async_http
 
-# Rate Limiting: 60 requests per minute
+# Rate Limiting: 60 requests per minute (同步與 async 版本共用)
 _req_count = 0
 _window_start = 0
+_rate_lock = threading.Lock()
 
-def get_realtime_quote(symbol):
+def _acquire():
+    """取得一次請求額度，超過每分鐘上限回傳 False"""
+    global _req_count, _window_start
+
+    with _rate_lock:
+        # Check Rate Limit
+        now = time.time()
+        if now - _window_start > 60:
+            # Reset window
+            _window_start = now
+            _req_count = 0
+
+        if _req_count >= 58: # Buffer: 設定 58 讓它稍微保守一點 (官方限 60)
+            print(f"[Warn] Fugle API Rate Limit Reached ({_req_count}/60). Fallback to Yahoo.")
+            return False
+
+        _req_count += 1
+        return True
+
+def _quote_url(symbol):
+    return f"{FUGLE_API_URL}/marketdata/v1.0/stock/intraday/quote/{symbol}"
+
+def fetch_quote(symbol):
     """
     從 Fugle API 取得個股即時報價 (含 Rate Limiting)
     API: https://api.fugle.tw/marketdata/v1.0/stock/intraday/quote/{symbol}
+    未設定金鑰、超過額度或查無代號回傳 None；連線錯誤與其他 HTTP 錯誤直接拋出 (供報價路由統計錯誤率)
     """
-    global _req_count, _window_start
-
     if not FUGLE_API_KEY:
         # print("[Debug] FUGLE_API_KEY not found.") # Reduce noise
         return None
 
-    # Check Rate Limit
-    now = time.time()
-    if now - _window_start > 60:
-        # Reset window
-        _window_start = now
-        _req_count = 0
-    
-    if _req_count >= 58: # Buffer: 設定 58 讓它稍微保守一點 (官方限 60)
-        print(f"[Warn] Fugle API Rate Limit Reached ({_req_count}/60). Fallback to Yahoo.")
-        return None
+    if not _acquire(): return None
 
-    _req_count += 1
+    url = _quote_url(symbol)
+    headers = {
+        "X-API-KEY": FUGLE_API_KEY
+    }
+    r = requests.get(url, headers=headers, timeout=5)
+    if r.status_code == 404: return None
+    if r.status_code != 200:
+        raise requests.HTTPError(f"Fugle API Error: {r.status_code} - {r.text[:200]}")
+    data = r.json()
+    # Fugle API Response Structure:
+    # {
+    #   "date": "2024-01-27",
+    #   "type": "EQUITY",
+    #   "exchange": "TWSE",
+    #   "market": "TSE",
+    #   "symbol": "2330",
+    #   "name": "台積電",
+    #   "referencePrice": 644,
+    #   "previousClose": 644,
+    #   ...
+    #   "total": {
+    #     "tradeValue": 12345678,
+    #     "tradeVolume": 12345, # Shares
+    #     "tradeVolumeAtBid": ...
+    #   },
+    #   "lastTrade": {
+    #     "price": 648,
+    #     "size": 1,
+    #     "time": "13:30:00"
+    #   },
+    #   "prices": [ ... ],
+    #   ...
+    # }
+    return data
 
+def get_realtime_quote(symbol):
+    """fetch_quote 的容錯版本，任何錯誤都回傳 None"""
     try:
-        url = f"https://api.fugle.tw/marketdata/v1.0/stock/intraday/quote/{symbol}"
-        headers = {
-            "X-API-KEY": FUGLE_API_KEY
-        }
-        r = requests.get(url, headers=headers, timeout=5)
-        
-        if r.status_code == 200:
-            data = r.json()
-            # Fugle API Response Structure:
-            # {
-            #   "date": "2024-01-27",
-            #   "type": "EQUITY",
-            #   "exchange": "TWSE",
-            #   "market": "TSE",
-            #   "symbol": "2330",
-            #   "name": "台積電",
-            #   "referencePrice": 644,
-            #   "previousClose": 644,
-            #   ...
-            #   "total": {
-            #     "tradeValue": 12345678,
-            #     "tradeVolume": 12345, # Shares
-            #     "tradeVolumeAtBid": ...
-            #   },
-            #   "lastTrade": {
-            #     "price": 648,
-            #     "size": 1,
-            #     "time": "13:30:00"
-            #   },
-            #   "prices": [ ... ],
-            #   ...
-            # }
-            
-            return data
-        else:
-            print(f"[Debug] Fugle API Error: {r.status_code} - {r.text}")
-            return None
+        return fetch_quote(symbol)
+    except Exception as e:
+        print(f"[Debug] Fugle Service Error: {e}")
+        return None
+
+async def fetch_quote_async(symbol):
+    """fetch_quote 的 async 版本 (共用 aiohttp 連線池與 Rate Limiting)"""
+    if not FUGLE_API_KEY or not _acquire(): return None
 
+    r = await async_http.request('GET', _quote_url(symbol), name='fugle',
+                                 headers={"X-API-KEY": FUGLE_API_KEY}, timeout=5)
+    if r.status == 404: return None
+    if r.status != 200: raise requests.HTTPError(f"Fugle API Error: {r.status} - {r.text[:200]}")
+    return r.json()
+
+async def get_realtime_quote_async(symbol):
+    """get_realtime_quote 的 async 版本"""
+    try:
+        return await fetch_quote_async(symbol)
     except Exception as e:
         print(f"[Debug] Fugle Service Error: {e}")
         return None
@@ -1,5 +1,9 @@
 import pandas as pd
 import numpy as np
+from utils.cache_backend import make_cache
+from utils.market_calendar import market_ttl, symbol_market
+from utils import process_pool
+from config import CPU_OFFLOAD_MIN_ROWS, PANEL_INDICATOR_ROWS
 
 def calculate_technical_indicators(df):
     """
@@ -88,3 +92,133 @@ def get_latest_indicators(df):
     except Exception as e:
         print(f"[Debug] Error getting latest indicators: {e}")
         return None
+
+def _latest_indicators_all(frames):
+    return {key: get_latest_indicators(df) for key, df in frames.items()}
+
+def _latest_indicators_shared(spec, keys):
+    # 在程序池的子程序執行：從共享記憶體取回 K 線後計算
+    return _latest_indicators_all(process_pool.load_frames(spec, keys))
+
+def get_latest_indicators_batch(frames):
+    """
+    多檔個股同時計算最新指標，frames: {key: DataFrame} -> {key: 指標 dict 或 None}
+    總列數達 CPU_OFFLOAD_MIN_ROWS 且啟用程序池時分批在子程序計算 (K 線經共享記憶體傳遞)
+    """
+    return process_pool.map_frames(_latest_indicators_shared, frames, _latest_indicators_all,
+                                   name='indicators', threshold=CPU_OFFLOAD_MIN_ROWS)
+
+def _indicator_ttu(key, value, now):
+    full_symbol, period, interval = key
+    return now + market_ttl(symbol_market(full_symbol), interval)
+
+indicator_cache = make_cache('indicators', maxsize=64, ttu=_indicator_ttu)
+
+def get_symbol_indicators(full_symbol, period="6mo", interval="1d"):
+    """
+    取得個股最新技術指標 (歷史資料與計算結果皆有快取)，供 AI 分析與盤後預熱共用
+    """
+    key = (full_symbol, period, interval)
+    indicators = indicator_cache.get(key)
+    if indicators is not None: return indicators
+
+    from services.stock_service import get_stock_history
+    df = get_stock_history(full_symbol, period, interval)
+    if df is None or df.empty: return None
+
+    indicators = get_latest_indicators(df)
+    if indicators: indicator_cache[key] = indicators
+    return indicators
+
+indicator_cache.refresher = lambda key: get_symbol_indicators(*key)
+
+def get_symbols_indicators(full_symbols, period="6mo", interval="1d"):
+    """
+    get_symbol_indicators 的批次版本 (e.g. 盤後預熱、選股)，回傳 {full_symbol: 指標}
+    已快取的直接使用，其餘取得歷史資料後一次計算並寫回快取
+    """
+    from services.stock_service import get_stock_history
+
+    results, frames = {}, {}
+    for full_symbol in full_symbols:
+        key = (full_symbol, period, interval)
+        indicators = indicator_cache.get(key)
+        if indicators is not None:
+            results[full_symbol] = indicators
+            continue
+        df = get_stock_history(full_symbol, period, interval)
+        if df is not None and not df.empty: frames[full_symbol] = df
+
+    for full_symbol, indicators in get_latest_indicators_batch(frames).items():
+        if indicators: indicator_cache[(full_symbol, period, interval)] = indicators
+        results[full_symbol] = indicators
+    return results
+
+# --- 全市場技術指標 (services.market_panel_service 的 memmap 日線) ---
+
+PANEL_CHUNK = 500
+
+def _panel_latest(close, volume):
+    """寬表 (日期 x 代號) 版本的 calculate_technical_indicators + get_latest_indicators，只回傳最後一天"""
+    prev_close = close.iloc[-2] if len(close) > 1 else close.iloc[-1]
+    delta = close.diff()
+    gain = delta.where(delta > 0, 0).rolling(window=14).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
+    macd_line = close.ewm(span=12, adjust=False).mean() - close.ewm(span=26, adjust=False).mean()
+    signal_line = macd_line.ewm(span=9, adjust=False).mean()
+    ma20 = close.rolling(window=20).mean()
+    std20 = close.rolling(window=20).std()
+    last = lambda frame: frame.iloc[-1]
+    return pd.DataFrame({
+        "close": last(close),
+        "change": last(close) - prev_close,
+        "change_percent": (last(close) - prev_close) / prev_close * 100,
+        "rsi": last(100 - (100 / (1 + gain / loss))),
+        "macd": last(macd_line),
+        "macd_hist": last(macd_line - signal_line),
+        "macd_signal": last(signal_line),
+        "ma_5": last(close.rolling(window=5).mean()),
+        "ma_20": last(ma20),
+        "ma_60": last(close.rolling(window=60).mean()),
+        "bb_upper": last(ma20 + std20 * 2),
+        "bb_lower": last(ma20 - std20 * 2),
+        "volume_delta": volume.iloc[-1] - (volume.iloc[-2] if len(volume) > 1 else volume.iloc[-1])
+    })
+
+def calculate_panel_indicators(panel, rows=PANEL_INDICATOR_ROWS, codes=None):
+    """
+    全市場 (或指定代號) 最後一個交易日的技術指標，公式與 calculate_technical_indicators 相同
+    直接取 memmap 最後 rows 天的視圖，每次計算 PANEL_CHUNK 檔，暫存記憶體只有數 MB
+    停牌日沿用前一日收盤；回傳 DataFrame (index: 代號，欄位同 get_latest_indicators)
+    """
+    if codes is None:
+        chunks = [slice(i, i + PANEL_CHUNK) for i in range(0, len(panel.codes), PANEL_CHUNK)]
+    else:
+        codes = [c for c in codes if c in panel.index]
+        chunks = [codes[i:i + PANEL_CHUNK] for i in range(0, len(codes), PANEL_CHUNK)]
+    results = []
+    for chunk in chunks:
+        close = panel.field('close', rows, chunk).astype(np.float64).ffill()
+        volume = panel.field('volume', rows, chunk).astype(np.float64)
+        results.append(_panel_latest(close, volume))
+    if not results: return pd.DataFrame()
+    return pd.concat(results).dropna(subset=['close'])
+
+def _market_indicator_ttu(key, value, now):
+    return now + market_ttl('tw')
+
+# 以面板的世代與更新時間為 key，面板更新後自然換成新的結果
+market_indicator_cache = make_cache('market_indicators', maxsize=2, ttu=_market_indicator_ttu)
+
+def get_market_indicators():
+    """全市場最新技術指標 (DataFrame，index 為代號)，面板尚未建立回傳 None"""
+    from services.market_panel_service import get_panel
+
+    panel = get_panel()
+    if panel is None: return None
+    key = (panel.generation, panel.updated_at, PANEL_INDICATOR_ROWS)
+    indicators = market_indicator_cache.get(key)
+    if indicators is not None: return indicators
+    indicators = calculate_panel_indicators(panel)
+    market_indicator_cache[key] = indicators
+    return indicators
@@ -0,0 +1,304 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from config import (
+    CACHE_DIR, INTRADAY_BARS, INTRADAY_POLL_INTERVAL, INTRADAY_ACTIVE_SECONDS, INTRADAY_MAX_SYMBOLS
+)
+from utils import metrics
+from utils.market_calendar import TW_TZ, TW_OPEN, TW_CLOSE, TW_SETTLE, now_taipei, is_tw_trading_day, latest_tw_publish
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 台股盤中 1 分 / 5 分 K 棒
+# - 由已取得的即時報價 (Fugle lastTrade / 證交所 MIS 最近成交價) 組成，5 分 K 由 1 分 K 合併
+# - 存在 CACHE_DIR/intraday.db (SQLite WAL)，所有 worker 讀寫同一份
+# - 成交量為累計成交量的差值；同一分鐘內多次報價更新該分鐘的高低收
+# - 沒有最近成交的報價 (MIS 以買賣中間價代替) 不寫入 K 棒，只記為「有在觀察」
+# - 近期被查詢過的代號在盤中以 MIS 批次輪詢 (一次請求查詢全部)，多個 worker 以 CACHE_DIR/intraday.lock 選出一個輪詢
+# - 每個代號記錄有在觀察的時段 (spans)；「即時」走勢圖以本機 K 棒繪製，
+#   開始記錄前的早盤與停止輪詢後的空檔才向 Yahoo 補抓
+
+DB_PATH = os.path.join(CACHE_DIR, 'intraday.db')
+LOCK_PATH = os.path.join(CACHE_DIR, 'intraday.lock')
+
+BAR_SECONDS = 60
+BAR_INTERVALS = {'1m': 1, '5m': 5}
+# 兩次觀察 (報價 / 輪詢) 相隔超過此秒數視為中斷，中間的時段要向 Yahoo 補抓
+GAP_SECONDS = max(BAR_SECONDS, 3 * INTRADAY_POLL_INTERVAL)
+# 補抓的 Yahoo 資料仍未涵蓋缺口時 (Yahoo 延遲)，隔多久再補抓一次
+BACKFILL_RETRY = 120
+# 每次 MIS 請求查詢的代號數 (網址長度限制)
+POLL_BATCH = 50
+# 同一個代號多久內的重複查詢不再更新最後查詢時間
+TOUCH_INTERVAL = 30
+PRUNE_EVERY = 500
+
+_local = threading.local()
+_lock = threading.Lock()
+_touched = {}       # symbol -> 最近一次寫入 last_request 的時間
+_backfill = {}      # (symbol, interval, 交易日) -> (Yahoo K 線, 抓取時間)
+_op_count = 0
+_poller = None
+_lock_file = None
+
+
+def _conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # 盤中資料可由 Yahoo 補回，不需每次寫入都 fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS series (symbol TEXT PRIMARY KEY, session TEXT, cum_volume INTEGER, last_request REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS bars (symbol TEXT, minute INTEGER, open REAL, high REAL, low REAL, close REAL, '
+                     'volume INTEGER, PRIMARY KEY (symbol, minute)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS spans (symbol TEXT, start_at REAL, end_at REAL, PRIMARY KEY (symbol, start_at)) WITHOUT ROWID')
+        _local.conn = conn
+    return conn
+
+def _session_time(now):
+    """報價所屬的交易日與 K 棒時間 (收盤後的最後成交歸到 13:30)，不在交易時段回傳 None"""
+    if not is_tw_trading_day(now.date()) or not (TW_OPEN <= now.time() < TW_SETTLE): return None
+    close = TW_TZ.localize(datetime.combine(now.date(), TW_CLOSE))
+    return now.date(), min(now, close).timestamp()
+
+def touch(symbol):
+    """標記代號近期被查詢 (盤中會持續輪詢)"""
+    if not INTRADAY_BARS: return
+    now = time.time()
+    if now - _touched.get(symbol, 0) >= TOUCH_INTERVAL:
+        if len(_touched) > 1000: _touched.clear()
+        _touched[symbol] = now
+        try:
+            _conn().execute('INSERT INTO series (symbol, last_request) VALUES (?, ?) '
+                            'ON CONFLICT(symbol) DO UPDATE SET last_request = excluded.last_request', (symbol, now))
+        except sqlite3.Error as e:
+            print(f"[Debug] Intraday touch failed for {symbol}: {e}")
+    _start_poller()
+
+def _record(conn, symbol, session, ts, price, cum_volume):
+    """在交易中寫入一筆觀察：延長 / 新增觀察時段，有成交價時更新該分鐘的 K 棒"""
+    row = conn.execute('SELECT session, cum_volume FROM series WHERE symbol = ?', (symbol,)).fetchone()
+    prev_volume = row[1] if row else None
+    if row is None or row[0] != session:
+        # 新的交易日：清掉前一日的 K 棒
+        conn.execute('DELETE FROM bars WHERE symbol = ?', (symbol,))
+        conn.execute('DELETE FROM spans WHERE symbol = ?', (symbol,))
+        conn.execute('INSERT INTO series (symbol, session, last_request) VALUES (?, ?, 0) '
+                     'ON CONFLICT(symbol) DO UPDATE SET session = excluded.session, cum_volume = NULL', (symbol, session))
+        prev_volume = None
+
+    span = conn.execute('SELECT start_at, end_at FROM spans WHERE symbol = ? ORDER BY start_at DESC LIMIT 1', (symbol,)).fetchone()
+    if span and ts - span[1] <= GAP_SECONDS:
+        if ts > span[1]: conn.execute('UPDATE spans SET end_at = ? WHERE symbol = ? AND start_at = ?', (ts, symbol, span[0]))
+    elif not span or ts > span[1]:
+        conn.execute('INSERT OR REPLACE INTO spans VALUES (?, ?, ?)', (symbol, ts, ts))
+
+    if price is None: return
+    volume = 0
+    if cum_volume is not None:
+        if prev_volume is not None: volume = max(cum_volume - prev_volume, 0)
+        conn.execute('UPDATE series SET cum_volume = ? WHERE symbol = ?', (max(cum_volume, prev_volume or 0), symbol))
+    minute = int(ts // BAR_SECONDS * BAR_SECONDS)
+    last = conn.execute('SELECT MAX(minute) FROM bars WHERE symbol = ?', (symbol,)).fetchone()[0]
+    if last == minute:
+        conn.execute('UPDATE bars SET high = MAX(high, ?), low = MIN(low, ?), close = ?, volume = volume + ? '
+                     'WHERE symbol = ? AND minute = ?', (price, price, price, volume, symbol, minute))
+    elif last is None or last < minute:
+        conn.execute('INSERT INTO bars VALUES (?, ?, ?, ?, ?, ?, ?)', (symbol, minute, price, price, price, price, volume))
+
+def record_many(observations, now=None):
+    """
+    在同一個交易中寫入多筆觀察 [(symbol, price, cum_volume)]，不在交易時段的略過
+    price 為 None 代表有查到但沒有最近成交 (只延長觀察時段)
+    """
+    global _op_count
+    if not INTRADAY_BARS or not observations: return
+    at = _session_time(now or now_taipei())
+    if at is None: return
+    session, ts = at[0].isoformat(), at[1]
+    try:
+        conn = _conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for symbol, price, cum_volume in observations:
+                _record(conn, symbol, session, ts, None if price is None else float(price), cum_volume)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        print(f"[Debug] Intraday record failed: {e}")
+        return
+    _op_count += 1
+    if _op_count % PRUNE_EVERY == 0: _prune()
+
+def record(symbol, price, cum_volume=None, now=None):
+    """加入一筆即時報價 (cum_volume 為當日累計成交股數)，不在交易時段的報價略過"""
+    if price is None: return
+    record_many([(symbol, price, cum_volume)], now)
+
+def _observation(quote):
+    """get_stock_info 格式的報價 -> (symbol, 成交價, 累計成交量)，只採用 Fugle / MIS (Yahoo 的台股報價有延遲)"""
+    if not quote or quote.get('source') not in ('fugle', 'mis'): return None
+    if quote.get('last_trade') is False: return quote['symbol'], None, None
+    return quote['symbol'], quote['price'], quote.get('volume')
+
+def record_quote(quote, now=None):
+    """get_stock_info 格式的報價 (沒有最近成交的 MIS 報價只記為有在觀察)"""
+    observation = _observation(quote)
+    if observation: record_many([observation], now)
+
+def _prune():
+    """只保留最近查詢的 INTRADAY_MAX_SYMBOLS 個代號"""
+    try:
+        conn = _conn()
+        conn.execute('DELETE FROM series WHERE symbol NOT IN (SELECT symbol FROM series ORDER BY last_request DESC LIMIT ?)',
+                     (INTRADAY_MAX_SYMBOLS,))
+        conn.execute('DELETE FROM bars WHERE symbol NOT IN (SELECT symbol FROM series)')
+        conn.execute('DELETE FROM spans WHERE symbol NOT IN (SELECT symbol FROM series)')
+    except sqlite3.Error as e:
+        print(f"[Debug] Intraday prune failed: {e}")
+
+def get_bars(symbol, interval='1m'):
+    """本機 K 棒 (DataFrame，欄位同 yfinance：Open / High / Low / Close / Volume，index 為台北時間)，沒有資料回傳 None"""
+    try:
+        bars = _conn().execute('SELECT minute, open, high, low, close, volume FROM bars WHERE symbol = ? ORDER BY minute',
+                               (symbol,)).fetchall()
+    except sqlite3.Error as e:
+        print(f"[Debug] Intraday read failed for {symbol}: {e}")
+        return None
+    if not bars: return None
+    df = pd.DataFrame(bars, columns=['Time', 'Open', 'High', 'Low', 'Close', 'Volume'])
+    df.index = pd.to_datetime(df.pop('Time'), unit='s', utc=True).dt.tz_convert(TW_TZ)
+    df.index.name = None
+    minutes = BAR_INTERVALS[interval]
+    if minutes == 1: return df
+    return df.resample(f'{minutes}min', label='left', closed='left').agg(
+        {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}).dropna(subset=['Close'])
+
+def _gaps(symbol, day, now):
+    """交易日 day 從開盤到目前 (或收盤) 之間沒有觀察到的時段 [(開始, 結束)]，epoch 秒"""
+    spans = _conn().execute('SELECT start_at, end_at FROM spans WHERE symbol = ? ORDER BY start_at', (symbol,)).fetchall()
+    covered = TW_TZ.localize(datetime.combine(day, TW_OPEN)).timestamp()
+    # 含 13:30 收盤那一根
+    end = TW_TZ.localize(datetime.combine(day, TW_CLOSE)).timestamp() + BAR_SECONDS
+    if day == now.date(): end = min(end, now.timestamp())
+    gaps = []
+    for start_at, end_at in spans:
+        if start_at > covered: gaps.append((covered, start_at))
+        covered = max(covered, end_at)
+    if end - covered > GAP_SECONDS: gaps.append((covered, end))
+    return gaps
+
+def session_frame(symbol, interval, backfill):
+    """
+    「即時」走勢圖的資料：本機 K 棒，沒有觀察到的時段 (開始記錄前的早盤、停止輪詢後的空檔)
+    以 backfill() 回傳的 Yahoo 同 interval K 線補上 (與缺口重疊的 K 棒整根改用 Yahoo)
+    不支援的 interval、沒有本機 K 棒或 K 棒不是最近一個交易時段時回傳 None (呼叫端改用 Yahoo)
+    """
+    if not INTRADAY_BARS or interval not in BAR_INTERVALS: return None
+    touch(symbol)
+    local = get_bars(symbol, interval)
+    if local is None: return None
+
+    now = now_taipei()
+    day = local.index[0].date()
+    # 只剩之前交易日的 K 棒 (今天尚未記錄到) 時不可當成今天的走勢
+    if day != latest_tw_publish(TW_OPEN, now).date(): return None
+    try: gaps = _gaps(symbol, day, now)
+    except sqlite3.Error as e:
+        print(f"[Debug] Intraday read failed for {symbol}: {e}")
+        return None
+    metrics.incr("intraday.chart_local")
+    if not gaps: return local
+
+    step = pd.Timedelta(minutes=BAR_INTERVALS[interval])
+    gaps = [(pd.Timestamp(a, unit='s', tz='UTC').tz_convert(TW_TZ), pd.Timestamp(b, unit='s', tz='UTC').tz_convert(TW_TZ))
+            for a, b in gaps]
+    key = (symbol, interval, day)
+    early, fetched_at = _backfill.get(key, (None, 0))
+    covered = early is not None and not early.empty and early.index[-1] + step >= gaps[-1][1]
+    if not covered and time.time() - fetched_at > BACKFILL_RETRY:
+        metrics.incr("intraday.backfill")
+        try:
+            df = backfill()
+        except Exception as e:
+            print(f"[Debug] Intraday backfill failed for {symbol}: {e}")
+            df = None
+        if df is not None and not df.empty:
+            df = df[['Open', 'High', 'Low', 'Close', 'Volume']]
+            df.index = df.index.tz_convert(TW_TZ)
+            in_gap = np.zeros(len(df), dtype=bool)
+            for a, b in gaps: in_gap |= (df.index < b) & (df.index + step > a)
+            early = df[in_gap]
+        with _lock:
+            if len(_backfill) > 2 * INTRADAY_MAX_SYMBOLS: _backfill.clear()
+            _backfill[key] = (early, time.time())
+
+    if early is None or early.empty: return local
+    return pd.concat([early, local[~local.index.isin(early.index)]]).sort_index()
+
+def poll_once():
+    """以 MIS 批次請求 (每次 POLL_BATCH 檔) 更新所有近期被查詢過的代號，回傳更新的代號數"""
+    from services.stock_service import get_mis_quotes
+
+    cutoff = time.time() - INTRADAY_ACTIVE_SECONDS
+    symbols = [row[0] for row in _conn().execute(
+        'SELECT symbol FROM series WHERE last_request >= ? ORDER BY last_request DESC LIMIT ?',
+        (cutoff, INTRADAY_MAX_SYMBOLS))]
+    updated = 0
+    for i in range(0, len(symbols), POLL_BATCH):
+        quotes = get_mis_quotes(symbols[i:i + POLL_BATCH])
+        record_many([o for o in map(_observation, quotes.values()) if o])
+        updated += len(quotes)
+    return updated
+
+def _is_poller():
+    """多個 worker 以 LOCK_PATH 選出一個輪詢 (同 scheduler)，該 worker 結束後其他 worker 會接手"""
+    global _lock_file
+    if _lock_file is not None: return True
+    if fcntl is None:
+        _lock_file = True
+        return True
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    f = open(LOCK_PATH, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    _lock_file = f
+    print(f"[Intraday] Worker {os.getpid()} is polling MIS.")
+    return True
+
+def _poll_loop():
+    while True:
+        time.sleep(INTRADAY_POLL_INTERVAL)
+        if _session_time(now_taipei()) is None or not _is_poller(): continue
+        try:
+            poll_once()
+        except Exception as e:
+            print(f"[Debug] Intraday poll failed: {e}")
+
+def _start_poller():
+    global _poller
+    if _poller or INTRADAY_POLL_INTERVAL <= 0: return
+    with _lock:
+        if _poller: return
+        _poller = threading.Thread(target=_poll_loop, name='intraday-poller', daemon=True)
+        _poller.start()
+
+def _symbol_count():
+    try: return _conn().execute('SELECT COUNT(*) FROM series').fetchone()[0]
+    except sqlite3.Error: return 0
+
+metrics.register_gauge("intraday.symbols", _symbol_count)
@@ -0,0 +1,171 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 規則式支撐 / 壓力 (取代 Gemini 成為圖表標線的來源，毫秒級完成)
+# 候選價位：轉折高低點 (pivot)、成交量密集區 (volume profile)、布林通道上下軌、月線 / 季線
+# 相近的候選價位 (ATR 的一半以內) 合併成一區，依權重與距離挑出最近的支撐與壓力
+# 回傳格式與 get_ai_stock_analysis 相同，AI 文字分析只是附加內容
+
+PIVOT_WINDOW = 3        # 左右各 N 根 K 棒內的最高 / 最低點視為轉折
+PROFILE_BINS = 24       # 成交量分佈的價格區間數
+PROFILE_QUANTILE = 0.75 # 成交量高於此分位數的區間視為密集區
+MAX_DISTANCE = 0.15     # 只考慮距離現價 15% 以內的價位
+DISTANCE_PENALTY = 5    # 權重 / (1 + 距離% * N)，越近越優先
+
+
+def _pivots(high, low, k=PIVOT_WINDOW):
+    """轉折高點與低點的索引"""
+    w = 2 * k + 1
+    if len(high) < w: return np.array([], dtype=int), np.array([], dtype=int)
+    hmax = sliding_window_view(high, w).max(axis=1)
+    lmin = sliding_window_view(low, w).min(axis=1)
+    highs = np.nonzero(high[k:len(high) - k] == hmax)[0] + k
+    lows = np.nonzero(low[k:len(low) - k] == lmin)[0] + k
+    return highs, lows
+
+def _volume_nodes(high, low, close, volume, bins=PROFILE_BINS):
+    """成交量密集區的中心價位與佔總量比例"""
+    if not np.nansum(volume): return np.array([]), np.array([])
+    typical = (high + low + close) / 3
+    hist, edges = np.histogram(typical, bins=bins, weights=volume)
+    share = hist / hist.sum()
+    # 沒有成交的區間 (價格集中時大多數區間) 不算密集區
+    mask = (share > 0) & (share >= np.quantile(share, PROFILE_QUANTILE))
+    return ((edges[:-1] + edges[1:]) / 2)[mask], share[mask]
+
+def _atr(high, low, close, n=14):
+    prev_close = np.concatenate(([close[0]], close[:-1]))
+    tr = np.maximum(high - low, np.maximum(np.abs(high - prev_close), np.abs(low - prev_close)))
+    return float(np.mean(tr[-n:]))
+
+def _candidates(high, low, close, volume):
+    """(價位, 權重, 來源) 陣列"""
+    n = len(close)
+    prices, weights, sources = [], [], []
+
+    def add(p, w, label):
+        p = np.atleast_1d(np.asarray(p, dtype=float))
+        prices.append(p)
+        weights.append(np.broadcast_to(np.asarray(w, dtype=float), p.shape))
+        sources.extend([label] * len(p))
+
+    # 轉折點：越近期權重越高 (1 ~ 2)
+    highs, lows = _pivots(high, low)
+    add(high[highs], 1 + highs / n, '前波高點')
+    add(low[lows], 1 + lows / n, '前波低點')
+
+    # 成交量密集區：依佔比換算 (最高 2)
+    nodes, share = _volume_nodes(high, low, close, volume)
+    if len(nodes): add(nodes, 2 * share / share.max(), '成交密集區')
+
+    # 布林通道與均線 (最後一筆)
+    if n >= 20:
+        window = close[-20:]
+        ma20, std20 = window.mean(), window.std(ddof=1)
+        add(ma20 + 2 * std20, 1.0, '布林上軌')
+        add(ma20 - 2 * std20, 1.0, '布林下軌')
+        add(ma20, 1.5, '月線')
+    if n >= 60:
+        add(close[-60:].mean(), 1.5, '季線')
+
+    if not prices: return np.array([]), np.array([]), []
+    return np.concatenate(prices), np.concatenate(weights), sources
+
+def _clusters(prices, weights, sources, tol):
+    """由低到高，與該區最低價差在 tol 以內的候選價位合併，回傳 [(加權平均價, 總權重, 來源)]"""
+    if not len(prices): return []
+    order = np.argsort(prices)
+    prices, weights = prices[order], weights[order]
+    sources = [sources[i] for i in order]
+    groups, start = [[0]], prices[0]
+    for i in range(1, len(prices)):
+        if prices[i] - start > tol:
+            groups.append([])
+            start = prices[i]
+        groups[-1].append(i)
+
+    clusters = []
+    for idx in groups:
+        w = weights[idx]
+        if w.sum() <= 0: continue
+        labels = list(dict.fromkeys(sources[i] for i in idx))
+        clusters.append((float(np.average(prices[idx], weights=w)), float(w.sum()), labels))
+    return clusters
+
+def _pick(clusters, close, below):
+    """現價下方 (支撐) 或上方 (壓力) 分數最高的一區"""
+    best, best_score = None, 0
+    for price, weight, labels in clusters:
+        distance = (close - price) / close if below else (price - close) / close
+        if distance <= 0 or distance > MAX_DISTANCE: continue
+        score = weight / (1 + distance * 100 / DISTANCE_PENALTY)
+        if score > best_score: best, best_score = (price, labels), score
+    return best
+
+def _round_price(price):
+    """依價位高低保留小數位數"""
+    if price is None: return None
+    if price >= 1000: return int(round(price))
+    return round(price, 2 if price < 100 else 1)
+
+def compute_levels(df):
+    """
+    由 OHLCV 計算支撐 / 壓力與趨勢
+    回傳與 get_ai_stock_analysis 相同格式的字典，資料不足時回傳 None
+    """
+    if df is None or len(df) < 2 * PIVOT_WINDOW + 1: return None
+    df = df.sort_index()
+    high = df['High'].to_numpy(dtype=float)
+    low = df['Low'].to_numpy(dtype=float)
+    close = df['Close'].to_numpy(dtype=float)
+    volume = df['Volume'].to_numpy(dtype=float) if 'Volume' in df else np.zeros(len(close))
+    valid = ~(np.isnan(high) | np.isnan(low) | np.isnan(close))
+    high, low, close, volume = high[valid], low[valid], close[valid], np.nan_to_num(volume[valid])
+    if len(close) < 2 * PIVOT_WINDOW + 1: return None
+
+    last = close[-1]
+    tol = max(_atr(high, low, close) * 0.5, last * 0.005)
+    clusters = _clusters(*_candidates(high, low, close, volume), tol)
+    support = _pick(clusters, last, below=True)
+    resistance = _pick(clusters, last, below=False)
+
+    # 趨勢：收盤與月線、季線的相對位置
+    ma20 = close[-20:].mean() if len(close) >= 20 else None
+    ma60 = close[-60:].mean() if len(close) >= 60 else None
+    if ma20 and last > ma20 and (ma60 is None or ma20 > ma60):
+        sentiment, trend = '看多', '收盤站上月線，均線多頭排列' if ma60 else '收盤站上月線'
+    elif ma20 and last < ma20 and (ma60 is None or ma20 < ma60):
+        sentiment, trend = '看空', '收盤跌破月線，均線空頭排列' if ma60 else '收盤跌破月線'
+    else:
+        sentiment, trend = '盤整', '均線糾結，方向未明'
+
+    support_price = _round_price(support[0]) if support else None
+    resistance_price = _round_price(resistance[0]) if resistance else None
+
+    if sentiment == '看多':
+        action = f"拉回 {support_price} 附近守穩可留意" if support_price else "沿月線偏多操作"
+    elif sentiment == '看空':
+        action = f"反彈至 {resistance_price} 附近留意賣壓" if resistance_price else "跌破前低前保守觀望"
+    else:
+        action = "區間操作，"
+        action += f"{support_price} ~ {resistance_price} 之間來回" if support_price and resistance_price else "等待方向確認"
+
+    reasons = [trend]
+    if support: reasons.append(f"支撐來自{'、'.join(support[1])}")
+    if resistance: reasons.append(f"壓力來自{'、'.join(resistance[1])}")
+    reason = '；'.join(reasons)
+
+    lines = [f"📊 趨勢：{sentiment} ({trend})"]
+    lines.append(f"🟢 支撐：{support_price} ({'、'.join(support[1])})" if support else "🟢 支撐：近期無明顯支撐")
+    lines.append(f"🔴 壓力：{resistance_price} ({'、'.join(resistance[1])})" if resistance else "🔴 壓力：近期無明顯壓力")
+    lines.append(f"💡 操作：{action}")
+    lines.append("⚠️ 依技術指標規則計算，僅供參考")
+
+    return {
+        "sentiment": sentiment,
+        "support_price": support_price,
+        "resistance_price": resistance_price,
+        "action": action,
+        "reason": reason,
+        "formatted_text": "\n".join(lines)
+    }
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import requests
+from config import TWSE_OPENAPI_URL, TPEX_OPENAPI_URL, PANEL_DIR, PANEL_MAX_DAYS
+from utils.common import is_tw_stock_symbol
+from utils.market_calendar import TW_SETTLE, latest_tw_publish, parse_openapi_date
+from utils.fanout import fan_out
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 全市場 (上市 + 上櫃) 日線 OHLCV 的欄位式儲存
+# - 每個欄位一個固定寬度的 np.memmap 檔 (float32 / int64)，shape = (日期容量, 代號容量)，
+#   一列為一個交易日，每日附加只寫入一列
+# - meta.json 記錄代號 / 日期索引與目前的世代 (generation)；容量不足或日期需要插入時寫成新世代，
+#   舊世代刪除後已開啟的 memmap 仍可讀到關閉為止
+# - 所有 worker 以唯讀 memmap 開啟 (共用 OS page cache，不複製)，meta 變動時才重新開啟
+# - 只有一個 worker 會寫入 (CACHE_DIR 下的檔案鎖)，資料來源為證交所 STOCK_DAY_ALL 與櫃買中心 OpenAPI
+
+STOCK_DAY_ALL_URL = f"{TWSE_OPENAPI_URL}/v1/exchangeReport/STOCK_DAY_ALL"
+TPEX_DAILY_URL = f"{TPEX_OPENAPI_URL}/v1/tpex_mainboard_daily_close_quotes"
+META_PATH = os.path.join(PANEL_DIR, 'meta.json')
+LOCK_PATH = os.path.join(PANEL_DIR, 'panel.lock')
+
+FIELDS = {'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32, 'volume': np.int64}
+# 重建時預留的空間 (新上市代號 / 之後的交易日)，用完才需要再重建
+CODE_HEADROOM = 256
+DATE_HEADROOM = 60
+BACKFILL_CHUNK = 100
+# 來源尚未更新到預期交易日 (e.g. 櫃買中心較晚公布) 時，每 10 分鐘重抓該來源，最多 3 小時
+RETRY_INTERVAL = 600
+RETRY_FOR = 3 * 3600
+
+_lock = threading.Lock()
+_panel = None
+_loaded_mtime = None
+last_update = {}
+
+
+class Panel:
+    """
+    唯讀的全市場日線：open / high / low / close / volume 皆為 (日期, 代號) 的 memmap 視圖 (不複製資料)
+    停牌或尚未上市的格子 close 為 NaN、volume 為 0
+    """
+
+    def __init__(self, meta):
+        self.generation = meta['generation']
+        self.updated_at = meta['updated_at']
+        self.codes = meta['codes']
+        self.suffixes = meta['suffixes']
+        self.dates = pd.DatetimeIndex(meta['dates'])
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        shape = (meta['date_capacity'], meta['code_capacity'])
+        n_dates, n_codes = len(self.dates), len(self.codes)
+        for field, dtype in FIELDS.items():
+            data = np.memmap(_field_path(self.generation, field), dtype=dtype, mode='r', shape=shape)
+            setattr(self, field, data[:n_dates, :n_codes])
+
+    def __len__(self):
+        return len(self.dates)
+
+    def full_symbol(self, code):
+        """Yahoo 代號 (e.g. 2330.TW / 6488.TWO)，不在面板中回傳 None"""
+        i = self.index.get(code)
+        return None if i is None else code + self.suffixes[i]
+
+    def field(self, name, rows=None, codes=None):
+        """
+        單一欄位的寬表 (index: 日期，columns: 代號)
+        rows 只取最後 N 個交易日；codes 為 None 或 slice (連續的代號範圍) 時為 memmap 的視圖 (不複製)
+        """
+        data = getattr(self, name)
+        dates = self.dates
+        if rows:
+            data, dates = data[-rows:], dates[-rows:]
+        if codes is None or isinstance(codes, slice):
+            codes = codes or slice(None)
+            return pd.DataFrame(data[:, codes], index=dates, columns=self.codes[codes], copy=False)
+        cols = [self.index[c] for c in codes if c in self.index]
+        return pd.DataFrame(data[:, cols], index=dates, columns=[self.codes[i] for i in cols], copy=False)
+
+    def frame(self, code, rows=None):
+        """單一代號的 OHLCV (欄位同 yfinance 日線，可直接交給 calculate_technical_indicators)，無資料的日期略過"""
+        i = self.index.get(code)
+        if i is None: return None
+        sl = slice(-rows, None) if rows else slice(None)
+        df = pd.DataFrame({
+            'Open': self.open[sl, i], 'High': self.high[sl, i], 'Low': self.low[sl, i],
+            'Close': self.close[sl, i], 'Volume': self.volume[sl, i]
+        }, index=self.dates[sl])
+        return df.dropna(subset=['Close'])
+
+
+def _field_path(generation, field):
+    return os.path.join(PANEL_DIR, str(generation), f"{field}.{np.dtype(FIELDS[field]).name}")
+
+def _read_meta():
+    try:
+        with open(META_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_meta(meta):
+    tmp_path = f"{META_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, separators=(',', ':'))
+    os.replace(tmp_path, META_PATH)
+
+def get_panel():
+    """目前的全市場日線 (meta.json 有變動 (其他 worker 已更新) 才重新開啟)，尚未建立回傳 None"""
+    global _panel, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(META_PATH)
+    except OSError:
+        return None
+    if mtime == _loaded_mtime: return _panel
+
+    with _lock:
+        if mtime == _loaded_mtime: return _panel
+        try:
+            meta = _read_meta()
+            _panel = Panel(meta) if meta and meta['dates'] else None
+            _loaded_mtime = mtime
+            if _panel:
+                print(f"[Debug] OHLCV panel loaded: {len(_panel.codes)} codes x {len(_panel)} days "
+                      f"(generation {_panel.generation}, last {_panel.dates[-1].date()})")
+        except Exception as e:
+            print(f"[Debug] Error loading OHLCV panel: {e}")
+        return _panel
+
+
+# --- 資料來源 ---
+
+def _number(value):
+    """OpenAPI 的數字字串 (含千分位，無成交為 '--' / '----' / '') 轉成 float，無資料為 NaN"""
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return float('nan')
+
+def _daily_rows(items, suffix, keys):
+    """OpenAPI 的每日收盤行情 -> (日期, {code: (open, high, low, close, volume, suffix)})"""
+    code_key, open_key, high_key, low_key, close_key, volume_key = keys
+    rows, day = {}, None
+    for item in items:
+        code = str(item.get(code_key, '')).strip()
+        if not is_tw_stock_symbol(code): continue
+        if day is None and item.get('Date'): day = parse_openapi_date(item['Date'])
+        volume = _number(item.get(volume_key))
+        rows[code] = (_number(item.get(open_key)), _number(item.get(high_key)), _number(item.get(low_key)),
+                      _number(item.get(close_key)), 0 if np.isnan(volume) else int(volume), suffix)
+    return day, rows
+
+def fetch_twse_daily():
+    """證交所上市個股當日收盤行情 (STOCK_DAY_ALL)"""
+    r = requests.get(STOCK_DAY_ALL_URL, timeout=20)
+    r.raise_for_status()
+    return _daily_rows(r.json(), '.TW', ('Code', 'OpeningPrice', 'HighestPrice', 'LowestPrice', 'ClosingPrice', 'TradeVolume'))
+
+def fetch_tpex_daily():
+    """櫃買中心上櫃個股當日收盤行情"""
+    r = requests.get(TPEX_DAILY_URL, timeout=20)
+    r.raise_for_status()
+    return _daily_rows(r.json(), '.TWO', ('SecuritiesCompanyCode', 'Open', 'High', 'Low', 'Close', 'TradingShares'))
+
+SOURCES = {"twse": fetch_twse_daily, "tpex": fetch_tpex_daily}
+
+def expected_trading_day(now=None):
+    """盤後行情應該是哪一天：收盤資料定案 (TW_SETTLE) 後為當天，否則 (含休市日) 為前一個交易日"""
+    return latest_tw_publish(TW_SETTLE, now).date()
+
+
+# --- 寫入 (只有持有檔案鎖的 worker 執行) ---
+
+def _open_fields(generation, shape, mode):
+    return {field: np.memmap(_field_path(generation, field), dtype=dtype, mode=mode, shape=shape)
+            for field, dtype in FIELDS.items()}
+
+def _write_cells(maps, row, cols, values, overwrite):
+    """將一個交易日的資料寫入 (row, cols)；overwrite=False 時只填入原本沒有資料的格子"""
+    values = np.array([v[:5] for v in values], dtype=np.float64)
+    if not overwrite:
+        empty = np.isnan(maps['close'][row, cols])
+        cols, values = cols[empty], values[empty]
+    for i, field in enumerate(FIELDS):
+        maps[field][row, cols] = values[:, i]
+
+def _rebuild(meta, days, overwrite):
+    """
+    寫成新世代：合併既有資料與 days ({date: {code: row}})，日期排序後只保留最近 PANEL_MAX_DAYS 天，
+    代號重新排序並預留容量；完成後才更新 meta.json，讀取端看到的一定是完整的一份
+    """
+    old_codes = meta['codes'] if meta else []
+    old_dates = meta['dates'] if meta else []
+    suffixes = dict(zip(old_codes, meta['suffixes'])) if meta else {}
+    for rows in days.values():
+        for code, row in rows.items(): suffixes.setdefault(code, row[5])
+
+    codes = sorted(suffixes)
+    dates = sorted(set(old_dates) | {d.isoformat() for d in days})[-PANEL_MAX_DAYS:]
+    generation = (meta['generation'] + 1) if meta else 1
+    shape = (min(len(dates) + DATE_HEADROOM, PANEL_MAX_DAYS + DATE_HEADROOM), len(codes) + CODE_HEADROOM)
+
+    os.makedirs(os.path.join(PANEL_DIR, str(generation)), exist_ok=True)
+    maps = _open_fields(generation, shape, 'w+')
+    for field, data in maps.items(): data[:] = np.nan if field != 'volume' else 0
+
+    code_index = {code: i for i, code in enumerate(codes)}
+    date_index = {d: i for i, d in enumerate(dates)}
+    if meta:
+        old = _open_fields(meta['generation'], (meta['date_capacity'], meta['code_capacity']), 'r')
+        kept = [(i, date_index[d]) for i, d in enumerate(old_dates) if d in date_index]
+        src_rows = np.array([i for i, _ in kept], dtype=np.intp)
+        dst_rows = np.array([j for _, j in kept], dtype=np.intp)
+        dst_cols = np.array([code_index[c] for c in old_codes], dtype=np.intp)
+        for field in FIELDS:
+            maps[field][np.ix_(dst_rows, dst_cols)] = old[field][src_rows, :len(old_codes)]
+        del old
+
+    for day, rows in days.items():
+        if day.isoformat() not in date_index: continue
+        cols = np.array([code_index[c] for c in rows], dtype=np.intp)
+        _write_cells(maps, date_index[day.isoformat()], cols, list(rows.values()), overwrite)
+    for data in maps.values(): data.flush()
+    del maps
+
+    _write_meta({
+        "generation": generation, "codes": codes, "suffixes": [suffixes[c] for c in codes],
+        "dates": dates, "date_capacity": shape[0], "code_capacity": shape[1], "updated_at": time.time()
+    })
+    # 舊世代 (其他 worker 已開啟的 memmap 在重新載入前仍可讀)
+    for name in os.listdir(PANEL_DIR):
+        if name.isdigit() and int(name) != generation:
+            shutil.rmtree(os.path.join(PANEL_DIR, name), ignore_errors=True)
+    print(f"[Debug] OHLCV panel rebuilt: generation {generation}, {len(codes)} codes x {len(dates)} days.")
+
+def _append(meta, day, rows, overwrite):
+    """
+    在目前世代就地寫入一個交易日 (新的最後一天或已存在的日期)，容量足夠時不需重建
+    回傳 False 代表需要重建
+    """
+    if not meta: return False
+    key = day.isoformat()
+    known = set(meta['codes'])
+    new_codes = [c for c in rows if c not in known]
+    is_new_date = key not in meta['dates']
+    if is_new_date and meta['dates'] and key < meta['dates'][-1]: return False
+    if len(meta['codes']) + len(new_codes) > meta['code_capacity']: return False
+    if is_new_date and len(meta['dates']) + 1 > meta['date_capacity']: return False
+
+    codes = meta['codes'] + new_codes
+    dates = meta['dates'] + [key] if is_new_date else meta['dates']
+    code_index = {code: i for i, code in enumerate(codes)}
+    maps = _open_fields(meta['generation'], (meta['date_capacity'], meta['code_capacity']), 'r+')
+    cols = np.array([code_index[c] for c in rows], dtype=np.intp)
+    _write_cells(maps, dates.index(key), cols, list(rows.values()), overwrite)
+    for data in maps.values(): data.flush()
+    del maps
+
+    _write_meta(dict(meta, codes=codes, suffixes=meta['suffixes'] + [rows[c][5] for c in new_codes],
+                     dates=dates, updated_at=time.time()))
+    return True
+
+def write_days(days, overwrite=True):
+    """
+    寫入多個交易日 {date: {code: (open, high, low, close, volume, suffix)}}
+    只有一個 worker 會實際寫入 (其他 worker 回傳 False)
+    """
+    lock_file = None
+    try:
+        os.makedirs(PANEL_DIR, exist_ok=True)
+        lock_file = open(LOCK_PATH, 'w')
+        if fcntl:
+            try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("[Debug] OHLCV panel update in progress by another worker.")
+                return False
+
+        meta = _read_meta()
+        if len(days) == 1:
+            (day, rows), = days.items()
+            if _append(meta, day, rows, overwrite): return True
+        _rebuild(meta, days, overwrite)
+        return True
+    finally:
+        if lock_file: lock_file.close()
+
+def update_panel(retry_interval=RETRY_INTERVAL, retry_for=RETRY_FOR):
+    """
+    附加最新一個交易日 (上市 + 上櫃同時下載)，由排程於盤後執行
+    只寫入日期為預期交易日 (expected_trading_day) 的來源；仍回傳前一日資料的來源每 retry_interval 秒
+    重抓，最多 retry_for 秒 (該日的格子若空著，計算指標時會沿用前一日收盤，漲跌幅全部變成 0%)
+    到期仍有來源未更新時拋出例外 (排程狀態的 last_error)
+    """
+    start = time.time()
+    expected = expected_trading_day()
+    pending = list(SOURCES)
+    codes = {}
+    while True:
+        fetched = fan_out({source: SOURCES[source] for source in pending})
+        days = {}
+        for source, result in fetched.items():
+            day = result[0] if result else None
+            if day is None or day < expected:
+                print(f"[Debug] OHLCV panel: {source} returned {day or 'no data'}, expected {expected}.")
+                continue
+            days.setdefault(day, {}).update(result[1])
+            codes[source] = len(result[1])
+        if days and write_days(days):
+            pending = [source for source in pending if source not in codes]
+        else:
+            for source in pending: codes.pop(source, None)
+        if not pending or time.time() + retry_interval > start + retry_for: break
+        print(f"[Panel] Waiting for {pending} to publish {expected}, retry in {retry_interval}s.")
+        time.sleep(retry_interval)
+
+    last_update.update({
+        "finished_at": time.time(),
+        "elapsed": round(time.time() - start, 2),
+        "date": expected.isoformat(),
+        "codes": codes,
+        "missing": pending
+    })
+    print(f"[Panel] Updated {expected} ({last_update['codes']}) in {last_update['elapsed']}s.")
+    if pending: raise RuntimeError(f"{', '.join(pending)} not updated to {expected}")
+    return last_update
+
+def backfill_panel(period='6mo', codes=None):
+    """
+    以 Yahoo 日線 (未還原權息) 補齊歷史，只填入原本沒有資料的格子 (官方收盤行情優先)
+    需要先執行過 update_panel 取得代號與上市 / 上櫃別
+    """
+    import yfinance as yf
+
+    panel = get_panel()
+    if panel is None:
+        print("[Debug] OHLCV panel is empty, run update_panel() first.")
+        return 0
+    symbols = [panel.full_symbol(c) for c in (codes or panel.codes) if c in panel.index]
+    days = {}
+    for i in range(0, len(symbols), BACKFILL_CHUNK):
+        chunk = symbols[i:i + BACKFILL_CHUNK]
+        try:
+            df = yf.download(chunk, period=period, interval='1d', group_by='ticker', auto_adjust=False,
+                             threads=True, progress=False)
+        except Exception as e:
+            print(f"[Debug] Backfill download failed for {chunk[0]}..: {e}")
+            continue
+        for symbol in chunk:
+            if symbol not in df.columns.get_level_values(0): continue
+            hist = df[symbol].dropna(subset=['Close'])
+            code, _, suffix = symbol.partition('.')
+            for ts, bar in hist.iterrows():
+                days.setdefault(ts.date(), {})[code] = (
+                    bar['Open'], bar['High'], bar['Low'], bar['Close'], int(bar['Volume'] or 0), '.' + suffix)
+        print(f"[Panel] Backfill downloaded {min(i + BACKFILL_CHUNK, len(symbols))}/{len(symbols)} symbols.")
+    if days: write_days(days, overwrite=False)
+    return len(days)
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from config import CACHE_DIR, CACHE_BACKEND, PREFETCH_WATCHLIST, PREFETCH_TOP_N, PREFETCH_LOOKBACK_DAYS
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 每行一筆 "timestamp symbol"，以 append 寫入讓多個 worker 共用同一份紀錄
+REQUEST_LOG_PATH = os.path.join(CACHE_DIR, 'symbol_requests.log')
+# 寫入與整理 (compact) 紀錄時持有的鎖：整理會以新檔取代舊檔，
+# 沒有鎖時其他 worker 同時 append 到舊檔的紀錄會遺失
+REQUEST_LOCK_PATH = os.path.join(CACHE_DIR, 'symbol_requests.lock')
+
+# 盤後預熱的常用圖表 (與 handle_message 的指令參數一致，才能命中快取)
+PREFETCH_CHARTS = [
+    ('1y', '1d', 'candlestick'),   # 日K
+    ('2y', '1wk', 'candlestick'),  # 週K
+    ('5y', '1mo', 'candlestick'),  # 月K
+    ('1mo', '1d', 'bar'),          # 交易量
+]
+
+_prefetch_lock = threading.Lock()
+last_prefetch = {}
+
+
+@contextmanager
+def _request_log_lock():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(REQUEST_LOCK_PATH, 'a') as lock_file:
+        if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def record_symbol_request(symbol):
+    """記錄一次個股查詢，供盤後預熱挑選熱門代號"""
+    try:
+        with _request_log_lock(), open(REQUEST_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(f"{int(time.time())} {symbol.upper()}\n")
+    except Exception as e:
+        print(f"[Debug] Error recording symbol request: {e}")
+
+def get_popular_symbols(limit=PREFETCH_TOP_N, days=PREFETCH_LOOKBACK_DAYS):
+    """讀取近 N 天的查詢紀錄，回傳最常被查詢的代號，並順便清掉過期紀錄"""
+    cutoff = time.time() - days * 86400
+    counter = Counter()
+    recent_lines = []
+    with _request_log_lock():
+        try:
+            with open(REQUEST_LOG_PATH, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        ts, symbol = line.split()
+                        if int(ts) < cutoff: continue
+                    except ValueError: continue
+                    counter[symbol] += 1
+                    recent_lines.append(line)
+        except FileNotFoundError:
+            return []
+
+        # Compact: 只保留 lookback 期間內的紀錄
+        try:
+            tmp_path = REQUEST_LOG_PATH + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines(recent_lines)
+            os.replace(tmp_path, REQUEST_LOG_PATH)
+        except Exception as e:
+            print(f"[Debug] Error compacting request log: {e}")
+
+    return [symbol for symbol, _ in counter.most_common(limit)]
+
+def get_prefetch_symbols():
+    """自選清單 + 近期熱門查詢 (去重，保留順序)"""
+    symbols = list(dict.fromkeys(PREFETCH_WATCHLIST + get_popular_symbols()))
+    return symbols
+
+def prefetch_symbol(symbol):
+    """預先抓取日線並產生常用圖表，回傳完整代號 (技術指標由 run_nightly_prefetch 批次計算)"""
+    from services.stock_service import get_valid_stock_obj, get_stock_name, get_stock_history
+    from services.chart_service import generate_stock_chart_url_yf
+
+    is_tw = any(c.isdigit() for c in symbol)
+    if is_tw:
+        stock, info, suffix = get_valid_stock_obj(symbol)
+        if not stock: return None
+        full_symbol = symbol + suffix
+    else:
+        full_symbol = symbol
+
+    # AI 分析使用的 6 個月日線
+    get_stock_history(full_symbol, '6mo', '1d')
+
+    # 圖表目前僅支援台股
+    if is_tw:
+        stock_name = get_stock_name(symbol)
+        for period, interval, chart_type in PREFETCH_CHARTS:
+            generate_stock_chart_url_yf(symbol, period, interval, chart_type=chart_type, stock_name=stock_name, suffix=suffix)
+    return full_symbol
+
+def check_shared_cache():
+    """
+    預熱只在一個 worker 執行 (排程的 leader 或收到 /prefetch 的 worker)，
+    CACHE_BACKEND=memory 時結果只留在該行程，其他 worker 仍會重新下載，因此要求共用快取
+    """
+    if CACHE_BACKEND == 'memory':
+        raise RuntimeError("Prefetch requires a shared cache (CACHE_BACKEND=sqlite or redis)")
+
+def run_nightly_prefetch():
+    """盤後預熱：依序處理所有代號，最後一次計算技術指標 (同一時間只允許一個批次執行)"""
+    check_shared_cache()
+    if not _prefetch_lock.acquire(blocking=False):
+        print("[Debug] Prefetch already running, skip.")
+        return None
+
+    try:
+        start = time.time()
+        symbols = get_prefetch_symbols()
+        print(f"[Prefetch] Warming {len(symbols)} symbols: {symbols}")
+        ok, failed, full_symbols = [], [], []
+        for symbol in symbols:
+            try:
+                full_symbol = prefetch_symbol(symbol)
+            except Exception as e:
+                print(f"[Debug] Prefetch error for {symbol}: {e}")
+                full_symbol = None
+            if full_symbol:
+                ok.append(symbol)
+                full_symbols.append(full_symbol)
+            else:
+                failed.append(symbol)
+
+        # AI 分析使用的技術指標 (多檔一起計算，啟用程序池時不佔用 worker)
+        try:
+            from services.indicator_service import get_symbols_indicators
+            get_symbols_indicators(full_symbols, '6mo', '1d')
+        except Exception as e:
+            print(f"[Debug] Prefetch indicators error: {e}")
+
+        last_prefetch.update({
+            "finished_at": time.time(),
+            "elapsed": round(time.time() - start, 2),
+            "ok": ok,
+            "failed": failed
+        })
+        print(f"[Prefetch] Done in {last_prefetch['elapsed']}s. OK={len(ok)}, Failed={failed}")
+        return last_prefetch
+    finally:
+        _prefetch_lock.release()
+
+def start_nightly_prefetch():
+    """在背景執行預熱，讓觸發的 HTTP 請求可以立即返回"""
+    t = threading.Thread(target=run_nightly_prefetch, name='nightly-prefetch', daemon=True)
+    t.start()
+    return t
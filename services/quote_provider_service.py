@@ -0,0 +1,254 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import (
+    QUOTE_PROVIDERS, QUOTE_HEDGE, QUOTE_HEDGE_MIN_SAMPLES, QUOTE_PROVIDER_MAX_ERROR,
+    QUOTE_PROVIDER_COOLDOWN, QUOTE_PROVIDER_WORKERS, QUOTE_FAKE_LATENCY, QUOTE_FAKE_ERROR_RATE, FETCH_DEADLINE
+)
+from utils import metrics, profiler, async_http
+
+# 台股即時報價的來源註冊與路由
+# - 每個來源實作 Provider 介面，由 stock_service 註冊 (fugle / mis / yahoo)，fake 在此註冊
+# - 依 EWMA 延遲排序健康的來源，依序查詢直到有結果；錯誤率過高的來源排到最後
+# - 第一個來源超過自己的 p95 延遲仍未回應時，同時查詢下一個來源 (hedge)，取先回來的結果
+# - QUOTE_PROVIDERS 決定啟用哪些來源，以及沒有統計資料時的順序
+
+EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 200
+
+# 來源查詢專用的執行緒池：Yahoo 來源內部會等待 fanout 的池，不能在 fanout 的池裡執行
+_executor = ThreadPoolExecutor(max_workers=QUOTE_PROVIDER_WORKERS, thread_name_prefix='quote-provider')
+
+
+class Provider:
+    """
+    報價來源的共同介面
+    fetch(symbol) 回傳 get_stock_info 格式的 dict (含 "source")，查無資料回傳 None，連線 / HTTP 錯誤直接拋出
+    """
+    name = None
+
+    def available(self):
+        return True
+
+    def fetch(self, symbol):
+        raise NotImplementedError
+
+    async def fetch_async(self, symbol):
+        return await async_http.run_blocking(self.fetch, symbol)
+
+
+class FakeProvider(Provider):
+    """本機假資料 (測試 / 壓力測試用)：固定延遲與錯誤率，價格依代號產生"""
+    name = 'fake'
+
+    def __init__(self, latency=QUOTE_FAKE_LATENCY, error_rate=QUOTE_FAKE_ERROR_RATE):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def _quote(self, symbol):
+        if random.random() < self.error_rate: raise RuntimeError("fake provider error")
+        rng = random.Random(symbol)
+        prev_close = round(rng.uniform(10, 1000), 1)
+        price = round(prev_close * rng.uniform(0.95, 1.05), 1)
+        change = price - prev_close
+        return {
+            "symbol": symbol, "name": symbol,
+            "price": price, "change": change, "change_percent": change / prev_close * 100,
+            "limit_up": round(prev_close * 1.1, 2), "limit_down": round(prev_close * 0.9, 2),
+            "volume": rng.randint(1, 50000) * 1000,
+            "high": max(price, prev_close), "low": min(price, prev_close), "avg_price": 0,
+            "type": "上市", "PE": "-", "Yield": "-", "PB": "-",
+            "source": self.name
+        }
+
+    def fetch(self, symbol):
+        time.sleep(self.latency)
+        return self._quote(symbol)
+
+    async def fetch_async(self, symbol):
+        await asyncio.sleep(self.latency)
+        return self._quote(symbol)
+
+
+class _Stats:
+    def __init__(self):
+        self.latency = None     # 有回應 (含查無資料) 的 EWMA 延遲
+        self.error_rate = 0.0   # EWMA 錯誤率 (查無資料不算錯誤)
+        self.hit_rate = 1.0     # EWMA 有資料的比例
+        self.samples = deque(maxlen=LATENCY_WINDOW)    # 有資料的延遲 (計算 p95)
+        self.last_error = 0
+        self.calls = 0
+
+    def record(self, elapsed, ok, error):
+        self.calls += 1
+        self.error_rate += EWMA_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        self.hit_rate += EWMA_ALPHA * ((1.0 if ok else 0.0) - self.hit_rate)
+        if error:
+            self.last_error = time.time()
+            return
+        self.latency = elapsed if self.latency is None else self.latency + EWMA_ALPHA * (elapsed - self.latency)
+        if ok: self.samples.append(elapsed)
+
+    def cost(self):
+        """取得一筆報價的預期秒數 (延遲 / 有資料比例)；尚無資料為 0，優先試用"""
+        return (self.latency or 0) / max(self.hit_rate, 0.05)
+
+    def healthy(self):
+        return self.error_rate < QUOTE_PROVIDER_MAX_ERROR or time.time() - self.last_error > QUOTE_PROVIDER_COOLDOWN
+
+    def p95(self):
+        """樣本不足時回傳 None (不 hedge)"""
+        if len(self.samples) < QUOTE_HEDGE_MIN_SAMPLES: return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+_lock = threading.Lock()
+_providers = {}
+_stats = {}
+
+
+def register(provider):
+    """註冊 (或取代) 報價來源"""
+    with _lock:
+        _providers[provider.name] = provider
+        _stats.setdefault(provider.name, _Stats())
+
+def ranked():
+    """依路由順序排列的可用來源：健康的依預期耗時 (無統計者依設定順序優先)，不健康的排在最後"""
+    with _lock:
+        candidates = [
+            (not _stats[name].healthy(), _stats[name].cost(), i, _providers[name])
+            for i, name in enumerate(QUOTE_PROVIDERS)
+            if name in _providers and _providers[name].available()
+        ]
+    return [c[-1] for c in sorted(candidates, key=lambda c: c[:3])]
+
+def _record(provider, start, result, error):
+    elapsed = time.monotonic() - start
+    name = provider.name
+    with _lock: _stats[name].record(elapsed, result is not None, error)
+    metrics.observe(f"quote_provider.{name}", elapsed)
+    if error: metrics.incr(f"quote_provider.{name}.error")
+    elif result is None: metrics.incr(f"quote_provider.{name}.miss")
+
+def _call(provider, symbol):
+    start = time.monotonic()
+    try:
+        result = provider.fetch(symbol)
+    except Exception as e:
+        print(f"[Debug] Quote provider '{provider.name}' failed for {symbol}: {e}")
+        _record(provider, start, None, True)
+        return None
+    _record(provider, start, result, False)
+    return result
+
+async def _call_async(provider, symbol):
+    start = time.monotonic()
+    try:
+        result = await provider.fetch_async(symbol)
+    except Exception as e:
+        print(f"[Debug] Quote provider '{provider.name}' failed for {symbol}: {e}")
+        _record(provider, start, None, True)
+        return None
+    _record(provider, start, result, False)
+    return result
+
+def _hedge_after(provider):
+    """距查詢開始多少秒後加開下一個來源 (None 代表不 hedge)"""
+    if not QUOTE_HEDGE: return None
+    with _lock: return _stats[provider.name].p95()
+
+def _next_wait(pending, queue, start, deadline):
+    """下一次等待的秒數，以及逾時時是否該 hedge"""
+    remaining = start + deadline - time.monotonic()
+    if len(pending) == 1 and queue:
+        (provider, launched), = pending.values()
+        hedge = _hedge_after(provider)
+        if hedge is not None:
+            hedge_in = launched + hedge - time.monotonic()
+            if hedge_in < remaining: return max(0, hedge_in), True
+    return max(0, remaining), False
+
+def get_quote(symbol, deadline=FETCH_DEADLINE):
+    """
+    依路由順序查詢台股即時報價，回傳第一個有資料的結果 (皆無資料或逾時回傳 None)
+    逾時或被 hedge 取代的查詢在背景繼續執行，結果仍計入統計
+    """
+    queue = ranked()
+    start = time.monotonic()
+    pending = {}    # future -> (provider, 開始時間)
+
+    def launch():
+        provider = queue.pop(0)
+        pending[_executor.submit(profiler.wrap(_call), provider, symbol)] = (provider, time.monotonic())
+
+    if queue: launch()
+    while pending:
+        timeout, hedge = _next_wait(pending, queue, start, deadline)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            if not hedge: break
+            metrics.incr("quote_provider.hedged")
+            launch()
+            continue
+        for f in done:
+            provider, _ = pending.pop(f)
+            result = f.result()
+            if result is not None:
+                metrics.incr(f"quote_provider.{provider.name}.served")
+                return result
+        if not pending and queue: launch()
+    if pending: print(f"[Debug] Quote providers exceeded {deadline}s for {symbol}.")
+    return None
+
+async def get_quote_async(symbol, deadline=FETCH_DEADLINE):
+    """get_quote 的 async 版本"""
+    queue = ranked()
+    start = time.monotonic()
+    pending = {}    # task -> (provider, 開始時間)
+
+    def launch():
+        provider = queue.pop(0)
+        pending[asyncio.ensure_future(_call_async(provider, symbol))] = (provider, time.monotonic())
+
+    if queue: launch()
+    while pending:
+        timeout, hedge = _next_wait(pending, queue, start, deadline)
+        done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            if not hedge: break
+            metrics.incr("quote_provider.hedged")
+            launch()
+            continue
+        for task in done:
+            provider, _ = pending.pop(task)
+            result = task.result()
+            if result is not None:
+                metrics.incr(f"quote_provider.{provider.name}.served")
+                return result
+        if not pending and queue: launch()
+    if pending: print(f"[Debug] Quote providers exceeded {deadline}s for {symbol}.")
+    return None
+
+def provider_report():
+    """各來源的 EWMA 延遲、錯誤率、p95 與健康狀態 (供 /metrics)"""
+    with _lock:
+        return {
+            name: {
+                "latency": round(s.latency, 4) if s.latency is not None else None,
+                "error_rate": round(s.error_rate, 4),
+                "hit_rate": round(s.hit_rate, 4),
+                "p95": round(s.p95(), 4) if s.p95() is not None else None,
+                "healthy": s.healthy(),
+                "calls": s.calls,
+                "enabled": name in QUOTE_PROVIDERS and _providers[name].available()
+            } for name, s in _stats.items()
+        }
+
+register(FakeProvider())
+
+metrics.register_gauge("quote_provider.queued", lambda: _executor._work_queue.qsize())
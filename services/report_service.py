@@ -0,0 +1,173 @@
+import os
+import json
+import time
+from functools import partial
+from config import CACHE_DIR, VALID_CURRENCIES, REPORT_MAX_AGE, REPORT_RESEND_GUARD
+from utils.common import get_greeting
+from utils.fanout import fan_out
+from utils import metrics
+from services.forex_service import get_taiwan_bank_rates
+from services.stock_service import generate_vix_report
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 定時推播報告：
+# - 排程在推送前先產生報告並存到 CACHE_DIR/reports (所有 worker 共用)
+# - 推送時 (排程或 /push_* 觸發) 直接使用預先產生的內容，不在 HTTP 請求中爬資料
+# - 記錄最後推送時間，排程與外部 cron 同時觸發也不會重複推送
+# - 同一份報告同時只會有一個在產生 (推送時若正在產生，等它完成直接使用)
+# - 記錄最後一次失敗原因，供 /push_* 回應與 /metrics 查看
+
+REPORT_DIR = os.path.join(CACHE_DIR, 'reports')
+
+
+def build_forex_report(currency):
+    forex_report = get_taiwan_bank_rates(currency)
+
+    # 處理報告回傳格式 (字串或列表)
+    if isinstance(forex_report, list) and forex_report:
+        report_str = f"📊 {currency} 匯率報告 (Top 10)\n{'-'*20}\n"
+        for item in forex_report:
+            report_str += f"{item['bank']}: {item['cash_selling']}\n"
+        return report_str
+    return str(forex_report) if forex_report else "查無資料"
+
+def build_vix_report():
+    # 失敗時拋出例外：不存成預先產生的報告、不推送，並記錄在 last_error
+    report = generate_vix_report()
+    if report is None: raise RuntimeError("VIX data unavailable")
+    return report
+
+def build_combined_report():
+    """韓幣匯率與 VIX 恐慌指數 (向後相容的 /push_report)"""
+    # 韓幣匯率與 VIX 互不相依，同時抓取
+    fetched = fan_out({
+        "krw": partial(get_taiwan_bank_rates, 'KRW'),
+        "vix": generate_vix_report
+    })
+    krw_report = fetched["krw"]
+    krw_str = ""
+    if isinstance(krw_report, list):
+        for item in krw_report[:5]:
+            krw_str += f"{item['bank']}: {item['cash_selling']}\n"
+    else: krw_str = str(krw_report)
+
+    vix_report = fetched["vix"] or "❌ 無法取得 VIX 資料"
+    return f"📊 韓幣匯率\n{krw_str}\n\n{vix_report}"
+
+def get_report_builder(name):
+    """報告名稱: vix / report / forex:KRW ..."""
+    if name == 'vix': return build_vix_report
+    if name == 'report': return build_combined_report
+    if name.startswith('forex:') and name[6:] in VALID_CURRENCIES:
+        return partial(build_forex_report, name[6:])
+    return None
+
+def _path(name, ext):
+    return os.path.join(REPORT_DIR, f"{name.replace(':', '_')}.{ext}")
+
+def _write_json(path, data):
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _build(name):
+    start = time.monotonic()
+    body = get_report_builder(name)()
+    _write_json(_path(name, 'json'), {"name": name, "built_at": time.time(), "body": body})
+    metrics.observe(f"report.build.{name}", time.monotonic() - start)
+    print(f"[Report] Prebuilt {name} in {time.monotonic() - start:.2f}s.")
+    return body
+
+def _build_lock(name):
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    lock_file = open(_path(name, 'build'), 'w')
+    if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def _record_error(name, e):
+    _write_json(_path(name, 'error'), {"name": name, "error": str(e), "at": time.time()})
+    metrics.incr(f"report.error.{name}")
+
+def prebuild_report(name):
+    """產生報告內容並存檔，供稍後推送"""
+    with _build_lock(name):
+        try:
+            return _build(name)
+        except Exception as e:
+            _record_error(name, e)
+            raise
+
+def get_prebuilt_report(name, max_age=REPORT_MAX_AGE):
+    """回傳仍在有效期內的預先產生報告內容，沒有則回傳 None"""
+    data = _read_json(_path(name, 'json'))
+    if not data or time.time() - data.get('built_at', 0) > max_age: return None
+    return data.get('body')
+
+def last_sent_at(name):
+    data = _read_json(_path(name, 'sent'))
+    return data.get('sent_at', 0) if data else 0
+
+def last_error(name):
+    """最後一次推送之後的失敗 {"error", "at"}，之後已成功推送則為 None"""
+    data = _read_json(_path(name, 'error'))
+    if not data or data.get('at', 0) < last_sent_at(name): return None
+    return data
+
+def report_status():
+    """各報告最後推送時間與未排除的失敗 (供 /metrics)"""
+    try:
+        files = os.listdir(REPORT_DIR)
+    except OSError:
+        return {}
+    names = sorted({f.rsplit('.', 1)[0].replace('_', ':', 1) for f in files if f.endswith(('.sent', '.error'))})
+    return {name: {"last_sent": last_sent_at(name) or None, "last_error": last_error(name)} for name in names}
+
+def send_report(name, push, force=False):
+    """
+    推送報告 (優先使用預先產生的內容，沒有才同步產生)
+    push(text) 負責實際送出；回傳 'sent' 或 'skipped' (近期已推送過)
+    """
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    with open(_path(name, 'lock'), 'w') as lock_file:
+        # 同一份報告同時只允許一個 worker 推送
+        if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        if not force and time.time() - last_sent_at(name) < REPORT_RESEND_GUARD:
+            print(f"[Report] {name} already sent recently, skip.")
+            metrics.incr(f"report.skipped.{name}")
+            return 'skipped'
+
+        try:
+            body = get_prebuilt_report(name)
+            if body is None:
+                # 排程的 prepare 可能正在產生，等它完成再看一次
+                with _build_lock(name):
+                    body = get_prebuilt_report(name)
+                    if body is None:
+                        metrics.incr(f"report.prebuilt_miss.{name}")
+                        body = _build(name)
+                    else:
+                        metrics.incr(f"report.prebuilt_hit.{name}")
+            else:
+                metrics.incr(f"report.prebuilt_hit.{name}")
+
+            push(f"{get_greeting()}！\n\n{body}")
+        except Exception as e:
+            _record_error(name, e)
+            raise
+        _write_json(_path(name, 'sent'), {"name": name, "sent_at": time.time()})
+        print(f"[Report] {name} sent.")
+        return 'sent'
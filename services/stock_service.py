@@ -1,175 +1,517 @@
 
+import time
+from functools import partial
 import requests
+import pandas as pd
 import yfinance as yf
-from cachetools import cached, TTLCache
+from cachetools import cached
+from cachetools.keys import hashkey
 import urllib3
+from concurrent.futures import TimeoutError as FuturesTimeout
+from config import TWSE_MIS_URL, FUGLE_API_KEY, QUOTE_CACHE_TTL, OPTIONAL_FETCH_DEADLINE
+from utils.market_calendar import market_ttl, symbol_market, seconds_until_tw_open
+from utils.fanout import fan_out, submit, probe_executor
+from utils import async_http
+from utils.async_http import fan_out_async
+from utils.cache_backend import make_cache
+from services.valuation_service import get_twse_stats
+from services.fugle_service import fetch_quote, fetch_quote_async
+from services import intraday_service
+from services import quote_provider_service
+from services.quote_provider_service import Provider, get_quote, get_quote_async
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # --- 股價相關 ---
 
-def get_valid_stock_obj(symbol):
-    def fetch(t):
-        try: s = yf.Ticker(t); return s, s.fast_info
-        except: return None, None
+def _probe_ticker(ticker):
+    """有即時價的 (Ticker, fast_info)，查無資料回傳 None"""
+    try:
+        s = yf.Ticker(ticker); i = s.fast_info
+        if i and hasattr(i, 'last_price') and i.last_price: return s, i
+    except: pass
+    return None
+
+def _pick_listing(results):
+    # 兩者皆有資料時以 .TW 優先
     for suffix in [".TW", ".TWO"]:
-        s, i = fetch(symbol + suffix)
-        try:
-            if i and hasattr(i, 'last_price') and i.last_price: return s, i, suffix
-        except: continue
+        if results.get(suffix):
+            s, i = results[suffix]
+            return s, i, suffix
     return None, None, None
 
-@cached(TTLCache(maxsize=1, ttl=300))
-def get_twse_stats():
+def get_valid_stock_obj(symbol):
+    # 上市/上櫃同時探測 (常在 fanout 的工作中被呼叫，探測走專用池)
+    return _pick_listing(fan_out({suffix: partial(_probe_ticker, symbol + suffix) for suffix in [".TW", ".TWO"]},
+                                 executor=probe_executor))
+
+async def get_valid_stock_obj_async(symbol):
+    return _pick_listing(await fan_out_async({
+        suffix: async_http.run_blocking(_probe_ticker, symbol + suffix) for suffix in [".TW", ".TWO"]
+    }))
+
+# --- 歷史 K 線 (AI 分析 / 圖表 / 盤後預熱共用) ---
+
+def _history_ttu(key, value, now):
+    full_symbol, period, interval = key
+    return now + market_ttl(symbol_market(full_symbol), interval)
+
+history_cache = make_cache('stock_history', maxsize=64, ttu=_history_ttu)
+
+def get_stock_history(full_symbol, period="6mo", interval="1d"):
+    """
+    取得歷史 K 線 (含快取)，full_symbol 需含後綴 (e.g. 2330.TW, AAPL)
+    台股日線在盤後會快取到下次開盤，空資料不快取
+    """
+    key = (full_symbol, period, interval)
+    df = history_cache.get(key)
+    if df is not None: return df
+
     try:
-        url = "https://openapi.twse.com.tw/v1/exchangeReport/BWIBBU_ALL"
-        r = requests.get(url)
-        if r.status_code == 200:
-            data = r.json()
-            stats = {}
-            for item in data:
-                code = item.get('Code')
-                stats[code] = {
-                    "PE": item.get('PEratio', '-'), 
-                    "Yield": item.get('DividendYield', '-'),
-                    "PB": item.get('PBratio', '-')
-                }
-            return stats
-    except: pass
-    return {}
+        df = yf.Ticker(full_symbol).history(period=period, interval=interval)
+    except Exception as e:
+        print(f"[Debug] Error fetching history for {full_symbol}: {e}")
+        return pd.DataFrame()
 
-@cached(TTLCache(maxsize=100, ttl=3600))
+    if not df.empty: history_cache[key] = df
+    return df
+
+history_cache.refresher = lambda key: get_stock_history(*key)
+
+def _name_ttu(key, value, now):
+    # 名稱只會在開盤時異動 (更名、新上市)
+    return now + max(seconds_until_tw_open(), 3600)
+
+name_cache = make_cache('stock_name', maxsize=100, ttu=_name_ttu)
+MIS_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0'}
+
+def _mis_url(symbols):
+    targets = [f"{ex}_{symbol}.tw" for symbol in symbols for ex in ("tse", "otc", "emg")]
+    return f"{TWSE_MIS_URL}/stock/api/getStockInfo.jsp?ex_ch={'|'.join(targets)}&json=1&delay=0"
+
+def _find_name(data, symbol):
+    for item in data.get('msgArray', []):
+        if item.get('c') == symbol and item.get('n'):
+            return item.get('n')
+    return None
+
+@cached(name_cache)
 def get_stock_name(symbol):
     try:
-        targets = [f"tse_{symbol}.tw", f"otc_{symbol}.tw", f"emg_{symbol}.tw"]
-        query = "|".join(targets)
-        url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={query}&json=1&delay=0"
-        
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0'}
-        r = requests.get(url, headers=headers, timeout=5, verify=False)
-        
+        r = requests.get(_mis_url([symbol]), headers=MIS_HEADERS, timeout=5, verify=False)
         if r.status_code == 200:
-            data = r.json()
-            if 'msgArray' in data:
-                for item in data['msgArray']:
-                    if item.get('c') == symbol and item.get('n'):
-                        return item.get('n')
+            return _find_name(r.json(), symbol) or symbol
     except Exception as e:
         print(f"[Debug] Error getting stock name for {symbol}: {e}")
     
     return symbol
 
-def get_stock_info(symbol):
+async def get_stock_name_async(symbol):
+    """get_stock_name 的 async 版本 (共用快取)"""
+    key = hashkey(symbol)
+    name = name_cache.get(key)
+    if name: return name
+    name = symbol
     try:
-        stock, info, suffix = get_valid_stock_obj(symbol)
-        
-        # 嘗試使用 Fugle API (僅針對台股)
-        if suffix in ['.TW', '.TWO']:
-            from config import FUGLE_API_KEY
-            print(f"[Debug] Fugle Key Present: {bool(FUGLE_API_KEY)}") # Check if key exists
-            if FUGLE_API_KEY:
-                from services.fugle_service import get_realtime_quote
-                print(f"[Debug] Attempting to fetch {symbol} from Fugle...")
-                fugle_data = get_realtime_quote(symbol) 
-                
-                if fugle_data:
-                    print(f"[Debug] Fugle Data Success. Price: {fugle_data.get('lastTrade', {}).get('price')}")
-                    try:
-                        name = fugle_data.get('name', symbol)
-                        price = fugle_data['lastTrade']['price']
-                        prev_close = fugle_data.get('previousClose')
-                        
-                        change = price - prev_close if prev_close else 0
-                        change_percent = (change / prev_close) * 100 if prev_close else 0
-                        
-                        # Fugle Total Volume is in SHARES
-                        volume = fugle_data['total']['tradeVolume']
-
-                        limit_up = fugle_data.get('limitUpPrice')
-                        limit_down = fugle_data.get('limitDownPrice')
-                        
-                        # Fallback if Fugle doesn't provide limits (should usually provide them)
-                        if not limit_up or not limit_down:
-                            from utils.common import calculate_twse_limit
-                            if not limit_up: limit_up = calculate_twse_limit(prev_close, is_up=True)
-                            if not limit_down: limit_down = calculate_twse_limit(prev_close, is_up=False)
-
-                        return {
-                            "symbol": fugle_data['symbol'],
-                            "name": name,
-                            "price": price,
-                            "change": change,
-                            "change_percent": change_percent,
-                            "limit_up": limit_up,
-                            "limit_down": limit_down,
-                            "volume": volume,
-                            "high": fugle_data.get('highPrice', price),
-                            "low": fugle_data.get('lowPrice', price),
-                            "avg_price": fugle_data.get('avgPrice', 0),
-                            "type": "上櫃" if suffix == ".TWO" else "上市",
-                            "PE": "-", 
-                            "Yield": "-", 
-                            "PB": "-",
-                            "source": "fugle" 
-                        }
-                    except Exception as e:
-                        print(f"[Debug] Error parsing Fugle data: {e}. Fallback to YFinance.")
-                else:
-                    print(f"[Debug] Fugle returned None (Simulated Fallback).")
-        
-        # Fallback to YFinance
-        print(f"[Debug] Fallback to YFinance for {symbol}...")
-        if not stock: 
-            print(f"[Debug] YFinance Ticker object invalid.")
-            return None
-        
-        extra_stats = {}
-        if suffix == ".TW":
-             all_stats = get_twse_stats()
-             if symbol in all_stats: extra_stats = all_stats[symbol]
+        r = await async_http.request('GET', _mis_url([symbol]), name='twse_mis', headers=MIS_HEADERS,
+                                     timeout=5, ssl=False)
+        if r.status == 200: name = _find_name(r.json(), symbol) or symbol
+    except Exception as e:
+        print(f"[Debug] Error getting stock name for {symbol}: {e}")
+    name_cache[key] = name
+    return name
 
-        stock_name = get_stock_name(symbol)
-        if symbol == '7866' and stock_name == '7866':
-            stock_name = "丹立"
+name_cache.refresher = lambda key: get_stock_name(*key)
 
-        price = info.last_price
-        prev_close = info.previous_close
-        if prev_close is None: prev_close = price
+def get_stock_names(symbols):
+    """
+    一次查詢多檔台股中文名稱 (單次 MIS 請求)，結果同步寫入 get_stock_name 的快取
+    回傳 {symbol: name}，查無名稱者以代號代替
+    """
+    names = {}
+    missing = []
+    for symbol in symbols:
+        name = name_cache.get(hashkey(symbol))
+        if name: names[symbol] = name
+        else: missing.append(symbol)
+    if not missing: return names
 
-        change = price - prev_close
-        try: change_percent = (change / prev_close * 100) if prev_close else 0
-        except: change_percent = 0
-            
+    try:
+        r = requests.get(_mis_url(missing), headers=MIS_HEADERS, timeout=5, verify=False)
+
+        if r.status_code == 200:
+            for item in r.json().get('msgArray', []):
+                code, name = item.get('c'), item.get('n')
+                if code in missing and name and code not in names:
+                    names[code] = name
+                    name_cache[hashkey(code)] = name
+    except Exception as e:
+        print(f"[Debug] Error getting stock names for {missing}: {e}")
+
+    for symbol in missing: names.setdefault(symbol, symbol)
+    return names
+
+def _ticker_frame(df, ticker):
+    """從 yf.download(group_by='ticker') 的結果取出單一代號的資料"""
+    if isinstance(df.columns, pd.MultiIndex):
+        if ticker not in df.columns.get_level_values(0): return None
+        df = df[ticker]
+    df = df.dropna(subset=['Close'])
+    return None if df.empty else df
+
+def get_batch_stock_info(symbols):
+    """
+    多檔股票報價 (台股 + 美股) 只發一次 yf.download
+    台股同時下載 .TW / .TWO 兩種後綴，以有資料者為準
+    美股名稱 / 市值 / 本益比取自 get_us_stock_info (有快取)、上市本益比等取自 get_twse_stats，
+    皆與下載同時進行，下載完成後最多再等 OPTIONAL_FETCH_DEADLINE，逾時者顯示代號與 "-" (結果仍會寫入快取)
+    回傳 list (依輸入順序，查無資料者略過)，每筆含 "market": "tw" / "us"，
+    欄位格式同 get_stock_info / get_us_stock_info
+    """
+    from utils.common import calculate_twse_limit, is_tw_stock_symbol
+
+    tw_symbols = [s for s in symbols if is_tw_stock_symbol(s)]
+    us_symbols = [s for s in symbols if s not in tw_symbols]
+    tickers = [s + suffix for s in tw_symbols for suffix in (".TW", ".TWO")] + us_symbols
+
+    optional = [("us", s) for s in us_symbols] + (["stats"] if tw_symbols else [])
+    # 抓 1 年日線，順便算出美股 52 週高低
+    fetched = fan_out({
+        "history": partial(yf.download, tickers, period="1y", interval="1d", group_by='ticker', threads=True, progress=False),
+        **({"stats": get_twse_stats} if tw_symbols else {}),
+        **{("us", s): partial(get_us_stock_info, s) for s in us_symbols}
+    }, optional=optional)
+    df = fetched["history"]
+    if df is None or df.empty: return []
+
+    names = get_stock_names(tw_symbols) if tw_symbols else {}
+    all_stats = fetched.get("stats") or {}
+    results = []
+
+    for symbol in symbols:
+        try:
+            if symbol in tw_symbols:
+                suffix = ".TW"
+                hist = _ticker_frame(df, symbol + ".TW")
+                if hist is None:
+                    suffix = ".TWO"
+                    hist = _ticker_frame(df, symbol + ".TWO")
+            else:
+                suffix = None
+                hist = _ticker_frame(df, symbol)
+            if hist is None:
+                print(f"[Debug] Batch quote: no data for {symbol}")
+                continue
+
+            last = hist.iloc[-1]
+            price = float(last['Close'])
+            prev_close = float(hist.iloc[-2]['Close']) if len(hist) >= 2 else price
+            change = price - prev_close
+            change_percent = (change / prev_close * 100) if prev_close else 0
+
+            if suffix:
+                extra_stats = all_stats.get(symbol, {}) if suffix == ".TW" else {}
+                results.append({
+                    "market": "tw",
+                    "symbol": symbol, "name": names.get(symbol, symbol),
+                    "price": price,
+                    "change": change,
+                    "change_percent": change_percent,
+                    "limit_up": calculate_twse_limit(prev_close, is_up=True),
+                    "limit_down": calculate_twse_limit(prev_close, is_up=False),
+                    "volume": float(last['Volume']),
+                    "high": float(last['High']),
+                    "low": float(last['Low']),
+                    "avg_price": 0,
+                    "type": "上櫃" if suffix == ".TWO" else "上市",
+                    "PE": extra_stats.get("PE", "-"),
+                    "Yield": extra_stats.get("Yield", "-"),
+                    "PB": extra_stats.get("PB", "-")
+                })
+            else:
+                profile = fetched[("us", symbol)] or {}
+                results.append({
+                    "market": "us",
+                    "symbol": symbol,
+                    "name": profile.get("name", symbol),
+                    "price": price,
+                    "change": change,
+                    "change_percent": change_percent,
+                    "high": float(last['High']),
+                    "low": float(last['Low']),
+                    "volume": int(last['Volume']),
+                    "market_cap": profile.get("market_cap", 0),
+                    "pe_ratio": profile.get("pe_ratio", '-'),
+                    "week_52_high": float(hist['High'].max()),
+                    "week_52_low": float(hist['Low'].min())
+                })
+        except Exception as e:
+            print(f"[Debug] Batch quote: error processing {symbol}: {e}")
+    return results
+
+def _fugle_quote(fugle_data, symbol, suffix):
+    """Fugle 即時報價轉成 get_stock_info 的格式，解析失敗回傳 None"""
+    print(f"[Debug] Fugle Data Success. Price: {fugle_data.get('lastTrade', {}).get('price')}")
+    try:
+        name = fugle_data.get('name', symbol)
+        price = fugle_data['lastTrade']['price']
+        prev_close = fugle_data.get('previousClose')
+        
+        change = price - prev_close if prev_close else 0
+        change_percent = (change / prev_close) * 100 if prev_close else 0
+        
+        # Fugle Total Volume is in SHARES
+        volume = fugle_data['total']['tradeVolume']
 
-        if suffix in ['.TW', '.TWO']:
+        limit_up = fugle_data.get('limitUpPrice')
+        limit_down = fugle_data.get('limitDownPrice')
+        
+        # Fallback if Fugle doesn't provide limits (should usually provide them)
+        if not limit_up or not limit_down:
             from utils.common import calculate_twse_limit
-            limit_up = calculate_twse_limit(prev_close, is_up=True)
-            limit_down = calculate_twse_limit(prev_close, is_up=False)
-        else:
-            # 美股無漲跌幅限制 (或不同規則)，此處暫時保留原樣或設為 0
-            limit_up = 0
-            limit_down = 0
+            if not limit_up: limit_up = calculate_twse_limit(prev_close, is_up=True)
+            if not limit_down: limit_down = calculate_twse_limit(prev_close, is_up=False)
 
         return {
-            "symbol": symbol, "name": stock_name,
-            "price": price, 
+            "symbol": fugle_data['symbol'],
+            "name": name,
+            "price": price,
             "change": change,
             "change_percent": change_percent,
             "limit_up": limit_up,
             "limit_down": limit_down,
-            "volume": info.last_volume, 
-            "high": info.day_high, 
-            "low": info.day_low,
-            "avg_price": 0,
+            "volume": volume,
+            "high": fugle_data.get('highPrice', price),
+            "low": fugle_data.get('lowPrice', price),
+            "avg_price": fugle_data.get('avgPrice', 0),
             "type": "上櫃" if suffix == ".TWO" else "上市",
-            "PE": extra_stats.get("PE", "-"),
-            "Yield": extra_stats.get("Yield", "-"),
-            "PB": extra_stats.get("PB", "-")
+            "PE": "-", 
+            "Yield": "-", 
+            "PB": "-",
+            "source": "fugle" 
+        }
+    except Exception as e:
+        print(f"[Debug] Error parsing Fugle data: {e}")
+        return None
+
+def _yahoo_quote(symbol, stock, info, suffix, stock_name):
+    """yfinance fast_info 轉成 get_stock_info 的格式"""
+    print(f"[Debug] Quote {symbol} from YFinance...")
+    if not stock: 
+        print(f"[Debug] YFinance Ticker object invalid.")
+        return None
+
+    stock_name = stock_name or symbol
+    if symbol == '7866' and stock_name == '7866':
+        stock_name = "丹立"
+
+    price = info.last_price
+    prev_close = info.previous_close
+    if prev_close is None: prev_close = price
+
+    change = price - prev_close
+    try: change_percent = (change / prev_close * 100) if prev_close else 0
+    except: change_percent = 0
+        
+
+    if suffix in ['.TW', '.TWO']:
+        from utils.common import calculate_twse_limit
+        limit_up = calculate_twse_limit(prev_close, is_up=True)
+        limit_down = calculate_twse_limit(prev_close, is_up=False)
+    else:
+        # 美股無漲跌幅限制 (或不同規則)，此處暫時保留原樣或設為 0
+        limit_up = 0
+        limit_down = 0
+
+    return {
+        "symbol": symbol, "name": stock_name,
+        "price": price, 
+        "change": change,
+        "change_percent": change_percent,
+        "limit_up": limit_up,
+        "limit_down": limit_down,
+        "volume": info.last_volume, 
+        "high": info.day_high, 
+        "low": info.day_low,
+        "avg_price": 0,
+        "type": "上櫃" if suffix == ".TWO" else "上市",
+        "PE": "-", "Yield": "-", "PB": "-",
+        "source": "yahoo"
+    }
+
+def _mis_quote(data, symbol):
+    """證交所基本市況 (getStockInfo) 轉成 get_stock_info 的格式，尚無成交價 / 查無代號回傳 None"""
+    def num(value):
+        try: return float(value)
+        except (TypeError, ValueError): return None
+
+    for item in sorted(data.get('msgArray', []), key=lambda i: i.get('ex') != 'tse'):
+        if item.get('c') != symbol or item.get('ex') not in ('tse', 'otc'): continue
+        price, prev_close = num(item.get('z')), num(item.get('y'))
+        last_trade = price is not None
+        if price is None:
+            # 最近一筆沒有成交 (z 為 "-")：以最佳買賣價的中間價代替
+            bid = num((item.get('b') or '').split('_')[0])
+            ask = num((item.get('a') or '').split('_')[0])
+            price = (bid + ask) / 2 if bid and ask else None
+        if price is None or not prev_close: return None
+
+        from utils.common import calculate_twse_limit
+        change = price - prev_close
+        if item.get('n'): name_cache[hashkey(symbol)] = item['n']
+        return {
+            "symbol": symbol, "name": item.get('n') or symbol,
+            "price": price,
+            "change": change,
+            "change_percent": change / prev_close * 100,
+            "limit_up": num(item.get('u')) or calculate_twse_limit(prev_close, is_up=True),
+            "limit_down": num(item.get('w')) or calculate_twse_limit(prev_close, is_up=False),
+            # MIS 成交量單位為張
+            "volume": int(num(item.get('v')) or 0) * 1000,
+            "high": num(item.get('h')) or price,
+            "low": num(item.get('l')) or price,
+            "avg_price": 0,
+            "type": "上櫃" if item.get('ex') == 'otc' else "上市",
+            "PE": "-", "Yield": "-", "PB": "-",
+            "source": "mis",
+            # False 代表 price 為買賣中間價 (不寫入盤中 K 棒)
+            "last_trade": last_trade
         }
+    return None
+
+def get_mis_quotes(symbols):
+    """一次 MIS 請求查詢多檔台股即時報價 (盤中 K 棒輪詢用)，回傳 {symbol: 報價}，查無資料者略過"""
+    try:
+        r = requests.get(_mis_url(symbols), headers=MIS_HEADERS, timeout=5, verify=False)
+        r.raise_for_status()
+        data = r.json()
+    except Exception as e:
+        print(f"[Debug] Error getting MIS quotes for {symbols}: {e}")
+        return {}
+    quotes = {symbol: _mis_quote(data, symbol) for symbol in symbols}
+    return {symbol: quote for symbol, quote in quotes.items() if quote}
+
+def _fugle_suffix(fugle_data):
+    return ".TWO" if fugle_data.get('market') == 'OTC' or fugle_data.get('exchange') == 'TPEx' else ".TW"
+
+class FugleProvider(Provider):
+    name = 'fugle'
+
+    def available(self):
+        return bool(FUGLE_API_KEY)
+
+    def fetch(self, symbol):
+        data = fetch_quote(symbol)
+        return _fugle_quote(data, symbol, _fugle_suffix(data)) if data else None
+
+    async def fetch_async(self, symbol):
+        data = await fetch_quote_async(symbol)
+        return _fugle_quote(data, symbol, _fugle_suffix(data)) if data else None
+
+class MisProvider(Provider):
+    name = 'mis'
+
+    def fetch(self, symbol):
+        r = requests.get(_mis_url([symbol]), headers=MIS_HEADERS, timeout=5, verify=False)
+        r.raise_for_status()
+        return _mis_quote(r.json(), symbol)
+
+    async def fetch_async(self, symbol):
+        r = await async_http.request('GET', _mis_url([symbol]), name='twse_mis', headers=MIS_HEADERS,
+                                     timeout=5, ssl=False)
+        if r.status != 200: raise requests.HTTPError(f"TWSE MIS Error: {r.status}")
+        return _mis_quote(r.json(), symbol)
+
+class YahooProvider(Provider):
+    name = 'yahoo'
+
+    def fetch(self, symbol):
+        # 上市/上櫃探測與中文名稱互不相依，同時抓取
+        fetched = fan_out({
+            "stock": partial(get_valid_stock_obj, symbol),
+            "name": partial(get_stock_name, symbol)
+        })
+        stock, info, suffix = fetched["stock"] or (None, None, None)
+        return _yahoo_quote(symbol, stock, info, suffix, fetched["name"])
+
+    async def fetch_async(self, symbol):
+        # 名稱走共用 aiohttp 連線池，yfinance 在執行緒池執行
+        fetched = await fan_out_async({
+            "stock": get_valid_stock_obj_async(symbol),
+            "name": get_stock_name_async(symbol)
+        })
+        stock, info, suffix = fetched["stock"] or (None, None, None)
+        return _yahoo_quote(symbol, stock, info, suffix, fetched["name"])
+
+for _provider in (FugleProvider(), MisProvider(), YahooProvider()):
+    quote_provider_service.register(_provider)
+
+def quote_ttl(market):
+    """即時報價的快取秒數 (盤中 QUOTE_CACHE_TTL，收盤後到下次開盤)"""
+    return market_ttl(market, live_ttl=QUOTE_CACHE_TTL)
+
+# 即時報價 (LINE 指令與 /api/v1 共用)，key: (市場, 代號)，查無資料不快取
+quote_cache = make_cache('stock_quote', maxsize=200, ttu=lambda key, value, now: now + quote_ttl(key[0]))
+
+def _with_valuation(symbol, info, stats):
+    """補上證交所 BWIBBU 的本益比 / 殖利率 / 股價淨值比 (只涵蓋上市股票，各報價來源共用)"""
+    row = (stats or {}).get(symbol) if info.get('type') == '上市' else None
+    if not row: return info
+    return {**info, **{k: row.get(k, '-') for k in ('PE', 'Yield', 'PB') if info.get(k, '-') == '-'}}
+
+def get_stock_info(symbol):
+    """
+    台股即時報價：依 QUOTE_PROVIDERS 與各來源的延遲 / 錯誤率選擇 Fugle / 證交所 MIS / Yahoo
+    本益比等與報價同時抓取，僅為附加資訊，逾時就略過不等
+    """
+    key = ('tw', symbol)
+    intraday_service.touch(symbol)
+    info = quote_cache.get(key)
+    if info is not None: return info
+    start = time.monotonic()
+    stats = submit(get_twse_stats)
+    try:
+        info = get_quote(symbol)
     except Exception as e:
         print(f"[Debug] Error getting stock info: {e}")
         return None
+    if info is not None:
+        try: info = _with_valuation(symbol, info, stats.result(timeout=max(0, start + OPTIONAL_FETCH_DEADLINE - time.monotonic())))
+        except FuturesTimeout: print(f"[Debug] TWSE stats not ready, quote {symbol} without PE.")
+        except Exception as e: print(f"[Debug] Error getting TWSE stats: {e}")
+        quote_cache[key] = info
+        intraday_service.record_quote(info)
+    return info
+
+async def get_stock_info_async(symbol):
+    """get_stock_info 的 async 版本 (共用快取)"""
+    key = ('tw', symbol)
+    intraday_service.touch(symbol)
+    info = quote_cache.get(key)
+    if info is not None: return info
+    try:
+        fetched = await fan_out_async({
+            "quote": get_quote_async(symbol),
+            "stats": async_http.run_blocking(get_twse_stats)
+        }, optional=("stats",))
+        info = fetched["quote"]
+    except Exception as e:
+        print(f"[Debug] Error getting stock info: {e}")
+        return None
+    if info is not None:
+        info = _with_valuation(symbol, info, fetched["stats"])
+        quote_cache[key] = info
+        intraday_service.record_quote(info)
+    return info
 
 def get_us_stock_info(symbol):
+    key = ('us', symbol)
+    info = quote_cache.get(key)
+    if info is not None: return info
+    info = _fetch_us_stock_info(symbol)
+    if info is not None: quote_cache[key] = info
+    return info
+
+def _fetch_us_stock_info(symbol):
     try:
         ticker = yf.Ticker(symbol)
         info = ticker.info
@@ -215,8 +557,9 @@ def get_vix_data(days=5):
         return None
 
 def generate_vix_report():
+    """VIX 恐慌指數報告文字，無法取得資料時回傳 None"""
     vix_data = get_vix_data(5)
-    if not vix_data: return "❌ 無法取得 VIX 資料"
+    if not vix_data: return None
     
     latest_vix = vix_data[-1]['value']
     if latest_vix < 15: sentiment = "😌 市場平靜"; sentiment_desc = "投資人情緒穩定"
@@ -229,45 +572,87 @@ def generate_vix_report():
     report += f"\n{'='*25}\n目前狀態：{sentiment}\n{sentiment_desc}\n\n💡 說明：\n• VIX < 15: 市場平靜\n• VIX 15-20: 正常波動\n• VIX 20-30: 市場緊張\n• VIX > 30: 高度恐慌"
     return report
 
-def get_market_dashboard_data():
-    tickers = ["^VIX", "^TWII", "0050.TW", "2330.TW"]
-    name_map = {"^VIX": "VIX 恐慌", "^TWII": "加權指數", "0050.TW": "元大 0050", "2330.TW": "台積電"}
-    results = []
+# --- 市場快況儀表板 ---
+
+# 預設顯示的代號 (使用者輸入的格式：台股不含後綴)
+DASHBOARD_DEFAULT = ["^VIX", "^TWII", "0050", "2330"]
+DASHBOARD_NAMES = {"^VIX": "VIX 恐慌", "^TWII": "加權指數", "0050": "元大 0050", "2330": "台積電"}
+
+def _dashboard_item(symbol, name, hist):
+    item_data = {
+        "symbol": symbol, "name": name,
+        "price": "-", "change": 0, "change_percent": 0, "color": "#333333", "sign": "",
+        "action_text": symbol
+    }
+    if hist is None or hist.empty: return item_data
+
+    last_row = hist.iloc[-1]
+    price = last_row['Close']
+    if len(hist) >= 2:
+        prev_row = hist.iloc[-2]
+        prev_close = prev_row['Close']
+        change = price - prev_close
+        change_percent = (change / prev_close) * 100
+    else: change = 0; change_percent = 0
+
+    color = "#eb4e3d" if change > 0 else "#27ba46" if change < 0 else "#333333"
+    sign = "+" if change > 0 else ""
+    item_data.update({
+        "price": f"{price:,.2f}",
+        "change": change,
+        "change_str": f"{sign}{change:.2f}",
+        "change_percent": f"{sign}{change_percent:.2f}%",
+        "color": color
+    })
+    return item_data
+
+def _download_recent(tickers):
+    if not tickers: return None
+    return yf.download(tickers, period="5d", interval="1d", group_by='ticker', threads=True, progress=False)
+
+def get_dashboard_quotes(symbols):
+    """
+    儀表板報價：每個市場只發一次 yf.download (台股含 ^TWII / 其他含美股與 ^VIX)
+    台股同時下載 .TW / .TWO，以有資料者為準
+    回傳 {symbol: item}，查無資料者價格顯示 "-"
+    """
+    from utils.common import is_tw_stock_symbol
+
+    tw_codes = [s for s in symbols if is_tw_stock_symbol(s)]
+    tw_tickers = [c + suffix for c in tw_codes for suffix in (".TW", ".TWO")]
+    tw_tickers += [s for s in symbols if s == "^TWII"]
+    other_tickers = [s for s in symbols if s not in tw_codes and s != "^TWII"]
+
+    fetched = fan_out({
+        "tw": partial(_download_recent, tw_tickers),
+        "other": partial(_download_recent, other_tickers),
+        "names": partial(get_stock_names, [c for c in tw_codes if c not in DASHBOARD_NAMES])
+    })
+    names = fetched["names"] or {}
+
+    quotes = {}
+    for symbol in symbols:
+        hist = None
+        try:
+            if symbol in tw_codes:
+                df = fetched["tw"]
+                if df is not None and not df.empty:
+                    hist = _ticker_frame(df, symbol + ".TW")
+                    if hist is None: hist = _ticker_frame(df, symbol + ".TWO")
+            else:
+                df = fetched["tw"] if symbol == "^TWII" else fetched["other"]
+                if df is not None and not df.empty: hist = _ticker_frame(df, symbol)
+        except Exception as e: print(f"[Debug] Error processing {symbol}: {e}")
+        name = DASHBOARD_NAMES.get(symbol) or names.get(symbol, symbol)
+        quotes[symbol] = _dashboard_item(symbol, name, hist)
+    return quotes
+
+def get_market_dashboard_data(symbols=None):
+    """依序回傳儀表板各列資料 (預設 DASHBOARD_DEFAULT)"""
+    symbols = symbols or DASHBOARD_DEFAULT
     try:
-        df = yf.download(tickers, period="5d", interval="1d", group_by='ticker', threads=True)
-        for symbol in tickers:
-            item_data = {
-                "symbol": symbol, "name": name_map.get(symbol, symbol),
-                "price": "-", "change": 0, "change_percent": 0, "color": "#333333", "sign": "",
-                "action_text": symbol.replace(".TW", "")
-            }
-            try:
-                if len(tickers) > 1: ticker_df = df[symbol]
-                else: ticker_df = df
-                ticker_df = ticker_df.dropna(subset=['Close'])
-                if not ticker_df.empty:
-                    last_row = ticker_df.iloc[-1]
-                    price = last_row['Close']
-                    if len(ticker_df) >= 2:
-                        prev_row = ticker_df.iloc[-2]
-                        prev_close = prev_row['Close']
-                        change = price - prev_close
-                        change_percent = (change / prev_close) * 100
-                    else: change = 0; change_percent = 0
-                    
-                    color = "#eb4e3d" if change > 0 else "#27ba46" if change < 0 else "#333333"
-                    sign = "+" if change > 0 else ""
-                    item_data.update({
-                        "price": f"{price:,.2f}",
-                        "change": change,
-                        "change_str": f"{sign}{change:.2f}",
-                        "change_percent": f"{sign}{change_percent:.2f}%",
-                        "color": color
-                    })
-            except Exception as e: print(f"[Debug] Error processing {symbol}: {e}")
-            results.append(item_data)
-        return results
+        quotes = get_dashboard_quotes(symbols)
+        return [quotes[s] for s in symbols]
     except Exception as e:
         print(f"[Debug] Error getting market dashboard data: {e}")
         return []
-
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import threading
+import requests
+from datetime import datetime
+from config import CACHE_DIR, TWSE_STATS_PUBLISH_TIME, TWSE_OPENAPI_URL
+from utils.cache_backend import register_external
+from utils.market_calendar import latest_tw_publish, next_tw_publish, parse_openapi_date
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 證交所 BWIBBU (本益比 / 殖利率 / 股價淨值比) 每日盤後才更新一次
+# - 以精簡 JSON 存在 CACHE_DIR，所有 worker 共用同一份快照
+# - 每個 worker 只在檔案變動時重新載入
+# - 公布時間後才會更新，並使用 ETag / If-Modified-Since 條件式下載
+# - 資料的 Date 是最近一個交易日才算最新 (公布前抓到的前一日資料照樣寫入，但會繼續重試)
+
+BWIBBU_URL = f"{TWSE_OPENAPI_URL}/v1/exchangeReport/BWIBBU_ALL"
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, 'bwibbu.json')
+LOCK_PATH = SNAPSHOT_PATH + '.lock'
+
+# 公布後若資料尚未更新 (304 / 同一天資料)，每 30 分鐘再試，最多到公布後 3 小時
+RETRY_INTERVAL = 1800
+PUBLISH_GRACE = 3 * 3600
+
+# _lock 只保護記憶體中的快照與檢查時間 (不在持有時下載)；讀取 _stats 不需要鎖
+_lock = threading.Lock()
+_snapshot = {}     # 磁碟上的快照內容 (meta + rows)
+_stats = {}        # 展開後的 {code: {"PE", "Yield", "PB"}}
+_loaded_mtime = None
+_next_check = 0
+_refreshing = False  # 本行程已有執行緒在下載，其他執行緒直接沿用現有資料
+
+# 全市場的表不經過快取，但大小計入快取記憶體預算 (/metrics 的 cache_memory.external)
+register_external("bwibbu", lambda: (_snapshot, _stats))
+
+
+def _publish_time():
+    return datetime.strptime(TWSE_STATS_PUBLISH_TIME, '%H:%M').time()
+
+def _is_current(snapshot):
+    """快照是否為最近一次公布的資料 (以資料本身的 Date 判斷，而非下載時間)"""
+    data_date = parse_openapi_date(snapshot.get('date'))
+    return data_date is not None and data_date >= latest_tw_publish(_publish_time()).date()
+
+def _read_snapshot():
+    """讀取磁碟上的快照，回傳 (mtime, snapshot)；沒有檔案或讀取失敗回傳 (None, None)"""
+    try:
+        mtime = os.path.getmtime(SNAPSHOT_PATH)
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            return mtime, json.load(f)
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        print(f"[Debug] Error loading BWIBBU snapshot: {e}")
+        return None, None
+
+def _load_from_disk():
+    """檔案有變動 (其他 worker 或本行程的下載已更新) 才重新載入，需持有 _lock"""
+    global _snapshot, _stats, _loaded_mtime
+    try:
+        if os.path.getmtime(SNAPSHOT_PATH) == _loaded_mtime: return True
+    except OSError:
+        return False
+
+    mtime, snapshot = _read_snapshot()
+    if snapshot is None: return False
+    _stats = {code: {"PE": row[0], "Yield": row[1], "PB": row[2]} for code, row in snapshot.get('rows', {}).items()}
+    _snapshot = snapshot
+    _loaded_mtime = mtime
+    print(f"[Debug] BWIBBU snapshot loaded: {len(_stats)} codes, date={snapshot.get('date')}")
+    return True
+
+def _write_snapshot(snapshot):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+def _refresh(current):
+    """
+    條件式下載 BWIBBU 並寫入磁碟快照，回傳 True 代表已取得最近一個交易日的資料
+    current 為呼叫時記憶體中的快照 (條件式下載的依據)；不修改記憶體中的資料，由呼叫端重新載入
+    只會有一個 worker 實際下載，其他 worker 直接沿用現有快照
+    """
+    lock_file = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        lock_file = open(LOCK_PATH, 'w')
+        if fcntl:
+            try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("[Debug] BWIBBU refresh in progress by another worker.")
+                return False
+
+        # 拿到鎖之後再讀一次，可能剛被其他 worker 更新完
+        current = _read_snapshot()[1] or current
+        if _is_current(current): return True
+
+        headers = {}
+        if current.get('etag'): headers['If-None-Match'] = current['etag']
+        if current.get('last_modified'): headers['If-Modified-Since'] = current['last_modified']
+
+        r = requests.get(BWIBBU_URL, headers=headers, timeout=10)
+        if r.status_code == 304:
+            print("[Debug] BWIBBU not modified.")
+            return False
+        if r.status_code != 200:
+            print(f"[Debug] BWIBBU fetch failed: {r.status_code}")
+            return False
+
+        data = r.json()
+        rows = {}
+        for item in data:
+            code = item.get('Code')
+            if not code: continue
+            rows[code] = [item.get('PEratio', '-'), item.get('DividendYield', '-'), item.get('PBratio', '-')]
+        data_date = next((item.get('Date') for item in data if item.get('Date')), None)
+
+        # 同一天的資料 (公布時間延後) 視為尚未更新
+        if data_date and data_date == current.get('date') and rows == current.get('rows'):
+            print(f"[Debug] BWIBBU still at {data_date}.")
+            return False
+
+        snapshot = {
+            "date": data_date,
+            "fetched_at": time.time(),
+            "etag": r.headers.get('ETag'),
+            "last_modified": r.headers.get('Last-Modified'),
+            "rows": rows
+        }
+        _write_snapshot(snapshot)
+        print(f"[Debug] BWIBBU refreshed: {len(rows)} codes, date={data_date}, {len(r.content)} bytes.")
+        # 公布時間前 (冷啟動) 取得的是前一個交易日的資料：先使用，但仍視為未更新
+        return _is_current(snapshot)
+    except Exception as e:
+        print(f"[Debug] Error refreshing BWIBBU: {e}")
+        return False
+    finally:
+        if lock_file: lock_file.close()
+
+def get_twse_stats():
+    """
+    取得全市場本益比 / 殖利率 / 股價淨值比 {code: {"PE", "Yield", "PB"}}
+    平常只讀記憶體；過了下一個檢查時間才看磁碟快照或重新下載
+    下載在 _lock 之外進行，期間其他執行緒直接回傳現有資料 (冷啟動時為空 dict)，完成後才換上新資料
+    """
+    global _next_check, _refreshing
+    if time.time() < _next_check: return _stats
+
+    with _lock:
+        if time.time() < _next_check or _refreshing: return _stats
+        _load_from_disk()
+        if _is_current(_snapshot):
+            _next_check = next_tw_publish(_publish_time()).timestamp()
+            return _stats
+        _refreshing = True
+        current = _snapshot
+
+    refreshed = False
+    try:
+        refreshed = _refresh(current)
+    finally:
+        with _lock:
+            _refreshing = False
+            _load_from_disk()
+            now = time.time()
+            publish = latest_tw_publish(_publish_time())
+            if refreshed:
+                _next_check = next_tw_publish(_publish_time()).timestamp()
+            elif now - publish.timestamp() < PUBLISH_GRACE or not _stats:
+                _next_check = now + RETRY_INTERVAL if _stats else now + 60
+            else:
+                # 已過寬限時間仍未更新 (e.g. 休市未公布)，沿用舊資料到下次公布
+                _next_check = next_tw_publish(_publish_time()).timestamp()
+    return _stats
@@ -0,0 +1,140 @@
+import os
+import time
+import sqlite3
+import threading
+from config import CACHE_DIR, WATCHLIST_DB, WATCHLIST_MAX, DASHBOARD_REFRESH
+from utils import metrics
+from services.stock_service import DASHBOARD_DEFAULT, get_dashboard_quotes
+
+# 個人自選清單 (加入 2330 / 移除 2330)
+# - 存在 SQLite (WATCHLIST_DB，建議放在 Persistent Disk)
+# - 所有使用者的清單合併成一組不重複的代號，每個市場一次批次下載，存成共用快照
+# - 每位使用者的儀表板都從快照組出來，成本只和代號數有關，與使用者數無關
+# - 問候時不等待整批更新：過期的快照在背景更新，回覆先使用舊快照
+
+# 問候儀表板固定顯示的指數，其後接個人自選 (沒有自選時顯示 DASHBOARD_DEFAULT)
+DASHBOARD_INDICES = ["^VIX", "^TWII"]
+
+# 更新失敗後隔多久再試 (不讓每一次問候都重新抓取)
+REFRESH_RETRY = 30
+
+_local = threading.local()
+_refresh_lock = threading.Lock()   # 背景更新進行中
+_state_lock = threading.Lock()
+_snapshot = {}            # symbol -> 儀表板資料
+_snapshot_symbols = set() # 快照中已查詢過的代號 (含查無資料者)
+_snapshot_at = 0
+_retry_at = 0
+
+
+def _conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(WATCHLIST_DB) or CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(WATCHLIST_DB, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS watchlists ('
+            ' user_id TEXT, symbol TEXT, added_at REAL, PRIMARY KEY (user_id, symbol))'
+        )
+        _local.conn = conn
+    return conn
+
+def get_watchlist(user_id):
+    rows = _conn().execute(
+        'SELECT symbol FROM watchlists WHERE user_id = ? ORDER BY added_at', (user_id,)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+def add_symbol(user_id, symbol):
+    """回傳 (是否成功, 目前清單)；超過 WATCHLIST_MAX 時不加入"""
+    watchlist = get_watchlist(user_id)
+    if symbol in watchlist: return True, watchlist
+    if len(watchlist) >= WATCHLIST_MAX: return False, watchlist
+    _conn().execute('INSERT OR IGNORE INTO watchlists VALUES (?, ?, ?)', (user_id, symbol, time.time()))
+    return True, watchlist + [symbol]
+
+def remove_symbol(user_id, symbol):
+    """回傳 (是否有移除, 目前清單)"""
+    cur = _conn().execute('DELETE FROM watchlists WHERE user_id = ? AND symbol = ?', (user_id, symbol))
+    return cur.rowcount > 0, get_watchlist(user_id)
+
+def get_all_symbols():
+    """所有使用者自選代號 (不重複)"""
+    return [r[0] for r in _conn().execute('SELECT DISTINCT symbol FROM watchlists').fetchall()]
+
+def count_users():
+    return _conn().execute('SELECT COUNT(DISTINCT user_id) FROM watchlists').fetchone()[0]
+
+def refresh_snapshot():
+    """合併預設代號與所有人的自選，批次更新共用快照"""
+    global _snapshot, _snapshot_symbols, _snapshot_at
+    symbols = list(dict.fromkeys(DASHBOARD_DEFAULT + get_all_symbols()))
+    start = time.monotonic()
+    quotes = get_dashboard_quotes(symbols)
+    with _state_lock:
+        _snapshot, _snapshot_symbols, _snapshot_at = quotes, set(symbols), time.time()
+    metrics.observe("watchlist.refresh", time.monotonic() - start)
+    print(f"[Watchlist] Snapshot refreshed: {len(symbols)} symbols in {time.monotonic() - start:.2f}s.")
+    return quotes
+
+def _refresh_in_background():
+    global _retry_at
+    try:
+        refresh_snapshot()
+    except Exception as e:
+        _retry_at = time.time() + REFRESH_RETRY
+        metrics.incr("watchlist.refresh_error")
+        print(f"[Debug] Error refreshing watchlist snapshot: {e}")
+    finally:
+        _refresh_lock.release()
+
+def _schedule_refresh():
+    """快照過期時在背景更新 (同時只有一個；失敗後 REFRESH_RETRY 秒內不再重試)"""
+    if time.time() - _snapshot_at < DASHBOARD_REFRESH or time.time() < _retry_at: return
+    if not _refresh_lock.acquire(blocking=False): return
+    threading.Thread(target=_refresh_in_background, name='watchlist-refresh', daemon=True).start()
+
+def warm_snapshot():
+    """啟動時在背景建立第一份快照 (第一則問候不必自己查詢)"""
+    _schedule_refresh()
+
+def _fetch_missing(symbols):
+    """快照中還沒有的代號 (剛加入自選 / 冷啟動) 直接查詢，並併入快照"""
+    global _snapshot, _snapshot_symbols, _retry_at
+    if time.time() < _retry_at: return {}
+    try:
+        quotes = get_dashboard_quotes(symbols)
+    except Exception as e:
+        _retry_at = time.time() + REFRESH_RETRY
+        print(f"[Debug] Error fetching dashboard quotes for {symbols}: {e}")
+        return {}
+    metrics.incr("watchlist.direct_fetch")
+    with _state_lock:
+        _snapshot = {**_snapshot, **quotes}
+        _snapshot_symbols = _snapshot_symbols | set(symbols)
+    return quotes
+
+def get_snapshot(required=()):
+    """
+    取得共用快照，不等待整批更新：過期 (DASHBOARD_REFRESH 秒) 時在背景更新並先回傳舊快照，
+    只有快照中沒有的 required 代號才直接查詢
+    """
+    _schedule_refresh()
+    snapshot = _snapshot
+    missing = [s for s in required if s not in _snapshot_symbols]
+    if not missing: return snapshot
+    return {**snapshot, **_fetch_missing(missing)}
+
+def get_user_dashboard(user_id):
+    """使用者的儀表板資料 (格式同 get_market_dashboard_data)"""
+    watchlist = []
+    if user_id:
+        try: watchlist = get_watchlist(user_id)
+        except Exception as e: print(f"[Debug] Error reading watchlist for {user_id}: {e}")
+    symbols = list(dict.fromkeys(DASHBOARD_INDICES + watchlist)) if watchlist else DASHBOARD_DEFAULT
+    snapshot = get_snapshot(symbols)
+    return [snapshot[s] for s in symbols if s in snapshot]
+
+metrics.register_gauge("watchlist.snapshot_symbols", lambda: len(_snapshot_symbols))
+metrics.register_gauge("watchlist.users", count_users)
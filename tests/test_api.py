@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+import api
+from utils.quota import COMMAND_CLASSES
+
+
+class ApiQuotaTest(unittest.TestCase):
+    """公開模式 (未設定 API_TOKEN) 的 /api/v1 配額"""
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(api.api_v1)
+        self.client = app.test_client()
+        patch = mock.patch.object(api, 'API_TOKEN', '')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_limited_request_gets_429_without_fetching(self):
+        with mock.patch.object(api, 'consume', return_value=(False, 12.3)) as consume, \
+             mock.patch.object(api, 'generate_stock_chart_url_async') as chart:
+            response = self.client.get('/api/v1/chart/2330,0050', headers={'X-Forwarded-For': '1.2.3.4'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '13')
+        # 沒有設定反向代理時不採用用戶端帶的 X-Forwarded-For
+        consume.assert_called_once_with('api_chart', 'ip:127.0.0.1', None, 2)
+        chart.assert_not_called()
+
+    def test_forwarded_for_from_trusted_proxy(self):
+        with mock.patch.object(api, 'API_TRUSTED_PROXIES', 1), \
+             mock.patch.object(api, 'consume', return_value=(False, 1)) as consume:
+            # 用戶端偽造的 6.6.6.6 在前，代理附加的實際來源在最後
+            self.client.get('/api/v1/chart/2330', headers={'X-Forwarded-For': '6.6.6.6, 1.2.3.4'})
+        self.assertEqual(consume.call_args.args[1], 'ip:1.2.3.4')
+
+    def test_public_api_has_its_own_quota_classes(self):
+        line_classes = {cls for command, cls in COMMAND_CLASSES.items() if not command.startswith('api_')}
+        for endpoint in ('quote', 'forex', 'indicators', 'chart'):
+            self.assertNotIn(COMMAND_CLASSES[f"api_{endpoint}"], line_classes)
+
+    def test_each_symbol_costs_one(self):
+        async def fake_quote(symbol):
+            return {"symbol": symbol}
+        with mock.patch.object(api, 'consume', return_value=(True, 0)) as consume, \
+             mock.patch.object(api, 'get_stock_info_async', fake_quote):
+            response = self.client.get('/api/v1/quote/2330,0050,2317')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(consume.call_args.args[0], 'api_quote')
+        self.assertEqual(consume.call_args.args[3], 3)
+
+    def test_token_holders_are_not_limited(self):
+        with mock.patch.object(api, 'API_TOKEN', 'secret'), \
+             mock.patch.object(api, 'consume') as consume:
+            self.assertEqual(self.client.get('/api/v1/quote/2330').status_code, 401)
+            with mock.patch.object(api, 'get_stock_info_async', mock.AsyncMock(return_value={"symbol": "2330"})):
+                response = self.client.get('/api/v1/quote/2330', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        consume.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,320 @@
+import io
+import os
+import pickle
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import socketserver
+import unittest
+from unittest import mock
+
+from utils import cache_backend
+from utils.cache_backend import MemoryCache, SQLiteCache, RedisCache, _MemoryBudget, _RespClient, _dumps, _loads
+
+
+def _ttl(seconds):
+    return lambda key, value, now: now + seconds
+
+
+class DumpsTest(unittest.TestCase):
+    def test_small_value_is_not_compressed(self):
+        blob = _dumps({"price": 1.5})
+        self.assertEqual(blob[:1], b'p')
+        self.assertEqual(_loads(blob), {"price": 1.5})
+
+    def test_large_value_is_compressed(self):
+        value = {"rows": list(range(2000))}
+        blob = _dumps(value)
+        self.assertEqual(blob[:1], b'z')
+        self.assertLess(len(blob), len(pickle.dumps(value)))
+        self.assertEqual(_loads(blob), value)
+
+    def test_loads_accepts_memoryview(self):
+        # sqlite3 回傳的 BLOB
+        self.assertEqual(_loads(memoryview(_dumps(("2330", 1)))), ("2330", 1))
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    """獨立的預算與註冊表，不影響其他模組的快取"""
+
+    def setUp(self):
+        self.budget = _MemoryBudget(50_000)
+        for p in (mock.patch.object(cache_backend, '_budget', self.budget),
+                  mock.patch.object(cache_backend, '_registry', {})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def make(self, name):
+        cache = MemoryCache(name, 100, _ttl(60))
+        cache_backend._registry[name] = cache
+        return cache
+
+    def test_external_data_counts_toward_report(self):
+        table = {"rows": {str(i): [1.0, 2.0, 3.0] for i in range(500)}}
+        cache_backend.register_external('table', lambda: table)
+        cache = self.make('quotes')
+        cache['k'] = 'v'
+        report = cache_backend.memory_report()
+        self.assertGreater(report["external"]["table"], 10_000)
+        self.assertEqual(report["used"], cache.currsize + report["external"]["table"])
+
+    def test_external_data_squeezes_caches(self):
+        cache = self.make('quotes')
+        for i in range(10): cache[i] = 'x' * 1000
+        self.assertEqual(len(cache), 10)
+        # 外部資料佔掉大部分預算後，快取要淘汰到總量回到預算內
+        cache_backend.register_external('table', lambda: b'x' * 45_000)
+        cache['new'] = 'x' * 1000
+        self.assertLessEqual(self.budget.used(), self.budget.limit)
+        self.assertLess(len(cache), 10)
+
+    def test_external_is_resized_periodically(self):
+        table = {}
+        cache_backend.register_external('table', lambda: table)
+        empty = self.budget.external()['table']
+        table.update({i: i for i in range(1000)})
+        self.assertEqual(self.budget.external()['table'], empty)
+        self.budget._external_at = 0
+        self.assertGreater(self.budget.external()['table'], empty)
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_round_trip_with_tuple_keys(self):
+        cache = SQLiteCache('quotes', 10, _ttl(60), path=self.path)
+        cache[('tw', '2330')] = {"price": 600.0}
+        self.assertEqual(cache[('tw', '2330')], {"price": 600.0})
+        self.assertIn(('tw', '2330'), cache)
+        self.assertIsNone(cache.get(('tw', '2317')))
+        self.assertEqual(len(cache), 1)
+
+    def test_shared_between_instances(self):
+        SQLiteCache('quotes', 10, _ttl(60), path=self.path)['k'] = 1
+        self.assertEqual(SQLiteCache('quotes', 10, _ttl(60), path=self.path)['k'], 1)
+        self.assertIsNone(SQLiteCache('other', 10, _ttl(60), path=self.path).get('k'))
+
+    def test_entry_expires(self):
+        cache = SQLiteCache('quotes', 10, _ttl(30), path=self.path)
+        now = time.time()
+        with mock.patch.object(cache_backend.time, 'time', return_value=now):
+            cache['k'] = 'v'
+        with mock.patch.object(cache_backend.time, 'time', return_value=now + 29):
+            self.assertEqual(cache['k'], 'v')
+        with mock.patch.object(cache_backend.time, 'time', return_value=now + 31):
+            self.assertNotIn('k', cache)
+            self.assertEqual(len(cache), 0)
+
+    def test_already_expired_value_is_not_stored(self):
+        cache = SQLiteCache('quotes', 10, _ttl(0), path=self.path)
+        cache['k'] = 'v'
+        self.assertIsNone(cache.get('k'))
+
+    def test_pop_and_delete(self):
+        cache = SQLiteCache('quotes', 10, _ttl(60), path=self.path)
+        cache['k'] = 'v'
+        self.assertEqual(cache.pop('k'), 'v')
+        self.assertEqual(cache.pop('k', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            del cache['k']
+
+    def test_prune_keeps_maxsize_latest_expiring(self):
+        cache = SQLiteCache('quotes', 3, lambda key, value, now: now + 60 + key, path=self.path)
+        cache.PRUNE_EVERY = 5
+        for i in range(5): cache[i] = i
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(i) for i in range(5)], [None, None, 2, 3, 4])
+
+
+class RespReadTest(unittest.TestCase):
+    def read(self, raw):
+        return _RespClient('redis://localhost')._read(io.BytesIO(raw))
+
+    def test_simple_and_integer_replies(self):
+        self.assertEqual(self.read(b'+OK\r\n'), b'OK')
+        self.assertEqual(self.read(b':42\r\n'), 42)
+
+    def test_error_reply_raises(self):
+        with self.assertRaisesRegex(RuntimeError, 'WRONGTYPE'):
+            self.read(b'-WRONGTYPE Operation against a key\r\n')
+
+    def test_nil_replies(self):
+        self.assertIsNone(self.read(b'$-1\r\n'))
+        self.assertIsNone(self.read(b'*-1\r\n'))
+
+    def test_bulk_string_may_contain_crlf(self):
+        self.assertEqual(self.read(b'$4\r\na\r\nb\r\n'), b'a\r\nb')
+        self.assertEqual(self.read(b'$0\r\n\r\n'), b'')
+
+    def test_nested_array(self):
+        self.assertEqual(self.read(b'*3\r\n$1\r\na\r\n:1\r\n*1\r\n$-1\r\n'), [b'a', 1, [None]])
+
+    def test_closed_connection(self):
+        with self.assertRaises(ConnectionError):
+            self.read(b'')
+
+    def test_unknown_reply(self):
+        with self.assertRaises(RuntimeError):
+            self.read(b'?\r\n')
+
+
+class _FakeRedis(socketserver.ThreadingTCPServer):
+    """只支援快取用到的指令，到期時間依 PX 以本機時間計算"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, password=None):
+        super().__init__(('127.0.0.1', 0), _FakeRedisHandler)
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.drop_next = False
+
+    @property
+    def url(self):
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}127.0.0.1:{self.server_address[1]}/2"
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line: return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            n = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def bulk(self, value):
+        return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        server = self.server
+        authed = not server.password
+        while True:
+            args = self.read_command()
+            if args is None: return
+            cmd = args[0].upper()
+            server.commands.append([cmd] + args[1:])
+            if server.drop_next:
+                server.drop_next = False
+                return
+            now = time.time()
+            for k, (_, expires_at) in list(server.data.items()):
+                if expires_at is not None and expires_at <= now: del server.data[k]
+
+            if cmd == b'AUTH':
+                authed = args[1].decode() == server.password
+                reply = b'+OK\r\n' if authed else b'-ERR invalid password\r\n'
+            elif not authed:
+                reply = b'-NOAUTH Authentication required.\r\n'
+            elif cmd == b'SELECT':
+                reply = b'+OK\r\n'
+            elif cmd == b'GET':
+                entry = server.data.get(args[1])
+                reply = self.bulk(entry[0] if entry else None)
+            elif cmd == b'SET':
+                expires_at = now + int(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b'PX' else None
+                server.data[args[1]] = (args[2], expires_at)
+                reply = b'+OK\r\n'
+            elif cmd == b'DEL':
+                reply = b':%d\r\n' % sum(server.data.pop(k, None) is not None for k in args[1:])
+            elif cmd == b'EXISTS':
+                reply = b':%d\r\n' % (args[1] in server.data)
+            elif cmd == b'KEYS':
+                prefix = args[1].rstrip(b'*')
+                keys = [k for k in server.data if k.startswith(prefix)]
+                reply = b'*%d\r\n' % len(keys) + b''.join(self.bulk(k) for k in keys)
+            else:
+                reply = b"-ERR unknown command '%s'\r\n" % cmd
+            self.wfile.write(reply)
+            self.wfile.flush()
+
+
+class RedisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _FakeRedis(password='secret')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = _RespClient(self.server.url)
+
+    def tearDown(self):
+        self.client._reset()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_auth_and_select_on_connect(self):
+        self.assertEqual(self.client.call(b'SET', b'k', b'v'), b'OK')
+        self.assertEqual([c[0] for c in self.server.commands[:2]], [b'AUTH', b'SELECT'])
+        self.assertEqual(self.server.commands[1][1], b'2')
+
+    def test_round_trip_and_prefix(self):
+        cache = RedisCache('quotes', 10, _ttl(60), client=self.client)
+        cache[('tw', '2330')] = {"price": 600.0, "rows": list(range(2000))}
+        self.assertEqual(cache[('tw', '2330')], {"price": 600.0, "rows": list(range(2000))})
+        self.assertIn(('tw', '2330'), cache)
+        self.assertEqual(list(self.server.data), [b"lfb:quotes:('tw', '2330')"])
+        # 大於 1KB 的值以 zlib 壓縮後存放
+        self.assertEqual(self.server.data[b"lfb:quotes:('tw', '2330')"][0][:1], b'z')
+
+    def test_ttl_is_sent_as_px_and_expires(self):
+        cache = RedisCache('quotes', 10, _ttl(0.2), client=self.client)
+        cache['k'] = 'v'
+        set_cmd = next(c for c in self.server.commands if c[0] == b'SET')
+        self.assertEqual(set_cmd[3], b'PX')
+        self.assertTrue(0 < int(set_cmd[4]) <= 200)
+        self.assertEqual(cache['k'], 'v')
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('k'))
+
+    def test_already_expired_value_is_not_sent(self):
+        cache = RedisCache('quotes', 10, _ttl(-1), client=self.client)
+        cache['k'] = 'v'
+        self.assertFalse(any(c[0] == b'SET' for c in self.server.commands))
+
+    def test_missing_key_and_delete(self):
+        cache = RedisCache('quotes', 10, _ttl(60), client=self.client)
+        self.assertIsNone(cache.get('missing'))
+        cache['k'] = 'v'
+        self.assertEqual(cache.pop('k'), 'v')
+        with self.assertRaises(KeyError):
+            del cache['k']
+
+    def test_clear_only_own_prefix(self):
+        quotes = RedisCache('quotes', 10, _ttl(60), client=self.client)
+        names = RedisCache('names', 10, _ttl(60), client=self.client)
+        quotes['a'] = 1; quotes['b'] = 2; names['a'] = 'x'
+        quotes.clear()
+        self.assertIsNone(quotes.get('a'))
+        self.assertEqual(names['a'], 'x')
+
+    def test_error_reply_is_a_cache_miss(self):
+        self.client = _RespClient(self.server.url.replace('secret', 'wrong'))
+        cache = RedisCache('quotes', 10, _ttl(60), client=self.client)
+        self.assertIsNone(cache.get('k'))
+        cache['k'] = 'v'    # 寫入失敗不拋出
+        self.assertEqual(self.server.data, {})
+
+    def test_reconnects_once_after_dropped_connection(self):
+        cache = RedisCache('quotes', 10, _ttl(60), client=self.client)
+        cache['k'] = 'v'
+        self.server.drop_next = True
+        self.assertEqual(cache['k'], 'v')
+
+    def test_unreachable_server_is_a_cache_miss(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        cache = RedisCache('quotes', 10, _ttl(60), client=_RespClient(f"redis://127.0.0.1:{port}", timeout=0.5))
+        self.assertIsNone(cache.get('k'))
+
+
+if __name__ == '__main__':
+    unittest.main()
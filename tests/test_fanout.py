@@ -0,0 +1,33 @@
+import time
+import unittest
+
+from utils import fanout
+
+
+def _slow(seconds, value):
+    return lambda: time.sleep(seconds) or value
+
+
+class NestedFanOutTest(unittest.TestCase):
+    def nested(self, **kwargs):
+        return fanout.fan_out({'inner': lambda: fanout.fan_out(**kwargs)})['inner']
+
+    def test_nested_call_keeps_deadline(self):
+        start = time.monotonic()
+        result = self.nested(calls={'slow': _slow(2, 1), 'fast': lambda: 2}, deadline=0.3)
+        self.assertEqual(result, {'slow': None, 'fast': 2})
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_nested_call_drops_optional(self):
+        result = self.nested(calls={'fast': lambda: 1, 'pe': _slow(2, 3)}, optional=('pe',), optional_deadline=0.1)
+        self.assertEqual(result, {'fast': 1, 'pe': None})
+
+    def test_nested_calls_run_in_parallel(self):
+        start = time.monotonic()
+        result = self.nested(calls={i: _slow(0.3, i) for i in range(4)})
+        self.assertEqual(result, {i: i for i in range(4)})
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+from utils.market_calendar import TW_TZ
+from services import intraday_service as intraday
+
+DAY = (2024, 10, 18)
+
+
+def _at(hour, minute, second=0):
+    return TW_TZ.localize(datetime(*DAY, hour, minute, second))
+
+
+def _mis(symbol, price, volume, last_trade=True):
+    return {"symbol": symbol, "price": price, "volume": volume, "source": "mis", "last_trade": last_trade}
+
+
+def _yahoo(start, end, interval='1m', price=50.0):
+    index = pd.date_range(_at(*start), _at(*end), freq=f"{intraday.BAR_INTERVALS[interval]}min", inclusive='left')
+    return pd.DataFrame({'Open': price, 'High': price, 'Low': price, 'Close': price, 'Volume': 1}, index=index)
+
+
+class _IntradayCase(unittest.TestCase):
+    """每個測試使用獨立的 SQLite 檔案"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for p in (mock.patch.object(intraday, 'DB_PATH', os.path.join(self.dir, 'intraday.db')),
+                  mock.patch.object(intraday, 'LOCK_PATH', os.path.join(self.dir, 'intraday.lock')),
+                  mock.patch.object(intraday, 'CACHE_DIR', self.dir),
+                  mock.patch.object(intraday, '_local', threading.local()),
+                  mock.patch.object(intraday, '_backfill', {}),
+                  mock.patch.object(intraday, '_touched', {}),
+                  mock.patch.object(intraday, '_lock_file', None),
+                  mock.patch.object(intraday, '_start_poller')):
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def tearDown(self):
+        conn = getattr(intraday._local, 'conn', None)
+        if conn: conn.close()
+        if intraday._lock_file not in (None, True): intraday._lock_file.close()
+
+    def frame(self, now, backfill):
+        with mock.patch.object(intraday, 'now_taipei', return_value=now):
+            return intraday.session_frame('2330', '1m', backfill)
+
+
+class RecordTest(_IntradayCase):
+    def test_bars_from_quotes(self):
+        intraday.record_quote(_mis('2330', 100.0, 1000), now=_at(9, 0, 5))
+        intraday.record_quote(_mis('2330', 101.0, 3000), now=_at(9, 0, 40))
+        intraday.record_quote(_mis('2330', 99.0, 3500), now=_at(9, 1, 10))
+        bars = intraday.get_bars('2330')
+        self.assertEqual(bars['Close'].tolist(), [101.0, 99.0])
+        self.assertEqual(bars['High'].tolist(), [101.0, 99.0])
+        self.assertEqual(bars['Volume'].tolist(), [2000, 500])
+
+    def test_midpoint_quote_is_not_a_trade(self):
+        intraday.record_quote(_mis('2330', 100.0, 1000), now=_at(9, 0, 5))
+        intraday.record_quote(_mis('2330', 100.5, 1000, last_trade=False), now=_at(9, 1, 5))
+        self.assertEqual(intraday.get_bars('2330')['Close'].tolist(), [100.0])
+
+    def test_yahoo_quotes_are_ignored(self):
+        intraday.record_quote({"symbol": "2330", "price": 100.0, "source": "yahoo"}, now=_at(9, 0, 5))
+        self.assertIsNone(intraday.get_bars('2330'))
+
+    def test_new_session_clears_bars(self):
+        intraday.record('2330', 100.0, 1000, now=_at(9, 0, 5))
+        intraday.record('2330', 110.0, 10, now=TW_TZ.localize(datetime(2024, 10, 21, 9, 0, 5)))
+        bars = intraday.get_bars('2330')
+        self.assertEqual(len(bars), 1)
+        self.assertEqual(bars['Volume'].tolist(), [0])
+
+    def test_shared_between_connections(self):
+        # 其他 worker (另一條連線) 寫入的 K 棒
+        intraday.record('2330', 100.0, 1000, now=_at(9, 0, 5))
+        other = threading.local()
+        with mock.patch.object(intraday, '_local', other):
+            self.assertEqual(intraday.get_bars('2330')['Close'].tolist(), [100.0])
+        other.conn.close()
+
+
+class SessionFrameTest(_IntradayCase):
+    def observe(self, start, end, price=100.0, step=10):
+        """start ~ end 每 step 秒一筆報價 (模擬輪詢)"""
+        t, volume = _at(*start), 0
+        while t <= _at(*end):
+            volume += 1000
+            intraday.record('2330', price, volume, now=t)
+            t += pd.Timedelta(seconds=step)
+
+    def test_contiguous_from_open_uses_local_only(self):
+        self.observe((9, 0), (9, 30))
+        backfill = mock.Mock()
+        frame = self.frame(_at(9, 30, 20), backfill)
+        backfill.assert_not_called()
+        self.assertEqual(len(frame), 31)
+
+    def test_early_session_is_backfilled(self):
+        self.observe((9, 5, 30), (9, 30))
+        frame = self.frame(_at(9, 30, 20), lambda: _yahoo((9, 0), (9, 29)))
+        # 09:00 ~ 09:05 (含只記錄到後半分鐘的 09:05) 來自 Yahoo
+        self.assertEqual(frame.index[0], _at(9, 0))
+        self.assertEqual(frame['Close'][:6].tolist(), [50.0] * 6)
+        self.assertEqual(frame['Close'][6:].tolist(), [100.0] * 25)
+        self.assertTrue(frame.index.is_unique)
+
+    def test_internal_gap_is_backfilled(self):
+        # 09:05 查詢後輪詢到 09:35 停止，12:00 再次查詢
+        self.observe((9, 0), (9, 35))
+        self.observe((12, 0, 30), (12, 10, 30))
+        frame = self.frame(_at(12, 10, 40), lambda: _yahoo((9, 0), (12, 5)))
+        gap = frame[(frame.index > _at(9, 35)) & (frame.index < _at(12, 0))]
+        self.assertEqual(len(gap), 144)
+        self.assertEqual(set(gap['Close']), {50.0})
+        # 缺口兩端只記錄到部分的 K 棒改用 Yahoo
+        self.assertEqual(frame.loc[_at(9, 35), 'Close'], 50.0)
+        self.assertEqual(frame.loc[_at(12, 0), 'Close'], 50.0)
+        self.assertEqual(frame.loc[_at(9, 34), 'Close'], 100.0)
+        self.assertEqual(frame.loc[_at(12, 1), 'Close'], 100.0)
+
+    def test_trailing_gap_after_polling_stopped(self):
+        self.observe((9, 0), (9, 30))
+        frame = self.frame(_at(13, 45), lambda: _yahoo((9, 0), (13, 31)))
+        self.assertEqual(frame.index[-1], _at(13, 30))
+        self.assertEqual(frame.loc[_at(10, 0), 'Close'], 50.0)
+
+    def test_backfill_is_not_refetched_until_retry(self):
+        self.observe((9, 5), (9, 30))
+        backfill = mock.Mock(return_value=_yahoo((9, 0), (9, 2)))
+        self.frame(_at(9, 30, 20), backfill)
+        self.frame(_at(9, 30, 30), backfill)
+        self.assertEqual(backfill.call_count, 1)
+
+    def test_previous_session_is_not_today(self):
+        # 10/17 記錄到 09:30，10/18 收盤後查詢：不可把 10/17 的 K 棒當成今天
+        thursday = pd.Timedelta(days=1)
+        t = _at(9, 0) - thursday
+        while t <= _at(9, 30) - thursday:
+            intraday.record('2330', 100.0, None, now=t)
+            t += pd.Timedelta(seconds=10)
+        backfill = mock.Mock(return_value=_yahoo((9, 0), (13, 31)))
+        self.assertIsNone(self.frame(_at(15, 0), backfill))
+        # 隔天開盤前仍是 10/18 的走勢
+        self.observe((9, 0), (13, 30), step=60)
+        monday_early = TW_TZ.localize(datetime(2024, 10, 21, 8, 30))
+        self.assertIsNotNone(self.frame(monday_early, mock.Mock(return_value=None)))
+
+    def test_failed_backfill_returns_local(self):
+        self.observe((9, 5), (9, 30))
+        frame = self.frame(_at(9, 30, 20), mock.Mock(side_effect=RuntimeError('yahoo down')))
+        self.assertEqual(frame.index[0], _at(9, 5))
+
+
+class PollerTest(_IntradayCase):
+    def test_only_one_worker_polls(self):
+        self.assertTrue(intraday._is_poller())
+        # 另一個 worker 的鎖定 (同一個檔案的另一個 open)
+        with mock.patch.object(intraday, '_lock_file', None):
+            self.assertFalse(intraday._is_poller())
+
+    def test_poll_records_recent_symbols_and_skips_midpoints(self):
+        with mock.patch.object(intraday.time, 'time', return_value=_at(9, 0).timestamp()):
+            intraday.touch('2330')
+            intraday.touch('2317')
+        quotes = {"2330": _mis('2330', 100.0, 1000), "2317": _mis('2317', 150.5, 0, last_trade=False)}
+        with mock.patch('services.stock_service.get_mis_quotes', return_value=quotes) as get, \
+             mock.patch.object(intraday.time, 'time', return_value=_at(9, 1).timestamp()), \
+             mock.patch.object(intraday, 'now_taipei', return_value=_at(9, 1)):
+            self.assertEqual(intraday.poll_once(), 2)
+        self.assertEqual(sorted(get.call_args.args[0]), ['2317', '2330'])
+        self.assertEqual(intraday.get_bars('2330')['Close'].tolist(), [100.0])
+        self.assertIsNone(intraday.get_bars('2317'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from services.level_service import compute_levels
+
+
+def _frame(close, volume=1000):
+    close = np.asarray(close, dtype=float)
+    return pd.DataFrame({'Open': close, 'High': close * 1.01, 'Low': close * 0.99, 'Close': close, 'Volume': volume},
+                        index=pd.date_range('2024-01-01', periods=len(close), freq='D'))
+
+
+class ComputeLevelsTest(unittest.TestCase):
+    def test_flat_series(self):
+        # 價格完全不動：成交量全落在同一個區間，其他區間為 0
+        df = pd.DataFrame({'Open': 50.0, 'High': 50.0, 'Low': 50.0, 'Close': 50.0, 'Volume': 1000},
+                          index=pd.date_range('2024-01-01', periods=120, freq='D'))
+        levels = compute_levels(df)
+        self.assertIsNotNone(levels)
+        self.assertEqual(levels['sentiment'], '盤整')
+
+    def test_single_spike(self):
+        rng = np.random.default_rng(0)
+        close = 50 + rng.normal(0, 0.3, 120)
+        close[60] = 80
+        levels = compute_levels(_frame(close))
+        self.assertIsNotNone(levels)
+
+    def test_no_volume(self):
+        self.assertIsNotNone(compute_levels(_frame(np.linspace(40, 60, 120), volume=0)))
+
+    def test_support_below_and_resistance_above(self):
+        close = np.concatenate([np.linspace(100, 120, 40), np.linspace(120, 100, 40), np.linspace(100, 110, 40)])
+        levels = compute_levels(_frame(close))
+        if levels['support_price']: self.assertLess(levels['support_price'], close[-1])
+        if levels['resistance_price']: self.assertGreater(levels['resistance_price'], close[-1])
+
+    def test_too_short(self):
+        self.assertIsNone(compute_levels(_frame([50.0] * 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from datetime import date, datetime
+from unittest import mock
+
+from utils.market_calendar import TW_TZ
+from services import market_panel_service as mp
+
+TODAY, YESTERDAY = date(2024, 10, 18), date(2024, 10, 17)
+
+
+def _source(*days):
+    """依序回傳各次抓取的 (日期, rows)"""
+    results = iter(days)
+    def fetch():
+        day = next(results)
+        return day, {f"{day.day}": (1.0, 1.0, 1.0, 1.0, 100, '.TW')}
+    return mock.Mock(side_effect=fetch)
+
+
+class _Clock:
+    """sleep 只推進時間，不實際等待"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class UpdatePanelTest(unittest.TestCase):
+    """來源日期與預期交易日不符 (尚未更新) 時不寫入，並重試該來源"""
+
+    def setUp(self):
+        self.write = mock.patch.object(mp, 'write_days', return_value=True).start()
+        mock.patch.object(mp, 'expected_trading_day', return_value=TODAY).start()
+        mock.patch.object(mp, 'time', _Clock()).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def sources(self, twse, tpex):
+        self.twse, self.tpex = twse, tpex
+        mock.patch.dict(mp.SOURCES, {"twse": twse, "tpex": tpex}).start()
+
+    def test_lagging_source_is_retried_until_current(self):
+        self.sources(_source(TODAY), _source(YESTERDAY, YESTERDAY, TODAY))
+        result = mp.update_panel(retry_interval=600, retry_for=3600)
+        self.assertEqual(self.twse.call_count, 1)
+        self.assertEqual(self.tpex.call_count, 3)
+        # 前一日的資料不寫入，每次只寫入當天的來源
+        self.assertEqual([list(c.args[0]) for c in self.write.call_args_list], [[TODAY], [TODAY]])
+        self.assertEqual(result["missing"], [])
+        self.assertEqual(set(result["codes"]), {"twse", "tpex"})
+
+    def test_gives_up_and_reports_missing_source(self):
+        self.sources(_source(TODAY), _source(*[YESTERDAY] * 10))
+        with self.assertRaisesRegex(RuntimeError, 'tpex'):
+            mp.update_panel(retry_interval=600, retry_for=1500)
+        self.assertEqual(self.tpex.call_count, 3)
+        self.assertEqual(mp.last_update["missing"], ["tpex"])
+        self.assertEqual(list(mp.last_update["codes"]), ["twse"])
+
+    def test_no_retry(self):
+        self.sources(_source(TODAY), _source(YESTERDAY))
+        with self.assertRaises(RuntimeError):
+            mp.update_panel(retry_for=0)
+        self.assertEqual(self.tpex.call_count, 1)
+
+    def test_failed_write_is_retried(self):
+        self.sources(_source(TODAY, TODAY), _source(TODAY, TODAY))
+        self.write.side_effect = [False, True]
+        self.assertEqual(mp.update_panel(retry_interval=600, retry_for=3600)["missing"], [])
+        self.assertEqual(self.write.call_count, 2)
+
+
+class ExpectedTradingDayTest(unittest.TestCase):
+    def at(self, *args):
+        return mp.expected_trading_day(TW_TZ.localize(datetime(*args)))
+
+    def test_today_after_settle(self):
+        self.assertEqual(self.at(2024, 10, 18, 16, 30), TODAY)
+
+    def test_previous_day_before_settle(self):
+        self.assertEqual(self.at(2024, 10, 18, 12, 0), YESTERDAY)
+
+    def test_weekend_is_last_trading_day(self):
+        self.assertEqual(self.at(2024, 10, 20, 16, 30), TODAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
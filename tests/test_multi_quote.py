@@ -0,0 +1,62 @@
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from utils.common import parse_multi_symbols
+from services import stock_service
+
+
+class ParseMultiSymbolsTest(unittest.TestCase):
+    def test_bare_us_tickers(self):
+        self.assertEqual(parse_multi_symbols("AAPL NVDA TSLA"), ['AAPL', 'NVDA', 'TSLA'])
+        self.assertEqual(parse_multi_symbols("aapl  nvda"), ['AAPL', 'NVDA'])
+
+    def test_bare_us_tickers_are_limited(self):
+        self.assertIsNone(parse_multi_symbols("AAPL NVDA TSLA MSFT AMZN META"))
+        self.assertEqual(len(parse_multi_symbols("AAPL,NVDA,TSLA,MSFT,AMZN,META")), 6)
+        self.assertEqual(len(parse_multi_symbols("$AAPL $NVDA $TSLA $MSFT $AMZN $META")), 6)
+
+    def test_not_a_query(self):
+        self.assertIsNone(parse_multi_symbols("AAPL"))
+        self.assertIsNone(parse_multi_symbols("2330 分析"))
+        self.assertIsNone(parse_multi_symbols("GOOD MORNING"))
+
+    def test_tw_symbols(self):
+        self.assertEqual(parse_multi_symbols("2330 2317 2330"), ['2330', '2317'])
+
+
+def _history(tickers):
+    index = pd.date_range('2024-10-01', periods=3, freq='D')
+    frames = {t: pd.DataFrame({'Open': 10.0, 'High': [11.0, 12.0, 13.0], 'Low': 9.0,
+                               'Close': [10.0, 10.0, 11.0], 'Volume': 100}, index=index) for t in tickers}
+    return pd.concat(frames, axis=1)
+
+
+class BatchUsProfileTest(unittest.TestCase):
+    def batch(self, profile):
+        with mock.patch.object(stock_service.yf, 'download', side_effect=lambda tickers, **kw: _history(tickers)), \
+             mock.patch.object(stock_service, 'get_us_stock_info', side_effect=profile):
+            return stock_service.get_batch_stock_info(['AAPL', 'NVDA'])
+
+    def test_profile_fills_name_market_cap_and_pe(self):
+        profiles = {'AAPL': {"name": "Apple Inc.", "market_cap": 3e12, "pe_ratio": 30.5, "price": 1.0}}
+        aapl, nvda = self.batch(profiles.get)
+        self.assertEqual((aapl['name'], aapl['market_cap'], aapl['pe_ratio']), ("Apple Inc.", 3e12, 30.5))
+        # 價格以批次下載為準
+        self.assertEqual(aapl['price'], 11.0)
+        self.assertEqual((nvda['name'], nvda['market_cap'], nvda['pe_ratio']), ("NVDA", 0, '-'))
+
+    def test_slow_profile_is_dropped(self):
+        def slow(symbol):
+            time.sleep(3)
+            return {"name": symbol.lower()}
+        start = time.monotonic()
+        stocks = self.batch(slow)
+        self.assertLess(time.monotonic() - start, 2.5)
+        self.assertEqual([s['name'] for s in stocks], ['AAPL', 'NVDA'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from services import prefetch_service as prefetch
+
+
+class RequestLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for p in (mock.patch.object(prefetch, 'CACHE_DIR', self.dir),
+                  mock.patch.object(prefetch, 'REQUEST_LOG_PATH', os.path.join(self.dir, 'symbol_requests.log')),
+                  mock.patch.object(prefetch, 'REQUEST_LOCK_PATH', os.path.join(self.dir, 'symbol_requests.lock'))):
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def test_popular_symbols(self):
+        for symbol in ['2330', '2330', 'aapl', '2330', 'AAPL', '0050']:
+            prefetch.record_symbol_request(symbol)
+        self.assertEqual(prefetch.get_popular_symbols(limit=2), ['2330', 'AAPL'])
+
+    def test_compaction_keeps_concurrent_appends(self):
+        def record(i):
+            for _ in range(200): prefetch.record_symbol_request(f"S{i}")
+        def compact():
+            for _ in range(50): prefetch.get_popular_symbols()
+        threads = [threading.Thread(target=record, args=(i,)) for i in range(4)] + [threading.Thread(target=compact)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        with open(prefetch.REQUEST_LOG_PATH, encoding='utf-8') as f:
+            self.assertEqual(sum(1 for _ in f), 800)
+
+
+class SharedCacheTest(unittest.TestCase):
+    def test_memory_backend_is_rejected(self):
+        with mock.patch.object(prefetch, 'CACHE_BACKEND', 'memory'):
+            with self.assertRaises(RuntimeError):
+                prefetch.run_nightly_prefetch()
+
+    def test_shared_backend_is_allowed(self):
+        with mock.patch.object(prefetch, 'CACHE_BACKEND', 'sqlite'):
+            prefetch.check_shared_cache()
+
+
+if __name__ == '__main__':
+    unittest.main()
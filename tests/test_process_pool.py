@@ -0,0 +1,49 @@
+import time
+import unittest
+from unittest import mock
+
+from utils import metrics, process_pool
+
+
+def _slow_square(x, seconds):
+    time.sleep(seconds)
+    return x * x
+
+
+class OffloadTimeoutTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.patches = [mock.patch.object(process_pool, 'CPU_POOL_WORKERS', 1),
+                       mock.patch.object(process_pool, 'CPU_TASK_TIMEOUT', 0.5)]
+        for p in cls.patches: p.start()
+        # 子程序啟動較慢，先暖機
+        process_pool.run(_slow_square, 2, 0, name='warmup')
+
+    @classmethod
+    def tearDownClass(cls):
+        process_pool._reset_pool()
+        for p in cls.patches: p.stop()
+
+    def test_remote_result(self):
+        self.assertEqual(process_pool.run(_slow_square, 3, 0, name='square'), 9)
+
+    def test_timeout_runs_inline(self):
+        before = metrics.get_counter("cpu_pool.slow_square.timeout")
+        # 子程序 1 秒才完成：0.5 秒逾時後改在原執行緒以同樣的參數計算
+        self.assertEqual(process_pool.run(_slow_square, 4, 1, name='slow_square'), 16)
+        self.assertEqual(metrics.get_counter("cpu_pool.slow_square.timeout"), before + 1)
+
+    def test_timeout_cancels_queued_chunks(self):
+        frames = {'a': [0], 'b': [0]}
+        with mock.patch.object(process_pool, 'CPU_POOL_WORKERS', 2), \
+             mock.patch.object(process_pool, 'shared_frames', mock.MagicMock()), \
+             mock.patch.object(process_pool, 'submit', side_effect=lambda fn, spec, chunk: self.futures.pop(0)):
+            self.futures = [mock.Mock(**{'result.side_effect': process_pool.FuturesTimeout}), mock.Mock()]
+            queued = self.futures[1]
+            result = process_pool.map_frames(mock.Mock(__name__='chunk'), frames, lambda f: 'inline', name='chunk')
+        self.assertEqual(result, 'inline')
+        queued.cancel.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils import quota
+
+
+class QuotaTest(unittest.TestCase):
+    """每個測試使用獨立的 quota.db"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for p in (mock.patch.object(quota, 'DB_PATH', os.path.join(self.dir, 'quota.db')),
+                  mock.patch.object(quota, 'CACHE_DIR', self.dir),
+                  mock.patch.object(quota, '_local', threading.local()),
+                  mock.patch.object(quota, 'QUOTA_LIMITS', {'ai': {'user': (2, 600), 'chat': (5, 600), 'global': (10, 600)}})):
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def tearDown(self):
+        conn = getattr(quota._local, 'conn', None)
+        if conn: conn.close()
+
+    def test_user_bucket_runs_out(self):
+        self.assertTrue(quota.consume('ai_analysis', 'U1', 'C1')[0])
+        self.assertTrue(quota.consume('ai_analysis', 'U1', 'C1')[0])
+        allowed, retry_after = quota.consume('ai_analysis', 'U1', 'C1')
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 300, delta=1)
+        self.assertTrue(quota.consume('ai_analysis', 'U2', 'C1')[0])
+
+    def test_unclassified_command_is_free(self):
+        for _ in range(5): self.assertEqual(quota.consume('greeting', 'U1'), (True, 0))
+
+    def test_report_does_not_expose_ids(self):
+        quota.consume('ai_analysis', 'Uf00dbabe', 'Cdeadbeef')
+        report = quota.quota_report()
+        self.assertNotIn('Uf00dbabe', str(report))
+        self.assertNotIn('Cdeadbeef', str(report))
+        self.assertEqual(report['ai']['top_users'], [(quota._redact('Uf00dbabe'), 1.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
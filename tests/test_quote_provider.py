@@ -0,0 +1,183 @@
+import time
+import asyncio
+import unittest
+from unittest import mock
+
+from utils import metrics
+from services import quote_provider_service as qp
+from services.quote_provider_service import FakeProvider, Provider, get_quote, get_quote_async, ranked
+
+
+def _fake(name, latency=0.01, error_rate=0.0):
+    provider = FakeProvider(latency=latency, error_rate=error_rate)
+    provider.name = name
+    return provider
+
+
+class _Empty(Provider):
+    """查無資料 (回傳 None) 的來源"""
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+
+    def fetch(self, symbol):
+        time.sleep(self.latency)
+        return None
+
+
+class _ProviderCase(unittest.TestCase):
+    """每個測試使用獨立的來源註冊表與統計"""
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(qp, '_providers', {}),
+            mock.patch.object(qp, '_stats', {}),
+            mock.patch.object(qp, 'QUOTE_HEDGE', True),
+            mock.patch.object(qp, 'QUOTE_HEDGE_MIN_SAMPLES', 3),
+        ]
+        for p in self.patches: p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches): p.stop()
+
+    def use(self, *providers):
+        for provider in providers: qp.register(provider)
+        order = [p.name for p in providers]
+        patch = mock.patch.object(qp, 'QUOTE_PROVIDERS', order)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def counter(self, name):
+        return metrics.snapshot()["counters"].get(name, 0)
+
+
+class QuoteProviderTest(_ProviderCase):
+    """以 FakeProvider 測試 get_quote 的路由、備援與 hedge (不連網)"""
+
+    def test_untried_providers_follow_configured_order(self):
+        self.use(_fake('a'), _fake('b'))
+        self.assertEqual([p.name for p in ranked()], ['a', 'b'])
+        self.assertEqual(get_quote('2330')['source'], 'a')
+
+    def test_routes_to_lowest_observed_latency(self):
+        slow, fast = _fake('slow', latency=0.08), _fake('fast', latency=0.01)
+        self.use(slow, fast)
+        # 兩者都有統計後，較快的排在前面 (即使設定順序在後)
+        qp._call(slow, '2330')
+        qp._call(fast, '2330')
+        self.assertEqual([p.name for p in ranked()], ['fast', 'slow'])
+        self.assertEqual(get_quote('2330')['source'], 'fast')
+
+    def test_low_hit_rate_costs_more(self):
+        # 延遲相同，但多半查無資料的來源預期耗時較長
+        empty, fake = _Empty('empty', latency=0.02), _fake('fake', latency=0.02)
+        self.use(empty, fake)
+        for _ in range(5): qp._call(empty, '2330')
+        qp._call(fake, '2330')
+        self.assertEqual([p.name for p in ranked()], ['fake', 'empty'])
+
+    def test_falls_back_on_error(self):
+        broken, backup = _fake('broken', error_rate=1.0), _fake('backup')
+        self.use(broken, backup)
+        quote = get_quote('2330')
+        self.assertEqual(quote['source'], 'backup')
+        self.assertEqual(quote['symbol'], '2330')
+        self.assertGreater(qp._stats['broken'].error_rate, 0)
+
+    def test_falls_back_on_miss(self):
+        self.use(_Empty('empty'), _fake('backup'))
+        self.assertEqual(get_quote('2330')['source'], 'backup')
+
+    def test_unhealthy_provider_is_ranked_last(self):
+        broken, backup = _fake('broken', error_rate=1.0), _fake('backup', latency=0.05)
+        self.use(broken, backup)
+        with mock.patch.object(qp, 'QUOTE_PROVIDER_MAX_ERROR', 0.1):
+            get_quote('2330')
+            self.assertFalse(qp._stats['broken'].healthy())
+            self.assertEqual([p.name for p in ranked()], ['backup', 'broken'])
+            # 冷卻時間過後重新排回
+            with mock.patch.object(qp, 'QUOTE_PROVIDER_COOLDOWN', 0):
+                self.assertEqual(ranked()[0].name, 'broken')
+
+    def test_all_providers_fail(self):
+        self.use(_fake('a', error_rate=1.0), _Empty('b'))
+        self.assertIsNone(get_quote('2330'))
+
+    def test_deadline(self):
+        self.use(_fake('slow', latency=0.5))
+        start = time.monotonic()
+        self.assertIsNone(get_quote('2330', deadline=0.1))
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_hedges_when_primary_exceeds_its_p95(self):
+        primary, secondary = _fake('primary', latency=0.01), _fake('secondary', latency=0.01)
+        self.use(primary, secondary)
+        for _ in range(3): qp._call(primary, '2330')
+        qp._call(secondary, '2330')
+        qp._stats['secondary'].latency = 1.0     # 讓 primary 排在前面
+        primary.latency = 0.5
+        hedged = self.counter("quote_provider.hedged")
+
+        start = time.monotonic()
+        quote = get_quote('2330')
+        self.assertEqual(quote['source'], 'secondary')
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(self.counter("quote_provider.hedged"), hedged + 1)
+
+    def test_no_hedge_without_enough_samples(self):
+        primary, secondary = _fake('primary', latency=0.15), _fake('secondary', latency=0.01)
+        self.use(primary, secondary)
+        hedged = self.counter("quote_provider.hedged")
+        self.assertEqual(get_quote('2330')['source'], 'primary')
+        self.assertEqual(self.counter("quote_provider.hedged"), hedged)
+
+    def test_no_hedge_when_disabled(self):
+        primary, secondary = _fake('primary', latency=0.01), _fake('secondary', latency=0.01)
+        self.use(primary, secondary)
+        for _ in range(3): qp._call(primary, '2330')
+        qp._stats['secondary'].latency = 1.0
+        primary.latency = 0.2
+        with mock.patch.object(qp, 'QUOTE_HEDGE', False):
+            self.assertEqual(get_quote('2330')['source'], 'primary')
+
+    def test_disabled_provider_is_skipped(self):
+        self.use(_fake('a'), _fake('b'))
+        with mock.patch.object(qp, 'QUOTE_PROVIDERS', ['b']):
+            self.assertEqual(get_quote('2330')['source'], 'b')
+
+
+class QuoteProviderAsyncTest(_ProviderCase):
+    """get_quote_async 與 get_quote 的行為一致"""
+
+    def test_falls_back_on_error(self):
+        self.use(_fake('broken', error_rate=1.0), _Empty('empty'), _fake('backup'))
+        self.assertEqual(asyncio.run(get_quote_async('2330'))['source'], 'backup')
+
+    def test_blocking_provider_runs_off_the_loop(self):
+        # 只實作 fetch 的來源在執行緒池執行
+        self.use(_Empty('empty'), _fake('backup'))
+        self.assertEqual(asyncio.run(get_quote_async('2330'))['source'], 'backup')
+
+    def test_hedges_when_primary_exceeds_its_p95(self):
+        primary, secondary = _fake('primary', latency=0.01), _fake('secondary', latency=0.01)
+        self.use(primary, secondary)
+        for _ in range(3): asyncio.run(qp._call_async(primary, '2330'))
+        asyncio.run(qp._call_async(secondary, '2330'))
+        qp._stats['secondary'].latency = 1.0
+        primary.latency = 0.5
+        hedged = self.counter("quote_provider.hedged")
+
+        start = time.monotonic()
+        quote = asyncio.run(get_quote_async('2330'))
+        self.assertEqual(quote['source'], 'secondary')
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(self.counter("quote_provider.hedged"), hedged + 1)
+
+    def test_deadline(self):
+        self.use(_fake('slow', latency=0.5))
+        self.assertIsNone(asyncio.run(get_quote_async('2330', deadline=0.1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
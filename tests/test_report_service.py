@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from services import report_service as reports
+
+
+class VixReportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        p = mock.patch.object(reports, 'REPORT_DIR', self.dir)
+        p.start()
+        self.addCleanup(p.stop)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def test_failed_build_is_not_cached_or_pushed(self):
+        push = mock.Mock()
+        with mock.patch.object(reports, 'generate_vix_report', return_value=None):
+            with self.assertRaises(RuntimeError):
+                reports.prebuild_report('vix')
+            self.assertIsNone(reports.get_prebuilt_report('vix'))
+            with self.assertRaises(RuntimeError):
+                reports.send_report('vix', push)
+        push.assert_not_called()
+        self.assertIn("VIX", reports.last_error('vix')["error"])
+
+    def test_success_is_pushed_and_clears_error(self):
+        push = mock.Mock()
+        with mock.patch.object(reports, 'generate_vix_report', return_value=None):
+            with self.assertRaises(RuntimeError): reports.prebuild_report('vix')
+        with mock.patch.object(reports, 'generate_vix_report', return_value="VIX 15.00"):
+            self.assertEqual(reports.send_report('vix', push), 'sent')
+        self.assertTrue(push.call_args.args[0].endswith("VIX 15.00"))
+        self.assertIsNone(reports.last_error('vix'))
+
+    def test_combined_report_keeps_krw_without_vix(self):
+        with mock.patch.object(reports, 'generate_vix_report', return_value=None), \
+             mock.patch.object(reports, 'get_taiwan_bank_rates', return_value=[{"bank": "台銀", "cash_selling": "0.0245"}]):
+            report = reports.build_combined_report()
+        self.assertIn("台銀: 0.0245", report)
+        self.assertIn("無法取得 VIX", report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from utils.market_calendar import latest_tw_publish
+from services import valuation_service as valuation
+
+
+def _response(date, pe='15.0', delay=None):
+    def get(url, headers=None, timeout=None):
+        if delay: delay.wait(5)
+        return mock.Mock(status_code=200, headers={}, content=b'',
+                         json=lambda: [{"Code": "2330", "Date": date, "PEratio": pe, "DividendYield": "1.5", "PBratio": "5.0"}])
+    return get
+
+
+class TwseStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for p in (mock.patch.object(valuation, 'CACHE_DIR', self.dir),
+                  mock.patch.object(valuation, 'SNAPSHOT_PATH', os.path.join(self.dir, 'bwibbu.json')),
+                  mock.patch.object(valuation, 'LOCK_PATH', os.path.join(self.dir, 'bwibbu.json.lock')),
+                  mock.patch.object(valuation, '_snapshot', {}),
+                  mock.patch.object(valuation, '_stats', {}),
+                  mock.patch.object(valuation, '_loaded_mtime', None),
+                  mock.patch.object(valuation, '_next_check', 0),
+                  mock.patch.object(valuation, '_refreshing', False)):
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        self.today = latest_tw_publish(valuation._publish_time()).strftime('%Y%m%d')
+
+    def test_refresh_and_cache(self):
+        with mock.patch.object(valuation.requests, 'get', side_effect=_response(self.today)) as get:
+            self.assertEqual(valuation.get_twse_stats()["2330"]["PE"], '15.0')
+            valuation.get_twse_stats()
+        self.assertEqual(get.call_count, 1)
+
+    def test_download_does_not_block_readers(self):
+        with mock.patch.object(valuation.requests, 'get', side_effect=_response('20200101', pe='9.0')):
+            valuation.get_twse_stats()
+        valuation._next_check = 0
+        release, results = threading.Event(), {}
+        with mock.patch.object(valuation.requests, 'get', side_effect=_response(self.today, delay=release)):
+            refresher = threading.Thread(target=lambda: results.setdefault('refresher', valuation.get_twse_stats()))
+            refresher.start()
+            for _ in range(500):
+                if valuation._refreshing: break
+                time.sleep(0.01)
+            # 下載中：鎖未被佔用，其他執行緒立即拿到舊資料
+            self.assertFalse(valuation._lock.locked())
+            self.assertEqual(valuation.get_twse_stats()["2330"]["PE"], '9.0')
+            release.set()
+            refresher.join()
+        self.assertEqual(results['refresher']["2330"]["PE"], '15.0')
+        self.assertEqual(valuation.get_twse_stats()["2330"]["PE"], '15.0')
+
+    def test_failed_refresh_keeps_old_stats(self):
+        with mock.patch.object(valuation.requests, 'get', side_effect=_response('20200101', pe='9.0')):
+            valuation.get_twse_stats()
+        valuation._next_check = 0
+        with mock.patch.object(valuation.requests, 'get', side_effect=RuntimeError('timeout')):
+            self.assertEqual(valuation.get_twse_stats()["2330"]["PE"], '9.0')
+        self.assertFalse(valuation._refreshing)
+        self.assertGreater(valuation._next_check, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Flex Message 產生 + 序列化的微基準測試
+before: 每次請求重建整棵元件樹再轉 JSON (舊做法)
+after : 預先編譯的樣板，只填入變動欄位
+
+Usage: python tools/bench_flex.py [-n 2000]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import flex_templates as ft
+
+TW_STOCK = {
+    'symbol': '2330', 'name': '台積電', 'type': '上市', 'price': 1000.0, 'change': 5.0, 'change_percent': 0.5,
+    'limit_up': 1095.0, 'limit_down': 900.0, 'high': 1005.0, 'low': 990.0, 'volume': 25000000.0,
+    'twse_stats': {'PE': '20.1', 'Yield': '1.8'}
+}
+US_STOCK = {
+    'symbol': 'AAPL', 'name': 'Apple Inc.', 'price': 200.0, 'change': -1.2, 'change_percent': -0.6,
+    'high': 201.0, 'low': 199.0, 'volume': 12345678, 'market_cap': 3.1e12, 'pe_ratio': 30.5,
+    'week_52_high': 250.0, 'week_52_low': 150.0
+}
+FOREX = {'currency': 'USD', 'price': 32.1234, 'change': 0.01, 'change_percent': 0.03}
+BANKS = [{'bank': f'銀行{i}', 'cash_selling': '32.5', 'spot_selling': '32.2'} for i in range(10)]
+DASHBOARD = [
+    {'name': name, 'action_text': name, 'price': '22,000.00', 'change_percent': '+1.00%', 'color': '#eb4e3d'}
+    for name in ('VIX 恐慌', '加權指數', '元大 0050', '台積電', '聯發科', 'AAPL')
+]
+
+
+def before_currency():
+    fields = ft._currency_fields(FOREX)
+    fields['bank_rows'] = [ft._bank_row(b, top=(i == 0)) for i, b in enumerate(BANKS[:5])]
+    return ft._currency_bubble(fields)
+
+def before_dashboard():
+    rows = [ft._dashboard_row(item) for item in DASHBOARD]
+    return ft._dashboard_bubble({'greeting': '早上好 🌞', 'user_name': 'Joe', 'rows': rows})
+
+CASES = {
+    'help': (ft._help_message, ft.generate_help_message),
+    'currency_menu': (ft._currency_menu, ft.generate_currency_menu_flex),
+    'currency': (before_currency, lambda: ft.generate_currency_flex_message(FOREX, BANKS)),
+    'dashboard': (before_dashboard, lambda: ft.generate_dashboard_flex_message('早上好 🌞', 'Joe', DASHBOARD)),
+    'tw_stock': (lambda: ft._stock_bubble(ft._stock_fields(TW_STOCK)), lambda: ft.generate_stock_flex_message(TW_STOCK)),
+    'us_stock': (lambda: ft._us_stock_bubble(ft._us_stock_fields(US_STOCK)), lambda: ft.generate_us_stock_flex_message(US_STOCK)),
+}
+
+
+def bench(build, n):
+    """產生訊息並序列化 (同 LineBotApi.reply_message)，回傳每則微秒數"""
+    start = time.perf_counter()
+    for _ in range(n):
+        json.dumps({'messages': [build().as_json_dict()]})
+    return (time.perf_counter() - start) / n * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000, help='每種訊息的執行次數')
+    args = parser.parse_args()
+
+    print(f"{'message':<15}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name, (before, after) in CASES.items():
+        # 兩種做法的輸出必須相同
+        assert before().as_json_dict() == after().as_json_dict(), name
+        b, a = bench(before, args.n), bench(after, args.n)
+        print(f"{name:<15}{b:>14.1f}{a:>14.1f}{b / a:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
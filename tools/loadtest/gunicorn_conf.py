@@ -0,0 +1,33 @@
+"""
+壓力測試用的 gunicorn 設定 (worker 數 / 類別仍由命令列指定)
+yfinance 沒有可設定的 API 網址，worker 啟動後把 *.yahoo.com 的請求改寫到 YAHOO_STUB_URL
+"""
+import os
+import time
+from urllib.parse import urlsplit
+
+def post_fork(server, worker):
+    stub = os.environ.get('YAHOO_STUB_URL')
+    if not stub: return
+
+    import yfinance as yf
+    from curl_cffi.requests import Session
+    from requests.cookies import create_cookie
+
+    # cookie / 時區快取放在這次測試的 CACHE_DIR，不影響本機正常使用的 yfinance 快取
+    yf.set_tz_cache_location(os.path.join(os.environ.get('CACHE_DIR', '/tmp'), 'yfinance'))
+    original = Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if not (parts.hostname and parts.hostname.endswith('yahoo.com')):
+            return original(self, method, url, *args, **kwargs)
+        url = f"{stub}/{parts.hostname}{parts.path or '/'}" + (f"?{parts.query}" if parts.query else '')
+        response = original(self, method, url, *args, **kwargs)
+        if parts.hostname == 'fc.yahoo.com':
+            # 正式環境會設定 .yahoo.com 的 A3 cookie，yfinance 據此沿用 crumb，不必每次重新取得
+            self.cookies.jar.set_cookie(create_cookie('A3', 'stub', domain='.yahoo.com',
+                                                      expires=int(time.time()) + 86400))
+        return response
+
+    Session.request = request
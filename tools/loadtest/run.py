@@ -0,0 +1,351 @@
+"""
+離線壓力測試：啟動上游 stub 與真正的 gunicorn，依指令組合以固定 RPS 送出已簽章的 webhook
+每一階段 (RPS) 回報：
+- throughput  : 每秒完成 (收到 reply / push) 的事件數
+- callback    : /callback 回應時間 p50 / p99 (gunicorn 接受請求的速度)
+- reply       : 送出 webhook 到 LINE stub 收到 reply 的時間 p50 / p99 (使用者感受到的延遲)
+- error       : /callback 失敗或沒有收到回覆的比例
+- saturation  : /metrics 取樣的事件執行緒使用率與排隊數 (各 worker 的最大值)
+錯誤率或 reply p99 超過門檻的第一個階段即為該 worker 類別的極限
+
+Usage:
+    python tools/loadtest/run.py --worker-class gthread --workers 2 --threads 4 --rps 2,5,10,20 --duration 30
+    python tools/loadtest/run.py --profile yahoo=600:0.05,gemini=8000 --mix tw_quote=50,ai_analysis=20
+"""
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import base64
+import random
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import Stubs, make_server, parse_profiles, stub_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CHANNEL_SECRET = 'loadtest-secret'
+
+# 指令類別 -> (權重, 訊息, 是否應有回覆)
+MIX = {
+    'tw_quote': (30, ['2330', '2317', '2454', '0050', '2881', '2603'], True),
+    'us_quote': (15, ['AAPL', 'NVDA', 'TSLA', 'MSFT', '^VIX'], True),
+    'forex': (10, ['USD', 'JPY', 'EUR', 'KRW'], True),
+    'forex_list': (3, ['USD 列表', 'JPY 列表'], True),
+    'forex_chart': (5, ['USD 1D', 'JPY 5D', 'EUR 1M'], True),
+    'multi_quote': (7, ['2330 2317 2454 0050', 'AAPL,NVDA,TSLA'], True),
+    'stock_chart': (10, ['2330 日K', '2317 週K', '2454 即時', '0050 交易量'], True),
+    'ai_analysis': (5, ['2330 分析', 'NVDA 分析'], True),
+    'greeting': (10, ['早安', 'HI', '自選'], True),
+    'chatter': (5, ['今天天氣不錯', '哈哈'], False)
+}
+
+
+def parse_mix(spec):
+    """ "tw_quote=50,ai_analysis=20" 覆寫權重 (0 代表不送)"""
+    mix = dict(MIX)
+    for item in (spec or '').split(','):
+        if '=' not in item: continue
+        name, weight = item.split('=', 1)
+        if name not in mix: raise SystemExit(f"unknown command class: {name} (choose from {', '.join(MIX)})")
+        mix[name] = (float(weight),) + mix[name][1:]
+    return {name: entry for name, entry in mix.items() if entry[0] > 0}
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def webhook_body(user_id, text, reply_token):
+    event = {
+        'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid.uuid4().hex.upper()[:26],
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': reply_token,
+        'message': {'id': str(random.getrandbits(60)), 'type': 'text', 'quoteToken': uuid.uuid4().hex, 'text': text}
+    }
+    return json.dumps({'destination': 'U' + '0' * 32, 'events': [event]}, ensure_ascii=False).encode()
+
+def sign(body, secret=CHANNEL_SECRET):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+class Target:
+    """以 stub 上游啟動的 gunicorn"""
+
+    def __init__(self, args, stub_url):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.workdir = tempfile.mkdtemp(prefix='loadtest_')
+        env = dict(os.environ)
+        env.update(stub_env(stub_url))
+        env.update({
+            'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'loadtest-token',
+            'GEMINI_API_KEY': 'loadtest',
+            'FUGLE_API_KEY': '' if args.no_fugle else 'loadtest',
+            'MY_USER_ID': 'U' + 'f' * 32,
+            'CACHE_DIR': os.path.join(self.workdir, 'cache'),
+            'SCHEDULER_ENABLED': 'false',
+            'CACHE_SNAPSHOT_INTERVAL': '0',
+            'PYTHONUNBUFFERED': '1'
+        })
+        if not args.keep_quotas:
+            env['QUOTAS'] = ','.join(f"{cls}.{scope}=0" for cls in ('ai', 'chart', 'quote') for scope in ('user', 'chat', 'global'))
+        for item in args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+
+        cmd = [
+            sys.executable, '-m', 'gunicorn', 'app:app',
+            '-c', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_conf.py'),
+            '-b', f"127.0.0.1:{self.port}", '-w', str(args.workers), '-k', args.worker_class,
+            '--threads', str(args.threads), '--timeout', '120'
+        ]
+        self.log_path = os.path.join(self.workdir, 'gunicorn.log')
+        self.log = open(self.log_path, 'w')
+        self.proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise SystemExit(f"gunicorn exited ({self.proc.returncode}), see {self.log_path}")
+            try:
+                if requests.get(self.url + '/', timeout=2).status_code == 200: return
+            except requests.RequestException: pass
+            time.sleep(0.5)
+        raise SystemExit(f"gunicorn not ready after {timeout}s, see {self.log_path}")
+
+    def stop(self):
+        self.proc.terminate()
+        try: self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired: self.proc.kill()
+        self.log.close()
+
+
+class MetricsSampler(threading.Thread):
+    """定期讀取 /metrics；每次只會打到其中一個 worker，以 pid 分開保存"""
+
+    def __init__(self, url, interval=0.5):
+        super().__init__(daemon=True)
+        self.url, self.interval = url + '/metrics', interval
+        self.samples = {}  # pid -> [(忙碌執行緒, 執行緒數, 事件排隊, 指令排隊, 抓取排隊)]
+        self.running = True
+        self.session = requests.Session()
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.session.get(self.url, timeout=5).json()
+                g = data.get('gauges', {})
+                max_workers = g.get('events.max_workers') or 1
+                active = g.get('events.active_chats', 0)
+                queued = max(0, active - max_workers) + g.get('events.pending', 0)
+                self.samples.setdefault(data.get('pid'), []).append(
+                    (min(active, max_workers), max_workers, queued, g.get('commands.queued', 0), g.get('fanout.queued', 0)))
+            except Exception: pass
+            time.sleep(self.interval)
+
+    def summary(self):
+        if not self.samples: return {}
+        per_worker = []
+        for pid, samples in self.samples.items():
+            per_worker.append({
+                'pid': pid,
+                'avg_busy': round(sum(s[0] / s[1] for s in samples) / len(samples), 3),
+                'peak_busy': round(max(s[0] / s[1] for s in samples), 3),
+                'peak_event_queue': max(s[2] for s in samples),
+                'peak_command_queue': max(s[3] for s in samples),
+                'peak_fanout_queue': max(s[4] for s in samples)
+            })
+        return {
+            'workers_seen': len(per_worker),
+            'avg_busy': max(w['avg_busy'] for w in per_worker),
+            'peak_busy': max(w['peak_busy'] for w in per_worker),
+            'peak_event_queue': max(w['peak_event_queue'] for w in per_worker),
+            'peak_command_queue': max(w['peak_command_queue'] for w in per_worker),
+            'peak_fanout_queue': max(w['peak_fanout_queue'] for w in per_worker),
+            'per_worker': per_worker
+        }
+
+
+def run_step(target, stubs, mix, rps, duration, users, drain):
+    """以 rps 送 duration 秒 (open loop，不等待前一個完成)，回傳統計"""
+    names = list(mix)
+    weights = [mix[n][0] for n in names]
+    user_ids = ['U' + uuid.uuid5(uuid.NAMESPACE_OID, str(i)).hex for i in range(users)]
+    local = threading.local()
+    sent = {}      # reply_token -> (送出時間, 指令類別, 應有回覆)
+    callbacks = [] # (耗時, 是否成功)
+    lock = threading.Lock()
+
+    def send(name):
+        session = getattr(local, 'session', None)
+        if session is None: session = local.session = requests.Session()
+        text = random.choice(mix[name][1])
+        token = uuid.uuid4().hex
+        body = webhook_body(random.choice(user_ids), text, token)
+        start = time.time()
+        with lock: sent[token] = (start, name, mix[name][2])
+        try:
+            r = session.post(target.url + '/callback', data=body, timeout=30,
+                             headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body)})
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock: callbacks.append((time.time() - start, ok))
+
+    stubs.take_deliveries()
+    sampler = MetricsSampler(target.url)
+    sampler.start()
+    total = int(rps * duration)
+    step_start = time.time()
+    with ThreadPoolExecutor(max_workers=min(256, max(16, int(rps * 4)))) as pool:
+        for i in range(total):
+            # 依排定時間送出，server 變慢也不降速 (才看得出排隊)
+            delay = step_start + i / rps - time.time()
+            if delay > 0: time.sleep(delay)
+            pool.submit(send, random.choices(names, weights)[0])
+        send_elapsed = time.time() - step_start
+
+    # 等待回覆 (最多 drain 秒)
+    replies, pushes = {}, 0
+    deadline = time.time() + drain
+    while True:
+        for at, kind, target_id, texts in stubs.take_deliveries():
+            if kind == 'reply': replies[target_id] = (at, texts)
+            else: pushes += 1
+        pending = [t for t, (_, _, expects) in sent.items() if expects and t not in replies]
+        if not pending or time.time() > deadline: break
+        time.sleep(0.2)
+    sampler.running = False
+    # 以最後一個回覆的時間計算 (不含等待逾時的部分)
+    elapsed = max([at for at, _ in replies.values()] + [step_start + send_elapsed]) - step_start
+
+    reply_latencies, error_replies, by_command = [], 0, {}
+    for token, (start, name, expects) in sent.items():
+        c = by_command.setdefault(name, {'sent': 0, 'replied': 0, 'latencies': []})
+        c['sent'] += 1
+        if token not in replies: continue
+        at, texts = replies[token]
+        c['replied'] += 1
+        c['latencies'].append(at - start)
+        reply_latencies.append(at - start)
+        if any(isinstance(t, str) and t.startswith('❌') for t in texts): error_replies += 1
+
+    expected = sum(1 for _, _, expects in sent.values() if expects)
+    callback_failures = sum(1 for _, ok in callbacks if not ok)
+    missing = expected - sum(1 for t, (_, _, expects) in sent.items() if expects and t in replies)
+    callback_latencies = [d for d, _ in callbacks]
+    return {
+        'target_rps': rps,
+        'sent': len(sent),
+        'send_rps': round(len(sent) / send_elapsed, 2) if send_elapsed else None,
+        'throughput': round(len(replies) / elapsed, 2),
+        'callback_p50': percentile(callback_latencies, 50),
+        'callback_p99': percentile(callback_latencies, 99),
+        'reply_p50': percentile(reply_latencies, 50),
+        'reply_p99': percentile(reply_latencies, 99),
+        'error_rate': round((callback_failures + missing) / max(1, len(sent)), 4),
+        'callback_failures': callback_failures,
+        'missing_replies': missing,
+        'error_replies': error_replies,
+        'pushes': pushes,
+        'saturation': sampler.summary(),
+        'commands': {
+            name: {'sent': c['sent'], 'replied': c['replied'],
+                   'p50': percentile(c['latencies'], 50), 'p99': percentile(c['latencies'], 99)}
+            for name, c in sorted(by_command.items())
+        }
+    }
+
+def fmt(seconds):
+    return '-' if seconds is None else f"{seconds * 1000:.0f}ms"
+
+def print_step(r):
+    s = r['saturation']
+    print(f"{r['target_rps']:>6g} {r['send_rps']:>8} {r['throughput']:>8} "
+          f"{fmt(r['callback_p50']):>8} {fmt(r['callback_p99']):>8} {fmt(r['reply_p50']):>8} {fmt(r['reply_p99']):>8} "
+          f"{r['error_rate'] * 100:>6.2f}% {s.get('avg_busy', 0) * 100:>6.0f}% {s.get('peak_busy', 0) * 100:>6.0f}% "
+          f"{s.get('peak_event_queue', '-'):>6} {s.get('peak_command_queue', '-'):>6}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker-class', default='gthread', help='gunicorn worker 類別 (sync / gthread / gevent ...)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rps', default='2,5,10,20', help='各階段的目標 RPS (逗號分隔)')
+    parser.add_argument('--duration', type=float, default=30, help='每階段秒數')
+    parser.add_argument('--drain', type=float, default=30, help='送完後等待回覆的秒數上限')
+    parser.add_argument('--users', type=int, default=200, help='模擬的使用者數 (同一使用者的事件依序處理)')
+    parser.add_argument('--mix', default='', help='指令權重覆寫，e.g. "tw_quote=50,ai_analysis=0"')
+    parser.add_argument('--profile', default='', help='上游延遲 (ms) 與錯誤率，e.g. "yahoo=600:0.05,line=50"')
+    parser.add_argument('--slo', type=float, default=5.0, help='reply p99 門檻秒數 (reply token 約數十秒內有效)')
+    parser.add_argument('--max-error', type=float, default=0.01, help='錯誤率門檻')
+    parser.add_argument('--no-fugle', action='store_true', help='不設定 FUGLE_API_KEY (台股報價改走 Yahoo)')
+    parser.add_argument('--keep-quotas', action='store_true', help='保留預設配額 (預設全部取消)')
+    parser.add_argument('--env', action='append', default=[], help='傳給 app 的環境變數，e.g. --env EVENT_MAX_WORKERS=16')
+    parser.add_argument('--json', help='結果另存為 JSON')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    stubs = Stubs(parse_profiles(args.profile))
+    server = make_server(stubs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{server.server_port}"
+
+    target = Target(args, stub_url)
+    results = []
+    try:
+        target.wait_ready()
+        print(f"gunicorn {args.worker_class} x{args.workers} (threads={args.threads}) at {target.url}, "
+              f"stubs at {stub_url}, logs in {target.log_path}")
+        print(f"{'rps':>6} {'sent/s':>8} {'done/s':>8} {'cb p50':>8} {'cb p99':>8} {'rp p50':>8} {'rp p99':>8} "
+              f"{'error':>7} {'busy':>7} {'peak':>7} {'evq':>6} {'cmdq':>6}")
+        for rps in (float(x) for x in args.rps.split(',') if x.strip()):
+            r = run_step(target, stubs, mix, rps, args.duration, args.users, args.drain)
+            results.append(r)
+            print_step(r)
+    finally:
+        target.stop()
+        server.shutdown()
+
+    broken = next((r for r in results if r['error_rate'] > args.max_error
+                   or (r['reply_p99'] or 0) > args.slo), None)
+    if broken:
+        ok = [r['target_rps'] for r in results if r['target_rps'] < broken['target_rps']]
+        healthy = f"last healthy step: {max(ok):g} rps" if ok else "no healthy step"
+        print(f"\nbreaking point: {broken['target_rps']:g} rps "
+              f"(error {broken['error_rate'] * 100:.2f}%, reply p99 {fmt(broken['reply_p99'])}); {healthy}")
+    elif results:
+        print(f"\nno breaking point up to {results[-1]['target_rps']:g} rps")
+
+    if results:
+        print("\nper command (last step):")
+        for name, c in results[-1]['commands'].items():
+            print(f"  {name:<12} sent {c['sent']:>5}  replied {c['replied']:>5}  p50 {fmt(c['p50']):>8}  p99 {fmt(c['p99']):>8}")
+        print(f"upstream calls: {json.dumps(stubs.counts, sort_keys=True)}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'steps': results, 'upstream': stubs.counts}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+壓力測試用的上游 stub (LINE / Yahoo / TWSE / TPEx / FindRate / QuickChart / Fugle / Gemini)
+所有服務共用一個 HTTP server，以路徑前綴區分：
+
+    /line/...        -> LINE_API_ENDPOINT
+    /yahoo/<host>/...-> yfinance 的請求 (由 gunicorn_conf.py 改寫網址)
+    /twse/...        -> TWSE_MIS_URL / TWSE_OPENAPI_URL
+    /tpex/...        -> TPEX_OPENAPI_URL
+    /findrate/...    -> FINDRATE_URL
+    /quickchart/...  -> QUICKCHART_URL
+    /fugle/...       -> FUGLE_API_URL
+    /gemini/...      -> GEMINI_API_ENDPOINT
+
+每個服務的延遲 (中位數，對數常態分佈) 與錯誤率可個別設定，格式: "yahoo=300:0.02,line=30"
+LINE 的 reply / push 會記錄下來，供 run.py 計算端到端延遲
+
+Usage: python tools/loadtest/stubs.py [--port 9100] [--profile yahoo=300:0.02]
+"""
+import json
+import math
+import time
+import random
+import zlib
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 服務 -> (延遲中位數 ms, 錯誤率)，大致依正式環境觀察到的數值
+DEFAULT_PROFILES = {
+    'line': (40, 0.0),
+    'yahoo': (250, 0.0),
+    'twse': (150, 0.0),
+    'tpex': (300, 0.0),
+    'findrate': (400, 0.0),
+    'quickchart': (300, 0.0),
+    'fugle': (80, 0.0),
+    'gemini': (2500, 0.0)
+}
+LATENCY_SIGMA = 0.4  # 對數常態分佈，p99 約為中位數的 2.5 倍
+
+TW_NAMES = {'2330': '台積電', '2317': '鴻海', '2454': '聯發科', '0050': '元大台灣50', '2881': '富邦金', '2603': '長榮'}
+# 全市場日線 (STOCK_DAY_ALL / 櫃買收盤行情) 的代號
+TWSE_CODES = list(TW_NAMES) + [str(code) for code in range(1101, 1141)]
+TPEX_CODES = [str(code) for code in range(6101, 6121)]
+BANKS = ['臺灣銀行', '兆豐銀行', '第一銀行', '華南銀行', '彰化銀行', '玉山銀行', '國泰世華', '台北富邦', '永豐銀行', '中國信託']
+
+INTERVAL_SECONDS = {
+    '1m': 60, '2m': 120, '5m': 300, '15m': 900, '30m': 1800, '60m': 3600, '90m': 5400, '1h': 3600,
+    '1d': 86400, '5d': 5 * 86400, '1wk': 7 * 86400, '1mo': 30 * 86400, '3mo': 90 * 86400
+}
+RANGE_DAYS = {'1d': 1, '5d': 5, '1mo': 22, '3mo': 66, '6mo': 126, '1y': 252, '2y': 504, '5y': 1260, '10y': 2520, 'ytd': 200, 'max': 2520}
+MAX_BARS = 3000
+
+
+def parse_profiles(spec):
+    """ "yahoo=300:0.02,line=30" -> {name: (ms, error_rate)}，未指定者用預設值"""
+    profiles = dict(DEFAULT_PROFILES)
+    for item in (spec or '').split(','):
+        if '=' not in item: continue
+        name, value = item.split('=', 1)
+        ms, _, error_rate = value.partition(':')
+        default_ms, default_error = profiles.get(name.strip(), (0, 0.0))
+        profiles[name.strip()] = (float(ms or default_ms), float(error_rate or default_error))
+    return profiles
+
+
+def _base_price(symbol):
+    if symbol.endswith('=X'): return 0.01 + zlib.crc32(symbol.encode()) % 4000 / 100
+    return 20 + zlib.crc32(symbol.encode()) % 980
+
+@lru_cache(maxsize=1024)
+def _walk(symbol, count):
+    """代號固定的隨機漫步 (同一代號每次結果相同)"""
+    rng = random.Random(symbol)
+    price, bars = _base_price(symbol), []
+    for _ in range(count):
+        open_ = price
+        price = max(1.0, price * (1 + rng.gauss(0, 0.015)))
+        high, low = max(open_, price) * (1 + rng.random() * 0.01), min(open_, price) * (1 - rng.random() * 0.01)
+        bars.append((round(open_, 2), round(high, 2), round(low, 2), round(price, 2), rng.randint(1000, 50000) * 1000))
+    return bars
+
+def _roc_date():
+    """今天的民國日期 (e.g. 1131018)，與證交所 / 櫃買中心 OpenAPI 相同"""
+    t = time.localtime()
+    return f"{t.tm_year - 1911}{t.tm_mon:02d}{t.tm_mday:02d}"
+
+def _tz(symbol):
+    if symbol.endswith(('.TW', '.TWO')) or symbol == '^TWII': return 'Asia/Taipei', 'CST', 28800
+    return 'America/New_York', 'EDT', -14400
+
+
+class Stubs:
+    """所有 stub 的狀態：延遲設定、請求計數、LINE 送出的訊息"""
+
+    def __init__(self, profiles=None):
+        self.profiles = profiles or dict(DEFAULT_PROFILES)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.deliveries = []  # (時間, 'reply'|'push', replyToken 或 to, 文字)
+
+    def _count(self, name, outcome):
+        with self.lock:
+            key = f"{name}.{outcome}"
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def delay(self, name):
+        """依設定延遲，回傳是否要模擬錯誤"""
+        ms, error_rate = self.profiles.get(name, (0, 0.0))
+        if ms > 0: time.sleep(ms / 1000 * math.exp(random.gauss(0, LATENCY_SIGMA)))
+        failed = random.random() < error_rate
+        self._count(name, 'error' if failed else 'ok')
+        return failed
+
+    def take_deliveries(self):
+        with self.lock:
+            deliveries, self.deliveries = self.deliveries, []
+        return deliveries
+
+    # --- 各服務的回應 (回傳 status, content_type, body) ---
+
+    def line(self, method, path, query, body):
+        if path.startswith('/v2/bot/message/reply') or path.startswith('/v2/bot/message/push'):
+            payload = json.loads(body or b'{}')
+            kind = 'reply' if 'reply' in path else 'push'
+            target = payload.get('replyToken') if kind == 'reply' else payload.get('to')
+            texts = [m.get('text') or m.get('altText') or m.get('type') for m in payload.get('messages', [])]
+            with self.lock: self.deliveries.append((time.time(), kind, target, texts))
+            return 200, 'application/json', {}
+        if path.startswith('/v2/bot/info'):
+            return 200, 'application/json', {'userId': 'U' + '0' * 32, 'basicId': '@stub', 'displayName': 'Stub Bot'}
+        if '/profile' in path or '/member/' in path:
+            return 200, 'application/json', {'userId': path.rsplit('/', 1)[-1], 'displayName': 'Load Tester'}
+        return 200, 'application/json', {}
+
+    def yahoo(self, method, path, query, body):
+        host, _, path = path.lstrip('/').partition('/')
+        path = '/' + path
+        if host == 'fc.yahoo.com' or not path.strip('/'):
+            return 200, 'text/html', '<html></html>'
+        if path.startswith('/v1/test/getcrumb'):
+            return 200, 'text/plain', 'stubcrumb'
+        if path.startswith('/v8/finance/chart/'):
+            return 200, 'application/json', self._yahoo_chart(path.rsplit('/', 1)[-1], query)
+        if path.startswith('/v10/finance/quoteSummary/'):
+            return 200, 'application/json', self._yahoo_summary(path.rsplit('/', 1)[-1])
+        if path.startswith('/v7/finance/quote'):
+            symbols = query.get('symbols', [''])[0].split(',')
+            return 200, 'application/json', {'quoteResponse': {'result': [self._yahoo_quote(s) for s in symbols if s], 'error': None}}
+        if '/fundamentals-timeseries/' in path:
+            return 200, 'application/json', {'timeseries': {'result': [{'meta': {'type': ['trailingPegRatio']}}], 'error': None}}
+        return 404, 'application/json', {'finance': {'result': None, 'error': {'code': 'Not Found'}}}
+
+    def _yahoo_chart(self, symbol, query):
+        interval = query.get('interval', ['1d'])[0]
+        step = INTERVAL_SECONDS.get(interval, 86400)
+        if 'period1' in query:
+            start = int(float(query['period1'][0]))
+            end = int(float(query.get('period2', [time.time()])[0]))
+            count = max(1, (end - start) // step)
+        else:
+            days = RANGE_DAYS.get(query.get('range', ['1mo'])[0], 22)
+            count = days * 6 * 3600 // step if step < 86400 else max(1, days * 86400 // step)
+        count = min(count, MAX_BARS)
+
+        end = int(time.time()) // step * step
+        timestamps = [end - (count - 1 - i) * step for i in range(count)]
+        bars = _walk(symbol, count)
+        timezone, tz_name, gmtoffset = _tz(symbol)
+        last = bars[-1][3]
+        prev = bars[-2][3] if count > 1 else last
+        period = {'timezone': tz_name, 'start': end - 6 * 3600, 'end': end, 'gmtoffset': gmtoffset}
+        quote = {
+            'open': [b[0] for b in bars], 'high': [b[1] for b in bars], 'low': [b[2] for b in bars],
+            'close': [b[3] for b in bars], 'volume': [b[4] for b in bars]
+        }
+        indicators = {'quote': [quote]}
+        if step >= 86400: indicators['adjclose'] = [{'adjclose': quote['close']}]
+        return {'chart': {'result': [{
+            'meta': {
+                'currency': 'TWD' if gmtoffset > 0 else 'USD', 'symbol': symbol, 'exchangeName': 'STB',
+                'fullExchangeName': 'Stub', 'instrumentType': 'EQUITY', 'firstTradeDate': timestamps[0],
+                'regularMarketTime': end, 'hasPrePostMarketData': False, 'gmtoffset': gmtoffset,
+                'timezone': tz_name, 'exchangeTimezoneName': timezone, 'regularMarketPrice': last,
+                'fiftyTwoWeekHigh': max(b[1] for b in bars), 'fiftyTwoWeekLow': min(b[2] for b in bars),
+                'regularMarketDayHigh': bars[-1][1], 'regularMarketDayLow': bars[-1][2],
+                'regularMarketVolume': bars[-1][4], 'longName': symbol, 'shortName': symbol,
+                'chartPreviousClose': prev, 'previousClose': prev, 'scale': 3, 'priceHint': 2,
+                'currentTradingPeriod': {'pre': period, 'regular': period, 'post': period},
+                'dataGranularity': interval, 'range': query.get('range', [''])[0],
+                'validRanges': list(RANGE_DAYS)
+            },
+            'timestamp': timestamps,
+            'indicators': indicators
+        }], 'error': None}}
+
+    def _yahoo_quote(self, symbol):
+        bars = _walk(symbol, 260)
+        last, prev = bars[-1][3], bars[-2][3]
+        return {
+            'symbol': symbol, 'shortName': symbol, 'longName': symbol, 'quoteType': 'EQUITY',
+            'currency': 'USD', 'regularMarketPrice': last, 'regularMarketPreviousClose': prev,
+            'regularMarketChange': last - prev, 'regularMarketChangePercent': (last - prev) / prev * 100,
+            'regularMarketDayHigh': bars[-1][1], 'regularMarketDayLow': bars[-1][2],
+            'regularMarketVolume': bars[-1][4], 'marketCap': int(last * 1e9),
+            'fiftyTwoWeekHigh': max(b[1] for b in bars), 'fiftyTwoWeekLow': min(b[2] for b in bars),
+            'trailingPE': 20.5
+        }
+
+    def _yahoo_summary(self, symbol):
+        q = self._yahoo_quote(symbol)
+        raw = lambda v: {'raw': v, 'fmt': str(v)}
+        return {'quoteSummary': {'result': [{
+            'quoteType': {'symbol': symbol, 'quoteType': 'EQUITY', 'shortName': symbol, 'longName': symbol},
+            'price': {'regularMarketPrice': raw(q['regularMarketPrice']), 'currency': q['currency'],
+                      'shortName': symbol, 'longName': symbol},
+            'summaryDetail': {
+                'previousClose': raw(q['regularMarketPreviousClose']), 'dayHigh': raw(q['regularMarketDayHigh']),
+                'dayLow': raw(q['regularMarketDayLow']), 'volume': raw(q['regularMarketVolume']),
+                'marketCap': raw(q['marketCap']), 'trailingPE': raw(q['trailingPE']),
+                'fiftyTwoWeekHigh': raw(q['fiftyTwoWeekHigh']), 'fiftyTwoWeekLow': raw(q['fiftyTwoWeekLow'])
+            }
+        }], 'error': None}}
+
+    def twse(self, method, path, query, body):
+        if path.startswith('/stock/api/getStockInfo.jsp'):
+            items = []
+            for target in query.get('ex_ch', [''])[0].split('|'):
+                ex, _, rest = target.partition('_')
+                code = rest.split('.')[0]
+                if not code or ex != 'tse': continue
+                bars = _walk(code + '.TW', 260)
+                last, prev = bars[-1], bars[-2][3]
+                items.append({'c': code, 'n': TW_NAMES.get(code, f"股票{code}"), 'ex': ex,
+                              'z': str(last[3]), 'y': str(prev), 'o': str(last[0]), 'h': str(last[1]),
+                              'l': str(last[2]), 'v': str(int(last[4] // 1000)),
+                              'u': str(round(prev * 1.1, 2)), 'w': str(round(prev * 0.9, 2))})
+            return 200, 'application/json', {'msgArray': items, 'rtcode': '0000'}
+        if path.startswith('/v1/exchangeReport/STOCK_DAY_ALL'):
+            rows = []
+            for code in TWSE_CODES:
+                o, h, l, c, v = _walk(code + '.TW', 260)[-1]
+                rows.append({'Date': _roc_date(), 'Code': code, 'Name': TW_NAMES.get(code, f"股票{code}"),
+                             'TradeVolume': str(v), 'OpeningPrice': f"{o:.2f}", 'HighestPrice': f"{h:.2f}",
+                             'LowestPrice': f"{l:.2f}", 'ClosingPrice': f"{c:.2f}"})
+            return 200, 'application/json', rows
+        if path.startswith('/v1/exchangeReport/BWIBBU_ALL'):
+            rows = [{'Code': code, 'Name': name, 'PEratio': '20.10', 'DividendYield': '2.10', 'PBratio': '5.00',
+                     'Date': time.strftime('%Y%m%d')} for code, name in TW_NAMES.items()]
+            return 200, 'application/json', rows
+        return 404, 'application/json', []
+
+    def tpex(self, method, path, query, body):
+        if path.startswith('/v1/tpex_mainboard_daily_close_quotes'):
+            rows = []
+            for code in TPEX_CODES:
+                o, h, l, c, v = _walk(code + '.TWO', 260)[-1]
+                rows.append({'Date': _roc_date(), 'SecuritiesCompanyCode': code, 'CompanyName': f"櫃買{code}",
+                             'Close': f"{c:.2f}", 'Open': f"{o:.2f}", 'High': f"{h:.2f}", 'Low': f"{l:.2f}",
+                             'TradingShares': f"{v:,}"})
+            return 200, 'application/json', rows
+        return 404, 'application/json', []
+
+    def findrate(self, method, path, query, body):
+        rng = random.Random(path)
+        base = 1 + rng.random() * 40
+        rows = ''.join(
+            f"<tr><td>{bank}</td><td>{base:.4f}</td><td>{base * 1.01:.4f}</td>"
+            f"<td>{base * 0.995:.4f}</td><td>{base * 1.005:.4f}</td><td>{time.strftime('%H:%M')}</td></tr>"
+            for bank in BANKS
+        )
+        html = ("<html><body><table><thead><tr><th>銀行名稱</th><th>現鈔買入</th><th>現鈔賣出</th>"
+                f"<th>即期買入</th><th>即期賣出</th><th>更新時間</th></tr></thead><tbody>{rows}</tbody></table></body></html>")
+        return 200, 'text/html; charset=utf-8', html
+
+    def quickchart(self, method, path, query, body):
+        return 200, 'application/json', {'success': True, 'url': f"https://quickchart.io/chart/render/sf-{random.getrandbits(64):x}"}
+
+    def fugle(self, method, path, query, body):
+        code = path.rstrip('/').rsplit('/', 1)[-1]
+        bars = _walk(code + '.TW', 260)
+        price, prev = bars[-1][3], bars[-2][3]
+        return 200, 'application/json', {
+            'symbol': code, 'name': TW_NAMES.get(code, f"股票{code}"), 'exchange': 'TWSE', 'market': 'TSE',
+            'previousClose': prev, 'referencePrice': prev,
+            'highPrice': bars[-1][1], 'lowPrice': bars[-1][2], 'avgPrice': price,
+            'lastTrade': {'price': price, 'size': 1, 'time': time.strftime('%H:%M:%S')},
+            'total': {'tradeVolume': bars[-1][4], 'tradeValue': bars[-1][4] * price}
+        }
+
+    def gemini(self, method, path, query, body):
+        analysis = {
+            'sentiment': '盤整', 'support_price': None, 'resistance_price': None,
+            'action': '區間操作', 'reason': 'stub', 'formatted_text': '📊 (stub) 區間盤整，等待方向確認'
+        }
+        return 200, 'application/json', {
+            'candidates': [{'content': {'parts': [{'text': json.dumps(analysis, ensure_ascii=False)}], 'role': 'model'},
+                            'finishReason': 'STOP', 'index': 0}],
+            'usageMetadata': {'promptTokenCount': 300, 'candidatesTokenCount': 120, 'totalTokenCount': 420}
+        }
+
+    def handle(self, method, raw_path, body):
+        url = urlsplit(raw_path)
+        name, _, path = url.path.lstrip('/').partition('/')
+        route = getattr(self, name, None) if name in self.profiles else None
+        if route is None:
+            if name == '_stats': return 200, 'application/json', self.counts
+            return 404, 'text/plain', 'unknown upstream'
+        if self.delay(name):
+            return 503, 'application/json', {'message': 'stub error'}
+        return route(method, '/' + path, parse_qs(url.query), body)
+
+
+def make_server(stubs, host='127.0.0.1', port=0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _serve(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            try: status, content_type, payload = stubs.handle(self.command, self.path, body)
+            except Exception as e: status, content_type, payload = 500, 'text/plain', str(e)
+            data = payload if isinstance(payload, bytes) else (
+                payload.encode() if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False).encode())
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def stub_env(base_url):
+    """讓 app 連到 stub 的環境變數"""
+    return {
+        'LINE_API_ENDPOINT': f"{base_url}/line",
+        'QUICKCHART_URL': f"{base_url}/quickchart",
+        'FINDRATE_URL': f"{base_url}/findrate",
+        'TWSE_MIS_URL': f"{base_url}/twse",
+        'TWSE_OPENAPI_URL': f"{base_url}/twse",
+        'TPEX_OPENAPI_URL': f"{base_url}/tpex",
+        'FUGLE_API_URL': f"{base_url}/fugle",
+        'GEMINI_API_ENDPOINT': f"{base_url}/gemini",
+        'YAHOO_STUB_URL': f"{base_url}/yahoo"
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--profile', default='', help='e.g. "yahoo=300:0.02,gemini=4000"')
+    args = parser.parse_args()
+
+    stubs = Stubs(parse_profiles(args.profile))
+    server = make_server(stubs, args.host, args.port)
+    base_url = f"http://{args.host}:{server.server_port}"
+    print(f"Stub upstreams listening on {base_url}")
+    for key, value in stub_env(base_url).items(): print(f"  {key}={value}")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+
+if __name__ == "__main__":
+    main()
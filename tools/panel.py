@@ -0,0 +1,53 @@
+"""
+全市場日線 (memmap OHLCV) 的維護工具
+update  : 下載證交所 / 櫃買中心最新一天的收盤行情並附加 (同排程的 panel 工作，但來源尚未更新時不等待重試)
+backfill: 以 Yahoo 日線補齊歷史 (需先 update 一次取得代號清單)，只填入沒有資料的格子
+scan    : 計算全市場最新技術指標並列出前幾筆 (檢查資料與記憶體用量)
+
+Usage: python tools/panel.py update
+       python tools/panel.py backfill [--period 6mo]
+       python tools/panel.py scan [--sort rsi] [-n 20]
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import market_panel_service
+from services.indicator_service import get_market_indicators
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'backfill', 'scan'])
+    parser.add_argument('--period', default='6mo')
+    parser.add_argument('--sort', default='rsi')
+    parser.add_argument('-n', type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'update':
+        try: print(market_panel_service.update_panel(retry_for=0))
+        except RuntimeError as e: print(f"incomplete: {e} (written: {market_panel_service.last_update['codes']})")
+    elif args.command == 'backfill':
+        print(f"{market_panel_service.backfill_panel(args.period)} days written")
+    else:
+        indicators = get_market_indicators()
+        if indicators is None:
+            print("Panel is empty, run `python tools/panel.py update` first.")
+            return
+        print(indicators.sort_values(args.sort, ascending=False).head(args.n).round(2).to_string())
+        print(f"{len(indicators)} codes")
+
+    panel = market_panel_service.get_panel()
+    if panel is not None:
+        print(f"panel: {len(panel.codes)} codes x {len(panel)} days, last {panel.dates[-1].date()}")
+    # ru_maxrss 在 Linux 為 KB
+    print(f"elapsed {time.perf_counter() - start:.2f}s, max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
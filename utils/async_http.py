@@ -0,0 +1,148 @@
+import os
+import json
+import atexit
+import time
+import asyncio
+import threading
+import weakref
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from config import (
+    ASYNC_HTTP_LIMIT, ASYNC_HTTP_TIMEOUT, ASYNC_BLOCKING_WORKERS,
+    FETCH_DEADLINE, OPTIONAL_FETCH_DEADLINE
+)
+from utils import metrics, profiler
+
+# 共用的 asyncio 事件迴圈 (背景執行緒) 與 aiohttp 連線池
+# - services 的 *_async 函式在此迴圈上執行，同步程式以 run_sync / spawn 呼叫
+# - yfinance 等沒有 async 版本的呼叫以 run_blocking 丟到獨立執行緒池
+#   (不與 fanout 共用，避免 yfinance 內部的 fan_out 等待同一個池而卡住)
+# - 每個行程 (gunicorn worker) 各自在第一次使用時建立
+
+_lock = threading.Lock()
+_loop = None
+_loop_thread = None
+_loop_pid = None
+_session = None
+_blocking = ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_WORKERS, thread_name_prefix='async-blocking')
+_chat_locks = weakref.WeakValueDictionary()
+
+
+class Response:
+    """已讀完內容的回應 (離開 session 後仍可使用)"""
+
+    def __init__(self, status, content, headers, encoding):
+        self.status = status
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_loop():
+    """共用事件迴圈 (必要時啟動背景執行緒)"""
+    global _loop, _loop_thread, _loop_pid
+    with _lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='asyncio', daemon=True)
+            _loop_thread.start()
+        return _loop
+
+def in_loop_thread():
+    return threading.current_thread() is _loop_thread
+
+def spawn(coro):
+    """在共用迴圈上執行 coroutine，回傳 concurrent.futures.Future (不等待)"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+def run_sync(coro, timeout=None):
+    """同步等待 coroutine 的結果 (不可在迴圈執行緒上呼叫，否則會卡死)"""
+    if in_loop_thread():
+        coro.close()
+        raise RuntimeError("run_sync() called from the event loop thread")
+    return spawn(coro).result(timeout)
+
+def run_blocking(fn, *args, **kwargs):
+    """在執行緒池執行同步函式，回傳可 await 的 Future"""
+    return asyncio.wrap_future(_blocking.submit(profiler.wrap(partial(fn, *args, **kwargs))))
+
+def chat_lock(chat_id):
+    """同一聊天室的 async 指令依序執行 (沒有指令在等待時自動釋放)"""
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+async def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT),
+            timeout=aiohttp.ClientTimeout(total=ASYNC_HTTP_TIMEOUT)
+        )
+    return _session
+
+def close():
+    """結束前關閉共用 session (避免 Unclosed connector 警告)"""
+    if _session is None or _session.closed or _loop_pid != os.getpid(): return
+    try: asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(5)
+    except Exception as e: print(f"[Debug] Error closing async session: {e}")
+
+atexit.register(close)
+
+async def request(method, url, name='http', timeout=None, prefix='upstream', **kwargs):
+    """
+    以共用 session 發送請求並讀完內容，回傳 Response
+    耗時記錄在 /metrics 的 <prefix>.<name>，連線錯誤與 4xx/5xx 計入 <prefix>.<name>.error
+    """
+    if timeout is not None: kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+    session = await get_session()
+    start = time.monotonic()
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            content = await resp.read()
+            response = Response(resp.status, content, resp.headers, resp.charset)
+    except Exception:
+        metrics.incr(f"{prefix}.{name}.error")
+        raise
+    finally:
+        metrics.observe(f"{prefix}.{name}", time.monotonic() - start)
+    if response.status >= 400: metrics.incr(f"{prefix}.{name}.error")
+    return response
+
+async def fan_out_async(calls, optional=(), deadline=FETCH_DEADLINE, optional_deadline=OPTIONAL_FETCH_DEADLINE):
+    """
+    utils.fanout.fan_out 的 async 版本
+    calls: dict name -> awaitable；逾時或發生錯誤的結果為 None，
+    逾時的工作在背景繼續執行 (結果仍會寫入各自的快取)
+    """
+    start = time.monotonic()
+    tasks = {name: asyncio.ensure_future(aw) for name, aw in calls.items()}
+    results = {}
+
+    async def collect(name, limit):
+        remaining = max(0, start + limit - time.monotonic())
+        try:
+            results[name] = await asyncio.wait_for(asyncio.shield(tasks[name]), remaining)
+        except asyncio.TimeoutError:
+            print(f"[Debug] fan_out_async: '{name}' exceeded {limit}s, dropped.")
+            results[name] = None
+        except Exception as e:
+            print(f"[Debug] fan_out_async: '{name}' failed: {e}")
+            results[name] = None
+
+    await asyncio.gather(*(collect(name, deadline) for name in tasks if name not in optional))
+    await asyncio.gather(*(collect(name, optional_deadline) for name in tasks if name in optional))
+    return results
+
+# 等待執行緒的同步呼叫數 (持續大於 0 代表 ASYNC_BLOCKING_WORKERS 不足)
+metrics.register_gauge("async.blocking_queued", lambda: _blocking._work_queue.qsize())
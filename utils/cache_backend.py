@@ -0,0 +1,602 @@
+import os
+import sys
+import time
+import zlib
+import pickle
+import socket
+import sqlite3
+import threading
+from urllib.parse import urlparse
+from cachetools import TLRUCache
+from config import CACHE_BACKEND, CACHE_DIR, REDIS_URL, CACHE_MEMORY_BUDGET_MB
+from utils import metrics
+
+# 可替換的快取後端，介面與 cachetools 相同 (cache[key] / cache[key] = value / cache.get)，
+# 可直接搭配 @cached(...) 使用
+# - memory: 行程內 TLRUCache (預設)
+# - sqlite: CACHE_DIR 下的 SQLite (WAL)，同一台機器的所有 gunicorn worker 共用
+# - redis : Redis 協定 (RESP)，可接 Redis / KeyDB / Valkey 等相容服務
+# 每筆資料都帶有到期時間 (ttl 固定秒數，或 ttu(key, value, now) 自訂到期時間)
+# 行程內快取共用 CACHE_MEMORY_BUDGET_MB 的記憶體預算 (見 MemoryCache)
+
+_COMPRESS_THRESHOLD = 1024
+_registry = {}
+
+MEMORY_BUDGET = int(CACHE_MEMORY_BUDGET_MB * 1024 * 1024)
+# 無法量到重新抓取耗時 (e.g. 從快照載入) 時的預設成本秒數
+DEFAULT_COST = 0.1
+# 容器超過此數量時只估算前面的元素再依比例放大
+_SIZE_SAMPLE = 200
+# 快取以外的常駐資料 (見 register_external) 重新估算大小的間隔秒數
+_EXTERNAL_RESIZE_INTERVAL = 30
+
+
+def _dumps(value):
+    """pickle + 大於 1KB 時 zlib 壓縮，第一個 byte 標記是否壓縮"""
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) > _COMPRESS_THRESHOLD:
+        return b'z' + zlib.compress(data, 1)
+    return b'p' + data
+
+def _loads(blob):
+    blob = bytes(blob)
+    if blob[:1] == b'z': return pickle.loads(zlib.decompress(blob[1:]))
+    return pickle.loads(blob[1:])
+
+def _key_str(key):
+    return repr(tuple(key)) if isinstance(key, tuple) else repr(key)
+
+def _make_ttu(ttl, ttu):
+    if ttu: return ttu
+    return lambda key, value, now: now + ttl
+
+def estimate_size(value, depth=0):
+    """
+    估算物件佔用的位元組數 (含內容)
+    DataFrame / Series 以 memory_usage(deep=True)、NumPy 陣列以 nbytes 計算；
+    大型容器只估算前 _SIZE_SAMPLE 個元素後依比例放大
+    """
+    if value is None or isinstance(value, (bool, int, float)): return sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray)): return sys.getsizeof(value)
+    usage = getattr(value, 'memory_usage', None)
+    if callable(usage):
+        try:
+            usage = usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+        except Exception: pass
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int): return nbytes + sys.getsizeof(value)
+    size = sys.getsizeof(value)
+    if depth >= 8: return size
+    if isinstance(value, dict): items = value.items()
+    elif isinstance(value, (list, tuple, set, frozenset)): items = value
+    elif hasattr(value, '__dict__'): items = vars(value).items()
+    else: return size
+    count, inner = 0, 0
+    for item in items:
+        if count == _SIZE_SAMPLE: break
+        if isinstance(item, tuple) and len(item) == 2 and not isinstance(value, (list, tuple, set, frozenset)):
+            inner += estimate_size(item[0], depth + 1) + estimate_size(item[1], depth + 1)
+        else:
+            inner += estimate_size(item, depth + 1)
+        count += 1
+    total = len(value) if hasattr(value, '__len__') else count
+    return size + (inner * total // count if count else 0)
+
+
+class MemoryCache(TLRUCache):
+    """
+    行程內快取 (thread-safe 的 TLRUCache，計時使用 time.time)
+    會記錄每筆資料的到期時間，供重啟時寫入/載入快照
+    - maxsize 為筆數上限 (超過時淘汰最久未使用的)
+    - currsize 為估算的位元組數；所有 MemoryCache 合計超過 MEMORY_BUDGET 時，
+      依 GreedyDual-Size 淘汰「重新抓取成本 / 大小」最低的資料 (成本為未命中到寫回之間的耗時)
+    """
+
+    def __init__(self, name, maxsize, ttu):
+        # 位元組上限交給整體預算 (_budget) 處理，單一快取不自行以 LRU 淘汰
+        super().__init__(maxsize=float('inf'), ttu=self._entry_ttu, timer=time.time)
+        self.name = name
+        self.max_entries = maxsize
+        self.refresher = None   # refresher(key): 重新抓取並寫回快取 (快照載入後用來更新過期資料)
+        self.cost = DEFAULT_COST    # 此快取重新抓取耗時的 EWMA (無法量測時使用)
+        self._ttu = ttu
+        self._lock = threading.RLock()
+        self._expires = {}
+        self._restore_expiry = {}
+        self._priority = {}     # key -> (GreedyDual 優先值, 成本秒數, 位元組數)
+        self._miss_at = {}      # key -> 最近一次未命中的時間 (monotonic)
+        self._sizing = None     # 寫入中的 (value, 位元組數)，避免重複估算
+
+    def _entry_ttu(self, key, value, now):
+        expires_at = self._restore_expiry.pop(key, None)
+        if expires_at is None: expires_at = self._ttu(key, value, now)
+        self._expires[key] = expires_at
+        return expires_at
+
+    def getsizeof(self, value):
+        if self._sizing is not None and self._sizing[0] is value: return self._sizing[1]
+        return estimate_size(value)
+
+    def _missed(self, key):
+        if len(self._miss_at) > 1000: self._miss_at.clear()
+        self._miss_at[key] = time.monotonic()
+
+    def _touch(self, key):
+        _, cost, size = self._priority.get(key, (0, self.cost, 1))
+        self._priority[key] = (_budget.inflation + cost / size, cost, size)
+
+    def _store(self, key, value, cost):
+        """寫入 (需持有 _lock)；超過筆數上限先淘汰最久未使用的，大於整體預算的單筆資料不快取"""
+        if key not in self:
+            while len(self) >= self.max_entries:
+                try: self.popitem()
+                except KeyError: break
+        size = max(estimate_size(value), 1)
+        if MEMORY_BUDGET and size > MEMORY_BUDGET:
+            print(f"[Debug] Cache {self.name}: entry too large ({size} bytes), not cached.")
+            metrics.incr(f"cache.{self.name}.too_large")
+            return
+        self._sizing = (value, size)
+        try: super().__setitem__(key, value)
+        finally: self._sizing = None
+        if super().__contains__(key):
+            cost = self.cost if cost is None else cost
+            self._priority[key] = (_budget.inflation + cost / size, cost, size)
+
+    def __getitem__(self, key):
+        with self._lock:
+            try: value = super().__getitem__(key)
+            except KeyError:
+                self._missed(key)
+                raise
+            self._touch(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            missed = self._miss_at.pop(key, None)
+            cost = None
+            if missed is not None:
+                cost = time.monotonic() - missed
+                self.cost += 0.2 * (cost - self.cost)
+            self._store(key, value, cost)
+        _budget.enforce()
+
+    def restore(self, key, value, expires_at):
+        """以快照中的原始到期時間寫回"""
+        with self._lock:
+            self._restore_expiry[key] = expires_at
+            try: self._store(key, value, None)
+            finally: self._restore_expiry.pop(key, None)
+        _budget.enforce()
+
+    def entries(self):
+        """目前仍有效的 (key, value, expires_at)"""
+        with self._lock:
+            self.expire()
+            for key in list(self._expires):
+                if key not in self: del self._expires[key]
+            return [(key, super(MemoryCache, self).__getitem__(key), self._expires[key]) for key in list(self._expires)]
+
+    def priorities(self):
+        """目前仍有效資料的 (優先值, 位元組數, key)，供整體預算淘汰"""
+        with self._lock:
+            self.expire()
+            return [(h, size, key) for key, (h, cost, size) in self._priority.items()]
+
+    def evict(self, key):
+        with self._lock:
+            if not super().__contains__(key): return False
+            del self[key]
+            return True
+
+    def expire(self, time=None):
+        with self._lock:
+            expired = super().expire(time)
+            for key, _ in expired: self._priority.pop(key, None)
+            return expired
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._priority.pop(key, None)
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock: return super().__contains__(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if super().__contains__(key): return self[key]
+            self._missed(key)
+            return default
+
+    def pop(self, key, default=None):
+        with self._lock: return super().pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._priority.clear()
+
+
+class _MemoryBudget:
+    """所有 MemoryCache 共用的記憶體預算 (GreedyDual-Size：被淘汰者的優先值成為新資料的基準，避免舊資料永久佔用)"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.inflation = 0.0
+        self._lock = threading.Lock()
+        self._external = {}         # name -> sizer()
+        self._external_sizes = {}   # name -> 最近一次估算的位元組數
+        self._external_at = 0.0
+
+    def caches(self):
+        return [c for c in list(_registry.values()) if isinstance(c, MemoryCache)]
+
+    def external(self):
+        """快取以外常駐資料的位元組數 (每 _EXTERNAL_RESIZE_INTERVAL 秒重新估算一次，估算失敗沿用上次的值)"""
+        now = time.monotonic()
+        if now >= self._external_at:
+            self._external_at = now + _EXTERNAL_RESIZE_INTERVAL
+            sizes = dict(self._external_sizes)
+            for name, sizer in list(self._external.items()):
+                try: sizes[name] = int(sizer())
+                except Exception as e: print(f"[Debug] Memory budget: sizing {name} failed: {e}")
+            self._external_sizes = sizes
+        return dict(self._external_sizes)
+
+    def used(self):
+        return sum(c.currsize for c in self.caches()) + sum(self.external().values())
+
+    def enforce(self):
+        if not self.limit or self.used() <= self.limit: return
+        with self._lock:
+            over = self.used() - self.limit
+            if over <= 0: return
+            candidates = sorted(
+                ((h, size, cache, key) for cache in self.caches() for h, size, key in cache.priorities()),
+                key=lambda c: c[0]
+            )
+            for h, size, cache, key in candidates:
+                if over <= 0: break
+                if cache.evict(key):
+                    over -= size
+                    self.inflation = max(self.inflation, h)
+                    metrics.incr(f"cache.{cache.name}.evicted")
+
+_budget = _MemoryBudget(MEMORY_BUDGET)
+
+def register_external(name, value):
+    """
+    登記不經過快取、但常駐記憶體的資料 (e.g. 全市場本益比表)，估算大小計入整體預算
+    value: 無參數 callable，回傳目前的物件 (模組會整個替換的全域變數要用 callable 取最新的)
+    外部資料本身不會被淘汰，超出預算時改淘汰快取資料
+    """
+    _budget._external[name] = lambda: estimate_size(value())
+    _budget._external_at = 0.0
+    metrics.register_gauge(f"memory.{name}.bytes", lambda: _budget.external().get(name, 0))
+
+def memory_report():
+    """各行程內快取與外部常駐資料的筆數 / 估算位元組數 (供 /metrics)"""
+    caches = {c.name: {"entries": len(c), "bytes": c.currsize, "cost": round(c.cost, 4)} for c in _budget.caches()}
+    external = _budget.external()
+    used = sum(c["bytes"] for c in caches.values()) + sum(external.values())
+    return {"budget": MEMORY_BUDGET, "used": used, "caches": caches, "external": external}
+
+
+class SQLiteCache:
+    """本機共用快取：所有 worker 讀寫同一個 SQLite 檔案 (WAL 模式讀寫不互鎖)"""
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, name, maxsize, ttu, path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttu = ttu
+        self.path = path or os.path.join(CACHE_DIR, 'cache.db')
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entries ('
+                ' name TEXT, key TEXT, value BLOB, expires_at REAL, PRIMARY KEY (name, key))'
+            )
+            self._local.conn = conn
+        return conn
+
+    def __getitem__(self, key):
+        try:
+            row = self._conn().execute(
+                'SELECT value, expires_at FROM cache_entries WHERE name = ? AND key = ?',
+                (self.name, _key_str(key))
+            ).fetchone()
+        except sqlite3.Error as e:
+            # 快取讀取失敗視同未命中
+            print(f"[Debug] SQLite cache read error ({self.name}): {e}")
+            raise KeyError(key)
+        if row is None or row[1] <= time.time(): raise KeyError(key)
+        return _loads(row[0])
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        expires_at = self.ttu(key, value, now)
+        if expires_at <= now: return
+        try:
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?)',
+                (self.name, _key_str(key), _dumps(value), expires_at)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0: self._prune(conn, now)
+        except sqlite3.Error as e:
+            print(f"[Debug] SQLite cache write error ({self.name}): {e}")
+
+    def __delitem__(self, key):
+        cur = self._conn().execute(
+            'DELETE FROM cache_entries WHERE name = ? AND key = ?', (self.name, _key_str(key))
+        )
+        if cur.rowcount == 0: raise KeyError(key)
+
+    def __contains__(self, key):
+        try: self[key]; return True
+        except KeyError: return False
+
+    def __len__(self):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM cache_entries WHERE name = ? AND expires_at > ?', (self.name, time.time())
+        ).fetchone()[0]
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        try: del self[key]
+        except KeyError: pass
+        return value
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache_entries WHERE name = ?', (self.name,))
+
+    def _prune(self, conn, now):
+        conn.execute('DELETE FROM cache_entries WHERE name = ? AND expires_at <= ?', (self.name, now))
+        conn.execute(
+            'DELETE FROM cache_entries WHERE rowid IN ('
+            ' SELECT rowid FROM cache_entries WHERE name = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.name, self.maxsize)
+        )
+
+
+class _RespClient:
+    """極簡 Redis 協定 (RESP2) client，只實作快取需要的指令"""
+
+    def __init__(self, url, timeout=2):
+        u = urlparse(url)
+        self.host = u.hostname or 'localhost'
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int(u.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _sock(self):
+        f = getattr(self._local, 'f', None)
+        if f is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._local.sock = sock
+            f = self._local.f = sock.makefile('rwb')
+            if self.password: self._call(b'AUTH', self.password)
+            if self.db: self._call(b'SELECT', str(self.db))
+        return f
+
+    def _reset(self):
+        try: self._local.sock.close()
+        except Exception: pass
+        self._local.f = None
+
+    def _read(self, f):
+        line = f.readline()
+        if not line: raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+': return rest
+        if kind == b'-': raise RuntimeError(rest.decode())
+        if kind == b':': return int(rest)
+        if kind == b'$':
+            n = int(rest)
+            if n < 0: return None
+            data = f.read(n + 2)
+            return data[:-2]
+        if kind == b'*':
+            n = int(rest)
+            return None if n < 0 else [self._read(f) for _ in range(n)]
+        raise RuntimeError(f"Unknown RESP reply: {line!r}")
+
+    def _call(self, *args):
+        f = self._local.f
+        parts = [b'*%d\r\n' % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(a), a))
+        f.write(b''.join(parts))
+        f.flush()
+        return self._read(f)
+
+    def call(self, *args):
+        try:
+            self._sock()
+            return self._call(*args)
+        except (OSError, ConnectionError):
+            # 連線中斷時重連一次
+            self._reset()
+            self._sock()
+            return self._call(*args)
+
+
+class RedisCache:
+    """Redis 協定共用快取，到期時間交給 Redis (PX) 處理"""
+
+    def __init__(self, name, maxsize, ttu, url=None, client=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttu = ttu
+        self.client = client or _RespClient(url or REDIS_URL)
+        self.prefix = f"lfb:{name}:"
+
+    def _k(self, key):
+        return (self.prefix + _key_str(key)).encode()
+
+    def __getitem__(self, key):
+        try: blob = self.client.call(b'GET', self._k(key))
+        except Exception as e:
+            # Redis 無法連線時視同未命中，直接抓上游
+            print(f"[Debug] Redis cache read error ({self.name}): {e}")
+            raise KeyError(key)
+        if blob is None: raise KeyError(key)
+        return _loads(blob)
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        ttl_ms = int((self.ttu(key, value, now) - now) * 1000)
+        if ttl_ms <= 0: return
+        try: self.client.call(b'SET', self._k(key), _dumps(value), b'PX', ttl_ms)
+        except Exception as e:
+            print(f"[Debug] Redis cache write error ({self.name}): {e}")
+
+    def __delitem__(self, key):
+        if not self.client.call(b'DEL', self._k(key)): raise KeyError(key)
+
+    def __contains__(self, key):
+        return bool(self.client.call(b'EXISTS', self._k(key)))
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        try: del self[key]
+        except KeyError: pass
+        return value
+
+    def clear(self):
+        keys = self.client.call(b'KEYS', (self.prefix + '*').encode()) or []
+        if keys: self.client.call(b'DEL', *keys)
+
+
+def make_cache(name, maxsize, ttl=None, ttu=None, backend=None):
+    """
+    依 CACHE_BACKEND 建立快取
+    ttl: 固定存活秒數；ttu(key, value, now): 回傳到期時間 (time.time 基準)
+    共用後端初始化失敗時退回行程內快取
+    """
+    backend = backend or CACHE_BACKEND
+    ttu = _make_ttu(ttl, ttu)
+    try:
+        if backend == 'sqlite': cache = SQLiteCache(name, maxsize, ttu)
+        elif backend == 'redis': cache = RedisCache(name, maxsize, ttu)
+        else: cache = MemoryCache(name, maxsize, ttu)
+    except Exception as e:
+        print(f"[Debug] Cache backend '{backend}' unavailable for {name}: {e}. Fallback to memory.")
+        cache = MemoryCache(name, maxsize, ttu)
+    _registry[name] = cache
+    if isinstance(cache, MemoryCache):
+        metrics.register_gauge(f"cache.{name}.bytes", lambda: cache.currsize)
+    return cache
+
+def get_registered_caches():
+    return dict(_registry)
+
+metrics.register_gauge("cache.memory_bytes", _budget.used)
+
+
+# --- 重啟暖機：行程內快取的磁碟快照 ---
+
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, 'snapshots')
+MAX_BACKGROUND_REFRESH = 50
+
+
+def _snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIR, f"{name}.pkl")
+
+def _read_snapshot(name):
+    try:
+        with open(_snapshot_path(name), 'rb') as f:
+            return _loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"[Debug] Error reading cache snapshot {name}: {e}")
+        return {}
+
+def snapshot_caches():
+    """
+    將行程內快取 (連同每筆到期時間) 寫入 CACHE_DIR/snapshots
+    多個 worker 共用同一份快照：寫入前先合併既有內容，保留較晚到期者
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    now = time.time()
+    for name, cache in list(_registry.items()):
+        if not isinstance(cache, MemoryCache): continue
+        try:
+            merged = {k: v for k, v in _read_snapshot(name).items() if v[1] > now - 86400}
+            for key, value, expires_at in cache.entries():
+                if key not in merged or merged[key][1] < expires_at:
+                    merged[key] = (value, expires_at)
+            tmp_path = f"{_snapshot_path(name)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(_dumps(merged))
+            os.replace(tmp_path, _snapshot_path(name))
+        except Exception as e:
+            print(f"[Debug] Error writing cache snapshot {name}: {e}")
+
+def restore_caches():
+    """
+    開機時載入快照：仍在有效期內的資料直接放回快取，
+    已過期的資料交給背景執行緒以 refresher 重新抓取
+    """
+    now = time.time()
+    stale = []
+    restored = 0
+    for name, cache in list(_registry.items()):
+        if not isinstance(cache, MemoryCache): continue
+        for key, (value, expires_at) in _read_snapshot(name).items():
+            if expires_at > now:
+                cache.restore(key, value, expires_at)
+                restored += 1
+            elif cache.refresher:
+                stale.append((expires_at, cache, key))
+    print(f"[Debug] Cache snapshot restored: {restored} entries, {len(stale)} to refresh.")
+
+    if stale:
+        # 最近才過期的優先更新
+        stale.sort(key=lambda x: x[0], reverse=True)
+        def refresh():
+            for _, cache, key in stale[:MAX_BACKGROUND_REFRESH]:
+                try: cache.refresher(key)
+                except Exception as e: print(f"[Debug] Background refresh failed for {cache.name} {key}: {e}")
+        threading.Thread(target=refresh, name='cache-warmup', daemon=True).start()
+    return restored
+
+def start_snapshot_thread(interval):
+    """定期寫入快照，並在行程結束 (部署 / 休眠) 時再寫一次"""
+    import atexit
+    atexit.register(snapshot_caches)
+    if interval <= 0: return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            snapshot_caches()
+    t = threading.Thread(target=loop, name='cache-snapshot', daemon=True)
+    t.start()
+    return t
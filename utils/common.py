@@ -15,6 +15,60 @@ def get_greeting():
     except:
         return "你好 🤖"
 
+# --- 代號判斷 ---
+
+def is_tw_stock_symbol(text):
+    """台股代號：4-6 碼英數字且含數字 (e.g. 2330, 00981A)"""
+    return text.isascii() and text.isalnum() and 4 <= len(text) <= 6 and any(c.isdigit() for c in text)
+
+def is_us_stock_symbol(text):
+    """美股代號 (1-5 個英文字母) 或指數 (e.g. ^VIX)"""
+    if text.startswith('^'): return text[1:].isalpha() and text[1:].isascii() and 2 <= len(text) <= 6
+    return text.isalpha() and text.isascii() and 1 <= len(text) <= 5
+
+MULTI_SEPARATORS = ',，、'
+# 只以空白分隔的純美股代號 (e.g. "AAPL NVDA TSLA") 可能是一般聊天，限制檔數
+MULTI_US_BARE_MAX = 5
+
+def parse_multi_symbols(text):
+    """
+    多檔查詢的代號清單 (2-12 檔，去重)，不是多檔查詢回傳 None
+    純英文短字 (e.g. "HI ALL", "OK GO") 容易與一般聊天混淆：含台股代號、以逗號 / 頓號分隔 (e.g. "AAPL,NVDA")
+    或每個代號前加 $ (e.g. "$AAPL $NVDA") 時最多 12 檔，只以空白分隔時限 2-5 檔 (e.g. "AAPL NVDA TSLA")
+    """
+    msg = text.upper().strip()
+    separated = any(sep in msg for sep in MULTI_SEPARATORS)
+    for sep in MULTI_SEPARATORS: msg = msg.replace(sep, ' ')
+    parts = msg.split()
+    tagged = bool(parts) and all(len(p) > 1 and p.startswith('$') for p in parts)
+    if tagged: parts = [p[1:] for p in parts]
+    if not 2 <= len(parts) <= 12: return None
+    if not all(is_tw_stock_symbol(p) or is_us_stock_symbol(p) for p in parts): return None
+    if not (separated or tagged or any(is_tw_stock_symbol(p) for p in parts) or len(parts) <= MULTI_US_BARE_MAX): return None
+    return list(dict.fromkeys(parts))
+
+# --- 指令分類 (與 handle_message 的判斷順序一致，供統計 / 去重 / 限流使用) ---
+
+AI_COMMANDS = ['分析', '策略', '建議']
+WATCHLIST_COMMANDS = ['加入', '移除', '刪除']
+WATCHLIST_VIEW_COMMANDS = ['自選', '我的自選', '自選清單']
+
+def classify_command(text):
+    from config import VALID_CURRENCIES
+    msg = text.upper().strip()
+    parts = msg.split()
+    if not parts: return 'other'
+    if msg in VALID_CURRENCIES: return 'forex'
+    if parts[0] in WATCHLIST_COMMANDS or msg in WATCHLIST_VIEW_COMMANDS: return 'watchlist'
+    if len(parts) == 2 and parts[0] in VALID_CURRENCIES:
+        return 'forex_list' if parts[1] == '列表' else 'forex_chart'
+    if parse_multi_symbols(msg): return 'multi_quote'
+    if len(parts) == 2 and parts[1] in AI_COMMANDS: return 'ai_analysis'
+    if len(parts) == 2 and parts[0].isdigit(): return 'stock_chart'
+    if is_us_stock_symbol(msg): return 'us_quote'
+    if is_tw_stock_symbol(msg): return 'tw_quote'
+    return 'other'
+
 # --- 台股工具 ---
 
 from decimal import Decimal, ROUND_FLOOR, ROUND_CEILING
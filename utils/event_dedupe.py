@@ -0,0 +1,83 @@
+import os
+import time
+import sqlite3
+import threading
+from config import CACHE_DIR, EVENT_DEDUPE_TTL, EVENT_DEDUPE_MAX
+from utils import metrics
+from utils.common import classify_command
+
+# 已處理的 webhookEventId (SQLite WAL，多個 worker 共用)
+# /callback 太慢時 LINE 會重送同一個事件，重送的事件直接略過，
+# 避免重複下載 / 呼叫 Gemini / 推播兩次報告
+
+DB_PATH = os.path.join(CACHE_DIR, 'webhook_events.db')
+PRUNE_EVERY = 200
+
+_local = threading.local()
+_insert_count = 0
+
+
+def _conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS processed_events (event_id TEXT PRIMARY KEY, expires_at REAL)')
+        _local.conn = conn
+    return conn
+
+def _prune(conn, now):
+    """刪除過期紀錄，並將總數限制在 EVENT_DEDUPE_MAX 內"""
+    conn.execute('DELETE FROM processed_events WHERE expires_at < ?', (now,))
+    conn.execute(
+        'DELETE FROM processed_events WHERE rowid IN ('
+        ' SELECT rowid FROM processed_events ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+        (EVENT_DEDUPE_MAX,)
+    )
+
+def mark_processed(event_id):
+    """第一次看到此事件回傳 True；已處理過 (未過期) 回傳 False"""
+    global _insert_count
+    now = time.time()
+    conn = _conn()
+    cur = conn.execute('INSERT OR IGNORE INTO processed_events VALUES (?, ?)', (event_id, now + EVENT_DEDUPE_TTL))
+    if cur.rowcount == 0:
+        # 已存在：過期的紀錄視為新事件
+        cur = conn.execute(
+            'UPDATE processed_events SET expires_at = ? WHERE event_id = ? AND expires_at < ?',
+            (now + EVENT_DEDUPE_TTL, event_id, now)
+        )
+        if cur.rowcount == 0: return False
+
+    _insert_count += 1
+    if _insert_count % PRUNE_EVERY == 0: _prune(conn, now)
+    return True
+
+def is_duplicate_event(event):
+    """
+    在 handle_message 之前檢查，重送的事件回傳 True
+    並依指令類型以平均耗時估算省下的上游工作量
+    """
+    event_id = getattr(event, 'webhook_event_id', None)
+    if not event_id: return False
+
+    context = getattr(event, 'delivery_context', None)
+    if context is not None and getattr(context, 'is_redelivery', False):
+        metrics.incr("dedupe.redelivered")
+
+    try:
+        if mark_processed(event_id): return False
+    except Exception as e:
+        # 去重失敗時寧可重複處理，也不要漏掉事件
+        print(f"[Debug] Event dedupe error: {e}")
+        return False
+
+    message = getattr(event, 'message', None)
+    command = classify_command(message.text) if getattr(message, 'text', None) else 'other'
+    metrics.incr("dedupe.dropped")
+    metrics.incr(f"dedupe.dropped.{command}")
+    saved = metrics.get_avg_timing(f"command.{command}")
+    if saved: metrics.incr("dedupe.saved_seconds", round(saved, 3))
+    print(f"[Debug] Duplicate webhook event dropped: {event_id} ({command})")
+    return True
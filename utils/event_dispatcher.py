@@ -0,0 +1,60 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import EVENT_MAX_WORKERS
+from utils import metrics
+
+# Webhook 事件分派：
+# 同一個聊天室 (user / group / room) 的事件依序處理，不同聊天室之間並行
+# 避免忙碌的群組卡住同一個 worker 上的私訊
+
+_executor = ThreadPoolExecutor(max_workers=EVENT_MAX_WORKERS, thread_name_prefix='event')
+_lock = threading.Lock()
+_queues = {}  # chat_id -> deque of events (key 存在代表該聊天室正在處理中)
+
+
+def get_chat_id(event):
+    source = event.source
+    if source.type == 'group': return source.group_id
+    if source.type == 'room': return source.room_id
+    return getattr(source, 'user_id', None)
+
+def _drain(chat_id, handle):
+    while True:
+        with _lock:
+            q = _queues[chat_id]
+            if not q:
+                del _queues[chat_id]
+                return
+            event = q.popleft()
+        try:
+            handle(event)
+        except Exception as e:
+            metrics.incr("events.error")
+            print(f"[Debug] Error handling event for {chat_id}: {e}")
+
+def dispatch(events, handle):
+    """將事件交給 worker pool，handle(event) 在背景執行"""
+    for event in events:
+        metrics.incr("events.received")
+        chat_id = get_chat_id(event)
+        with _lock:
+            q = _queues.get(chat_id)
+            if q is not None:
+                # 同聊天室已有事件在處理，排在後面
+                q.append(event)
+                continue
+            _queues[chat_id] = deque([event])
+        _executor.submit(_drain, chat_id, handle)
+
+def pending_events():
+    with _lock:
+        return sum(len(q) for q in _queues.values())
+
+def active_chats():
+    with _lock:
+        return len(_queues)
+
+metrics.register_gauge("events.pending", pending_events)
+metrics.register_gauge("events.active_chats", active_chats)
+metrics.register_gauge("events.max_workers", lambda: EVENT_MAX_WORKERS)
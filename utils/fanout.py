@@ -0,0 +1,77 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from config import FANOUT_MAX_WORKERS, FANOUT_PROBE_WORKERS, FANOUT_NESTED_WORKERS, FETCH_DEADLINE, OPTIONAL_FETCH_DEADLINE
+from utils import metrics, profiler
+
+# 所有指令共用的抓取執行緒池 (網路 I/O 為主，GIL 影響不大)
+_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='fanout')
+# 末端工作 (上市/上櫃探測) 專用：fanout 的工作裡還要並行探測時改用這個池，
+# 不在池內等待同一個池 (池滿時外層佔住全部執行緒、內層排不到隊而逾時)
+probe_executor = ThreadPoolExecutor(max_workers=FANOUT_PROBE_WORKERS, thread_name_prefix='fanout-probe')
+# 巢狀 fan_out (在某個池的工作裡再呼叫 fan_out 到同一個池) 改送到這個池，
+# 仍保有 deadline 與可捨棄項目的逾時，而不是依序直接執行
+nested_executor = ThreadPoolExecutor(max_workers=FANOUT_NESTED_WORKERS, thread_name_prefix='fanout-nested')
+
+
+def _in_pool(executor):
+    return threading.current_thread().name.startswith(executor._thread_name_prefix + '_')
+
+def submit(fn, *args, **kwargs):
+    """將單一工作丟到共用執行緒池，回傳 Future"""
+    return _executor.submit(profiler.wrap(fn), *args, **kwargs)
+
+def _run_inline(calls):
+    results = {}
+    for name, fn in calls.items():
+        try:
+            results[name] = fn()
+        except Exception as e:
+            print(f"[Debug] fan_out: '{name}' failed: {e}")
+            results[name] = None
+    return results
+
+def fan_out(calls, optional=(), deadline=FETCH_DEADLINE, optional_deadline=OPTIONAL_FETCH_DEADLINE, executor=None):
+    """
+    並行執行多個互不相依的抓取，總耗時約等於最慢的那一個 (而非加總)
+    calls: dict name -> 無參數 callable (可用 lambda / functools.partial)
+    optional: 可捨棄的項目 (e.g. 本益比)，最多等到必要項目完成或 optional_deadline，
+              以較晚者為準，逾時即以 None 代替，不拖慢回覆
+    必要項目最多等 deadline 秒；逾時或發生錯誤的結果皆為 None
+    逾時的工作會在背景繼續執行 (結果仍會寫入各自的快取)
+    executor: 預設為共用池；已在該池的執行緒中呼叫時改用 nested_executor (不等待自己所在的池)，
+              連 nested_executor 都已在使用中 (第三層) 時才依序直接執行
+    """
+    executor = executor or _executor
+    if _in_pool(executor):
+        if _in_pool(nested_executor):
+            metrics.incr("fanout.inline")
+            return _run_inline(calls)
+        metrics.incr("fanout.nested")
+        executor = nested_executor
+
+    start = time.monotonic()
+    futures = {name: executor.submit(profiler.wrap(fn)) for name, fn in calls.items()}
+    results = {}
+
+    def collect(name, limit):
+        remaining = max(0, start + limit - time.monotonic())
+        try:
+            results[name] = futures[name].result(timeout=remaining)
+        except FuturesTimeout:
+            print(f"[Debug] fan_out: '{name}' exceeded {limit}s, dropped.")
+            results[name] = None
+        except Exception as e:
+            print(f"[Debug] fan_out: '{name}' failed: {e}")
+            results[name] = None
+
+    for name in futures:
+        if name not in optional: collect(name, deadline)
+    for name in futures:
+        if name in optional: collect(name, optional_deadline)
+    return results
+
+# 等待執行緒的抓取數 (持續大於 0 代表 FANOUT_MAX_WORKERS 不足)
+metrics.register_gauge("fanout.queued", lambda: _executor._work_queue.qsize())
+metrics.register_gauge("fanout.probe_queued", lambda: probe_executor._work_queue.qsize())
+metrics.register_gauge("fanout.nested_queued", lambda: nested_executor._work_queue.qsize())
@@ -1,54 +1,118 @@
-
+import re
 from linebot.models import (
     FlexSendMessage, BubbleContainer, BoxComponent, TextComponent, ButtonComponent,
-    MessageAction, SeparatorComponent, ImageSendMessage, TextSendMessage, FillerComponent
+    MessageAction, SeparatorComponent, ImageSendMessage, TextSendMessage, FillerComponent,
+    CarouselContainer
 )
 
-def generate_currency_flex_message(forex_data, bank_report_text):
-    c_code = forex_data['currency']
-    price = forex_data['price']
-    change = forex_data['change']
-    percent = forex_data['change_percent']
-    
-    if change > 0: color = "#eb4e3d"; sign = "+"
-    elif change < 0: color = "#27ba46"; sign = ""
-    else: color = "#333333"; sign = ""
-
-    # Build Top 5 Banks Rows
-    bank_rows = []
-    # Header
-    bank_rows.append(
-        BoxComponent(
-            layout='horizontal',
-            contents=[
-                TextComponent(text="銀行", size='xxs', color='#aaaaaa', flex=3),
-                TextComponent(text="現鈔賣出", size='xxs', color='#aaaaaa', align='end', flex=2),
-                TextComponent(text="即期賣出", size='xxs', color='#aaaaaa', align='end', flex=2)
-            ]
-        )
-    )
-    
-    # Data Rows
-    if isinstance(bank_report_text, list):
-        for i, b in enumerate(bank_report_text[:5]): # Top 5
-            row_color = "#333333"
-            if i == 0: row_color = "#eb4e3d" # Top 1 highlight
-            
-            bank_rows.append(
-                BoxComponent(
-                    layout='horizontal', margin='xs',
-                    contents=[
-                        TextComponent(text=b['bank'], size='xs', color=row_color, flex=3, weight='bold' if i==0 else 'regular'),
-                        TextComponent(text=b['cash_selling'], size='xs', color=row_color, align='end', flex=2),
-                        TextComponent(text=b['spot_selling'], size='xs', color='#555555', align='end', flex=2)
-                    ]
-                )
-            )
-    else:
-        # Fallback if error string
-        bank_rows.append(TextComponent(text=str(bank_report_text), size='xs', color='#ff0000'))
+# --- 預先編譯的 Flex 樣板 ---
+# 每種卡片的結構只在啟動時建立一次並轉成 JSON dict，
+# 每次請求只替換變動的欄位 (文字 / 顏色 / 列表)，其餘部分直接共用
+# 固定內容的選單 (功能說明 / 幣別選單) 直接快取成可送出的訊息
+# 下方 _xxx_bubble(f) 負責結構，_xxx_fields(data) 負責欄位格式
+
+_SLOT = re.compile(r'\x00(\*?\w+)\x00')
+
+
+def _slot(name):
+    return f"\x00{name}\x00"
+
+class _Slots(dict):
+    """編譯樣板時代替欄位值：一般欄位回傳 slot 字串，列表欄位回傳展開標記"""
+
+    def __init__(self, lists=()):
+        super().__init__({name: [TextComponent(text=_slot('*' + name))] for name in lists})
+
+    def __missing__(self, key):
+        return _slot(key)
+
+def _compile(node):
+    """找出含 slot 的路徑，回傳填值計畫 (沒有 slot 時回傳 None)"""
+    if isinstance(node, str):
+        if '\x00' not in node: return None
+        return _SLOT.sub(r'{\1}', node.replace('{', '{{').replace('}', '}}'))
+    if isinstance(node, dict):
+        plan = {}
+        for key, value in node.items():
+            p = _compile(value)
+            if p is not None: plan[key] = p
+        return ('dict', plan) if plan else None
+    if isinstance(node, list):
+        plan = {}
+        for i, value in enumerate(node):
+            m = _SLOT.fullmatch(value.get('text', '')) if isinstance(value, dict) else None
+            if m and m.group(1).startswith('*'):
+                plan[i] = ('splice', m.group(1)[1:])
+                continue
+            p = _compile(value)
+            if p is not None: plan[i] = p
+        return ('list', plan) if plan else None
+    return None
+
+def _fill(node, plan, values):
+    """依計畫複製有變動的路徑並填入欄位，其餘節點直接共用"""
+    if isinstance(plan, str): return plan.format_map(values)
+    kind, ops = plan
+    if kind == 'dict':
+        new = dict(node)
+        for key, p in ops.items(): new[key] = _fill(node[key], p, values)
+        return new
+    new = []
+    for i, value in enumerate(node):
+        p = ops.get(i)
+        if p is None: new.append(value)
+        elif p[0] == 'splice': new.extend(values[p[1]])
+        else: new.append(_fill(value, p, values))
+    return new
 
+class CompiledFlexMessage(FlexSendMessage):
+    """已轉成 JSON dict 的 Flex Message，送出時不再逐層轉換"""
 
+    def __init__(self, data):
+        self.type = 'flex'
+        self.alt_text = data['altText']
+        self.contents = data['contents']
+        self.quick_reply = None
+        self._data = data
+
+    def as_json_dict(self):
+        return self._data
+
+class FlexTemplate:
+    """
+    build(f) 以欄位 f 建立訊息或元件；編譯時 f 中的值都是 slot
+    lists: 會展開成多個元件的列表欄位 (e.g. 銀行列表)
+    """
+
+    def __init__(self, build, lists=()):
+        self.data = build(_Slots(lists)).as_json_dict()
+        self.plan = _compile(self.data)
+
+    def fill(self, values):
+        return _fill(self.data, self.plan, values) if self.plan else self.data
+
+    def render(self, values):
+        return CompiledFlexMessage(self.fill(values))
+
+
+def _change_color(change):
+    return "#eb4e3d" if change > 0 else "#27ba46" if change < 0 else "#333333"
+
+# --- 匯率卡片 ---
+
+def _bank_row(f, top=False):
+    row_color = "#eb4e3d" if top else "#333333" # Top 1 highlight
+    return BoxComponent(
+        layout='horizontal', margin='xs',
+        contents=[
+            TextComponent(text=f['bank'], size='xs', color=row_color, flex=3, weight='bold' if top else 'regular'),
+            TextComponent(text=f['cash_selling'], size='xs', color=row_color, align='end', flex=2),
+            TextComponent(text=f['spot_selling'], size='xs', color='#555555', align='end', flex=2)
+        ]
+    )
+
+def _currency_bubble(f):
+    c_code = f['code']
     return FlexSendMessage(
         alt_text=f"{c_code} 匯率快報",
         contents=BubbleContainer(
@@ -60,15 +124,26 @@ def generate_currency_flex_message(forex_data, bank_report_text):
                     BoxComponent(
                         layout='baseline', margin='md',
                         contents=[
-                            TextComponent(text=f"{price:.4f}", weight='bold', size='3xl', color=color),
-                            TextComponent(text=f"{sign}{change:.4f} ({sign}{percent:.2f}%)", size='xs', color=color, margin='md', flex=0)
+                            TextComponent(text=f['price'], weight='bold', size='3xl', color=f['color']),
+                            TextComponent(text=f['change'], size='xs', color=f['color'], margin='md', flex=0)
                         ]
                     ),
                     SeparatorComponent(margin='lg'),
                     TextComponent(text="🇹🇼 台灣銀行最佳匯率 (Top 5)", size='sm', weight='bold', color='#555555', margin='lg'),
                     BoxComponent(
                         layout='vertical', margin='md', spacing='xs',
-                        contents=bank_rows
+                        contents=[
+                            # Header
+                            BoxComponent(
+                                layout='horizontal',
+                                contents=[
+                                    TextComponent(text="銀行", size='xxs', color='#aaaaaa', flex=3),
+                                    TextComponent(text="現鈔賣出", size='xxs', color='#aaaaaa', align='end', flex=2),
+                                    TextComponent(text="即期賣出", size='xxs', color='#aaaaaa', align='end', flex=2)
+                                ]
+                            ),
+                            *f['bank_rows']
+                        ]
                     ),
                     SeparatorComponent(margin='lg'),
                     TextComponent(text="歷史走勢圖:", size='xs', color='#aaaaaa', margin='md'),
@@ -92,7 +167,24 @@ def generate_currency_flex_message(forex_data, bank_report_text):
         )
     )
 
-def generate_help_message():
+def _bank_error_row(bank_report_text):
+    # Fallback if error string
+    return TextComponent(text=str(bank_report_text), size='xs', color='#ff0000')
+
+def _currency_fields(forex_data):
+    change = forex_data['change']
+    percent = forex_data['change_percent']
+    sign = "+" if change > 0 else ""
+    return {
+        "code": forex_data['currency'],
+        "price": f"{forex_data['price']:.4f}",
+        "color": _change_color(change),
+        "change": f"{sign}{change:.4f} ({sign}{percent:.2f}%)"
+    }
+
+# --- 功能說明 / 幣別選單 (固定內容) ---
+
+def _help_message():
     """產生整合式功能說明選單"""
     return FlexSendMessage(
         alt_text="功能選單",
@@ -102,9 +194,9 @@ def generate_help_message():
                 contents=[
                     TextComponent(text="🤖 金融助手功能導覽", weight='bold', size='lg', color='#1DB446'),
                     TextComponent(text="點擊下方按鈕或輸入指令試試看！", size='xs', color='#aaaaaa', margin='xs'),
-                    
+
                     SeparatorComponent(margin='md'),
-                    
+
                     # 1. 外匯專區
                     TextComponent(text="🌏 外匯查詢", weight='bold', size='sm', color='#555555', margin='md'),
                     BoxComponent(
@@ -144,9 +236,15 @@ def generate_help_message():
                         ]
                     ),
                     TextComponent(text="指令: 輸入美股代碼 (如 TSLA, MSFT)", size='xs', color='#999999', margin='xs', wrap=True),
-                    
+
                     SeparatorComponent(margin='md'),
-                    
+
+                    # 4. 自選清單
+                    TextComponent(text="⭐ 自選清單", weight='bold', size='sm', color='#555555', margin='md'),
+                    TextComponent(text="指令: 加入 {代號} / 移除 {代號} / 自選", size='xs', color='#999999', margin='xs', wrap=True),
+
+                    SeparatorComponent(margin='md'),
+
                     # Footer
                     ButtonComponent(style='link', height='sm', action=MessageAction(label='查詢 ID', text='ID'), margin='sm')
                 ]
@@ -154,10 +252,8 @@ def generate_help_message():
         )
     )
 
-def generate_currency_menu_flex():
+def _currency_menu():
     """產生熱門幣別選擇選單"""
-    from config import VALID_CURRENCIES # Import locally if needed, or pass
-    
     # 定義熱門 8 大幣別
     currencies = [
         {"code": "USD", "name": "美金"}, {"code": "JPY", "name": "日圓"},
@@ -165,20 +261,20 @@ def generate_currency_menu_flex():
         {"code": "KRW", "name": "韓元"}, {"code": "AUD", "name": "澳幣"},
         {"code": "GBP", "name": "英鎊"}, {"code": "THB", "name": "泰銖"}
     ]
-    
+
     # Grid Layout: 2 columns x 4 rows
     rows = []
     current_row = []
-    
+
     for i, curr in enumerate(currencies):
         btn = ButtonComponent(
-            style='secondary', 
+            style='secondary',
             height='sm',
             action=MessageAction(label=f"{curr['name']} ({curr['code']})", text=f"{curr['code']} 列表"), # 直接查列表
             flex=1
         )
         current_row.append(btn)
-        
+
         # 每兩個換一行，或是最後一個
         if len(current_row) == 2 or i == len(currencies) - 1:
             rows.append(BoxComponent(layout='horizontal', spacing='sm', margin='sm', contents=current_row))
@@ -200,60 +296,49 @@ def generate_currency_menu_flex():
         )
     )
 
-def generate_dashboard_flex_message(greeting_text, user_name, market_data):
-    """
-    產生市場快況儀表板 Flex Message
-    greeting_text: 問候語 (e.g. "早安 🌞")
-    user_name:使用者名稱 (e.g. "Joe")
-    market_data: get_market_dashboard_data() 的回傳結果 list
-    """
-    
-    # 建立 Dashboard Items (Vertical List)
-    dashboard_rows = []
-    
-    for item in market_data:
-        # Row for each market index
-        row = BoxComponent(
-            layout='baseline',
-            spacing='sm',
-            margin='md',
-            action=MessageAction(label=item['name'], text=item['action_text']), # 點擊觸發查詢
-            contents=[
-               TextComponent(text=item['name'], size='sm', color='#555555', flex=4),
-               TextComponent(text=item['price'], size='sm', weight='bold', align='end', flex=3),
-               TextComponent(text=item['change_percent'], size='xs', color=item['color'], align='end', flex=3)
-            ]
-        )
-        dashboard_rows.append(row)
+# --- 市場快況儀表板 ---
 
+def _dashboard_row(f):
+    # Row for each market index
+    return BoxComponent(
+        layout='baseline',
+        spacing='sm',
+        margin='md',
+        action=MessageAction(label=f['name'], text=f['action_text']), # 點擊觸發查詢
+        contents=[
+           TextComponent(text=f['name'], size='sm', color='#555555', flex=4),
+           TextComponent(text=f['price'], size='sm', weight='bold', align='end', flex=3),
+           TextComponent(text=f['change_percent'], size='xs', color=f['color'], align='end', flex=3)
+        ]
+    )
+
+def _dashboard_bubble(f):
     return FlexSendMessage(
-        alt_text=f"{greeting_text}！市場快訊",
+        alt_text=f"{f['greeting']}！市場快訊",
         contents=BubbleContainer(
             size='giga', # Make it wider
             body=BoxComponent(
                 layout='vertical',
                 contents=[
                     # Header Section with Greeting
-                    TextComponent(text=f"{greeting_text}", weight='bold', size='xl', color='#1DB446'),
-                    TextComponent(text=f"{user_name} 大帥哥！", weight='bold', size='lg', margin='xs'),
+                    TextComponent(text=f"{f['greeting']}", weight='bold', size='xl', color='#1DB446'),
+                    TextComponent(text=f"{f['user_name']} 大帥哥！", weight='bold', size='lg', margin='xs'),
                     TextComponent(text="我是您的金融小幫手 🤖", size='xs', color='#aaaaaa', margin='xs'),
-                    
+
                     SeparatorComponent(margin='md'),
-                    
+
                     # Target Market Dashboard Header
                     TextComponent(text="📊 重點行情", size='sm', weight='bold', color='#999999', margin='md'),
-                    
+
                     # Dashboard Rows (with fallback for empty data)
                     BoxComponent(
                         layout='vertical',
                         margin='sm',
-                        contents=dashboard_rows if dashboard_rows else [
-                            TextComponent(text="📡 資料載入中...", size='sm', color='#999999', align='center')
-                        ]
+                        contents=f['rows']
                     ),
-                    
+
                     SeparatorComponent(margin='lg'),
-                    
+
                     # Footer Buttons
                     BoxComponent(
                         layout='horizontal',
@@ -261,11 +346,11 @@ def generate_dashboard_flex_message(greeting_text, user_name, market_data):
                         spacing='sm',
                         contents=[
                             ButtonComponent(
-                                style='secondary', height='sm', 
+                                style='secondary', height='sm',
                                 action=MessageAction(label='匯率選單', text='匯率選單')
                             ),
                             ButtonComponent(
-                                style='secondary', height='sm', 
+                                style='secondary', height='sm',
                                 action=MessageAction(label='使用說明', text='使用說明')
                             )
                         ]
@@ -275,37 +360,25 @@ def generate_dashboard_flex_message(greeting_text, user_name, market_data):
         )
     )
 
-def generate_us_stock_flex_message(data):
-    """生成美股資訊 Flex Message（美股慣例：紅漲綠跌）"""
-    # 美股顏色：紅漲綠跌
-    color = "#eb4e3d" if data['change'] > 0 else "#27ba46" if data['change'] < 0 else "#333333"
-    sign = "+" if data['change'] > 0 else ""
-    
-    # 格式化市值
-    market_cap = data['market_cap']
-    if market_cap > 1_000_000_000_000:
-        market_cap_str = f"${market_cap/1_000_000_000_000:.2f}T"
-    elif market_cap > 1_000_000_000:
-        market_cap_str = f"${market_cap/1_000_000_000:.2f}B"
-    elif market_cap > 1_000_000:
-        market_cap_str = f"${market_cap/1_000_000:.2f}M"
-    else:
-        market_cap_str = f"${market_cap:,.0f}"
-    
+_DASHBOARD_EMPTY = TextComponent(text="📡 資料載入中...", size='sm', color='#999999', align='center')
+
+# --- 美股卡片 ---
+
+def _us_stock_bubble(f):
     return FlexSendMessage(
-        alt_text=f"{data['symbol']} 美股",
+        alt_text=f"{f['symbol']} 美股",
         contents=BubbleContainer(
             body=BoxComponent(
                 layout='vertical',
                 contents=[
-                    TextComponent(text=f"🇺🇸 {data['name']}", weight='bold', size='lg', wrap=True),
-                    TextComponent(text=data['symbol'], size='sm', color='#999999', margin='xs'),
+                    TextComponent(text=f"🇺🇸 {f['name']}", weight='bold', size='lg', wrap=True),
+                    TextComponent(text=f['symbol'], size='sm', color='#999999', margin='xs'),
                     BoxComponent(
                         layout='baseline', margin='md',
                         contents=[
-                            TextComponent(text=f"${data['price']:.2f}", weight='bold', size='3xl', color=color),
-                            TextComponent(text=f"{sign}{data['change']:.2f} ({sign}{data['change_percent']:.2f}%)", 
-                                        size='sm', color=color, margin='md', flex=0)
+                            TextComponent(text=f['price'], weight='bold', size='3xl', color=f['color']),
+                            TextComponent(text=f['change'],
+                                        size='sm', color=f['color'], margin='md', flex=0)
                         ]
                     ),
                     SeparatorComponent(margin='lg'),
@@ -316,29 +389,28 @@ def generate_us_stock_flex_message(data):
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="最高", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"${data['high']:.2f}", align='end', size='sm', flex=2),
+                                    TextComponent(text=f['high'], align='end', size='sm', flex=2),
                                     TextComponent(text="最低", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"${data['low']:.2f}", align='end', size='sm', flex=2)
+                                    TextComponent(text=f['low'], align='end', size='sm', flex=2)
                                 ]
                             ),
                             BoxComponent(
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="成交量", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['volume']:,}", align='end', size='sm', flex=2),
+                                    TextComponent(text=f['volume'], align='end', size='sm', flex=2),
                                     TextComponent(text="市值", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=market_cap_str, align='end', size='sm', flex=2)
+                                    TextComponent(text=f['market_cap'], align='end', size='sm', flex=2)
                                 ]
                             ),
                             BoxComponent(
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="P/E", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=str(data['pe_ratio']) if data['pe_ratio'] != '-' else '-', 
+                                    TextComponent(text=f['pe_ratio'],
                                                 align='end', size='sm', flex=2),
                                     TextComponent(text="52週區間", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"${data['week_52_low']:.2f}-${data['week_52_high']:.2f}" 
-                                                if data['week_52_high'] != '-' else '-', 
+                                    TextComponent(text=f['week_52'],
                                                 align='end', size='xs', flex=2)
                                 ]
                             )
@@ -349,22 +421,52 @@ def generate_us_stock_flex_message(data):
         )
     )
 
-def generate_stock_flex_message(data):
-    color = "#eb4e3d" if data['change'] > 0 else "#27ba46" if data['change'] < 0 else "#333333"
+def _us_stock_fields(data):
+    # 美股顏色：紅漲綠跌
     sign = "+" if data['change'] > 0 else ""
-    
+
+    # 格式化市值
+    market_cap = data['market_cap']
+    if not market_cap:
+        market_cap_str = "-"
+    elif market_cap > 1_000_000_000_000:
+        market_cap_str = f"${market_cap/1_000_000_000_000:.2f}T"
+    elif market_cap > 1_000_000_000:
+        market_cap_str = f"${market_cap/1_000_000_000:.2f}B"
+    elif market_cap > 1_000_000:
+        market_cap_str = f"${market_cap/1_000_000:.2f}M"
+    else:
+        market_cap_str = f"${market_cap:,.0f}"
+
+    return {
+        "name": data['name'],
+        "symbol": data['symbol'],
+        "price": f"${data['price']:.2f}",
+        "color": _change_color(data['change']),
+        "change": f"{sign}{data['change']:.2f} ({sign}{data['change_percent']:.2f}%)",
+        "high": f"${data['high']:.2f}",
+        "low": f"${data['low']:.2f}",
+        "volume": f"{data['volume']:,}",
+        "market_cap": market_cap_str,
+        "pe_ratio": str(data['pe_ratio']) if data['pe_ratio'] != '-' else '-',
+        "week_52": f"${data['week_52_low']:.2f}-${data['week_52_high']:.2f}" if data['week_52_high'] != '-' else '-'
+    }
+
+# --- 台股卡片 (Fugle 資料來源的版面略有不同) ---
+
+def _stock_bubble(f, fugle=False):
     return FlexSendMessage(
-        alt_text=f"{data['symbol']} 股價",
+        alt_text=f"{f['symbol']} 股價",
         contents=BubbleContainer(
             body=BoxComponent(
                 layout='vertical',
                 contents=[
-                    TextComponent(text=f"{data['name']} ({data['symbol']}) {data['type']}", weight='bold', size='xl'),
+                    TextComponent(text=f['title'], weight='bold', size='xl'),
                     BoxComponent(
                         layout='baseline', margin='md',
                         contents=[
-                            TextComponent(text=f"{data['price']:.2f}", weight='bold', size='3xl', color=color),
-                            TextComponent(text=f"{sign}{data['change']:.2f} ({sign}{data['change_percent']:.2f}%)", size='sm', color=color, margin='md', flex=0)
+                            TextComponent(text=f['price'], weight='bold', size='3xl', color=f['color']),
+                            TextComponent(text=f['change'], size='sm', color=f['color'], margin='md', flex=0)
                         ]
                     ),
                     SeparatorComponent(margin='lg'),
@@ -375,41 +477,38 @@ def generate_stock_flex_message(data):
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="漲停", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['limit_up']:.2f}", align='end', color='#eb4e3d', size='sm', flex=2),
+                                    TextComponent(text=f['limit_up'], align='end', color='#eb4e3d', size='sm', flex=2),
                                     TextComponent(text="跌停", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['limit_down']:.2f}", align='end', color='#27ba46', size='sm', flex=2)
+                                    TextComponent(text=f['limit_down'], align='end', color='#27ba46', size='sm', flex=2)
                                 ]
                             ),
                             BoxComponent(
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="最高", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['high']:.2f}", align='end', size='sm', flex=2),
+                                    TextComponent(text=f['high'], align='end', size='sm', flex=2),
                                     TextComponent(text="最低", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['low']:.2f}", align='end', size='sm', flex=2)
+                                    TextComponent(text=f['low'], align='end', size='sm', flex=2)
                                 ]
                             ),
                             BoxComponent(
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="成交(張)", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(
-                                        text=f"{data['volume']:,.0f}" if data.get('source') == 'fugle' else f"{data['volume']/1000:,.0f}", 
-                                        align='end', size='sm', flex=2
-                                    ),
+                                    TextComponent(text=f['volume_lots'], align='end', size='sm', flex=2),
                                     # Fugle 模式不顯示總量(股), 一般模式顯示
                                 ] + ([
                                     TextComponent(text="總量(股)", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data['volume']:,.0f}", align='end', size='sm', flex=2)
-                                ] if data.get('source') != 'fugle' else [TextComponent(text=" ", flex=3)])
+                                    TextComponent(text=f['volume_shares'], align='end', size='sm', flex=2)
+                                ] if not fugle else [TextComponent(text=" ", flex=3)])
                             ),
                             BoxComponent(
                                 layout='baseline',
                                 contents=[
                                     TextComponent(text="本益比", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data.get('twse_stats', {}).get('PE', '-')}", align='end', size='sm', flex=2),
+                                    TextComponent(text=f['pe'], align='end', size='sm', flex=2),
                                     TextComponent(text="殖利率", color='#aaaaaa', size='sm', flex=1),
-                                    TextComponent(text=f"{data.get('twse_stats', {}).get('Yield', '-')}%" if data.get('twse_stats', {}).get('Yield', '-') != '-' else '-', align='end', size='sm', flex=2)
+                                    TextComponent(text=f['yield'], align='end', size='sm', flex=2)
                                 ]
                             )
                         ]
@@ -420,31 +519,120 @@ def generate_stock_flex_message(data):
                         contents=[
                             ButtonComponent(
                                 style='primary', height='sm',
-                                action=MessageAction(label='即時走勢圖', text=f"{data['symbol']} 即時")
+                                action=MessageAction(label='即時走勢圖', text=f"{f['symbol']} 即時")
                             ),
                             BoxComponent(
                                 layout='horizontal', spacing='sm',
                                 contents=[
-                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='日 K', text=f"{data['symbol']} 日K")),
-                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='週 K', text=f"{data['symbol']} 週K")),
-                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='月 K', text=f"{data['symbol']} 月K"))
+                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='日 K', text=f"{f['symbol']} 日K")),
+                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='週 K', text=f"{f['symbol']} 週K")),
+                                    ButtonComponent(style='secondary', height='sm', action=MessageAction(label='月 K', text=f"{f['symbol']} 月K"))
                                 ]
                             ),
                             # Fugle 專屬功能: 52週股價
                             *(
                                 [ButtonComponent(
                                      style='secondary', height='sm', margin='sm',
-                                     action=MessageAction(label='近 52 週股價', text=f'{data["symbol"]} 52週')
-                                )] if data.get('source') == 'fugle' else []
+                                     action=MessageAction(label='近 52 週股價', text=f'{f["symbol"]} 52週')
+                                )] if fugle else []
                             ),
                             ButtonComponent(
                                 style='primary', color='#7000F0', height='sm', margin='sm',
-                                action=MessageAction(label='AI 策略分析', text=f'{data["symbol"]} 分析')
+                                action=MessageAction(label='AI 策略分析', text=f'{f["symbol"]} 分析')
                             ),
-                            ButtonComponent(style='link', height='sm', action=MessageAction(label='近3日交易量', text=f"{data['symbol']} 交易量"))
+                            ButtonComponent(style='link', height='sm', action=MessageAction(label='近3日交易量', text=f"{f['symbol']} 交易量"))
                         ]
                     )
                 ]
             )
         )
     )
+
+def _stock_fields(data):
+    sign = "+" if data['change'] > 0 else ""
+    stats = data.get('twse_stats', {})
+    is_fugle = data.get('source') == 'fugle'
+    return {
+        "symbol": data['symbol'],
+        "title": f"{data['name']} ({data['symbol']}) {data['type']}",
+        "price": f"{data['price']:.2f}",
+        "color": _change_color(data['change']),
+        "change": f"{sign}{data['change']:.2f} ({sign}{data['change_percent']:.2f}%)",
+        "limit_up": f"{data['limit_up']:.2f}",
+        "limit_down": f"{data['limit_down']:.2f}",
+        "high": f"{data['high']:.2f}",
+        "low": f"{data['low']:.2f}",
+        "volume_lots": f"{data['volume']:,.0f}" if is_fugle else f"{data['volume']/1000:,.0f}",
+        "volume_shares": f"{data['volume']:,.0f}",
+        "pe": f"{stats.get('PE', '-')}",
+        "yield": f"{stats.get('Yield', '-')}%" if stats.get('Yield', '-') != '-' else '-'
+    }
+
+
+# --- 編譯樣板 (啟動時一次) ---
+
+_HELP_MESSAGE = CompiledFlexMessage(_help_message().as_json_dict())
+_CURRENCY_MENU = CompiledFlexMessage(_currency_menu().as_json_dict())
+_BANK_ROW = FlexTemplate(_bank_row)
+_BANK_ROW_TOP = FlexTemplate(lambda f: _bank_row(f, top=True))
+_CURRENCY = FlexTemplate(_currency_bubble, lists=('bank_rows',))
+_DASHBOARD_ROW = FlexTemplate(_dashboard_row)
+_DASHBOARD_EMPTY_ROW = _DASHBOARD_EMPTY.as_json_dict()
+_DASHBOARD = FlexTemplate(_dashboard_bubble, lists=('rows',))
+_US_STOCK = FlexTemplate(_us_stock_bubble)
+_STOCK = FlexTemplate(_stock_bubble)
+_STOCK_FUGLE = FlexTemplate(lambda f: _stock_bubble(f, fugle=True))
+
+
+def generate_currency_flex_message(forex_data, bank_report_text):
+    fields = _currency_fields(forex_data)
+    # Data Rows (Top 5, Top 1 highlight)
+    if isinstance(bank_report_text, list):
+        fields["bank_rows"] = [(_BANK_ROW_TOP if i == 0 else _BANK_ROW).fill(b) for i, b in enumerate(bank_report_text[:5])]
+    else:
+        fields["bank_rows"] = [_bank_error_row(bank_report_text).as_json_dict()]
+    return _CURRENCY.render(fields)
+
+def generate_help_message():
+    """產生整合式功能說明選單 (固定內容，直接使用快取)"""
+    return _HELP_MESSAGE
+
+def generate_currency_menu_flex():
+    """產生熱門幣別選擇選單 (固定內容，直接使用快取)"""
+    return _CURRENCY_MENU
+
+def generate_dashboard_flex_message(greeting_text, user_name, market_data):
+    """
+    產生市場快況儀表板 Flex Message
+    greeting_text: 問候語 (e.g. "早安 🌞")
+    user_name:使用者名稱 (e.g. "Joe")
+    market_data: get_market_dashboard_data() 的回傳結果 list
+    """
+    rows = [_DASHBOARD_ROW.fill(item) for item in market_data] or [_DASHBOARD_EMPTY_ROW]
+    return _DASHBOARD.render({"greeting": greeting_text, "user_name": user_name, "rows": rows})
+
+def generate_us_stock_flex_message(data):
+    """生成美股資訊 Flex Message（美股慣例：紅漲綠跌）"""
+    return _US_STOCK.render(_us_stock_fields(data))
+
+def generate_stock_flex_message(data):
+    template = _STOCK_FUGLE if data.get('source') == 'fugle' else _STOCK
+    return template.render(_stock_fields(data))
+
+def generate_stock_carousel_message(stocks):
+    """
+    多檔股票報價 Carousel (台股/美股可混合)
+    stocks: get_batch_stock_info() 的回傳結果 list (LINE 限制最多 12 張)
+    """
+    bubbles = []
+    for data in stocks[:12]:
+        if data.get('market') == 'us':
+            bubbles.append(generate_us_stock_flex_message(data).contents)
+        else:
+            bubbles.append(generate_stock_flex_message(data).contents)
+
+    return CompiledFlexMessage({
+        "type": "flex",
+        "altText": f"{' / '.join(d['symbol'] for d in stocks[:12])} 股價",
+        "contents": {"type": "carousel", "contents": bubbles}
+    })
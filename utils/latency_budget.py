@@ -0,0 +1,206 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from cachetools import TTLCache
+from config import REPLY_BUDGET, REPLY_BUDGETS, REPLY_TOKEN_DEADLINE, COMMAND_MAX_WORKERS
+from utils import metrics, profiler
+from utils import async_http
+from utils.cache_backend import register_external
+from utils.quota import COMMAND_CLASSES
+
+# 指令專用的執行緒池 (與 fanout 的抓取池分開，避免巢狀等待互相卡住)
+_executor = ThreadPoolExecutor(max_workers=COMMAND_MAX_WORKERS, thread_name_prefix='command')
+
+# ASYNC_MODE 下在事件迴圈上執行中的指令數 (只在迴圈執行緒上更新)
+_in_flight = 0
+
+# 最近一次成功的結果 (e.g. 報價)，逾時時可先回覆並標示為延遲資料
+_last_good = TTLCache(maxsize=500, ttl=86400)
+register_external("last_good", lambda: dict(_last_good.items()))
+
+
+def remember(key, value):
+    _last_good[key] = (value, time.time())
+
+def recall(key):
+    """回傳 (value, 儲存時間) 或 None"""
+    return _last_good.get(key)
+
+def get_budget(command):
+    """REPLY_BUDGETS 可指定指令 (e.g. stock_chart) 或指令類別 (e.g. chart)，指令優先"""
+    if command in REPLY_BUDGETS: return REPLY_BUDGETS[command]
+    return REPLY_BUDGETS.get(COMMAND_CLASSES.get(command), REPLY_BUDGET)
+
+_unknown_budgets = set(REPLY_BUDGETS) - set(COMMAND_CLASSES) - set(COMMAND_CLASSES.values())
+if _unknown_budgets:
+    print(f"[Debug] REPLY_BUDGETS: unknown commands {sorted(_unknown_budgets)} ignored "
+          f"(valid: {', '.join(sorted(set(COMMAND_CLASSES) | set(COMMAND_CLASSES.values())))})")
+
+def run_within_budget(command, build_full, reply, push, build_partial=None, budget=None):
+    """
+    在 reply token 有效期間內盡量回覆完整結果
+    - build_full() 在預算內完成：直接 reply
+    - 逾時且 build_partial() 有部分結果 (e.g. 無圖的文字報價、標示延遲的快取)：
+      先 reply 部分結果，完整結果完成後再 push 補送
+    - 逾時且沒有部分結果：繼續等到 REPLY_TOKEN_DEADLINE，仍未完成則改用 push
+    build_full / build_partial 回傳要送出的訊息 (None 代表不回覆)
+    回傳 True 代表在預算內完成
+    """
+    budget = get_budget(command) if budget is None else budget
+    start = time.monotonic()
+    future = _executor.submit(profiler.wrap(build_full))
+
+    def finished():
+        metrics.observe(f"command.{command}", time.monotonic() - start)
+
+    def deliver_later(f):
+        finished()
+        try: result = f.result()
+        except Exception as e:
+            print(f"[Debug] Command '{command}' failed after budget: {e}")
+            metrics.incr(f"reply_budget.{command}.error")
+            return
+        if result:
+            try: push(result)
+            except Exception as e: print(f"[Debug] Push after budget failed: {e}")
+
+    try:
+        result = future.result(timeout=budget)
+        metrics.incr(f"reply_budget.{command}.hit")
+        finished()
+        if result: reply(result)
+        return True
+    except FuturesTimeout:
+        metrics.incr(f"reply_budget.{command}.miss")
+        print(f"[Debug] Command '{command}' exceeded reply budget ({budget}s).")
+    except Exception as e:
+        metrics.incr(f"reply_budget.{command}.error")
+        finished()
+        print(f"[Debug] Command '{command}' failed: {e}")
+        return False
+
+    partial_result = build_partial() if build_partial else None
+    if partial_result:
+        metrics.incr(f"reply_budget.{command}.partial")
+        reply(partial_result)
+        future.add_done_callback(deliver_later)
+        return False
+
+    try:
+        result = future.result(timeout=max(0, REPLY_TOKEN_DEADLINE - (time.monotonic() - start)))
+        finished()
+        if result: reply(result)
+    except FuturesTimeout:
+        metrics.incr(f"reply_budget.{command}.push")
+        future.add_done_callback(deliver_later)
+    except Exception as e:
+        finished()
+        print(f"[Debug] Command '{command}' failed: {e}")
+    return False
+
+async def run_within_budget_async(command, build_full, reply, push, build_partial=None, budget=None):
+    """
+    run_within_budget 的 async 版本 (在共用事件迴圈上執行)
+    build_full 為 coroutine function；reply / push 為 async 函式 (接收訊息)
+    逾時後的補送在背景 task 完成，不佔用呼叫端 (e.g. 同聊天室的下一個指令)
+    """
+    budget = get_budget(command) if budget is None else budget
+    start = time.monotonic()
+    task = asyncio.ensure_future(build_full())
+
+    def finished():
+        metrics.observe(f"command.{command}", time.monotonic() - start)
+
+    async def deliver_later():
+        try: result = await task
+        except Exception as e:
+            finished()
+            print(f"[Debug] Command '{command}' failed after budget: {e}")
+            metrics.incr(f"reply_budget.{command}.error")
+            return
+        finished()
+        if result:
+            try: await push(result)
+            except Exception as e: print(f"[Debug] Push after budget failed: {e}")
+
+    try:
+        result = await asyncio.wait_for(asyncio.shield(task), budget)
+        metrics.incr(f"reply_budget.{command}.hit")
+        finished()
+        if result: await reply(result)
+        return True
+    except asyncio.TimeoutError:
+        metrics.incr(f"reply_budget.{command}.miss")
+        print(f"[Debug] Command '{command}' exceeded reply budget ({budget}s).")
+    except Exception as e:
+        metrics.incr(f"reply_budget.{command}.error")
+        finished()
+        print(f"[Debug] Command '{command}' failed: {e}")
+        return False
+
+    partial_result = build_partial() if build_partial else None
+    if partial_result:
+        metrics.incr(f"reply_budget.{command}.partial")
+        await reply(partial_result)
+        _spawn_background(deliver_later())
+        return False
+
+    try:
+        result = await asyncio.wait_for(asyncio.shield(task), max(0, REPLY_TOKEN_DEADLINE - (time.monotonic() - start)))
+        finished()
+        if result: await reply(result)
+    except asyncio.TimeoutError:
+        metrics.incr(f"reply_budget.{command}.push")
+        _spawn_background(deliver_later())
+    except Exception as e:
+        finished()
+        print(f"[Debug] Command '{command}' failed: {e}")
+    return False
+
+_background = set()
+
+def _spawn_background(coro):
+    # 保留 task 的參考，避免尚未完成就被回收
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+def submit_within_budget(chat_id, command, build_full, reply, push, build_partial=None, budget=None):
+    """
+    ASYNC_MODE：將指令交給共用事件迴圈後立即返回 (webhook worker 不需等待)
+    同一聊天室的指令依序執行，回傳 concurrent.futures.Future
+    剖析中的事件會持續剖析到指令在迴圈上完成
+    """
+    session = profiler.detach()
+
+    async def run():
+        global _in_flight
+        _in_flight += 1
+        try:
+            with profiler.attach(session):
+                async with async_http.chat_lock(chat_id):
+                    await run_within_budget_async(command, build_full, reply, push, build_partial, budget)
+        except Exception as e:
+            metrics.incr("events.error")
+            print(f"[Debug] Async command '{command}' failed for {chat_id}: {e}")
+        finally:
+            _in_flight -= 1
+
+    return async_http.spawn(run())
+
+# 等待執行緒的指令數 (持續大於 0 代表 COMMAND_MAX_WORKERS 不足)
+metrics.register_gauge("commands.queued", lambda: _executor._work_queue.qsize())
+metrics.register_gauge("commands.in_flight_async", lambda: _in_flight)
+
+def budget_report():
+    """各指令在預算內完成的比例，供 /metrics 使用"""
+    counters = metrics.snapshot()["counters"]
+    report = {}
+    for name, value in counters.items():
+        if not name.startswith("reply_budget."): continue
+        _, command, outcome = name.split(".", 2)
+        report.setdefault(command, {"budget": get_budget(command)})[outcome] = value
+    for command, r in report.items():
+        total = r.get("hit", 0) + r.get("miss", 0)
+        r["hit_rate"] = round(r.get("hit", 0) / total, 3) if total else None
+    return report
@@ -0,0 +1,167 @@
+import re
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+from config import (
+    LINE_API_ENDPOINT, LINE_API_TIMEOUT, LINE_CONNECT_TIMEOUT, LINE_POOL_SIZE,
+    PROFILE_CACHE_MAX, PROFILE_CACHE_TTL, BOT_USER_ID
+)
+from utils import metrics
+from utils import async_http
+from utils.cache_backend import make_cache
+
+# LINE Messaging API 包裝：
+# - 所有請求共用同一個 requests.Session (連線池 + keep-alive)，並設定連線 / 讀取逾時
+# - 依 API 端點記錄耗時 (/metrics 的 line_api.*)
+# - 使用者名稱快取 (LRU + TTL)，問候時不必每次呼叫 profile API
+# - 機器人 user_id 在啟動時取得一次 (判斷是否被標記)
+# - ASYNC_MODE 的 reply / push 改用 async_http 的共用 aiohttp 連線池
+
+# /v2/bot/group/Cxxxx/member/Uxxxx -> group/_/member/_
+_ID_SEGMENT = re.compile(r'/[UCR][0-9a-f]{32}')
+BOT_INFO_RETRY = 60
+
+
+def endpoint_name(url):
+    path = url.split('://', 1)[-1].split('/', 1)[-1].split('?', 1)[0]
+    path = _ID_SEGMENT.sub('/_', '/' + path)
+    return path.replace('/v2/bot/', '', 1).strip('/').replace('/', '.')
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """共用連線池的 HttpClient，並記錄各端點耗時"""
+
+    def __init__(self, timeout=None):
+        super().__init__(timeout=timeout or (LINE_CONNECT_TIMEOUT, LINE_API_TIMEOUT))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=LINE_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        name = endpoint_name(url)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except Exception:
+            metrics.incr(f"line_api.{name}.error")
+            raise
+        finally:
+            metrics.observe(f"line_api.{name}", time.monotonic() - start)
+        if response.status_code >= 400: metrics.incr(f"line_api.{name}.error")
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, timeout, headers=headers, data=data)
+
+
+profile_cache = make_cache('line_profile', maxsize=PROFILE_CACHE_MAX, ttl=PROFILE_CACHE_TTL)
+
+
+class LineClient:
+    """
+    LineBotApi 的包裝，reply_message / push_message 等方法直接轉給 LineBotApi
+    另外提供 bot_user_id 與 get_display_name
+    """
+
+    def __init__(self, channel_access_token):
+        self.api = LineBotApi(channel_access_token, endpoint=LINE_API_ENDPOINT,
+                              timeout=(LINE_CONNECT_TIMEOUT, LINE_API_TIMEOUT), http_client=PooledHttpClient)
+        self.channel_access_token = channel_access_token
+        self._bot_user_id = BOT_USER_ID
+        self._bot_info_checked_at = 0
+        self._bot_info_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    async def _post_async(self, path, data):
+        # 耗時與錯誤數同樣記錄在 line_api.<端點>
+        response = await async_http.request(
+            'POST', f"{LINE_API_ENDPOINT}{path}", name=endpoint_name(path), prefix='line_api',
+            data=json.dumps(data), timeout=LINE_CONNECT_TIMEOUT + LINE_API_TIMEOUT,
+            headers={'Authorization': f"Bearer {self.channel_access_token}", 'Content-Type': 'application/json'}
+        )
+        if response.status != 200:
+            try: error = Error.new_from_json_dict(response.json())
+            except ValueError: error = Error(message=response.text)
+            raise LineBotApiError(response.status, response.headers,
+                                  request_id=response.headers.get('X-Line-Request-Id'), error=error)
+
+    async def reply_message_async(self, reply_token, messages, notification_disabled=False):
+        """reply_message 的 async 版本 (訊息格式相同)"""
+        if not isinstance(messages, (list, tuple)): messages = [messages]
+        await self._post_async('/v2/bot/message/reply', {
+            'replyToken': reply_token,
+            'messages': [message.as_json_dict() for message in messages],
+            'notificationDisabled': notification_disabled
+        })
+
+    async def push_message_async(self, to, messages, notification_disabled=False):
+        """push_message 的 async 版本 (訊息格式相同)"""
+        if not isinstance(messages, (list, tuple)): messages = [messages]
+        await self._post_async('/v2/bot/message/push', {
+            'to': to,
+            'messages': [message.as_json_dict() for message in messages],
+            'notificationDisabled': notification_disabled
+        })
+
+    def resolve_bot_info(self):
+        """取得機器人 user_id (啟動時呼叫；失敗時 BOT_INFO_RETRY 秒後才會再試)"""
+        with self._bot_info_lock:
+            if self._bot_user_id: return self._bot_user_id
+            if time.time() - self._bot_info_checked_at < BOT_INFO_RETRY: return None
+            self._bot_info_checked_at = time.time()
+            try:
+                self._bot_user_id = self.api.get_bot_info().user_id
+                print(f"[Debug] Bot user id resolved: {self._bot_user_id}")
+            except Exception as e:
+                print(f"[Debug] Error getting bot info: {e}")
+        return self._bot_user_id
+
+    def resolve_bot_info_async(self):
+        threading.Thread(target=self.resolve_bot_info, name='line-bot-info', daemon=True).start()
+
+    @property
+    def bot_user_id(self):
+        return self._bot_user_id or self.resolve_bot_info()
+
+    def get_display_name(self, source, user_id=None):
+        """
+        依訊息來源 (群組 / 聊天室 / 私訊) 取得使用者名稱，結果快取 PROFILE_CACHE_TTL 秒
+        查詢失敗回傳 None
+        """
+        user_id = user_id or getattr(source, 'user_id', None)
+        if not user_id: return None
+        chat_id = getattr(source, 'group_id', None) or getattr(source, 'room_id', None)
+        key = (source.type, chat_id, user_id)
+        name = profile_cache.get(key)
+        if name: return name
+
+        try:
+            if source.type == 'group':
+                profile = self.api.get_group_member_profile(chat_id, user_id)
+            elif source.type == 'room':
+                profile = self.api.get_room_member_profile(chat_id, user_id)
+            else:
+                profile = self.api.get_profile(user_id)
+        except Exception as e:
+            print(f"[Debug] Error getting profile for {user_id}: {e}")
+            return None
+        profile_cache[key] = profile.display_name
+        return profile.display_name
@@ -0,0 +1,240 @@
+import pytz
+from datetime import date, datetime, timedelta, time as dtime
+from config import TW_MARKET_HOLIDAYS, LIVE_CACHE_TTL
+
+# --- 台股交易時段 ---
+TW_TZ = pytz.timezone('Asia/Taipei')
+TW_OPEN = dtime(9, 0)
+TW_CLOSE = dtime(13, 30)
+# Yahoo 的日 K 在收盤後仍會延遲更新，保守一點等到 14:00 才視為定案
+TW_SETTLE = dtime(14, 0)
+
+# 固定日期的國定假日 (月, 日)；農曆節日與補假每年不同，由 TW_MARKET_HOLIDAYS 設定
+TW_FIXED_HOLIDAYS = {(1, 1), (2, 28), (5, 1), (10, 10)}
+TW_EXTRA_HOLIDAYS = {date.fromisoformat(d) for d in TW_MARKET_HOLIDAYS}
+
+# 銀行牌告匯率 (FindRate) 在營業日 9:00 ~ 16:00 間更新
+TW_BANK_OPEN = dtime(9, 0)
+TW_BANK_CLOSE = dtime(16, 0)
+
+# --- 美股 (NYSE) 交易時段 ---
+US_TZ = pytz.timezone('America/New_York')
+US_OPEN = dtime(9, 30)
+US_CLOSE = dtime(16, 0)
+US_SETTLE = dtime(16, 30)
+
+# --- 外匯 (週日 17:00 ~ 週五 17:00 紐約時間) ---
+FX_ROLL = dtime(17, 0)
+
+# 分鐘級別的 interval (yfinance)
+INTRADAY_INTERVALS = ('1m', '2m', '5m', '15m', '30m', '60m', '90m', '1h')
+
+
+def now_taipei():
+    return datetime.now(TW_TZ)
+
+def is_tw_trading_day(d):
+    """週一到週五，排除固定國定假日與 TW_MARKET_HOLIDAYS"""
+    if d.weekday() >= 5: return False
+    return (d.month, d.day) not in TW_FIXED_HOLIDAYS and d not in TW_EXTRA_HOLIDAYS
+
+def is_tw_market_open(now=None):
+    now = now or now_taipei()
+    return is_tw_trading_day(now.date()) and TW_OPEN <= now.time() < TW_CLOSE
+
+def is_tw_data_settled(now=None):
+    """盤後 (含休市日) 日線資料已定案，不會再變動"""
+    now = now or now_taipei()
+    if not is_tw_trading_day(now.date()): return True
+    return now.time() < TW_OPEN or now.time() >= TW_SETTLE
+
+def _next_tw_time(at, now):
+    """下一個 (> now) 台股交易日的 at 時刻"""
+    now = now.astimezone(TW_TZ)
+    d = now.date()
+    if now.time() >= at: d += timedelta(days=1)
+    while not is_tw_trading_day(d): d += timedelta(days=1)
+    return TW_TZ.localize(datetime.combine(d, at))
+
+def next_tw_open(now=None):
+    return _next_tw_time(TW_OPEN, now or now_taipei())
+
+def seconds_until_tw_open(now=None):
+    now = now or now_taipei()
+    return max(0, (next_tw_open(now) - now).total_seconds())
+
+def is_tw_bank_open(now=None):
+    now = (now or now_taipei()).astimezone(TW_TZ)
+    return is_tw_trading_day(now.date()) and TW_BANK_OPEN <= now.time() < TW_BANK_CLOSE
+
+def tw_cache_ttl(interval="1d", now=None, live_ttl=LIVE_CACHE_TTL, intraday_ttl=60):
+    """台股資料的快取秒數 (見 market_ttl)"""
+    return market_ttl('tw', interval, now, live_ttl, intraday_ttl)
+
+def latest_tw_publish(publish_time, now=None):
+    """最近一次 (<= now) 交易日盤後資料公布時間"""
+    now = now or now_taipei()
+    d = now.date()
+    if now.time() < publish_time: d -= timedelta(days=1)
+    while not is_tw_trading_day(d): d -= timedelta(days=1)
+    return TW_TZ.localize(datetime.combine(d, publish_time))
+
+def parse_openapi_date(value):
+    """證交所 / 櫃買中心 OpenAPI 的日期：民國 (1131018) 或西元 (20241018)，無法解析回傳 None"""
+    value = str(value or '').strip()
+    try:
+        if len(value) == 8: return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+        return date(int(value[:-4]) + 1911, int(value[-4:-2]), int(value[-2:]))
+    except ValueError:
+        return None
+
+def next_tw_publish(publish_time, now=None):
+    """下一次 (> now) 交易日盤後資料公布時間"""
+    now = now or now_taipei()
+    d = now.date()
+    if now.time() >= publish_time: d += timedelta(days=1)
+    while not is_tw_trading_day(d): d += timedelta(days=1)
+    return TW_TZ.localize(datetime.combine(d, publish_time))
+
+
+# --- 美股行事曆 ---
+
+def _easter(year):
+    """復活節日期 (Gregorian, Anonymous algorithm)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+def _nth_weekday(year, month, weekday, n):
+    """該月第 n 個星期幾 (n = -1 代表最後一個)"""
+    if n > 0:
+        d = date(year, month, 1)
+        d += timedelta(days=(weekday - d.weekday()) % 7)
+        return d + timedelta(weeks=n - 1)
+    d = date(year + (month == 12), month % 12 + 1, 1) - timedelta(days=1)
+    return d - timedelta(days=(d.weekday() - weekday) % 7)
+
+def _observed(d):
+    """週六的假日提前到週五、週日的順延到週一"""
+    if d.weekday() == 5: return d - timedelta(days=1)
+    if d.weekday() == 6: return d + timedelta(days=1)
+    return d
+
+def us_market_holidays(year):
+    """NYSE 休市日"""
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),             # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),             # Washington's Birthday
+        _easter(year) - timedelta(days=2),       # Good Friday
+        _nth_weekday(year, 5, 0, -1),            # Memorial Day
+        _observed(date(year, 7, 4)),             # Independence Day
+        _nth_weekday(year, 9, 0, 1),             # Labor Day
+        _nth_weekday(year, 11, 3, 4),            # Thanksgiving
+        _observed(date(year, 12, 25)),           # Christmas
+    }
+    if year >= 2022: holidays.add(_observed(date(year, 6, 19)))  # Juneteenth
+    # 元旦落在週六時不提前到前一年的 12/31
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5: holidays.add(_observed(new_year))
+    return holidays
+
+def is_us_trading_day(d):
+    return d.weekday() < 5 and d not in us_market_holidays(d.year)
+
+def last_us_close(now=None):
+    """最近一次 (<= now) 美股收盤時間 (美東時間)"""
+    now = (now or now_taipei()).astimezone(US_TZ)
+    d = now.date()
+    if now.time() < US_CLOSE: d -= timedelta(days=1)
+    while not is_us_trading_day(d): d -= timedelta(days=1)
+    return US_TZ.localize(datetime.combine(d, US_CLOSE))
+
+def is_us_data_settled(now=None):
+    """美股收盤 (含延遲更新時間) 或休市，資料不會再變動"""
+    now = (now or now_taipei()).astimezone(US_TZ)
+    if not is_us_trading_day(now.date()): return True
+    return now.time() < US_OPEN or now.time() >= US_SETTLE
+
+def next_us_open(now=None):
+    now = (now or now_taipei()).astimezone(US_TZ)
+    d = now.date()
+    if now.time() >= US_OPEN: d += timedelta(days=1)
+    while not is_us_trading_day(d): d += timedelta(days=1)
+    return US_TZ.localize(datetime.combine(d, US_OPEN))
+
+
+# --- 外匯行事曆 (只處理週末休市) ---
+
+def is_fx_market_open(now=None):
+    """紐約時間週五 17:00 收盤，週日 17:00 開盤"""
+    now = (now or now_taipei()).astimezone(US_TZ)
+    weekday, t = now.weekday(), now.time()
+    if weekday == 5: return False
+    if weekday == 4: return t < FX_ROLL
+    if weekday == 6: return t >= FX_ROLL
+    return True
+
+def next_fx_open(now=None):
+    """下一次週日 17:00 (紐約時間) 開盤"""
+    now = (now or now_taipei()).astimezone(US_TZ)
+    d = now.date() + timedelta(days=(6 - now.weekday()) % 7)
+    if d == now.date() and now.time() >= FX_ROLL: d += timedelta(days=7)
+    return US_TZ.localize(datetime.combine(d, FX_ROLL))
+
+
+# --- 依市場決定快取到期時間 ---
+
+# 市場 -> (資料是否仍在變動, 下次開始變動的時間)
+_MARKETS = {
+    'tw': (lambda now: not is_tw_data_settled(now.astimezone(TW_TZ)), next_tw_open),
+    'tw_bank': (is_tw_bank_open, lambda now: _next_tw_time(TW_BANK_OPEN, now)),
+    'us': (lambda now: not is_us_data_settled(now), next_us_open),
+    'fx': (is_fx_market_open, next_fx_open),
+}
+
+def symbol_market(full_symbol):
+    """Yahoo 代號所屬的市場: tw / fx / crypto / us (含指數、VIX)"""
+    if full_symbol.endswith(('.TW', '.TWO')) or full_symbol == '^TWII': return 'tw'
+    if full_symbol.endswith('=X'): return 'fx'
+    if full_symbol.endswith(('-USD', '-USDT')): return 'crypto'
+    return 'us'
+
+def is_market_live(market, now=None):
+    """市場資料是否仍可能變動 (未知市場如加密貨幣視為隨時變動)"""
+    entry = _MARKETS.get(market)
+    return entry is None or entry[0](now or now_taipei())
+
+def market_ttl(market, interval="1d", now=None, live_ttl=LIVE_CACHE_TTL, intraday_ttl=60):
+    """
+    快取秒數：資料仍在變動時分鐘線 intraday_ttl、日線以上 live_ttl；
+    收盤 / 休市時快取到下次開始變動 (e.g. 台股下次開盤、外匯週日晚上開盤)
+    """
+    now = now or now_taipei()
+    live = intraday_ttl if interval in INTRADAY_INTERVALS else live_ttl
+    if is_market_live(market, now): return live
+    return max((_MARKETS[market][1](now) - now).total_seconds(), live)
+
+def fx_chart_window(period, interval, now=None):
+    """外匯走勢圖的 (period, interval)：週末休市時 1d 沒有資料，直接改抓最近 5 日"""
+    if period == '1d' and not is_fx_market_open(now): return '5d', '60m'
+    return period, interval
+
+def is_schedule_day(calendar, now=None):
+    """
+    排程是否在今天執行
+    - tw: 台北時間今天是台股交易日
+    - us: 24 小時內有美股收盤 (有新的收盤資料，e.g. VIX)
+    - daily: 每天
+    """
+    now = now or now_taipei()
+    if calendar == 'tw': return is_tw_trading_day(now.astimezone(TW_TZ).date())
+    if calendar == 'us': return (now - last_us_close(now)).total_seconds() < 86400
+    return True
@@ -0,0 +1,59 @@
+import os
+import time
+import threading
+from collections import defaultdict
+
+# 行程內的簡易指標 (計數 / 耗時)，由 /metrics 輸出
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = {}
+_gauges = {}
+_started_at = time.time()
+
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+def observe(name, seconds):
+    """記錄一次耗時 (秒)"""
+    with _lock:
+        t = _timings.get(name)
+        if t is None:
+            t = _timings[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        t["count"] += 1
+        t["total"] += seconds
+        t["max"] = max(t["max"], seconds)
+
+def register_gauge(name, fn):
+    """註冊即時數值 (e.g. 佇列長度)，於輸出時才呼叫 fn() 取值"""
+    _gauges[name] = fn
+
+def get_counter(name):
+    return _counters.get(name, 0)
+
+def get_avg_timing(name):
+    t = _timings.get(name)
+    return t["total"] / t["count"] if t and t["count"] else None
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: {
+                "count": t["count"],
+                "avg": round(t["total"] / t["count"], 4) if t["count"] else 0,
+                "max": round(t["max"], 4)
+            } for name, t in _timings.items()
+        }
+    gauges = {}
+    for name, fn in list(_gauges.items()):
+        try: gauges[name] = fn()
+        except Exception as e: gauges[name] = f"error: {e}"
+    return {
+        "pid": os.getpid(),
+        "uptime": round(time.time() - _started_at, 1),
+        "counters": counters,
+        "timings": timings,
+        "gauges": gauges
+    }
@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from config import CPU_POOL_WORKERS, CPU_TASK_TIMEOUT
+from utils import metrics
+
+# CPU 密集工作 (read_html、批次指標、長歷史圖表) 的程序池
+# - 每個 gunicorn worker 在第一次使用時各自建立 (forkserver，不從多執行緒的 worker 直接 fork)
+# - 低於門檻、未啟用 (CPU_POOL_WORKERS=0)、程序池故障或逾時 (CPU_TASK_TIMEOUT) 時直接在呼叫端計算
+# - K 線資料以 shared_frames 放進共享記憶體，子程序依 spec 取回，不必 pickle 整個 DataFrame
+# 在子程序執行的函式必須是模組層級函式 (可被 pickle)
+
+OHLCV = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def enabled():
+    return CPU_POOL_WORKERS > 0
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=ctx)
+            _pool_pid = os.getpid()
+        return _pool
+
+def _reset_pool():
+    global _pool
+    with _lock:
+        if _pool is not None: _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def submit(fn, *args, **kwargs):
+    """丟到程序池，回傳 Future (需先確認 enabled())"""
+    return _get_pool().submit(fn, *args, **kwargs)
+
+def _results(futures):
+    """
+    在 CPU_TASK_TIMEOUT 內取回所有結果 (包含排隊時間)
+    逾時或失敗時取消尚未開始的工作；已在子程序執行的無法中斷，完成後結果直接丟棄
+    """
+    deadline = time.monotonic() + CPU_TASK_TIMEOUT
+    try:
+        return [f.result(timeout=max(0, deadline - time.monotonic())) for f in futures]
+    except BaseException:
+        for f in futures: f.cancel()
+        raise
+
+def _offload(name, remote, inline):
+    """
+    remote() 在程序池執行，失敗時一律改為直接計算 (回傳與 inline() 相同)：
+    - 程序池故障 (e.g. 子程序被 OOM killer 結束)：重建程序池
+    - 逾時 (程序池忙碌或工作卡住)
+    """
+    start = time.monotonic()
+    try:
+        return remote()
+    except BrokenProcessPool as e:
+        print(f"[Debug] Process pool broken ({e}), running {name} inline.")
+        metrics.incr(f"cpu_pool.{name}.error")
+        _reset_pool()
+        return inline()
+    except FuturesTimeout:
+        print(f"[Debug] Process pool task {name} exceeded {CPU_TASK_TIMEOUT}s, running inline.")
+        metrics.incr(f"cpu_pool.{name}.timeout")
+        return inline()
+    finally:
+        metrics.observe(f"cpu_pool.{name}", time.monotonic() - start)
+
+def run(fn, *args, size=0, threshold=0, name=None, **kwargs):
+    """size 達到 threshold 且已啟用程序池時在子程序執行 fn，否則直接呼叫"""
+    name = name or fn.__name__.lstrip('_')
+    if not enabled() or size < threshold:
+        metrics.incr(f"cpu_pool.{name}.inline")
+        return fn(*args, **kwargs)
+    return _offload(name, lambda: _results([submit(fn, *args, **kwargs)])[0],
+                    lambda: fn(*args, **kwargs))
+
+def pending():
+    pool = _pool
+    if pool is None or _pool_pid != os.getpid(): return 0
+    return len(pool._pending_work_items)
+
+# --- 共享記憶體中的 K 線 ---
+
+@contextmanager
+def shared_frames(frames, columns=OHLCV):
+    """
+    將 {key: DataFrame (DatetimeIndex)} 放進同一塊共享記憶體，產生可傳給子程序的 spec
+    離開 with 區塊時釋放；缺少的欄位以 NaN 填入
+    """
+    keys = list(frames)
+    lengths = [len(frames[k]) for k in keys]
+    rows, ncol = sum(lengths), len(columns)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, rows * (ncol + 1) * 8))
+    try:
+        values = np.ndarray((rows, ncol), dtype=np.float64, buffer=shm.buf)
+        index = np.ndarray((rows,), dtype=np.int64, buffer=shm.buf, offset=rows * ncol * 8)
+        layout, start = [], 0
+        for key, length in zip(keys, lengths):
+            df = frames[key]
+            values[start:start + length] = df.reindex(columns=list(columns)).to_numpy(dtype=np.float64)
+            index[start:start + length] = df.index.asi8
+            tz = str(df.index.tz) if getattr(df.index, 'tz', None) is not None else None
+            layout.append((key, start, length, tz))
+            start += length
+        del values, index
+        yield {'name': shm.name, 'rows': rows, 'columns': tuple(columns), 'frames': layout}
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _attach(name):
+    # 子程序只讀取，不向 resource_tracker 登記 (由建立者負責 unlink)
+    try: return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: return shared_memory.SharedMemory(name=name)
+
+def load_frames(spec, keys=None):
+    """依 spec 從共享記憶體還原 DataFrame (複製一份，之後即可釋放共享記憶體)"""
+    shm = _attach(spec['name'])
+    try:
+        rows, columns = spec['rows'], list(spec['columns'])
+        values = np.ndarray((rows, len(columns)), dtype=np.float64, buffer=shm.buf)
+        index = np.ndarray((rows,), dtype=np.int64, buffer=shm.buf, offset=rows * len(columns) * 8)
+        wanted = set(keys) if keys is not None else None
+        frames = {}
+        for key, start, length, tz in spec['frames']:
+            if wanted is not None and key not in wanted: continue
+            idx = pd.to_datetime(index[start:start + length].copy(), utc=tz is not None)
+            if tz: idx = idx.tz_convert(tz)
+            frames[key] = pd.DataFrame(values[start:start + length].copy(), index=idx, columns=columns)
+        del values, index
+        return frames
+    finally:
+        shm.close()
+
+def _call_with_frame(fn, spec, *args, **kwargs):
+    df = next(iter(load_frames(spec).values()))
+    return fn(df, *args, **kwargs)
+
+def run_frame(fn, df, *args, threshold=0, name=None, columns=OHLCV, **kwargs):
+    """fn(df, *args)；列數達 threshold 且已啟用程序池時 df 經共享記憶體交給子程序計算"""
+    name = name or fn.__name__.lstrip('_')
+    if not enabled() or len(df) < threshold:
+        metrics.incr(f"cpu_pool.{name}.inline")
+        return fn(df, *args, **kwargs)
+
+    def remote():
+        with shared_frames({0: df}, columns) as spec:
+            return _results([submit(_call_with_frame, fn, spec, *args, **kwargs)])[0]
+    return _offload(name, remote, lambda: fn(df, *args, **kwargs))
+
+def map_frames(fn, frames, inline, name=None, threshold=0, columns=OHLCV):
+    """
+    對 {key: DataFrame} 批次計算，fn(spec, keys) 在子程序內以 load_frames 取回資料並回傳 {key: 結果}
+    總列數低於 threshold 或未啟用時改呼叫 inline(frames)，結果格式相同
+    資料只寫入共享記憶體一次，依程序數切成數批平行計算
+    """
+    name = name or fn.__name__.lstrip('_')
+    rows = sum(len(df) for df in frames.values())
+    if not enabled() or rows < threshold or not frames:
+        metrics.incr(f"cpu_pool.{name}.inline")
+        return inline(frames)
+
+    def remote():
+        keys = list(frames)
+        chunks = [keys[i::CPU_POOL_WORKERS] for i in range(CPU_POOL_WORKERS) if keys[i::CPU_POOL_WORKERS]]
+        with shared_frames(frames, columns) as spec:
+            results = {}
+            for chunk_results in _results([submit(fn, spec, chunk) for chunk in chunks]): results.update(chunk_results)
+            return results
+    return _offload(name, remote, lambda: inline(frames))
+
+metrics.register_gauge("cpu_pool.pending", pending)
@@ -0,0 +1,213 @@
+import os
+import sys
+import hmac
+import time
+import random
+import cProfile
+import threading
+import itertools
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from config import (
+    PROFILE_MODE, PROFILE_RATE, PROFILE_DIR, PROFILE_INTERVAL, PROFILE_TOKEN,
+    PROFILE_MIN_SECONDS, PROFILE_MAX_FILES
+)
+from utils import metrics
+
+# 事件層級的效能剖析 (預設關閉)
+# - sample  : 背景執行緒每 PROFILE_INTERVAL 秒取樣一次堆疊，輸出 collapsed stack (可直接給 flamegraph.pl / speedscope)
+# - cprofile: cProfile 完整記錄，輸出 .pstats (python -m pstats)
+# 觸發方式：PROFILE_MODE + PROFILE_RATE (依比例抽樣)，或帶管理者標頭的 webhook 請求 (X-Profile / X-Profile-Token)
+# 取樣只記錄替這個事件工作的執行緒：fanout / 指令 / async-blocking 執行緒池以 wrap() 帶入目前的 session
+# ASYNC_MODE 的指令交給事件迴圈後，以 detach() / attach() 把 session 帶進該 task，剖析持續到 task 結束
+# (取樣包含事件迴圈執行緒，同時間其他聊天室的 coroutine 也會被取樣到)
+# 檔名帶有 classify_command 的指令類型，e.g. 20250101-093000_tw_quote_1234_1.collapsed
+# 注意：Python 3.12+ 的 cProfile 同時記錄所有執行緒且一次只能有一個，忙碌時該事件改用取樣
+
+MODES = ('sample', 'cprofile')
+LEGACY_CPROFILE = sys.version_info < (3, 12)
+
+_current = ContextVar('profile_session', default=None)
+_cprofile_lock = threading.Lock()
+_seq = itertools.count(1)
+_NULL = nullcontext()
+
+
+class _Session:
+    def __init__(self, command, mode):
+        self.command = command
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.threads = Counter()    # thread ident -> 進行中的工作數
+        self.stacks = Counter()
+        self.samples = 0
+        self.pending = 1            # 事件本身 + detach() 交出去尚未結束的工作
+        self.finish = None
+
+    def hold(self):
+        with self.lock: self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done: self.finish()
+
+    def enter_thread(self):
+        with self.lock: self.threads[threading.get_ident()] += 1
+
+    def exit_thread(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] -= 1
+            if self.threads[ident] <= 0: del self.threads[ident]
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self.lock: idents = list(self.threads)
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is None: continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+
+def wrap(fn):
+    """
+    丟到其他執行緒的工作帶入目前的 session (未剖析時原樣回傳，幾乎沒有額外成本)
+    fanout / latency_budget / async_http 在 submit 前呼叫
+    """
+    session = _current.get()
+    if session is None: return fn
+
+    def run(*args, **kwargs):
+        token = _current.set(session)
+        session.enter_thread()
+        try: return fn(*args, **kwargs)
+        finally:
+            session.exit_thread()
+            _current.reset(token)
+    return run
+
+def detach():
+    """
+    事件的工作交給事件迴圈非同步完成前呼叫 (ASYNC_MODE)，回傳給 attach() 使用的 session
+    剖析會持續到對應的 attach() 結束；未剖析時回傳 None
+    """
+    session = _current.get()
+    if session is not None: session.hold()
+    return session
+
+@contextmanager
+def attach(session):
+    """在事件迴圈的 task 中帶入 detach() 取得的 session (記錄迴圈執行緒)，結束時釋放"""
+    if session is None:
+        yield
+        return
+    token = _current.set(session)
+    session.enter_thread()
+    try:
+        yield
+    finally:
+        session.exit_thread()
+        _current.reset(token)
+        session.release()
+
+def requested_mode(headers):
+    """管理者標頭 (X-Profile: sample|cprofile 與正確的 X-Profile-Token) 要求的剖析方式"""
+    if not PROFILE_TOKEN: return None
+    mode = headers.get('X-Profile')
+    if mode not in MODES: return None
+    if not hmac.compare_digest(headers.get('X-Profile-Token', ''), PROFILE_TOKEN): return None
+    metrics.incr("profile.requested")
+    return mode
+
+def profile_event(text, mode=None):
+    """
+    包住單一事件的處理，text 為訊息內容 (用來分類指令)
+    mode 為管理者標頭要求的方式；未指定時依 PROFILE_MODE / PROFILE_RATE 抽樣
+    """
+    if mode is None:
+        if PROFILE_MODE not in MODES or random.random() >= PROFILE_RATE: return _NULL
+        mode = PROFILE_MODE
+    from utils.common import classify_command
+    return _profiled(classify_command(text), mode)
+
+@contextmanager
+def _profiled(command, mode):
+    if mode == 'cprofile' and not _cprofile_lock.acquire(blocking=False):
+        metrics.incr("profile.cprofile_busy")
+        mode = 'sample'
+    session = _Session(command, mode)
+    token = _current.set(session)
+    session.enter_thread()
+    start = time.monotonic()
+    stop = threading.Event()
+    profiler = sampler = None
+
+    def finish():
+        # 事件與 detach() 交出的工作都結束後才停止 (可能在事件迴圈執行緒上)
+        elapsed = time.monotonic() - start
+        if profiler and LEGACY_CPROFILE: _cprofile_lock.release()
+        elif profiler:
+            profiler.disable()
+            _cprofile_lock.release()
+        if sampler:
+            stop.set()
+            if sampler is not threading.current_thread(): sampler.join()
+        metrics.observe(f"profile.{mode}", elapsed)
+        if elapsed >= PROFILE_MIN_SECONDS: _write(session, profiler, elapsed)
+
+    session.finish = finish
+    try:
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = threading.Thread(target=_sample_loop, args=(session, stop), name='profile-sampler', daemon=True)
+            sampler.start()
+        yield session
+    finally:
+        # 3.12 以前的 cProfile 只記錄 enable 的執行緒，也只能在同一個執行緒 disable
+        if profiler and LEGACY_CPROFILE: profiler.disable()
+        session.exit_thread()
+        _current.reset(token)
+        session.release()
+
+def _sample_loop(session, stop):
+    while not stop.wait(PROFILE_INTERVAL):
+        session.sample()
+
+def _write(session, profiler, elapsed):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}_{session.command}_{os.getpid()}_{next(_seq)}"
+        if profiler:
+            path = os.path.join(PROFILE_DIR, name + '.pstats')
+            profiler.dump_stats(path)
+        else:
+            path = os.path.join(PROFILE_DIR, name + '.collapsed')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in session.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        metrics.incr(f"profile.{session.mode}.written")
+        print(f"[Debug] Profile written: {path} ({elapsed:.2f}s, {session.samples} samples)")
+        _prune()
+    except Exception as e:
+        print(f"[Debug] Error writing profile: {e}")
+
+def _prune():
+    """只保留最新的 PROFILE_MAX_FILES 個檔案"""
+    files = sorted(
+        (os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR) if f.endswith(('.pstats', '.collapsed'))),
+        key=os.path.getmtime
+    )
+    for path in files[:max(0, len(files) - PROFILE_MAX_FILES)]:
+        try: os.remove(path)
+        except OSError: pass
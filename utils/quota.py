@@ -0,0 +1,144 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from config import CACHE_DIR, QUOTA_LIMITS
+from utils import metrics
+
+# 昂貴指令的配額 (token bucket)：每位使用者 / 每個聊天室 / 全域，依指令類別分開計算
+# 存在 CACHE_DIR/quota.db (SQLite WAL)，多個 worker 共用同一組額度
+# 超過額度時由呼叫端改回覆快取結果，或提示幾秒後再試
+
+DB_PATH = os.path.join(CACHE_DIR, 'quota.db')
+PRUNE_EVERY = 500
+SCOPES = ('user', 'chat', 'global')
+
+# classify_command 的結果 -> 指令類別
+COMMAND_CLASSES = {
+    'ai_analysis': 'ai',
+    'stock_chart': 'chart', 'forex_chart': 'chart',
+    'tw_quote': 'quote', 'us_quote': 'quote', 'multi_quote': 'quote',
+    'forex': 'quote', 'forex_list': 'quote',
+    # /api/v1 公開模式 (見 api.py)，與 LINE 指令分開計算
+    'api_quote': 'api', 'api_forex': 'api', 'api_indicators': 'api', 'api_chart': 'api_chart'
+}
+
+_local = threading.local()
+_op_count = 0
+
+
+def _conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)')
+        _local.conn = conn
+    return conn
+
+def _bucket_keys(cls, user_id, chat_id):
+    """(scope, key, capacity, period)；1 對 1 聊天的 chat 與 user 相同，只算一次"""
+    keys = []
+    for scope in SCOPES:
+        limit = QUOTA_LIMITS.get(cls, {}).get(scope)
+        if not limit: continue
+        if scope == 'user':
+            if not user_id: continue
+            key = f"{cls}:user:{user_id}"
+        elif scope == 'chat':
+            if not chat_id or chat_id == user_id: continue
+            key = f"{cls}:chat:{chat_id}"
+        else:
+            key = f"{cls}:global"
+        keys.append((scope, key) + limit)
+    return keys
+
+def _level(row, capacity, period, now):
+    """依經過時間補充後的剩餘 token"""
+    if row is None: return float(capacity)
+    tokens, updated_at = row
+    return min(capacity, tokens + (now - updated_at) * capacity / period)
+
+def consume(command, user_id=None, chat_id=None, cost=1):
+    """
+    扣除 command 所屬類別的額度，三個 bucket 都足夠才會扣
+    回傳 (是否允許, 需等待秒數)
+    """
+    global _op_count
+    cls = COMMAND_CLASSES.get(command)
+    if not cls: return True, 0
+    keys = _bucket_keys(cls, user_id, chat_id)
+    if not keys: return True, 0
+
+    now = time.time()
+    try:
+        conn = _conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for scope, key, capacity, period in keys:
+                row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+                levels.append(_level(row, capacity, period, now))
+
+            short = [
+                (scope, (min(cost, capacity) - level) * period / capacity)
+                for (scope, key, capacity, period), level in zip(keys, levels) if level < min(cost, capacity)
+            ]
+            if short:
+                conn.execute('ROLLBACK')
+                scope, retry_after = max(short, key=lambda x: x[1])
+                metrics.incr(f"quota.{cls}.limited.{scope}")
+                return False, retry_after
+
+            for (scope, key, capacity, period), level in zip(keys, levels):
+                conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, level - cost, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        # 配額檢查失敗時不擋使用者
+        print(f"[Debug] Quota check error: {e}")
+        return True, 0
+
+    metrics.incr(f"quota.{cls}.allowed")
+    _op_count += 1
+    if _op_count % PRUNE_EVERY == 0: _prune(now)
+    return True, 0
+
+def _prune(now):
+    """刪除已經補滿一段時間的 bucket (與不存在時相同)"""
+    longest = max((limit[1] for limits in QUOTA_LIMITS.values() for limit in limits.values()), default=0)
+    try: _conn().execute('DELETE FROM buckets WHERE updated_at < ?', (now - longest,))
+    except Exception as e: print(f"[Debug] Quota prune error: {e}")
+
+def _redact(identity):
+    """/metrics 不需驗證，使用者 / 聊天室 ID 只列出雜湊 (可用同樣方式算出已知 ID 的雜湊比對)"""
+    return hashlib.sha256(identity.encode()).hexdigest()[:12]
+
+def quota_report(top_n=5):
+    """各類別的設定、全域剩餘額度與用量最多的使用者 / 聊天室 (ID 為雜湊)，供 /metrics 使用"""
+    now = time.time()
+    report = {}
+    try: rows = _conn().execute('SELECT key, tokens, updated_at FROM buckets').fetchall()
+    except Exception as e: return {"error": str(e)}
+
+    for cls, limits in QUOTA_LIMITS.items():
+        r = report[cls] = {
+            "limits": {scope: f"{capacity:g}/{period:g}s" for scope, (capacity, period) in limits.items()},
+            "allowed": metrics.get_counter(f"quota.{cls}.allowed"),
+            "limited": {scope: metrics.get_counter(f"quota.{cls}.limited.{scope}") for scope in limits},
+            "served_cached": metrics.get_counter(f"quota.{cls}.served_cached")
+        }
+        for scope, (capacity, period) in limits.items():
+            levels = [
+                (_redact(key.split(':', 2)[-1]), round(_level((tokens, updated_at), capacity, period, now), 2))
+                for key, tokens, updated_at in rows if key.startswith(f"{cls}:{scope}")
+            ]
+            if scope == 'global':
+                r["global_remaining"] = levels[0][1] if levels else capacity
+            else:
+                r[f"top_{scope}s"] = sorted(levels, key=lambda x: x[1])[:top_n]
+    return report
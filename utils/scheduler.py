@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from config import CACHE_DIR
+from utils.market_calendar import TW_TZ, now_taipei, is_schedule_day
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機開發：不做跨 process 鎖定
+    fcntl = None
+
+# 行程內排程器 (台北時間，依台股 / 美股行事曆決定當天是否執行)
+# 多個 gunicorn worker 以 CACHE_DIR/scheduler.lock 選出一個執行排程，
+# 該 worker 結束後其他 worker 會在一分鐘內接手
+# 每個工作可指定 prepare (提前 lead 秒執行，e.g. 先產生報告) 與 run (準時執行，e.g. 推送)
+# run 時 prepare 若仍在進行，會先等它完成 (不重複產生)
+
+LOCK_PATH = os.path.join(CACHE_DIR, 'scheduler.lock')
+LEADER_RETRY = 60
+# 啟動時若剛好錯過排程時間 (e.g. 部署中)，在此秒數內仍會補執行
+MISFIRE_GRACE = 300
+
+_jobs = []
+_lock_file = None
+_started = False
+
+
+def parse_schedule(spec):
+    """
+    "vix@18:00/us,forex:KRW@09:00/tw" -> [("vix", time(18, 0), "us"), ...]
+    行事曆省略時為 daily
+    """
+    jobs = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item or '@' not in item: continue
+        name, when = item.split('@', 1)
+        when, _, calendar = when.partition('/')
+        try:
+            at = datetime.strptime(when.strip(), '%H:%M').time()
+        except ValueError:
+            print(f"[Debug] Invalid schedule time: {item}")
+            continue
+        jobs.append((name.strip(), at, calendar.strip() or 'daily'))
+    return jobs
+
+def next_fire_time(at, calendar, now=None):
+    """下一次 (>= now - MISFIRE_GRACE) 符合行事曆的執行時間"""
+    now = now or now_taipei()
+    d = (now - timedelta(seconds=MISFIRE_GRACE)).date()
+    for _ in range(30):
+        fire = TW_TZ.localize(datetime.combine(d, at))
+        if fire >= now - timedelta(seconds=MISFIRE_GRACE) and is_schedule_day(calendar, fire):
+            return fire
+        d += timedelta(days=1)
+    return None
+
+def add_job(name, at, calendar, run, prepare=None, lead=0):
+    _jobs.append({
+        "name": name, "at": at, "calendar": calendar,
+        "run": run, "prepare": prepare, "lead": lead,
+        "next": None, "prepared_for": None, "preparing": None, "last_run": None, "last_error": None
+    })
+
+def _is_leader():
+    global _lock_file
+    if _lock_file is not None: return True
+    if fcntl is None:
+        _lock_file = True
+        return True
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    f = open(LOCK_PATH, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    _lock_file = f
+    print(f"[Scheduler] Worker {os.getpid()} is running the schedule.")
+    return True
+
+def _run_step(job, step):
+    preparing = job["preparing"]
+    if step == "run" and preparing and preparing.is_alive():
+        print(f"[Scheduler] {job['name']} waiting for prepare to finish.")
+        preparing.join(MISFIRE_GRACE)
+    try:
+        job[step]()
+        if step == "run": job["last_error"] = None
+    except Exception as e:
+        job["last_error"] = f"{step}: {e}"
+        print(f"[Debug] Scheduled job {job['name']} {step} failed: {e}")
+
+def _tick(now):
+    """執行到期的 prepare / run，回傳距離下一個事件的秒數"""
+    wait = LEADER_RETRY
+    for job in _jobs:
+        if job["next"] is None:
+            job["next"] = next_fire_time(job["at"], job["calendar"], now)
+            if job["next"] is None: continue
+        fire = job["next"]
+
+        if job["prepare"] and job["prepared_for"] != fire:
+            prepare_at = fire - timedelta(seconds=job["lead"])
+            if now >= prepare_at:
+                job["prepared_for"] = fire
+                job["preparing"] = threading.Thread(target=_run_step, args=(job, "prepare"), name=f"prepare-{job['name']}", daemon=True)
+                job["preparing"].start()
+            else:
+                wait = min(wait, (prepare_at - now).total_seconds())
+
+        if now >= fire:
+            job["last_run"] = now.isoformat()
+            job["next"] = next_fire_time(job["at"], job["calendar"], fire + timedelta(seconds=MISFIRE_GRACE + 1))
+            threading.Thread(target=_run_step, args=(job, "run"), name=f"job-{job['name']}", daemon=True).start()
+        else:
+            wait = min(wait, (fire - now).total_seconds())
+    return max(1, wait)
+
+def _loop():
+    while True:
+        if not _is_leader():
+            time.sleep(LEADER_RETRY)
+            continue
+        time.sleep(_tick(now_taipei()))
+
+def start_scheduler():
+    global _started
+    if _started or not _jobs: return
+    _started = True
+    threading.Thread(target=_loop, name='scheduler', daemon=True).start()
+
+def get_schedule():
+    """排程狀態，供 /metrics 使用"""
+    return [{
+        "name": job["name"],
+        "at": job["at"].strftime('%H:%M'),
+        "calendar": job["calendar"],
+        "next": job["next"].isoformat() if job["next"] else None,
+        "last_run": job["last_run"],
+        "last_error": job["last_error"]
+    } for job in _jobs]